@@ -0,0 +1,173 @@
+from django.conf import settings
+
+from alignment.models import AlignmentConsensus
+from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS
+
+from collections import OrderedDict
+from io import BytesIO
+import json
+import logging
+import pickle
+import threading
+import time
+import numpy as np
+
+
+# stored consensus data starts with the magic bytes and a format version, older rows are pickled Alignment objects
+MAGIC = b'GPCRDB-CONSENSUS'
+FORMAT_VERSION = 1
+
+# number of decoded consensus objects kept per process, and seconds before they are read again
+CACHE_SIZE = getattr(settings, 'CONSENSUS_CACHE_SIZE', 64)
+CACHE_TIMEOUT = 60*60
+
+AA_LIST = list(AMINO_ACIDS.keys())
+
+# feature membership of each amino acid (features x amino acids)
+FEATURE_MEMBERS = np.array([[aa in members for aa in AA_LIST] for members in AMINO_ACID_GROUPS.values()],
+    dtype=np.int64)
+
+logger = logging.getLogger('protwis')
+
+
+class ConsensusData:
+    """Consensus sequences and residue statistics of a family alignment
+
+    Only the amino acid counts per position are stored, the dictionaries read by the views (consensus, aa_count) are
+    built from them on first access."""
+    def __init__(self, segments, positions, aa_counts, num_proteins):
+        """
+        @param segments: segment slugs
+        @param positions: (segment index, generic number) of each position, in consensus order
+        @param aa_counts: array (amino acids in AMINO_ACIDS order x positions) of residue counts
+        @param num_proteins: number of aligned proteins
+        """
+        self.segments = segments
+        self.positions = positions
+        self.aa_counts = aa_counts
+        self.num_proteins = num_proteins
+        self._consensus = None
+        self._forced_consensus = None
+        self._aa_count = None
+
+    @classmethod
+    def from_alignment(cls, a):
+        """Consensus data of an alignment with calculated statistics"""
+        segments = list(a.consensus.keys())
+        positions = []
+        for i, segment in enumerate(segments):
+            for gn in a.consensus[segment]:
+                positions.append((i, gn))
+        aa_counts = np.zeros((len(AA_LIST), len(positions)), dtype=np.int32)
+        for col, (i, gn) in enumerate(positions):
+            counts = a.aa_count[segments[i]][gn]
+            aa_counts[:, col] = [counts.get(aa, 0) for aa in AA_LIST]
+        return cls(segments, positions, aa_counts, len(a.proteins))
+
+    def encode(self):
+        """Binary representation stored in AlignmentConsensus.alignment"""
+        header = json.dumps({
+            'segments': self.segments,
+            'positions': self.positions,
+            'num_proteins': self.num_proteins,
+            'amino_acids': AA_LIST,
+        })
+        stream = BytesIO()
+        np.savez_compressed(stream, header=np.frombuffer(header.encode('utf-8'), dtype=np.uint8),
+            aa_counts=self.aa_counts)
+        return MAGIC + bytes([FORMAT_VERSION]) + stream.getvalue()
+
+    @classmethod
+    def decode(cls, data):
+        """Consensus data from its binary representation, or from a pickled Alignment stored by earlier builds"""
+        data = bytes(data)
+        if not data.startswith(MAGIC):
+            return cls.from_alignment(pickle.loads(data))
+        version = data[len(MAGIC)]
+        if version != FORMAT_VERSION:
+            raise ValueError('Unsupported consensus format version {}'.format(version))
+
+        arrays = np.load(BytesIO(data[len(MAGIC) + 1:]), allow_pickle=False)
+        header = json.loads(arrays['header'].tobytes().decode('utf-8'))
+        aa_counts = arrays['aa_counts']
+        if header['amino_acids'] != AA_LIST:
+            # the amino acid order has changed since the data was stored
+            order = [header['amino_acids'].index(aa) if aa in header['amino_acids'] else -1 for aa in AA_LIST]
+            aa_counts = np.where(np.array(order)[:, None] >= 0, aa_counts[order], 0)
+        return cls(header['segments'], [tuple(p) for p in header['positions']], aa_counts, header['num_proteins'])
+
+    def _summarize(self):
+        """Consensus and forced consensus, as in Alignment.summarize_statistics"""
+        self._consensus = OrderedDict([(s, OrderedDict()) for s in self.segments])
+        self._forced_consensus = OrderedDict([(s, OrderedDict()) for s in self.segments])
+        max_counts = self.aa_counts.max(axis=0).tolist()
+        most_frequent = self.aa_counts.argmax(axis=0).tolist()
+        num_most_frequent = (self.aa_counts == self.aa_counts.max(axis=0)).sum(axis=0).tolist()
+        for col, (i, gn) in enumerate(self.positions):
+            segment = self.segments[i]
+            frequency = round(max_counts[col]/self.num_proteins*100)
+            conservation = str(frequency)
+            cons_interval = '0' if len(conservation) == 1 else conservation[:-1]
+            aa = AA_LIST[most_frequent[col]]
+            self._forced_consensus[segment][gn] = aa
+            self._consensus[segment][gn] = [aa if num_most_frequent[col] == 1 else '+', cons_interval, frequency]
+
+    @property
+    def consensus(self):
+        """segment -> generic number -> [amino acid or + for ties, conservation interval, conservation %]"""
+        if self._consensus is None:
+            self._summarize()
+        return self._consensus
+
+    @property
+    def forced_consensus(self):
+        """segment -> generic number -> most frequent amino acid (first one in ties)"""
+        if self._forced_consensus is None:
+            self._summarize()
+        return self._forced_consensus
+
+    @property
+    def aa_count(self):
+        """segment -> generic number -> amino acid -> count"""
+        if self._aa_count is None:
+            self._aa_count = OrderedDict([(s, OrderedDict()) for s in self.segments])
+            for col, counts in enumerate(self.aa_counts.T.tolist()):
+                i, gn = self.positions[col]
+                self._aa_count[self.segments[i]][gn] = OrderedDict(zip(AA_LIST, counts))
+        return self._aa_count
+
+    def feature_counts(self):
+        """Array (features in AMINO_ACID_GROUPS order x positions) of residue counts with each feature"""
+        return FEATURE_MEMBERS.dot(self.aa_counts)
+
+
+class ConsensusCache:
+    """Decoded consensus data of families, least recently used entries are dropped first"""
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, slug):
+        """Consensus data of a family slug, None if no consensus is stored"""
+        with cls._lock:
+            if slug in cls._cache:
+                loaded, consensus = cls._cache[slug]
+                if time.time() - loaded < CACHE_TIMEOUT:
+                    cls._cache.move_to_end(slug)
+                    return consensus
+
+        try:
+            consensus = ConsensusData.decode(AlignmentConsensus.objects.values_list('alignment', flat=True).get(
+                slug=slug))
+        except AlignmentConsensus.DoesNotExist:
+            return None
+        except Exception as msg:
+            logger.error('Failed decoding consensus {}: {}'.format(slug, msg))
+            return None
+
+        with cls._lock:
+            cls._cache[slug] = (time.time(), consensus)
+            cls._cache.move_to_end(slug)
+            while len(cls._cache) > CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return consensus
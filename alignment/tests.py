@@ -1,3 +1,61 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from alignment import consensus
+from alignment.consensus import AA_LIST, ConsensusData
+
+from collections import OrderedDict
+from unittest import mock
+import pickle
+import types
+import numpy as np
+
+
+def aa_counts(*columns):
+    """Count array (amino acids x positions) from dicts of amino acid counts"""
+    return np.array([[column.get(aa, 0) for column in columns] for aa in AA_LIST], dtype=np.int32)
+
+
+class ConsensusDataTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.data = ConsensusData(['TM1', 'TM2'], [(0, '1x50'), (0, '1x51'), (1, '2x50')],
+            aa_counts({'N': 4}, {'A': 3, '-': 1}, {'L': 2, 'I': 2}), 4)
+
+    def test_round_trip(self):
+        data = ConsensusData.decode(self.data.encode())
+        self.assertEqual(data.segments, ['TM1', 'TM2'])
+        self.assertEqual(data.positions, [(0, '1x50'), (0, '1x51'), (1, '2x50')])
+        self.assertEqual(data.num_proteins, 4)
+        self.assertTrue(np.array_equal(data.aa_counts, self.data.aa_counts))
+
+    def test_consensus(self):
+        # ties are shown as +, the forced consensus takes the first amino acid
+        self.assertEqual(self.data.consensus, OrderedDict([
+            ('TM1', OrderedDict([('1x50', ['N', '10', 100]), ('1x51', ['A', '7', 75])])),
+            ('TM2', OrderedDict([('2x50', ['+', '5', 50])])),
+        ]))
+        self.assertEqual(self.data.forced_consensus['TM2']['2x50'], AA_LIST[min(AA_LIST.index('L'),
+            AA_LIST.index('I'))])
+        self.assertEqual(self.data.aa_count['TM1']['1x51']['A'], 3)
+        self.assertEqual(list(self.data.aa_count['TM1']['1x51']), AA_LIST)
+
+    def test_legacy_pickle(self):
+        # rows of earlier builds are pickled alignments
+        alignment = types.SimpleNamespace(proteins=[1, 2, 3, 4], consensus=self.data.consensus,
+            aa_count=self.data.aa_count)
+        data = ConsensusData.decode(pickle.dumps(alignment))
+        self.assertEqual(data.consensus, self.data.consensus)
+        self.assertEqual(data.num_proteins, 4)
+
+    def test_amino_acid_order(self):
+        # data stored with another amino acid order is reordered when read
+        stored = ConsensusData(self.data.segments, self.data.positions, self.data.aa_counts[::-1], 4)
+        with mock.patch.object(consensus, 'AA_LIST', AA_LIST[::-1]):
+            encoded = stored.encode()
+        self.assertTrue(np.array_equal(ConsensusData.decode(encoded).aa_counts, self.data.aa_counts))
+
+    def test_unsupported_version(self):
+        encoded = bytearray(self.data.encode())
+        encoded[len(consensus.MAGIC)] = consensus.FORMAT_VERSION + 1
+        with self.assertRaises(ValueError):
+            ConsensusData.decode(encoded)
@@ -244,6 +244,7 @@ def render_alignment(request):
 
     # create an alignment object
     a = Alignment()
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
@@ -287,6 +288,7 @@ def render_alignment(request):
 def render_family_alignment(request, slug):
     # create an alignment object
     a = Alignment()
+    a.use_matrix_engine = True
 
     # fetch proteins and segments
     proteins = Protein.objects.filter(family__slug__startswith=slug, sequence_type__slug='wt')
@@ -167,7 +167,7 @@ class testTemplate(TemplateView):
                 
                 print(pdb_code)
     
-                structure = load_pdb_var(pdb_code,reference.pdb_data.pdb)
+                structure = reference.get_pdb_structure(pdb_code)
                 pchain = structure[0][preferred_chain]
                 state_id = reference.protein_conformation.state.id
                 
@@ -1,3 +1,41 @@
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from api import views
+from api.views import StructureList
+
+from unittest import mock
+
+
+class StructureListTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(views, 'cache', LocMemCache('api-tests', {})),
+            mock.patch.object(views.ReleaseNotes, 'objects'),
+            mock.patch.object(views.Structure, 'objects'),
+            mock.patch.object(StructureList, 'serialize_structures',
+                return_value=[{'pdb_code': '2RH1'}, {'pdb_code': '3SN6'}]),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        views.ReleaseNotes.objects.aggregate.return_value = {'date__max': '2020-01-01'}
+        views.Structure.objects.aggregate.return_value = {'pk__count': 2, 'pk__max': 2}
+        self.request = mock.Mock()
+        self.request.accepted_renderer.format = 'api'
+
+    def test_cached_list(self):
+        self.assertEqual(len(StructureList().get(self.request).data), 2)
+        StructureList().get(self.request)
+        self.assertEqual(StructureList.serialize_structures.call_count, 1)
+
+    def test_structures_built_again(self):
+        # structures built again within the same release are not served from the cache
+        StructureList().get(self.request)
+        views.Structure.objects.aggregate.return_value = {'pk__count': 2, 'pk__max': 4}
+        StructureList().get(self.request)
+        self.assertEqual(StructureList.serialize_structures.call_count, 2)
+        views.Structure.objects.aggregate.return_value = {'pk__count': 3, 'pk__max': 4}
+        StructureList().get(self.request)
+        self.assertEqual(StructureList.serialize_structures.call_count, 3)
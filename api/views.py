@@ -4,10 +4,14 @@ from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, FileUploadParser
 from rest_framework.renderers import JSONRenderer
 from django.template.loader import render_to_string
-from django.db.models import Q
+from django.db.models import Count, Max, Q
 from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
 
-from interaction.models import ResidueFragmentInteraction
+from common.models import ReleaseNotes
+from interaction.models import ResidueFragmentInteraction, StructureLigandInteraction
 from mutation.models import MutationRaw
 from protein.models import Protein, ProteinConformation, ProteinFamily, Species, ProteinSegment
 from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme, ResidueGenericNumberEquivalent
@@ -24,6 +28,7 @@ from drugs.models import Drugs
 
 import json, os
 from io import StringIO
+from string import Template
 from Bio.PDB import PDBIO
 from collections import OrderedDict
 
@@ -209,72 +214,104 @@ class StructureList(views.APIView):
     \n/structure/
     """
 
+    @staticmethod
+    def data_version():
+        """The data release and the number and latest id of the structures, which change when structures are
+        built again without a new release"""
+        structures = Structure.objects.aggregate(Count('pk'), Max('pk'))
+        return '{}_{}_{}'.format(ReleaseNotes.objects.aggregate(Max('date'))['date__max'], structures['pk__count'],
+            structures['pk__max'])
+
     def get(self, request, pdb_code=None, entry_name=None, representative=None):
-        if pdb_code:
-            structures = Structure.objects.filter(pdb_code__index=pdb_code)
-        elif entry_name and representative:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name,
-                representative=True)
-        elif entry_name:
-            structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name)
-        elif representative:
-            structures = Structure.objects.filter(representative=True)
-        else:
-            structures = Structure.objects.all()
-
-        structures = structures.exclude(refined=True).prefetch_related('protein_conformation__protein__parent__species', 'pdb_code',
-            'protein_conformation__protein__parent__family', 'protein_conformation__protein__parent__species',
-            'publication__web_link', 'structureligandinteraction_set__ligand__properities', 'structure_type',
-            'structureligandinteraction_set__ligand__properities__ligand_type',
-            'structureligandinteraction_set__ligand_role')
-
-        # structures = self.get_structures(pdb_code, entry_name, representative)
-
-        # convert objects to a list of dictionaries
-        # normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)
+        cache_key = 'api_structure_list_{}_{}_{}_{}'.format(self.data_version(), pdb_code, entry_name, representative)
+        s = cache.get(cache_key)
+        if s is None:
+            if pdb_code:
+                structures = Structure.objects.filter(pdb_code__index=pdb_code)
+            elif entry_name and representative:
+                structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name,
+                    representative=True)
+            elif entry_name:
+                structures = Structure.objects.filter(protein_conformation__protein__parent__entry_name=entry_name)
+            elif representative:
+                structures = Structure.objects.filter(representative=True)
+            else:
+                structures = Structure.objects.all()
+
+            s = self.serialize_structures(structures.exclude(refined=True))
+            cache.set(cache_key, s, 60*60*24*7)
+
+        # if a structure is selected, return a single dict rather then a list of dicts
+        if len(s) == 1:
+            return Response(s[0])
+
+        # stream lists of structures, unless they are shown in the browsable API
+        if request.accepted_renderer.format == 'api':
+            return Response(s)
+        return StreamingHttpResponse(self.stream_json_list(s), content_type='application/json')
+
+    def serialize_structures(self, structures):
+        """Convert structures to a list of dictionaries with two queries (structures and annotated ligands)
+
+        normal serializers can not be used because of abstraction of tables (e.g. protein_conformation)"""
+        rows = structures.order_by('pk').values_list('pk', 'pdb_code__index',
+            'protein_conformation__protein__parent__entry_name', 'protein_conformation__protein__parent__family__slug',
+            'protein_conformation__protein__parent__species__latin_name', 'preferred_chain', 'resolution',
+            'publication_date', 'structure_type__name', 'state__name', 'distance', 'publication__web_link__index',
+            'publication__web_link__web_resource__url')
+
+        # ligands of all structures
+        ligands = {}
+        interactions = StructureLigandInteraction.objects.filter(structure__in=structures, annotated=True).order_by(
+            'pk').values_list('structure_id', 'ligand__name', 'ligand__properities__ligand_type__name',
+            'ligand_role__name')
+        for structure_id, name, ligand_type, role in interactions:
+            ligand = {}
+            if name:
+                ligand['name'] = name
+            if ligand_type:
+                ligand['type'] = ligand_type
+            if role:
+                ligand['function'] = role
+            if ligand:
+                ligands.setdefault(structure_id, []).append(ligand)
+
         s = []
-        for structure in structures:
+        for r in rows:
             # essential fields
             structure_data = {
-                'pdb_code': structure.pdb_code.index,
-                'protein': structure.protein_conformation.protein.parent.entry_name,
-                'family': structure.protein_conformation.protein.parent.family.slug,
-                'species': structure.protein_conformation.protein.parent.species.latin_name,
-                'preferred_chain': structure.preferred_chain,
-                'resolution': structure.resolution,
-                'publication_date': structure.publication_date,
-                'type': structure.structure_type.name,
-                'state': structure.state.name,
-                'distance': structure.distance,
+                'pdb_code': r[1],
+                'protein': r[2],
+                'family': r[3],
+                'species': r[4],
+                'preferred_chain': r[5],
+                'resolution': r[6],
+                'publication_date': r[7],
+                'type': r[8],
+                'state': r[9],
+                'distance': r[10],
             }
 
             # publication
-            if structure.publication:
-                structure_data['publication'] = structure.publication.web_link.__str__()
+            if r[11] is not None:
+                structure_data['publication'] = Template(r[12]).substitute(index=r[11])
             else:
                 structure_data['publication'] = None
 
             # ligand
-            ligands = []
-            for interaction in structure.structureligandinteraction_set.filter(annotated=True):
-                ligand = {}
-                if interaction.ligand.name:
-                    ligand['name'] = interaction.ligand.name
-                if interaction.ligand.properities.ligand_type and interaction.ligand.properities.ligand_type.name:
-                    ligand['type'] = interaction.ligand.properities.ligand_type.name
-                if interaction.ligand_role and interaction.ligand_role.name:
-                    ligand['function'] = interaction.ligand_role.name
-                if ligand:
-                    ligands.append(ligand)
-            structure_data['ligands'] = ligands
+            structure_data['ligands'] = ligands.get(r[0], [])
 
             s.append(structure_data)
+        return s
 
-        # if a structure is selected, return a single dict rather then a list of dicts
-        if len(s) == 1:
-            s = s[0]
-
-        return Response(s)
+    def stream_json_list(self, items):
+        """Encode a list as JSON one item at a time, in the same format as the JSON renderer"""
+        yield '['
+        for i, item in enumerate(items):
+            if i:
+                yield ','
+            yield json.dumps(item, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+        yield ']'
 
     def get_structures(self, pdb_code=None, representative=None):
         return Structure.objects.all()
@@ -355,6 +392,7 @@ class FamilyAlignment(views.APIView):
             # create an alignment object
             a = Alignment()
             a.show_padding = False
+            a.use_matrix_engine = True
 
             # load data from selection into the alignment
             a.load_proteins(ps)
@@ -474,6 +512,7 @@ class ProteinSimilaritySearchAlignment(views.APIView):
             # create an alignment object
             a = Alignment()
             a.show_padding = False
+            a.use_matrix_engine = True
 
             # load data from API into the alignment
             a.load_reference_protein(reference[0])
@@ -554,6 +593,7 @@ class ProteinAlignment(views.APIView):
             # create an alignment object
             a = Alignment()
             a.show_padding = False
+            a.use_matrix_engine = True
 
             # load data from selection into the alignment
             a.load_proteins(ps)
@@ -655,6 +695,7 @@ class StructureTemplate(views.APIView):
             # create an alignment object
             a = Alignment()
             a.show_padding = False
+            a.use_matrix_engine = True
 
             # load data from selection into the alignment
             a.load_reference_protein(ref)
@@ -4,7 +4,12 @@ from django.conf import settings
 from django.db import connection
 
 import datetime
+import json
 import logging
+import os
+import queue
+import time
+import traceback
 from multiprocessing import Queue, Process, Value, Lock
 
 
@@ -13,6 +18,13 @@ class Command(BaseCommand):
 
     logger = logging.getLogger(__name__)
 
+    # commands that implement process_item (instead of main_func) set this, prepare_input then runs them with the
+    # batch scheduler
+    process_items = False
+
+    # maximum number of items a worker claims at once when using process_item
+    item_batch_size = 8
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -25,8 +37,38 @@ class Command(BaseCommand):
             dest='test',
             default=False,
             help='Include only a subset of data for testing')
+        parser.add_argument('--retries',
+            type=int,
+            action='store',
+            dest='retries',
+            default=1,
+            help='Number of times failed items are retried')
+        parser.add_argument('--task-report',
+            type=str,
+            action='store',
+            dest='task_report',
+            default=False,
+            help='Write a JSON report of the processing time of each item to this file')
+
+    def execute(self, *args, **options):
+        self.options = options
+        return super(Command, self).execute(*args, **options)
+
+    def process_item(self, item, iteration):
+        """Process a single item of the list given to prepare_input
+
+        Commands that set process_items implement this instead of main_func. It is called in a worker process for
+        each item, an exception marks the item as failed (it is retried with --retries) without stopping the other
+        items."""
+        raise NotImplementedError
 
     def prepare_input(self, proc, items, iteration=1):
+        if self.process_items:
+            if type(self).process_item is Command.process_item:
+                raise CommandError('{} sets process_items but does not implement process_item'.format(
+                    self.__module__.split('.')[-1]))
+            return self.schedule_items(proc, items, iteration)
+
         q = Queue()
         procs = list()
         num_items = len(items)
@@ -54,4 +96,136 @@ class Command(BaseCommand):
             p.start()
 
         for p in procs:
-            p.join()
\ No newline at end of file
+            p.join()
+
+    def schedule_items(self, proc, items, iteration=1):
+        """Run process_item for all items in parallel
+
+        Workers claim small batches of items from a shared counter until all items are done, so that slow items do
+        not leave the other workers idle. Failed items are retried, and a summary of the item timings is logged (and
+        written to --task-report)."""
+        num_items = len(items)
+        if not num_items:
+            return False
+
+        options = getattr(self, 'options', {})
+        retries = options.get('retries', 1)
+        start = time.time()
+        records = {}
+        pending = list(range(num_items))
+        attempt = 0
+        while pending:
+            attempt += 1
+            failed = []
+            for r in self.run_item_workers(proc, items, pending, iteration):
+                r['attempt'] = attempt
+                records[r['index']] = r
+                if r['error']:
+                    failed.append(r['index'])
+            if failed and attempt <= retries:
+                self.logger.warning('Retrying {} failed items (attempt {})'.format(len(failed), attempt + 1))
+                pending = sorted(failed)
+            else:
+                pending = []
+
+        self.report_items(records, proc, iteration, time.time() - start)
+        return True
+
+    def run_item_workers(self, proc, items, indices, iteration):
+        """Process the items at the given indices with proc workers, returns one timing record per item"""
+        proc = max(1, min(proc, len(indices)))
+        num = Value('i', 0)
+        lock = Lock()
+        results = Queue()
+
+        connection.close()
+        procs = list()
+        for i in range(0, proc):
+            p = Process(target=self.item_worker, args=([items, indices, iteration, proc, num, lock, results]))
+            procs.append(p)
+            p.start()
+
+        # collect the results while the workers run, a worker signals it is done with None
+        records = []
+        finished = 0
+        while finished < proc:
+            try:
+                r = results.get(timeout=1)
+            except queue.Empty:
+                if not any([p.is_alive() for p in procs]):
+                    break
+                continue
+            if r is None:
+                finished += 1
+            else:
+                records.append(r)
+
+        for p in procs:
+            p.join()
+
+        # items claimed by a worker that died are reported as failed
+        done = set([r['index'] for r in records])
+        for i in indices:
+            if i not in done:
+                records.append({'index': i, 'item': str(items[i]), 'seconds': 0, 'worker': None,
+                    'error': 'Not processed, worker exited'})
+        return records
+
+    def item_worker(self, items, indices, iteration, proc, num, lock, results):
+        try:
+            while True:
+                # claim a batch, the batches get smaller towards the end of the list
+                with lock:
+                    first = num.value
+                    if first >= len(indices):
+                        break
+                    size = max(1, min(self.item_batch_size, int((len(indices) - first) / (2 * proc))))
+                    num.value = first + size
+
+                for i in indices[first:first + size]:
+                    item = items[i]
+                    start = time.time()
+                    error = None
+                    try:
+                        self.process_item(item, iteration)
+                    except Exception:
+                        error = traceback.format_exc()
+                        self.logger.error('Failed processing {}\n{}'.format(item, error))
+                    results.put({'index': i, 'item': str(item), 'seconds': time.time() - start, 'worker': os.getpid(),
+                        'error': error})
+        finally:
+            results.put(None)
+
+    def report_items(self, records, proc, iteration, elapsed):
+        """Log a summary of the item timings and write the --task-report file"""
+        records = sorted(records.values(), key=lambda r: r['index'])
+        times = [r['seconds'] for r in records]
+        failed = [r for r in records if r['error']]
+        retried = [r for r in records if r['attempt'] > 1]
+        busy = sum(times)
+        utilization = busy / (elapsed * proc) * 100 if elapsed and proc else 0
+
+        self.logger.info('Processed {} items in {:.1f}s with {} processes ({:.0f}% utilization), mean {:.2f}s, '
+            'max {:.2f}s per item, {} retried, {} failed'.format(len(records), elapsed, proc, utilization,
+            busy / len(records) if records else 0, max(times) if times else 0, len(retried), len(failed)))
+        for r in sorted(records, key=lambda r: -r['seconds'])[:10]:
+            self.logger.info('Slowest: {} {:.2f}s'.format(r['item'], r['seconds']))
+        for r in failed:
+            self.logger.error('Failed: {} (after {} attempts)'.format(r['item'], r['attempt']))
+
+        report = {
+            'command': self.__module__.split('.')[-1],
+            'iteration': iteration,
+            'processes': proc,
+            'seconds': elapsed,
+            'utilization': utilization,
+            'items': records,
+        }
+        if not hasattr(self, 'task_reports'):
+            self.task_reports = []
+        self.task_reports.append(report)
+
+        path = getattr(self, 'options', {}).get('task_report')
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.task_reports, f, indent=1)
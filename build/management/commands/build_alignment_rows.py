@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+
+from common.alignment_store import STORE_DIR, RESIDUE_DTYPE, current_stamp, write_store
+from protein.models import ProteinConformation, ProteinSegment
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme
+
+import logging
+import numpy as np
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the residue rows of all protein conformations for building alignments without database access'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path',
+            type=str,
+            action='store',
+            dest='path',
+            default=STORE_DIR,
+            help='Directory of the alignment row store')
+
+    def handle(self, *args, **options):
+        try:
+            self.logger.info('CREATING ALIGNMENT ROW STORE')
+            self.build_store(options['path'])
+            self.logger.info('COMPLETED CREATING ALIGNMENT ROW STORE')
+        except Exception as msg:
+            print(msg)
+            self.logger.error(msg)
+
+    def build_store(self, path):
+        # lookup tables
+        schemes = list(ResidueNumberingScheme.objects.values('id', 'parent_id', 'slug', 'short_name', 'name'))
+        scheme_index = dict([(s['id'], i) for i, s in enumerate(schemes)])
+        segments = list(ProteinSegment.objects.values('id', 'slug', 'name', 'category', 'fully_aligned', 'partial',
+            'proteinfamily'))
+        segment_index = dict([(s['id'], i) for i, s in enumerate(segments)])
+        generic_numbers = []
+        gn_index = {}
+        for gn_id, label, scheme_id, segment_id in ResidueGenericNumber.objects.values_list('id', 'label', 'scheme_id',
+            'protein_segment_id'):
+            gn_index[gn_id] = len(generic_numbers)
+            generic_numbers.append((gn_id, label, scheme_index[scheme_id], segment_index.get(segment_id, -1)))
+
+        # alternative generic numbers, grouped per residue
+        self.logger.info('Fetching alternative generic numbers')
+        through = Residue.alternative_generic_numbers.through
+        alternative_gns = {}
+        for residue_id, gn_id in through.objects.values_list('residue_id', 'residuegenericnumber_id').iterator():
+            alternative_gns.setdefault(residue_id, []).append(gn_index[gn_id])
+
+        # protein conformation labels
+        pconf_labels = dict([(pc[0], pc[1:]) for pc in ProteinConformation.objects.values_list('id',
+            'protein__entry_name', 'state__slug')])
+
+        # read before the residues, residues changed meanwhile make the store out of date
+        stamp = current_stamp()
+
+        self.logger.info('Fetching residues')
+        rs = Residue.objects.order_by('protein_conformation_id', 'sequence_number').values_list('id',
+            'protein_conformation_id', 'protein_segment_id', 'generic_number_id', 'display_generic_number_id',
+            'amino_acid', 'sequence_number')
+        num_residues = rs.count()
+        residues = np.zeros(num_residues, dtype=RESIDUE_DTYPE)
+        alternative_offsets = np.zeros(num_residues + 1, dtype=np.int64)
+        alternatives = []
+        conformations = {}
+        i = -1
+        for i, r in enumerate(rs.iterator()):
+            residue_id, pconf_id, segment_id, gn_id, dgn_id, amino_acid, sequence_number = r
+            if pconf_id not in conformations:
+                conformations[pconf_id] = list(pconf_labels[pconf_id]) + [i, i]
+            conformations[pconf_id][3] = i + 1
+
+            residues[i] = (segment_index.get(segment_id, -1), gn_index.get(gn_id, -1), gn_index.get(dgn_id, -1),
+                amino_acid.encode('ascii', 'replace'), sequence_number)
+            alternatives.extend(alternative_gns.get(residue_id, []))
+            alternative_offsets[i + 1] = len(alternatives)
+
+        # residues may have been added or removed since counting
+        residues = residues[:i + 1]
+        alternative_offsets = alternative_offsets[:i + 2]
+
+        write_store(path, conformations, residues, alternative_offsets, np.array(alternatives, dtype=np.int32),
+            segments, generic_numbers, schemes, stamp)
+        self.logger.info('Stored {} residues of {} protein conformations in {}'.format(len(residues),
+            len(conformations), path))
@@ -1,7 +1,21 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
+from django.db import connection
 
+from multiprocessing import Process
 import datetime
+import json
+import time
+import traceback
+
+
+def run_step(name, args, kwargs):
+    """Run a build command in a worker process, exits with a non-zero code if the command fails"""
+    try:
+        call_command(name, *args, **kwargs)
+    except BaseException:
+        traceback.print_exc()
+        raise SystemExit(1)
 
 
 class Command(BaseCommand):
@@ -28,52 +42,210 @@ class Command(BaseCommand):
                             action='store_false',
                             default=True,
                             help='Skip building contact network for test build')
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            action='store',
+                            dest='jobs',
+                            default=1,
+                            help='Number of independent build steps to run at the same time')
+        parser.add_argument('--from',
+                            type=str,
+                            action='store',
+                            dest='from_step',
+                            default=False,
+                            help='Restart the build at this step (runs this step and all steps listed after it)')
+        parser.add_argument('--only',
+                            type=str,
+                            action='store',
+                            dest='only',
+                            default=False,
+                            help='Comma separated list of steps to run, dependencies are assumed to be built')
+        parser.add_argument('--report',
+                            type=str,
+                            action='store',
+                            dest='report',
+                            default=False,
+                            help='Write a JSON report of the step timings to this file')
+        parser.add_argument('--list',
+                            action='store_true',
+                            dest='list',
+                            default=False,
+                            help='List the build steps and their dependencies')
+
+    def get_steps(self, options):
+        """Build steps as (step name, command, positional arguments, options, dependencies), in a valid order"""
+        steps = [
+            ['build_common', 'build_common', [], {}, []],
+            ['build_human_proteins', 'build_human_proteins', [], {}, ['build_common']],
+            ['build_blast_database', 'build_blast_database', [], {}, ['build_human_proteins']],
+            ['build_other_proteins', 'build_other_proteins', [], {'constructs_only': options['test'], 'proc': options['proc']}, ['build_blast_database']], # build only constructs in test mode
+            ['build_annotation', 'build_annotation', [], {'proc': options['proc']}, ['build_other_proteins']],
+            ['build_blast_database_annotated', 'build_blast_database', [], {}, ['build_annotation']],
+            ['build_links', 'build_links', [], {}, ['build_annotation']],
+            ['build_construct_proteins', 'build_construct_proteins', [], {}, ['build_blast_database_annotated']],
+            ['build_structures', 'build_structures', [], {'proc': options['proc']}, ['build_construct_proteins', 'build_links']],
+            ['build_structure_coordinates', 'build_structure_coordinates', [], {'proc': options['proc'], 'test': options['test']}, ['build_structures']],
+            ['build_construct_data', 'build_construct_data', [], {}, ['build_structures']],
+            ['update_construct_mutations', 'update_construct_mutations', [], {}, ['build_construct_data']],
+            # ligands are also created by the structure, construct and mutant steps, so these run one after the other
+            ['build_ligands_from_cache', 'build_ligands_from_cache', [], {'proc': options['proc'], 'test_run': options['test']}, ['update_construct_mutations']],
+            ['build_ligand_assays', 'build_ligand_assays', [], {'proc': options['proc'], 'test_run': options['test']}, ['build_ligands_from_cache']],
+            ['build_mutant_data', 'build_mutant_data', [], {'proc': options['proc'], 'test_run': options['test']}, ['build_ligand_assays']],
+            ['build_crystal_interactions', 'build_crystal_interactions', [], {'proc': options['proc'], 'incremental': True, 'test': options['test']}, ['build_structures']],
+            ['build_protein_sets', 'build_protein_sets', [], {}, ['build_structures']],
+            ['build_consensus_sequences', 'build_consensus_sequences', [], {'proc': options['proc']}, ['build_annotation']],
+            ['build_g_proteins', 'build_g_proteins', [], {}, ['build_annotation']],
+            ['build_arrestins', 'build_arrestins', [], {}, ['build_annotation']],
+            ['build_signprot_complex', 'build_signprot_complex', [], {}, ['build_g_proteins', 'build_structures']],
+            ['build_drugs', 'build_drugs', [], {}, ['build_annotation']],
+            ['build_nhs', 'build_nhs', [], {}, ['build_drugs']],
+            ['build_mutational_landscape', 'build_mutational_landscape', [], {}, ['build_annotation']],
+            ['build_residue_sets', 'build_residue_sets', [], {}, ['build_structures']],
+            ['build_dynamine_annotation', 'build_dynamine_annotation', [], {'proc': options['proc']}, ['build_protein_sets']],
+            ['build_alignment_rows', 'build_alignment_rows', [], {}, ['build_structures', 'build_g_proteins', 'build_arrestins', 'build_signprot_complex']],
+            ['build_template_similarity', 'build_template_similarity', [], {}, ['build_structures', 'build_annotation']],
+            ['build_homology_models', 'build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}, ['build_structures', 'build_signprot_complex', 'build_alignment_rows', 'build_template_similarity']],
+            ['build_blast_database_final', 'build_blast_database', [], {}, ['build_homology_models', 'build_g_proteins', 'build_arrestins']],
+            ['build_text', 'build_text', [], {}, ['build_common']],
+        ]
+        # the release notes summarize everything
+        steps.append(['build_release_notes', 'build_release_notes', [], {}, [s[0] for s in steps]])
+        return steps
 
     def handle(self, *args, **options):
         if options['test']:
             print('Running in test mode')
 
-        commands = [
-            ['build_common'],
-            ['build_human_proteins'],
-            ['build_blast_database'],
-            ['build_other_proteins', {'constructs_only': options['test'] ,'proc': options['proc']}], # build only constructs in test mode
-            ['build_annotation', {'proc': options['proc']}],
-            ['build_blast_database'],
-            ['build_links'],
-            ['build_construct_proteins'],
-            ['build_structures', {'proc': options['proc']}],
-            ['build_construct_data'],
-            ['update_construct_mutations'],
-            ['build_ligands_from_cache', {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_ligand_assays', {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_mutant_data', {'proc': options['proc'], 'test_run': options['test']}],
-            # ['build_crystal_interactions', {'proc': options['proc']}],
-            ['build_protein_sets'],
-            ['build_consensus_sequences', {'proc': options['proc']}],
-            ['build_g_proteins'],
-            ['build_arrestins'],
-            ['build_signprot_complex'],
-            ['build_drugs'],
-            ['build_nhs'],
-            ['build_mutational_landscape'],
-            ['build_residue_sets'],
-            ['build_dynamine_annotation', {'proc': options['proc']}],
-            ['build_homology_models', ['--update', '-z'], {'proc': options['proc'], 'test_run': options['test']}],
-            ['build_blast_database'],
-            ['build_text'],
-            ['build_release_notes'],
-        ]
+        steps = self.get_steps(options)
+        names = [s[0] for s in steps]
 
-        for c in commands:
-            print('{} Running {}'.format(
-                datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), c[0]))
-            if len(c) == 2:
-                call_command(c[0], **c[1])
-            elif len(c) == 3:
-                call_command(c[0], *c[1], **c[2])
+        if options['list']:
+            for name, command, step_args, step_options, dependencies in steps:
+                print('{} ({}) <- {}'.format(name, command, ', '.join(dependencies)))
+            return
+
+        # steps to run
+        selected = names
+        if options['from_step']:
+            if options['from_step'] not in names:
+                raise CommandError('Unknown step {}'.format(options['from_step']))
+            selected = names[names.index(options['from_step']):]
+        if options['only']:
+            selected = [s.strip() for s in options['only'].split(',')]
+            unknown = [s for s in selected if s not in names]
+            if unknown:
+                raise CommandError('Unknown steps {}'.format(', '.join(unknown)))
+        steps = [s for s in steps if s[0] in selected]
+
+        self.timings = []
+        start = time.time()
+        failed = self.run_steps(steps, max(1, options['jobs']))
+        elapsed = time.time() - start
+
+        self.write_report(options['report'], elapsed)
+        if failed:
+            raise CommandError('Build failed at {}'.format(', '.join(failed)))
+
+        print('{} Build completed in {:.0f} seconds'.format(datetime.datetime.strftime(
+            datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), elapsed))
+
+    def log(self, message):
+        print('{} {}'.format(datetime.datetime.strftime(datetime.datetime.now(), '%Y-%m-%d %H:%M:%S'), message))
+
+    def run_steps(self, steps, jobs):
+        """Run steps as soon as their dependencies have finished, with at most jobs steps at a time
+
+        Dependencies on steps that are not selected are considered done. Returns the names of failed steps, steps
+        depending on a failed step are skipped."""
+        selected = set([s[0] for s in steps])
+        waiting = list(steps)
+        running = {}
+        done = set()
+        failed = []
+        skipped = set()
+
+        while waiting or running:
+            # skip steps that can never run (steps are listed after their dependencies)
+            for step in list(waiting):
+                if any([d in failed or d in skipped for d in step[4]]):
+                    waiting.remove(step)
+                    skipped.add(step[0])
+                    self.log('Skipping {}, a dependency failed'.format(step[0]))
+                    self.timings.append({'step': step[0], 'command': step[1], 'status': 'skipped',
+                        'dependencies': step[4]})
+
+            # start steps that are ready
+            for step in list(waiting):
+                if len(running) >= jobs:
+                    break
+                if all([d in done or d not in selected for d in step[4]]):
+                    waiting.remove(step)
+                    running[step[0]] = self.start_step(step, jobs)
+
+            if not running:
+                if waiting:
+                    # only possible with dependency cycles
+                    raise CommandError('Unresolvable dependencies for {}'.format(', '.join([s[0] for s in waiting])))
+                break
+
+            # wait for a step to finish
+            finished = self.wait_for_step(running)
+            timing = running.pop(finished)
+            if timing['status'] == 'completed':
+                done.add(finished)
             else:
-                call_command(c[0])
+                failed.append(finished)
+
+        return failed
+
+    def start_step(self, step, jobs):
+        name, command, step_args, step_options, dependencies = step
+        self.log('Running {}'.format(name))
+        timing = {'step': name, 'command': command, 'dependencies': dependencies, 'start': time.time()}
+        self.timings.append(timing)
+
+        if jobs == 1:
+            # run in this process, one step at a time
+            try:
+                call_command(command, *step_args, **step_options)
+                timing['status'] = 'completed'
+            except Exception:
+                traceback.print_exc()
+                timing['status'] = 'failed'
+            self.finish_step(timing)
+        else:
+            connection.close()
+            timing['process'] = Process(target=run_step, args=(command, step_args, step_options))
+            timing['process'].start()
+        return timing
+
+    def wait_for_step(self, running):
+        """Wait until one of the running steps has finished and return its name"""
+        while True:
+            for name, timing in running.items():
+                if 'process' not in timing:
+                    return name
+                if not timing['process'].is_alive():
+                    timing['process'].join()
+                    timing['status'] = 'completed' if timing['process'].exitcode == 0 else 'failed'
+                    del timing['process']
+                    self.finish_step(timing)
+                    return name
+            time.sleep(1)
+
+    def finish_step(self, timing):
+        timing['end'] = time.time()
+        timing['seconds'] = round(timing['end'] - timing['start'], 1)
+        self.log('{} {} in {} seconds'.format(timing['step'], timing['status'], timing['seconds']))
 
-        print('{} Build completed'.format(datetime.datetime.strftime(
-            datetime.datetime.now(), '%Y-%m-%d %H:%M:%S')))
+    def write_report(self, path, elapsed):
+        """Print the step timings and write them as JSON if a report file is given"""
+        for t in sorted([t for t in self.timings if 'seconds' in t], key=lambda t: -t['seconds']):
+            print('{:>10.1f}s {} ({})'.format(t['seconds'], t['step'], t['status']))
+        if path:
+            report = {
+                'seconds': round(elapsed, 1),
+                'steps': [dict([(k, v) for k, v in t.items() if k != 'process']) for t in self.timings],
+            }
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=1)
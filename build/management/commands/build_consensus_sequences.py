@@ -7,11 +7,11 @@ from build.management.commands.build_human_proteins import Command as BuildHuman
 from residue.functions import *
 from protein.models import Protein, ProteinConformation, ProteinFamily, ProteinSegment, ProteinSequenceType
 from common.alignment import Alignment
+from alignment.consensus import ConsensusData
 from alignment.models import AlignmentConsensus
 
 import os
 import yaml
-import pickle
 
 class Command(BuildHumanProteins):
     help = 'Builds consensus sequences for human proteins in all families'
@@ -105,14 +105,14 @@ class Command(BuildHumanProteins):
             a.calculate_statistics()
 
             try:
-                # Save alignment
-                AlignmentConsensus.objects.create(slug=family.slug, alignment=pickle.dumps(a))
+                # Save consensus data
+                AlignmentConsensus.objects.create(slug=family.slug, alignment=ConsensusData.from_alignment(a).encode())
 
-                # Load alignment to ensure it works
-                a = pickle.loads(AlignmentConsensus.objects.get(slug=family.slug).alignment)
-                self.logger.info('Succesfully pickled {}'.format(family))
+                # Load consensus data to ensure it works
+                ConsensusData.decode(AlignmentConsensus.objects.get(slug=family.slug).alignment)
+                self.logger.info('Succesfully stored consensus data for {}'.format(family))
             except:
-                self.logger.error('Failed pickle for {}'.format(family))
+                self.logger.error('Failed storing consensus data for {}'.format(family))
 
             self.logger.info('Completed building alignment for {}'.format(family))
 
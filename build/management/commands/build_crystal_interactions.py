@@ -1,17 +1,21 @@
 from django.core.management.base import BaseCommand
+from django.conf import settings
 from build.management.commands.base_build import Command as BaseBuild
 
-from django.db import transaction
+from django.db import connection, transaction
 
 from contactnetwork.models import *
 from residue.models import Residue
 
 import contactnetwork.interaction as ci
 
+import hashlib
 import logging
-import datetime
+import os
+import shutil
 
 from contactnetwork.cube import compute_interactions
+from contactnetwork import frequencies
 
 from django.contrib.contenttypes.models import ContentType
 
@@ -19,120 +23,172 @@ class Command(BaseBuild):
     help = 'Compute interactions for all available crystals.'
 
     logger = logging.getLogger(__name__)
+
+    process_items = True
+
+    # one file per finished structure containing the checksum of the PDB data it was computed from
+    progress_dir = os.sep.join([settings.BUILD_CACHE_DIR, 'crystal_interactions'])
+
+    # mapping of computed interactions to models and their extra fields
+    interaction_models = {
+        ci.VanDerWaalsInteraction: (VanDerWaalsInteraction, {}),
+        ci.HydrophobicInteraction: (HydrophobicInteraction, {}),
+        ci.PolarSidechainSidechainInteraction: (PolarSidechainSidechainInteraction, {}),
+        ci.PolarBackboneSidechainInteraction: (PolarBackboneSidechainInteraction, {'res1_is_sidechain': False}),
+        ci.PolarSideChainBackboneInteraction: (PolarBackboneSidechainInteraction, {'res1_is_sidechain': True}),
+        ci.FaceToFaceInteraction: (FaceToFaceInteraction, {}),
+        ci.FaceToEdgeInteraction: (FaceToEdgeInteraction, {'res1_has_face': True}),
+        ci.EdgeToFaceInteraction: (FaceToEdgeInteraction, {'res1_has_face': False}),
+        ci.PiCationInteraction: (PiCationInteraction, {'res1_has_pi': True}),
+        ci.CationPiInteraction: (PiCationInteraction, {'res1_has_pi': False}),
+    }
+
     def add_arguments(self, parser):
-        parser.add_argument('-p', '--proc',
-            type=int,
-            action='store',
-            dest='proc',
-            default=1,
-            help='Number of processes to run')
+        super(Command, self).add_arguments(parser=parser)
+        parser.add_argument('-i', '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Only (re)compute structures with new or changed PDB data, also resumes an interrupted run')
 
     def handle(self, *args, **options):
-        self.delete_all()
-        self.structures = Structure.objects.all().exclude(refined=True)
+        self.incremental = options['incremental']
+        if not self.incremental:
+            self.delete_all()
+        os.makedirs(self.progress_dir, exist_ok=True)
+
+        self.structures = Structure.objects.all().exclude(refined=True).select_related(
+            'protein_conformation__protein', 'pdb_data').order_by('pk')
+        if options['test']:
+            self.structures = self.structures[:20]
         self.prepare_input(options['proc'], self.structures)
+        frequencies.invalidate()
         self.logger.info('Finished building crystal interaction data for all PDBs!')
 
     def delete_all(self):
-        VanDerWaalsInteraction.objects.all().delete()
-        HydrophobicInteraction.objects.all().delete()
-        PolarBackboneSidechainInteraction.objects.all().delete()
-        PolarSidechainSidechainInteraction.objects.all().delete()
-        FaceToFaceInteraction.objects.all().delete()
-        FaceToEdgeInteraction.objects.all().delete()
-        PiCationInteraction.objects.all().delete()
+        Interaction.objects.all().delete()
         InteractingResiduePair.objects.all().delete()
+        InteractionFact.objects.all().delete()
+        if os.path.isdir(self.progress_dir):
+            shutil.rmtree(self.progress_dir)
         self.logger.info('Deleted crystal interactions data all PDBs...')
 
-    # @transaction.atomic
-    def main_func(self, positions, iteration,count,lock):
-        while count.value<len(self.structures):
-            with lock:
-                s = self.structures[count.value]
-                pdb_code = s.protein_conformation.protein.entry_name
-                count.value +=1 
-                self.logger.info('Generating crystal interactions data for PDB \'{}\'... ({} out of {})'.format(pdb_code, count.value, len(self.structures)))
-
-            try:
-                interacting_pairs = compute_interactions(pdb_code)
-            except:
-                self.logger.error('Error with computing interactions (%s)' % (pdb_code))
+    def progress_file(self, pdb_code):
+        return os.sep.join([self.progress_dir, pdb_code + '.md5'])
+
+    def is_up_to_date(self, s, pdb_code, checksum):
+        """Check whether interactions were computed from the same PDB data in an earlier (or interrupted) run"""
+        try:
+            with open(self.progress_file(pdb_code)) as f:
+                previous = f.read().strip()
+        except IOError:
+            return False
+        return (previous == checksum and InteractingResiduePair.objects.filter(referenced_structure=s).exists()
+            and InteractionFact.objects.filter(structure=s).exists())
+
+    def process_item(self, s, iteration):
+        pdb_code = s.protein_conformation.protein.entry_name
+        self.logger.info('Generating crystal interactions data for PDB \'{}\'...'.format(pdb_code))
+
+        pdb_data = s.pdb_data.pdb if s.pdb_data else None
+        checksum = hashlib.md5(pdb_data.encode('utf-8')).hexdigest() if pdb_data else ''
+        if self.incremental and pdb_data and self.is_up_to_date(s, pdb_code, checksum):
+            self.logger.info('Skipping unchanged PDB \'{}\''.format(pdb_code))
+            return
+
+        try:
+            interacting_pairs = compute_interactions(pdb_code, structure=s, pdb_data=pdb_data)
+        except:
+            self.logger.error('Error with computing interactions (%s)' % (pdb_code))
+            return
+
+        with transaction.atomic():
+            InteractingResiduePair.objects.filter(referenced_structure=s).delete()
+            InteractionFact.objects.filter(structure=s).delete()
+            self.save_interactions(s, interacting_pairs)
+
+        if checksum:
+            with open(self.progress_file(pdb_code), 'w') as f:
+                f.write(checksum)
+
+        self.logger.info('Generated crystal interactions data for PDB \'{}\'...'.format(pdb_code))
+
+    def save_interactions(self, s, interacting_pairs):
+        conformation = s.protein_conformation
+
+        # Get the residues (pk, generic number, segment and amino acid per sequence number)
+        residues = {}
+        for r in Residue.objects.filter(protein_conformation=conformation).values_list('sequence_number', 'pk',
+            'generic_number__label', 'protein_segment__slug', 'amino_acid'):
+            residues[r[0]] = r
+
+        pairs = []
+        pair_residues = []
+        pair_interactions = []
+        pair_ctype = ContentType.objects.get_for_model(InteractingResiduePair, for_concrete_model=False)
+        for p in interacting_pairs:
+            res1_seq_num = p.get_residue_1().id[1]
+            res2_seq_num = p.get_residue_2().id[1]
+            if res1_seq_num not in residues or res2_seq_num not in residues:
+                self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
                 continue
 
-            for p in interacting_pairs:
-                # Create the pair
-                res1_seq_num = p.get_residue_1().id[1]
-                res2_seq_num = p.get_residue_2().id[1]
-                conformation = s.protein_conformation
-
-                # Get the residues
-                try:
-                    res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                    res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
-                except Residue.DoesNotExist:
-                    self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
-                    continue
+            pairs.append(InteractingResiduePair(res1_id=residues[res1_seq_num][1], res2_id=residues[res2_seq_num][1],
+                referenced_structure=s, polymorphic_ctype=pair_ctype))
+            pair_residues.append((residues[res1_seq_num], residues[res2_seq_num]))
+            pair_interactions.append(p.get_interactions())
 
-                # Save the pair
-                pair = InteractingResiduePair()
-                pair.res1 = res1
-                pair.res2 = res2
-                pair.referenced_structure = s
-                pair.save()
-
-                # Add the interactions to the pair
-                for i in p.get_interactions():
-                    if type(i) is ci.VanDerWaalsInteraction:
-                        ni = VanDerWaalsInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.HydrophobicInteraction:
-                        ni = HydrophobicInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.PolarSidechainSidechainInteraction:
-                        ni = PolarSidechainSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.save()
-                    elif type(i) is ci.PolarBackboneSidechainInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = False
-                        ni.save()
-                    elif type(i) is ci.PolarSideChainBackboneInteraction:
-                        ni = PolarBackboneSidechainInteraction()
-                        ni.interacting_pair = pair
-                        ni.is_charged_res1 = i.is_charged_res1
-                        ni.is_charged_res2 = i.is_charged_res2
-                        ni.res1_is_sidechain = True
-                        ni.save()
-                    elif type(i) is ci.FaceToFaceInteraction:
-                        ni = FaceToFaceInteraction()
-                        ni.interacting_pair = pair
-                        ni.save()
-                    elif type(i) is ci.FaceToEdgeInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = True
-                        ni.save()
-                    elif type(i) is ci.EdgeToFaceInteraction:
-                        ni = FaceToEdgeInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_face = False
-                        ni.save()
-                    elif type(i) is ci.PiCationInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = True
-                        ni.save()
-                    elif type(i) is ci.CationPiInteraction:
-                        ni = PiCationInteraction()
-                        ni.interacting_pair = pair
-                        ni.res1_has_pi = False
-                        ni.save()
-
-            self.logger.info('Generated crystal interactions data for PDB \'{}\'...'.format(pdb_code))
+        # Save the pairs
+        pairs = InteractingResiduePair.objects.bulk_create(pairs)
+
+        # Add the interactions to the pairs, and a denormalised fact row per interaction
+        interactions = []
+        facts = []
+        for pair, (res1, res2), computed in zip(pairs, pair_residues, pair_interactions):
+            for i in computed:
+                if type(i) not in self.interaction_models:
+                    continue
+                model, fields = self.interaction_models[type(i)]
+                ni = model(interacting_pair_id=pair.pk, **fields)
+                if isinstance(ni, PolarInteraction):
+                    ni.is_charged_res1 = i.is_charged_res1
+                    ni.is_charged_res2 = i.is_charged_res2
+                interactions.append(ni)
+                facts.append(InteractionFact(structure=s, pdb=conformation.protein.entry_name,
+                    interaction_type=model._meta.model_name, res1_seq=res1[0], res2_seq=res2[0], gn1=res1[2],
+                    gn2=res2[2], segment1=res1[3], segment2=res2[3], aa1=res1[4], aa2=res2[4]))
+        self.bulk_create_interactions(interactions)
+        InteractionFact.objects.bulk_create(facts)
+
+    def bulk_create_interactions(self, interactions):
+        """Insert polymorphic interactions in bulk
+
+        bulk_create does not support multi-table inherited models, so the Interaction rows are created with
+        bulk_create and the rows of the subclass tables are inserted with one executemany per table."""
+        grouped = {}
+        for ni in interactions:
+            grouped.setdefault(type(ni), []).append(ni)
+
+        for model, objs in grouped.items():
+            ctype = ContentType.objects.get_for_model(model, for_concrete_model=False)
+            roots = Interaction.objects.bulk_create([Interaction(interacting_pair_id=ni.interacting_pair_id,
+                polymorphic_ctype=ctype) for ni in objs])
+
+            # tables of the inheritance chain below Interaction, top down
+            chain = [m for m in reversed(model._meta.get_parent_list()) if m is not Interaction] + [model]
+            with connection.cursor() as cursor:
+                for m in chain:
+                    fields = m._meta.local_concrete_fields
+                    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(connection.ops.quote_name(m._meta.db_table),
+                        ', '.join([connection.ops.quote_name(f.column) for f in fields]),
+                        ', '.join(['%s'] * len(fields)))
+                    rows = []
+                    for root, ni in zip(roots, objs):
+                        row = []
+                        for f in fields:
+                            if f.one_to_one and f.remote_field.parent_link:
+                                row.append(root.pk)
+                            else:
+                                row.append(f.get_db_prep_save(getattr(ni, f.attname), connection))
+                        rows.append(row)
+                    cursor.executemany(sql, rows)
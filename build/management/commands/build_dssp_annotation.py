@@ -18,6 +18,9 @@ class Command(BaseBuild):
     help = 'Add dssp annotations to structures.'
 
     logger = logging.getLogger(__name__)
+
+    process_items = True
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -130,33 +133,29 @@ class Command(BaseBuild):
     # S   Bend
 
     # @transaction.atomic
-    def main_func(self, positions, iteration,count,lock):
-        while count.value<len(self.structures):
-            with lock:
-                s = self.structures[count.value]
-                count.value +=1 
-                self.logger.info('Generating DSSP data for \'{}\'... ({} out of {})'.format(s, count.value, len(self.structures)))
-            print(s)
-
-            pdbcode = s.pdb_code.index.lower()
-            chain = s.preferred_chain
-
-            # Grab DSSP db index number
-            url = 'http://mrs.cmbi.ru.nl/search?db=dssp&q=%s&count=3' % (pdbcode)
-            r = request.urlopen(url)
-            t = r.geturl()
-            d_id = t.split('=')[2][:-3]
-
-            # Grab DSSP file
-            url = 'http://mrs.cmbi.ru.nl/download?db=dssp&nr=$index'
-            cache_dir = ['dssp', 'id']
-            dssp = fetch_from_web_api(url, d_id, cache_dir, raw=True)
-
-            # Parse file
-            dssp = self.dssp_dict(dssp,chain)
-
-            rs = Residue.objects.filter(protein_conformation=s.protein_conformation).all()
-
-            for r in rs:
-                if r.sequence_number in dssp:
-                    point, created = ResidueDataPoint.objects.get_or_create(data_type=self.dssp_type, residue=r, value_text=dssp[r.sequence_number])
+    def process_item(self, s, iteration):
+        self.logger.info('Generating DSSP data for \'{}\'...'.format(s))
+        print(s)
+
+        pdbcode = s.pdb_code.index.lower()
+        chain = s.preferred_chain
+
+        # Grab DSSP db index number
+        url = 'http://mrs.cmbi.ru.nl/search?db=dssp&q=%s&count=3' % (pdbcode)
+        r = request.urlopen(url)
+        t = r.geturl()
+        d_id = t.split('=')[2][:-3]
+
+        # Grab DSSP file
+        url = 'http://mrs.cmbi.ru.nl/download?db=dssp&nr=$index'
+        cache_dir = ['dssp', 'id']
+        dssp = fetch_from_web_api(url, d_id, cache_dir, raw=True)
+
+        # Parse file
+        dssp = self.dssp_dict(dssp,chain)
+
+        rs = Residue.objects.filter(protein_conformation=s.protein_conformation).all()
+
+        for r in rs:
+            if r.sequence_number in dssp:
+                point, created = ResidueDataPoint.objects.get_or_create(data_type=self.dssp_type, residue=r, value_text=dssp[r.sequence_number])
@@ -13,6 +13,8 @@ class Command(BaseBuild):
     help = 'Add dynamine annotations.'
 
     logger = logging.getLogger(__name__)
+
+    process_items = True
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -95,14 +97,8 @@ class Command(BaseBuild):
 
 
     # @transaction.atomic
-    def main_func(self, positions, iteration,count,lock):
-        while count.value<len(self.proteins):
-            with lock:
-                p = self.proteins[count.value]
-                count.value +=1 
-                self.logger.info('Generating dynamine data for \'{}\'... ({} out of {})'.format(p, count.value, len(self.proteins)))
-            # if 'opsd_bovin'!=str(p):
-            #     continue
-            dynamine = self.save_dynamine_prediction(p)
-            print(p,dynamine)
+    def process_item(self, p, iteration):
+        self.logger.info('Generating dynamine data for \'{}\'...'.format(p))
+        dynamine = self.save_dynamine_prediction(p)
+        print(p,dynamine)
 
@@ -7,6 +7,7 @@ from residue.models import Residue
 from residue.functions import dgn, ggn
 from structure.models import *
 from structure.functions import HSExposureCB, PdbStateIdentifier
+from structure.downloads import remove_model_archive, save_model_archive
 from common.alignment import AlignedReferenceTemplate, GProteinAlignment
 from common.definitions import *
 from common.models import WebLink
@@ -105,6 +106,7 @@ class Command(BaseBuild):
             sign_prot = '{}_{}'.format(name_list[2].split('-')[1], name_list[3])
             main_structure = name_list[4]
             build_date = name_list[5]
+        build_date = datetime.strptime(build_date, '%Y-%m-%d').date()
 
         with open(os.sep.join([path, modelname, modelname+'.pdb']), 'r') as pdb_file:
             pdb_data = pdb_file.read()
@@ -185,6 +187,8 @@ class Command(BaseBuild):
                                                                 main_template=m_s, 
                                                                 pdb=pdb_data, 
                                                                 version=build_date)
+            # the stored download files are written again once the templates are uploaded
+            remove_model_archive(hommod)
             res_prot = r_prot
             bulk_residues = []
             for r in templates[1:]:
@@ -213,6 +217,7 @@ class Command(BaseBuild):
                 srss.homology_model, srss.template, srss.similarity = hommod, s_s, s[1]
                 bulk_sims.append(srss)
             StructureComplexModelSeqSim.objects.bulk_create(bulk_sims)
+            save_model_archive(hommod)
             
         # Homology model
         else:
@@ -234,6 +239,8 @@ class Command(BaseBuild):
                                                         main_template=m_s, 
                                                         pdb=pdb_data, 
                                                         version=build_date)
+            # the stored download files are written again once the templates are uploaded
+            remove_model_archive(hommod)
             bulk_residues = []
             for r in templates[1:]:
                 r = r.split(',')
@@ -259,3 +266,4 @@ class Command(BaseBuild):
                 srss.homology_model, srss.template, srss.similarity = hommod, s_s, s[1]
                 bulk_sims.append(srss)
             StructureModelSeqSim.objects.bulk_create(bulk_sims)
+            save_model_archive(hommod)
@@ -0,0 +1,33 @@
+from build.management.commands.base_build import Command as BaseBuild
+
+from residue.models import Residue
+from structure.coordinates import STORE_DIR, StructureCoordinates
+from structure.models import Structure
+
+import logging
+import os
+
+
+class Command(BaseBuild):
+    help = 'Parses the PDB data of all structures into memory mappable coordinate arrays'
+
+    logger = logging.getLogger(__name__)
+
+    process_items = True
+
+    def handle(self, *args, **options):
+        os.makedirs(STORE_DIR, exist_ok=True)
+        self.structures = list(Structure.objects.exclude(pdb_data=None).select_related('pdb_code', 'pdb_data',
+            'protein_conformation').order_by('pk'))
+        if options['test']:
+            self.structures = self.structures[:20]
+        self.prepare_input(options['proc'], self.structures)
+        self.logger.info('Finished parsing structure coordinates')
+
+    def process_item(self, s, iteration):
+        # generic numbers of the residues in the preferred chain
+        generic_numbers = dict(Residue.objects.filter(protein_conformation=s.protein_conformation).exclude(
+            generic_number=None).values_list('sequence_number', 'generic_number__label'))
+        coordinates = StructureCoordinates.from_pdb(s.pdb_data.pdb, {s.preferred_chain[0]: generic_numbers},
+            s.pdb_data_id)
+        coordinates.save(StructureCoordinates.store_path(s))
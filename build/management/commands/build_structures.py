@@ -17,6 +17,7 @@ from construct.functions import *
 from contactnetwork.models import *
 import contactnetwork.interaction as ci
 from contactnetwork.cube import compute_interactions
+from contactnetwork import frequencies
 
 from Bio.PDB import PDBParser,PPBuilder
 from Bio import pairwise2
@@ -61,6 +62,8 @@ yaml.add_constructor(_mapping_tag, dict_constructor)
 class Command(BaseBuild):
     help = 'Reads source data and creates pdb structure records'
 
+    process_items = True
+
     def add_arguments(self, parser):
         parser.add_argument('-p', '--proc',
             type=int,
@@ -142,6 +145,8 @@ class Command(BaseBuild):
             for i in range(1,iterations+1):
                 self.prepare_input(options['proc'], self.filenames, i)
 
+            # contact networks may have been rebuilt
+            frequencies.invalidate()
             self.logger.info('COMPLETED CREATING STRUCTURES')
         except Exception as msg:
             print(msg)
@@ -815,6 +820,7 @@ class Command(BaseBuild):
 
         for i in ii:
             i.delete()
+        InteractionFact.objects.filter(structure=s).delete()
 
 
     def build_contact_network(self,s,pdb_code):
@@ -824,6 +830,7 @@ class Command(BaseBuild):
             self.logger.error('Error with computing interactions (%s)' % (pdb_code))
             return
 
+        facts = []
         for p in interacting_pairs:
             # Create the pair
             res1_seq_num = p.get_residue_1().id[1]
@@ -832,8 +839,10 @@ class Command(BaseBuild):
 
             # Get the residues
             try:
-                res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
+                res1 = Residue.objects.select_related('generic_number', 'protein_segment').get(
+                    sequence_number=res1_seq_num, protein_conformation=conformation)
+                res2 = Residue.objects.select_related('generic_number', 'protein_segment').get(
+                    sequence_number=res2_seq_num, protein_conformation=conformation)
             except Residue.DoesNotExist:
                 self.logger.warning('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
                 # print('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
@@ -848,6 +857,7 @@ class Command(BaseBuild):
 
             # Add the interactions to the pair
             for i in p.get_interactions():
+                ni = None
                 if type(i) is ci.VanDerWaalsInteraction:
                     ni = VanDerWaalsInteraction()
                     ni.interacting_pair = pair
@@ -900,651 +910,629 @@ class Command(BaseBuild):
                     ni.interacting_pair = pair
                     ni.res1_has_pi = False
                     ni.save()
-
-
-    def main_func(self, positions, iteration,count,lock):
-        # filenames
-        # if not positions[1]:
-        #     filenames = self.filenames[positions[0]:]
-        # else:
-        #     filenames = self.filenames[positions[0]:positions[1]]
-        filenames = self.filenames
-        while count.value<len(filenames):
-            with lock:
-                source_file = filenames[count.value]
-                count.value +=1 
-            source_file_path = os.sep.join([self.structure_data_dir, source_file])
-            # if source_file != "2RH1.yaml":
-            #     continue
-            if os.path.isfile(source_file_path) and source_file[0] != '.':
-                with open(source_file_path, 'r') as f:
-                    sd = yaml.load(f)
-                    # is this a representative structure (will be used to guide structure-based alignments)?
-                    representative = False
-                    if 'representative' in sd and sd['representative']:
-                        representative = True
-
-                    # only process representative structures on first iteration
-                    if not representative and iteration == 1:
-                        continue
-
-                    # skip representative structures on second iteration
-                    if representative and iteration == 2:
-                        continue
-
-                    # is there a construct?
-                    if 'construct' not in sd:
-                        self.logger.error('No construct specified, skipping!')
-                        continue
-
-                    self.logger.info('Reading file {}'.format(source_file_path))
-                    # print('{}'.format(sd['pdb']))
-                    # read the yaml file
-
-                    # does the construct exists?
-                    try:
-                        con = Protein.objects.get(entry_name=sd['construct'])
-                    except Protein.DoesNotExist:
-                        print('BIG ERROR Construct {} does not exists, skipping!'.format(sd['construct']))
-                        self.logger.error('Construct {} does not exists, skipping!'.format(sd['construct']))
-                        continue
-
-                    # create a structure record
-                    try:
-                        s = Structure.objects.get(protein_conformation__protein=con)
-
-                        # If update_flag is true then update existing structures
-                        # Otherwise only make new structures
-                        if not self.incremental_mode:
-                            self.purge_contact_network(s)
-                            s = s.delete()
-                            s = Structure()
-                        else:
-                            continue
-
-                    except Structure.DoesNotExist:
+                if ni is not None:
+                    facts.append(frequencies.interaction_fact(s, pair, ni))
+
+        # Denormalised copy of the interactions for the contact browser
+        InteractionFact.objects.bulk_create(facts)
+
+
+    def process_item(self, source_file, iteration):
+        source_file_path = os.sep.join([self.structure_data_dir, source_file])
+        # if source_file != "2RH1.yaml":
+        #     continue
+        if os.path.isfile(source_file_path) and source_file[0] != '.':
+            with open(source_file_path, 'r') as f:
+                sd = yaml.load(f)
+                # is this a representative structure (will be used to guide structure-based alignments)?
+                representative = False
+                if 'representative' in sd and sd['representative']:
+                    representative = True
+
+                # only process representative structures on first iteration
+                if not representative and iteration == 1:
+                    return
+
+                # skip representative structures on second iteration
+                if representative and iteration == 2:
+                    return
+
+                # is there a construct?
+                if 'construct' not in sd:
+                    self.logger.error('No construct specified, skipping!')
+                    return
+
+                self.logger.info('Reading file {}'.format(source_file_path))
+                # print('{}'.format(sd['pdb']))
+                # read the yaml file
+
+                # does the construct exists?
+                try:
+                    con = Protein.objects.get(entry_name=sd['construct'])
+                except Protein.DoesNotExist:
+                    print('BIG ERROR Construct {} does not exists, skipping!'.format(sd['construct']))
+                    self.logger.error('Construct {} does not exists, skipping!'.format(sd['construct']))
+                    return
+
+                # create a structure record
+                try:
+                    s = Structure.objects.get(protein_conformation__protein=con)
+
+                    # If update_flag is true then update existing structures
+                    # Otherwise only make new structures
+                    if not self.incremental_mode:
+                        self.purge_contact_network(s)
+                        s = s.delete()
                         s = Structure()
+                    else:
+                        return
+
+                except Structure.DoesNotExist:
+                    s = Structure()
                     
-                    s.representative = representative
+                s.representative = representative
+
+                # protein state
+                if 'state' not in sd:
+                    self.logger.warning('State not defined, using default state {}'.format(
+                        settings.DEFAULT_PROTEIN_STATE))
+                    state = settings.DEFAULT_STATE.title()
+                else:
+                    state = sd['state']
+                state_slug = slugify(state)
+                try:
+                    ps, created = ProteinState.objects.get_or_create(slug=state_slug, defaults={'name': state})
+                    if created:
+                        self.logger.info('Created protein state {}'.format(ps.name))
+                except IntegrityError:
+                    ps = ProteinState.objects.get(slug=state_slug)
+                s.state = ps
+
+                # xtal activation value aka Delta Distance (Å)
+                if 'distance' not in sd:
+                    self.logger.warning('Delta distance not defined, using default value {}'.format(None))
+                    distance = None
+                else:
+                    distance = sd['distance']
+                s.distance = distance
+
+                # protein conformation
+                try:
+                    s.protein_conformation = ProteinConformation.objects.get(protein=con)
+                except ProteinConformation.DoesNotExist:
+                    self.logger.error('Protein conformation for construct {} does not exists'.format(con))
+                    return
+                if s.protein_conformation.state is not state:
+                    ProteinConformation.objects.filter(protein=con).update(state=ps)
+
+                # get the PDB file and save to DB
+                sd['pdb'] = sd['pdb'].upper()
+                if not os.path.exists(self.pdb_data_dir):
+                    os.makedirs(self.pdb_data_dir)
+
+                pdb_path = os.sep.join([self.pdb_data_dir, sd['pdb'] + '.pdb'])
+                if not os.path.isfile(pdb_path):
+                    self.logger.info('Fetching PDB file {}'.format(sd['pdb']))
+                    url = 'http://www.rcsb.org/pdb/files/%s.pdb' % sd['pdb']
+                    pdbdata_raw = urlopen(url).read().decode('utf-8')
+                    with open(pdb_path, 'w') as f:
+                        f.write(pdbdata_raw)
+                else:
+                    with open(pdb_path, 'r') as pdb_file:
+                        pdbdata_raw = pdb_file.read()
+
+                pdbdata, created = PdbData.objects.get_or_create(pdb=pdbdata_raw)
+                s.pdb_data = pdbdata
+
+                # UPDATE HETSYN with its PDB reference instead + GRAB PUB DATE, PMID, DOI AND RESOLUTION
+                hetsyn = {}
+                hetsyn_reverse = {}
+                for line in pdbdata_raw.splitlines():
+                    if line.startswith('HETSYN'):
+                        m = re.match("HETSYN[\s]+([\w]{3})[\s]+(.+)",line) ### need to fix bad PDB formatting where col4 and col5 are put together for some reason -- usually seen when the id is +1000
+                        if (m):
+                            hetsyn[m.group(2).strip()] = m.group(1).upper()
+                            hetsyn_reverse[m.group(1)] = m.group(2).strip().upper()
+                    if line.startswith('HETNAM'):
+                        m = re.match("HETNAM[\s]+([\w]{3})[\s]+(.+)",line) ### need to fix bad PDB formatting where col4 and col5 are put together for some reason -- usually seen when the id is +1000
+                        if (m):
+                            hetsyn[m.group(2).strip()] = m.group(1).upper()
+                            hetsyn_reverse[m.group(1)] = m.group(2).strip().upper()
+                    if line.startswith('REVDAT   1'):
+                        sd['publication_date'] = line[13:22]
+                    if line.startswith('JRNL        PMID'):
+                        sd['pubmed_id'] = line[19:].strip()
+                    if line.startswith('JRNL        DOI'):
+                        sd['doi_id'] = line[19:].strip()
+
+                if len(hetsyn) == 0:
+                    self.logger.info("PDB file contained NO hetsyn")
+
+                with open(pdb_path,'r') as header:
+                    header_dict = parse_pdb_header(header)
+                sd['publication_date'] = header_dict['release_date']
+                sd['resolution'] = str(header_dict['resolution']).strip()
+                sd['structure_method'] = header_dict['structure_method']
+
+                # structure type
+                if 'structure_method' in sd and sd['structure_method']:
+                    structure_type = sd['structure_method'].capitalize()
+                    structure_type_slug = slugify(sd['structure_method'])
 
-                    # protein state
-                    if 'state' not in sd:
-                        self.logger.warning('State not defined, using default state {}'.format(
-                            settings.DEFAULT_PROTEIN_STATE))
-                        state = settings.DEFAULT_STATE.title()
-                    else:
-                        state = sd['state']
-                    state_slug = slugify(state)
                     try:
-                        ps, created = ProteinState.objects.get_or_create(slug=state_slug, defaults={'name': state})
+                        st, created = StructureType.objects.get_or_create(slug=structure_type_slug,
+                            defaults={'name': structure_type})
                         if created:
-                            self.logger.info('Created protein state {}'.format(ps.name))
+                            self.logger.info('Created structure type {}'.format(st))
                     except IntegrityError:
-                        ps = ProteinState.objects.get(slug=state_slug)
-                    s.state = ps
+                        st = StructureType.objects.get(slug=structure_type_slug)
+                    s.structure_type = st
+                else:
+                    self.logger.warning('No structure type specified in PDB file {}'.format(sd['pdb']))
 
-                    # xtal activation value aka Delta Distance (Å)
-                    if 'distance' not in sd:
-                        self.logger.warning('Delta distance not defined, using default value {}'.format(None))
-                        distance = None
+                matched = 0
+                if 'ligand' in sd and sd['ligand']:
+                    if isinstance(sd['ligand'], list):
+                        ligands = sd['ligand']
                     else:
-                        distance = sd['distance']
-                    s.distance = distance
-
-                    # protein conformation
+                        ligands = [sd['ligand']]
+                    for ligand in ligands:
+                        if 'name' in ligand:
+                            if ligand['name'].upper() in hetsyn:
+                                self.logger.info('Ligand {} matched to PDB records'.format(ligand['name']))
+                                matched = 1
+                                ligand['name'] = hetsyn[ligand['name'].upper()]
+                            elif ligand['name'].upper() in hetsyn_reverse:
+                                matched = 1
+
+                if matched==0 and len(hetsyn)>0:
+                    self.logger.info('No ligand names found in HET in structure {}'.format(sd['pdb']))
+
+                # REMOVE? can be used to dump structure files with updated ligands
+                # yaml.dump(sd, open(source_file_path, 'w'), indent=4)
+
+                # pdb code
+                if 'pdb' in sd:
                     try:
-                        s.protein_conformation = ProteinConformation.objects.get(protein=con)
-                    except ProteinConformation.DoesNotExist:
-                        self.logger.error('Protein conformation for construct {} does not exists'.format(con))
-                        continue
-                    if s.protein_conformation.state is not state:
-                        ProteinConformation.objects.filter(protein=con).update(state=ps)
-
-                    # get the PDB file and save to DB
-                    sd['pdb'] = sd['pdb'].upper()
-                    if not os.path.exists(self.pdb_data_dir):
-                        os.makedirs(self.pdb_data_dir)
-
-                    pdb_path = os.sep.join([self.pdb_data_dir, sd['pdb'] + '.pdb'])
-                    if not os.path.isfile(pdb_path):
-                        self.logger.info('Fetching PDB file {}'.format(sd['pdb']))
-                        url = 'http://www.rcsb.org/pdb/files/%s.pdb' % sd['pdb']
-                        pdbdata_raw = urlopen(url).read().decode('utf-8')
-                        with open(pdb_path, 'w') as f:
-                            f.write(pdbdata_raw)
-                    else:
-                        with open(pdb_path, 'r') as pdb_file:
-                            pdbdata_raw = pdb_file.read()
-
-                    pdbdata, created = PdbData.objects.get_or_create(pdb=pdbdata_raw)
-                    s.pdb_data = pdbdata
-
-                    # UPDATE HETSYN with its PDB reference instead + GRAB PUB DATE, PMID, DOI AND RESOLUTION
-                    hetsyn = {}
-                    hetsyn_reverse = {}
-                    for line in pdbdata_raw.splitlines():
-                        if line.startswith('HETSYN'):
-                            m = re.match("HETSYN[\s]+([\w]{3})[\s]+(.+)",line) ### need to fix bad PDB formatting where col4 and col5 are put together for some reason -- usually seen when the id is +1000
-                            if (m):
-                                hetsyn[m.group(2).strip()] = m.group(1).upper()
-                                hetsyn_reverse[m.group(1)] = m.group(2).strip().upper()
-                        if line.startswith('HETNAM'):
-                            m = re.match("HETNAM[\s]+([\w]{3})[\s]+(.+)",line) ### need to fix bad PDB formatting where col4 and col5 are put together for some reason -- usually seen when the id is +1000
-                            if (m):
-                                hetsyn[m.group(2).strip()] = m.group(1).upper()
-                                hetsyn_reverse[m.group(1)] = m.group(2).strip().upper()
-                        if line.startswith('REVDAT   1'):
-                            sd['publication_date'] = line[13:22]
-                        if line.startswith('JRNL        PMID'):
-                            sd['pubmed_id'] = line[19:].strip()
-                        if line.startswith('JRNL        DOI'):
-                            sd['doi_id'] = line[19:].strip()
-
-                    if len(hetsyn) == 0:
-                        self.logger.info("PDB file contained NO hetsyn")
-
-                    with open(pdb_path,'r') as header:
-                        header_dict = parse_pdb_header(header)
-                    sd['publication_date'] = header_dict['release_date']
-                    sd['resolution'] = str(header_dict['resolution']).strip()
-                    sd['structure_method'] = header_dict['structure_method']
-
-                    # structure type
-                    if 'structure_method' in sd and sd['structure_method']:
-                        structure_type = sd['structure_method'].capitalize()
-                        structure_type_slug = slugify(sd['structure_method'])
+                        web_resource = WebResource.objects.get(slug='pdb')
+                    except:
+                        # abort if pdb resource is not found
+                        raise Exception('PDB resource not found, aborting!')
+                    s.pdb_code, created = WebLink.objects.get_or_create(index=sd['pdb'],
+                        web_resource=web_resource)
+                else:
+                    self.logger.error('PDB code not specified for structure {}, skipping!'.format(sd['pdb']))
+                    return
 
-                        try:
-                            st, created = StructureType.objects.get_or_create(slug=structure_type_slug,
-                                defaults={'name': structure_type})
-                            if created:
-                                self.logger.info('Created structure type {}'.format(st))
-                        except IntegrityError:
-                            st = StructureType.objects.get(slug=structure_type_slug)
-                        s.structure_type = st
-                    else:
-                        self.logger.warning('No structure type specified in PDB file {}'.format(sd['pdb']))
+                # insert into plain text fields
+                if 'preferred_chain' in sd:
+                    s.preferred_chain = sd['preferred_chain']
+                else:
+                    self.logger.warning('Preferred chain not specified for structure {}'.format(sd['pdb']))
+                if 'resolution' in sd:
+                    s.resolution = float(sd['resolution'])
+                else:
+                    self.logger.warning('Resolution not specified for structure {}'.format(sd['pdb']))
+                if 'publication_date' in sd:
+                    s.publication_date = sd['publication_date']
+                else:
+                    self.logger.warning('Publication date not specified for structure {}'.format(sd['pdb']))
 
-                    matched = 0
-                    if 'ligand' in sd and sd['ligand']:
-                        if isinstance(sd['ligand'], list):
-                            ligands = sd['ligand']
-                        else:
-                            ligands = [sd['ligand']]
-                        for ligand in ligands:
-                            if 'name' in ligand:
-                                if ligand['name'].upper() in hetsyn:
-                                    self.logger.info('Ligand {} matched to PDB records'.format(ligand['name']))
-                                    matched = 1
-                                    ligand['name'] = hetsyn[ligand['name'].upper()]
-                                elif ligand['name'].upper() in hetsyn_reverse:
-                                    matched = 1
-
-                    if matched==0 and len(hetsyn)>0:
-                        self.logger.info('No ligand names found in HET in structure {}'.format(sd['pdb']))
-
-                    # REMOVE? can be used to dump structure files with updated ligands
-                    # yaml.dump(sd, open(source_file_path, 'w'), indent=4)
-
-                    # pdb code
-                    if 'pdb' in sd:
+                # publication
+                try:
+                    if 'doi_id' in sd:
                         try:
-                            web_resource = WebResource.objects.get(slug='pdb')
-                        except:
-                            # abort if pdb resource is not found
-                            raise Exception('PDB resource not found, aborting!')
-                        s.pdb_code, created = WebLink.objects.get_or_create(index=sd['pdb'],
-                            web_resource=web_resource)
-                    else:
-                        self.logger.error('PDB code not specified for structure {}, skipping!'.format(sd['pdb']))
-                        continue
-
-                    # insert into plain text fields
-                    if 'preferred_chain' in sd:
-                        s.preferred_chain = sd['preferred_chain']
-                    else:
-                        self.logger.warning('Preferred chain not specified for structure {}'.format(sd['pdb']))
-                    if 'resolution' in sd:
-                        s.resolution = float(sd['resolution'])
-                    else:
-                        self.logger.warning('Resolution not specified for structure {}'.format(sd['pdb']))
-                    if 'publication_date' in sd:
-                        s.publication_date = sd['publication_date']
-                    else:
-                        self.logger.warning('Publication date not specified for structure {}'.format(sd['pdb']))
-
-                    # publication
-                    try:
-                        if 'doi_id' in sd:
+                            s.publication = Publication.objects.get(web_link__index=sd['doi_id'])
+                        except Publication.DoesNotExist as e:
+                            p = Publication()
                             try:
-                                s.publication = Publication.objects.get(web_link__index=sd['doi_id'])
-                            except Publication.DoesNotExist as e:
-                                p = Publication()
-                                try:
-                                    p.web_link = WebLink.objects.get(index=sd['doi_id'], web_resource__slug='doi')
-                                except WebLink.DoesNotExist:
-                                    wl = WebLink.objects.create(index=sd['doi_id'],
-                                        web_resource = WebResource.objects.get(slug='doi'))
-                                    p.web_link = wl
-                                p.update_from_doi(doi=sd['doi_id'])
-                                p.save()
-                                s.publication = p
-                        elif 'pubmed_id' in sd:
+                                p.web_link = WebLink.objects.get(index=sd['doi_id'], web_resource__slug='doi')
+                            except WebLink.DoesNotExist:
+                                wl = WebLink.objects.create(index=sd['doi_id'],
+                                    web_resource = WebResource.objects.get(slug='doi'))
+                                p.web_link = wl
+                            p.update_from_doi(doi=sd['doi_id'])
+                            p.save()
+                            s.publication = p
+                    elif 'pubmed_id' in sd:
+                        try:
+                            s.publication = Publication.objects.get(web_link__index=sd['pubmed_id'])
+                        except Publication.DoesNotExist as e:
+                            p = Publication()
                             try:
-                                s.publication = Publication.objects.get(web_link__index=sd['pubmed_id'])
-                            except Publication.DoesNotExist as e:
-                                p = Publication()
-                                try:
-                                    p.web_link = WebLink.objects.get(index=sd['pubmed_id'],
-                                        web_resource__slug='pubmed')
-                                except WebLink.DoesNotExist:
-                                    wl = WebLink.objects.create(index=sd['pubmed_id'],
-                                        web_resource = WebResource.objects.get(slug='pubmed'))
-                                    p.web_link = wl
-                                p.update_from_pubmed_data(index=sd['pubmed_id'])
-                                p.save()
-                                s.publication = p
-                    except:
-                        self.logger.error('Error saving publication'.format(sd['pdb']))
-
-                    if source_file.split('.')[0] in self.xtal_seg_ends and not self.incremental_mode:
-                        s.annotated = True
-                    else:
-                        s.annotated = False
+                                p.web_link = WebLink.objects.get(index=sd['pubmed_id'],
+                                    web_resource__slug='pubmed')
+                            except WebLink.DoesNotExist:
+                                wl = WebLink.objects.create(index=sd['pubmed_id'],
+                                    web_resource = WebResource.objects.get(slug='pubmed'))
+                                p.web_link = wl
+                            p.update_from_pubmed_data(index=sd['pubmed_id'])
+                            p.save()
+                            s.publication = p
+                except:
+                    self.logger.error('Error saving publication'.format(sd['pdb']))
+
+                if source_file.split('.')[0] in self.xtal_seg_ends and not self.incremental_mode:
+                    s.annotated = True
+                else:
+                    s.annotated = False
 
-                    s.refined = False
+                s.refined = False
 
-                    # save structure before adding M2M relations
-                    s.save()
-                    # StructureLigandInteraction.objects.filter(structure=s).delete()
+                # save structure before adding M2M relations
+                s.save()
+                # StructureLigandInteraction.objects.filter(structure=s).delete()
 
-                    # endogenous ligand(s)
-                    default_ligand_type = 'Small molecule'
-                    if representative and 'endogenous_ligand' in sd and sd['endogenous_ligand']:
-                        if isinstance(sd['endogenous_ligand'], list):
-                            endogenous_ligands = sd['endogenous_ligand']
+                # endogenous ligand(s)
+                default_ligand_type = 'Small molecule'
+                if representative and 'endogenous_ligand' in sd and sd['endogenous_ligand']:
+                    if isinstance(sd['endogenous_ligand'], list):
+                        endogenous_ligands = sd['endogenous_ligand']
+                    else:
+                        endogenous_ligands = [sd['endogenous_ligand']]
+                    for endogenous_ligand in endogenous_ligands:
+                        if endogenous_ligand['type']:
+                            lt, created = LigandType.objects.get_or_create(slug=slugify(endogenous_ligand['type']),
+                                defaults={'name': endogenous_ligand['type']})
                         else:
-                            endogenous_ligands = [sd['endogenous_ligand']]
-                        for endogenous_ligand in endogenous_ligands:
-                            if endogenous_ligand['type']:
-                                lt, created = LigandType.objects.get_or_create(slug=slugify(endogenous_ligand['type']),
-                                    defaults={'name': endogenous_ligand['type']})
-                            else:
-                                lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
-                                    defaults={'name': default_ligand_type})
-                            ligand = Ligand()
+                            lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
+                                defaults={'name': default_ligand_type})
+                        ligand = Ligand()
 
-                            if 'iupharId' not in endogenous_ligand:
-                                endogenous_ligand['iupharId'] = 0
+                        if 'iupharId' not in endogenous_ligand:
+                            endogenous_ligand['iupharId'] = 0
 
-                            ligand = ligand.load_by_gtop_id(endogenous_ligand['name'], endogenous_ligand['iupharId'],
-                                lt)
-                            try:
-                                s.protein_conformation.protein.parent.endogenous_ligands.add(ligand)
-                            except IntegrityError:
-                                self.logger.info('Endogenous ligand for protein {}, already added. Skipping.'.format(
-                                    s.protein_conformation.protein.parent))
-
-                    # ligands
-                    peptide_chain = ""
-                    if 'ligand' in sd and sd['ligand'] and sd['ligand']!='None':
-                        if isinstance(sd['ligand'], list):
-                            ligands = sd['ligand']
-                        else:
-                            ligands = [sd['ligand']]
-                        for ligand in ligands:
-                            l = False
-                            peptide_chain = ""
-                            if 'chain' in ligand:
-                                peptide_chain = ligand['chain']
-                                # ligand['name'] = 'pep'
-                            if ligand['name'] and ligand['name'] != 'None': # some inserted as none.
-                                ligand['type'] = ligand['type'].lower()
-                                # use annoted ligand type or default type
-                                if ligand['type']:
-                                    lt, created = LigandType.objects.get_or_create(slug=slugify(ligand['type']),
-                                        defaults={'name': ligand['type']})
-                                else:
-                                    lt, created = LigandType.objects.get_or_create(
-                                        slug=slugify(default_ligand_type), defaults={'name': default_ligand_type})
-
-                                # set pdb reference for structure-ligand interaction
-                                if len(ligand['name'])>3 and ligand['type']=='peptide':
-                                    pdb_reference = 'pep'
-                                else:
-                                    pdb_reference = ligand['name']
+                        ligand = ligand.load_by_gtop_id(endogenous_ligand['name'], endogenous_ligand['iupharId'],
+                            lt)
+                        try:
+                            s.protein_conformation.protein.parent.endogenous_ligands.add(ligand)
+                        except IntegrityError:
+                            self.logger.info('Endogenous ligand for protein {}, already added. Skipping.'.format(
+                                s.protein_conformation.protein.parent))
+
+                # ligands
+                peptide_chain = ""
+                if 'ligand' in sd and sd['ligand'] and sd['ligand']!='None':
+                    if isinstance(sd['ligand'], list):
+                        ligands = sd['ligand']
+                    else:
+                        ligands = [sd['ligand']]
+                    for ligand in ligands:
+                        l = False
+                        peptide_chain = ""
+                        if 'chain' in ligand:
+                            peptide_chain = ligand['chain']
+                            # ligand['name'] = 'pep'
+                        if ligand['name'] and ligand['name'] != 'None': # some inserted as none.
+                            ligand['type'] = ligand['type'].lower()
+                            # use annoted ligand type or default type
+                            if ligand['type']:
+                                lt, created = LigandType.objects.get_or_create(slug=slugify(ligand['type']),
+                                    defaults={'name': ligand['type']})
+                            else:
+                                lt, created = LigandType.objects.get_or_create(
+                                    slug=slugify(default_ligand_type), defaults={'name': default_ligand_type})
 
-                                # use pubchem_id
-                                if 'pubchemId' in ligand and ligand['pubchemId'] and ligand['pubchemId'] != 'None':
-                                    # create ligand
-                                    l = Ligand()
+                            # set pdb reference for structure-ligand interaction
+                            if len(ligand['name'])>3 and ligand['type']=='peptide':
+                                pdb_reference = 'pep'
+                            else:
+                                pdb_reference = ligand['name']
 
+                            # use pubchem_id
+                            if 'pubchemId' in ligand and ligand['pubchemId'] and ligand['pubchemId'] != 'None':
+                                # create ligand
+                                l = Ligand()
 
-                                    # update ligand by pubchem id
-                                    ligand_title = False
-                                    if 'title' in ligand and ligand['title']:
-                                        ligand_title = ligand['title']
-                                    l = l.load_from_pubchem('cid', ligand['pubchemId'], lt, ligand_title)
 
+                                # update ligand by pubchem id
+                                ligand_title = False
+                                if 'title' in ligand and ligand['title']:
+                                    ligand_title = ligand['title']
+                                l = l.load_from_pubchem('cid', ligand['pubchemId'], lt, ligand_title)
 
-                                # if no pubchem id is specified, use name
-                                else:
-                                    # use ligand title, if specified
-                                    if 'title' in ligand and ligand['title']:
-                                        ligand['name'] = ligand['title']
-
-                                    # create empty properties
-                                    lp = LigandProperities.objects.create()
-                                    lp.ligand_type = lt
-                                    lp.save()
-                                    # create the ligand
-                                    try:
-                                        l, created = Ligand.objects.get_or_create(name=ligand['name'], canonical=True,
-                                            defaults={'properities': lp, 'ambigious_alias': False})
-                                        if created:
-                                            self.logger.info('Created ligand {}'.format(ligand['name']))
-                                        else:
-                                            pass
-                                    except IntegrityError:
-                                        l = Ligand.objects.get(name=ligand['name'], canonical=True)
 
-                                    # save ligand
-                                    l.save()
+                            # if no pubchem id is specified, use name
                             else:
-                                continue
-
-                            # structure-ligand interaction
-                            if l and ligand['role']:
-                                role_slug = slugify(ligand['role'])
+                                # use ligand title, if specified
+                                if 'title' in ligand and ligand['title']:
+                                    ligand['name'] = ligand['title']
+
+                                # create empty properties
+                                lp = LigandProperities.objects.create()
+                                lp.ligand_type = lt
+                                lp.save()
+                                # create the ligand
                                 try:
-                                    lr, created = LigandRole.objects.get_or_create(slug=role_slug,
-                                    defaults={'name': ligand['role']})
+                                    l, created = Ligand.objects.get_or_create(name=ligand['name'], canonical=True,
+                                        defaults={'properities': lp, 'ambigious_alias': False})
                                     if created:
-                                        self.logger.info('Created ligand role {}'.format(ligand['role']))
+                                        self.logger.info('Created ligand {}'.format(ligand['name']))
+                                    else:
+                                        pass
                                 except IntegrityError:
-                                    lr = LigandRole.objects.get(slug=role_slug)
-
-                                i, created = StructureLigandInteraction.objects.get_or_create(structure=s,
-                                    ligand=l, ligand_role=lr, annotated=True,
-                                    defaults={'pdb_reference': pdb_reference})
-                                if i.pdb_reference != pdb_reference:
-                                    i.pdb_reference = pdb_reference
-                                    i.save()
+                                    l = Ligand.objects.get(name=ligand['name'], canonical=True)
 
+                                # save ligand
+                                l.save()
+                        else:
+                            continue
 
-                    # structure segments
-                    if 'segments' in sd and sd['segments']:
-                        for segment, positions in sd['segments'].items():
-                            # fetch (create if needed) sequence segment
+                        # structure-ligand interaction
+                        if l and ligand['role']:
+                            role_slug = slugify(ligand['role'])
                             try:
-                                protein_segment = ProteinSegment.objects.get(slug=segment)
-                            except ProteinSegment.DoesNotExist:
-                                self.logger.error('Segment {} not found'.format(segment))
-                                continue
-
-                            struct_seg, created = StructureSegment.objects.update_or_create(structure=s,
-                                protein_segment=protein_segment, defaults={'start': positions[0], 'end': positions[1]})
-                    # all representive structures should have defined segments
-                    elif representative:
-                        self.logger.warning('Segments not defined for representative structure {}'.format(sd['pdb']))
+                                lr, created = LigandRole.objects.get_or_create(slug=role_slug,
+                                defaults={'name': ligand['role']})
+                                if created:
+                                    self.logger.info('Created ligand role {}'.format(ligand['role']))
+                            except IntegrityError:
+                                lr = LigandRole.objects.get(slug=role_slug)
 
-                    # structure segments for modeling
-                    if 'segments_in_structure' in sd and sd['segments_in_structure']:
-                        for segment, positions in sd['segments_in_structure'].items():
-                            # fetch (create if needed) sequence segment
-                            try:
-                                protein_segment = ProteinSegment.objects.get(slug=segment)
-                            except ProteinSegment.DoesNotExist:
-                                self.logger.error('Segment {} not found'.format(segment))
-                                continue
+                            i, created = StructureLigandInteraction.objects.get_or_create(structure=s,
+                                ligand=l, ligand_role=lr, annotated=True,
+                                defaults={'pdb_reference': pdb_reference})
+                            if i.pdb_reference != pdb_reference:
+                                i.pdb_reference = pdb_reference
+                                i.save()
 
-                            struct_seg_mod, created = StructureSegmentModeling.objects.update_or_create(structure=s,
-                                protein_segment=protein_segment, defaults={'start': positions[0], 'end': positions[1]})
 
-                    # structure coordinates
-                    if 'coordinates' in sd and sd['coordinates']:
-                        for segment, coordinates in sd['coordinates'].items():
-                            # fetch (create if needed) sequence segment
-                            try:
-                                protein_segment = ProteinSegment.objects.get(slug=segment)
-                            except ProteinSegment.DoesNotExist:
-                                self.logger.error('Segment {} not found'.format(segment))
-                                continue
+                # structure segments
+                if 'segments' in sd and sd['segments']:
+                    for segment, positions in sd['segments'].items():
+                        # fetch (create if needed) sequence segment
+                        try:
+                            protein_segment = ProteinSegment.objects.get(slug=segment)
+                        except ProteinSegment.DoesNotExist:
+                            self.logger.error('Segment {} not found'.format(segment))
+                            continue
 
-                            # fetch (create if needed) coordinates description
-                            try:
-                                description, created = StructureCoordinatesDescription.objects.get_or_create(
-                                    text=coordinates)
-                                if created:
-                                    self.logger.info('Created structure coordinate description {}'.format(coordinates))
-                            except IntegrityError:
-                                description = StructureCoordinatesDescription.objects.get(text=coordinates)
-
-                            sc = StructureCoordinates()
-                            sc.structure = s
-                            sc.protein_segment = protein_segment
-                            sc.description = description
-                            sc.save()
-
-                    # structure engineering
-                    if 'engineering' in sd and sd['engineering']:
-                        for segment, engineering in sd['engineering'].items():
-                            # fetch (create if needed) sequence segment
-                            try:
-                                protein_segment = ProteinSegment.objects.get(slug=segment)
-                            except ProteinSegment.DoesNotExist:
-                                self.logger.error('Segment {} not found'.format(segment))
-                                continue
+                        struct_seg, created = StructureSegment.objects.update_or_create(structure=s,
+                            protein_segment=protein_segment, defaults={'start': positions[0], 'end': positions[1]})
+                # all representive structures should have defined segments
+                elif representative:
+                    self.logger.warning('Segments not defined for representative structure {}'.format(sd['pdb']))
 
-                            # fetch (create if needed) engineering description
-                            try:
-                                description, created = StructureEngineeringDescription.objects.get_or_create(
-                                    text=engineering)
-                                if created:
-                                    self.logger.info('Created structure coordinate description {}'.format(engineering))
-                            except IntegrityError:
-                                description = StructureEngineeringDescription.objects.get(text=engineering)
-
-                            se = StructureEngineering()
-                            se.structure = s
-                            se.protein_segment = protein_segment
-                            se.description = description
-                            se.save()
-
-                    # protein anomalies
-                    anomaly_entry = self.xtal_anomalies[s.protein_conformation.protein.parent.entry_name]
-                    segment_codes = {'1':'TM1','12':'ICL1','2':'TM2','23':'ECL1','3':'TM3','34':'ICL2','4':'TM4','5':'TM5','6':'TM6','7':'TM7'}
-                    all_bulges, all_constrictions = OrderedDict(), OrderedDict()
-                    for key, val in anomaly_entry.items():
-                        if 'x' not in val:
+                # structure segments for modeling
+                if 'segments_in_structure' in sd and sd['segments_in_structure']:
+                    for segment, positions in sd['segments_in_structure'].items():
+                        # fetch (create if needed) sequence segment
+                        try:
+                            protein_segment = ProteinSegment.objects.get(slug=segment)
+                        except ProteinSegment.DoesNotExist:
+                            self.logger.error('Segment {} not found'.format(segment))
                             continue
-                        if key[0] not in segment_codes:
+
+                        struct_seg_mod, created = StructureSegmentModeling.objects.update_or_create(structure=s,
+                            protein_segment=protein_segment, defaults={'start': positions[0], 'end': positions[1]})
+
+                # structure coordinates
+                if 'coordinates' in sd and sd['coordinates']:
+                    for segment, coordinates in sd['coordinates'].items():
+                        # fetch (create if needed) sequence segment
+                        try:
+                            protein_segment = ProteinSegment.objects.get(slug=segment)
+                        except ProteinSegment.DoesNotExist:
+                            self.logger.error('Segment {} not found'.format(segment))
                             continue
-                        segment = segment_codes[key.split('x')[0]]
-                        if len(key.split('x')[1])==3:
-                            try:
-                                all_bulges[segment] = all_bulges[segment]+[val]
-                            except:
-                                all_bulges[segment] = [val]
-                        else:
-                            try:
-                                all_constrictions[segment] = all_constrictions[segment]+[val]
-                            except:
-                                all_constrictions[segment] = [val]
 
-                    scheme = s.protein_conformation.protein.residue_numbering_scheme
-                    if len(all_bulges)>0:
-                        pa_slug = 'bulge'
+                        # fetch (create if needed) coordinates description
                         try:
-                            pab, created = ProteinAnomalyType.objects.get_or_create(slug=pa_slug, defaults={
-                                'name': 'Bulge'})
+                            description, created = StructureCoordinatesDescription.objects.get_or_create(
+                                text=coordinates)
                             if created:
-                                self.logger.info('Created protein anomaly type {}'.format(pab))
+                                self.logger.info('Created structure coordinate description {}'.format(coordinates))
                         except IntegrityError:
-                            pab = ProteinAnomalyType.objects.get(slug=pa_slug)
-
-                        for segment, bulges in all_bulges.items():
-                            for bulge in bulges:
-                                try:
-                                    gn, created = ResidueGenericNumber.objects.get_or_create(label=bulge,
-                                        scheme=scheme, defaults={'protein_segment': ProteinSegment.objects.get(
-                                        slug=segment)})
-                                    if created:
-                                        self.logger.info('Created generic number {}'.format(gn))
-                                except IntegrityError:
-                                    gn =  ResidueGenericNumber.objects.get(label=bulge, scheme=scheme)
-
-                                try:
-                                    pa, created = ProteinAnomaly.objects.get_or_create(anomaly_type=pab,
-                                        generic_number=gn)
-                                    if created:
-                                        self.logger.info('Created protein anomaly {}'.format(pa))
-                                except IntegrityError:
-                                    pa, created = ProteinAnomaly.objects.get(anomaly_type=pab, generic_number=gn)
+                            description = StructureCoordinatesDescription.objects.get(text=coordinates)
+
+                        sc = StructureCoordinates()
+                        sc.structure = s
+                        sc.protein_segment = protein_segment
+                        sc.description = description
+                        sc.save()
+
+                # structure engineering
+                if 'engineering' in sd and sd['engineering']:
+                    for segment, engineering in sd['engineering'].items():
+                        # fetch (create if needed) sequence segment
+                        try:
+                            protein_segment = ProteinSegment.objects.get(slug=segment)
+                        except ProteinSegment.DoesNotExist:
+                            self.logger.error('Segment {} not found'.format(segment))
+                            continue
 
-                                s.protein_anomalies.add(pa)
-                    if len(all_constrictions)>0:
-                        pa_slug = 'constriction'
+                        # fetch (create if needed) engineering description
                         try:
-                            pac, created = ProteinAnomalyType.objects.get_or_create(slug=pa_slug, defaults={
-                                'name': 'Constriction'})
+                            description, created = StructureEngineeringDescription.objects.get_or_create(
+                                text=engineering)
                             if created:
-                                self.logger.info('Created protein anomaly type {}'.format(pac))
+                                self.logger.info('Created structure coordinate description {}'.format(engineering))
                         except IntegrityError:
-                            pac = ProteinAnomalyType.objects.get(slug=pa_slug)
+                            description = StructureEngineeringDescription.objects.get(text=engineering)
+
+                        se = StructureEngineering()
+                        se.structure = s
+                        se.protein_segment = protein_segment
+                        se.description = description
+                        se.save()
+
+                # protein anomalies
+                anomaly_entry = self.xtal_anomalies[s.protein_conformation.protein.parent.entry_name]
+                segment_codes = {'1':'TM1','12':'ICL1','2':'TM2','23':'ECL1','3':'TM3','34':'ICL2','4':'TM4','5':'TM5','6':'TM6','7':'TM7'}
+                all_bulges, all_constrictions = OrderedDict(), OrderedDict()
+                for key, val in anomaly_entry.items():
+                    if 'x' not in val:
+                        continue
+                    if key[0] not in segment_codes:
+                        continue
+                    segment = segment_codes[key.split('x')[0]]
+                    if len(key.split('x')[1])==3:
+                        try:
+                            all_bulges[segment] = all_bulges[segment]+[val]
+                        except:
+                            all_bulges[segment] = [val]
+                    else:
+                        try:
+                            all_constrictions[segment] = all_constrictions[segment]+[val]
+                        except:
+                            all_constrictions[segment] = [val]
 
-                        for segment, constrictions in all_constrictions.items():
-                            for constriction in constrictions:
-                                try:
-                                    gn, created = ResidueGenericNumber.objects.get_or_create(label=constriction,
-                                        scheme=scheme, defaults={'protein_segment': ProteinSegment.objects.get(
-                                        slug=segment)})
-                                    if created:
-                                        self.logger.info('Created generic number {}'.format(gn))
-                                except IntegrityError:
-                                    gn =  ResidueGenericNumber.objects.get(label=constriction, scheme=scheme)
+                scheme = s.protein_conformation.protein.residue_numbering_scheme
+                if len(all_bulges)>0:
+                    pa_slug = 'bulge'
+                    try:
+                        pab, created = ProteinAnomalyType.objects.get_or_create(slug=pa_slug, defaults={
+                            'name': 'Bulge'})
+                        if created:
+                            self.logger.info('Created protein anomaly type {}'.format(pab))
+                    except IntegrityError:
+                        pab = ProteinAnomalyType.objects.get(slug=pa_slug)
 
-                                try:
-                                    pa, created = ProteinAnomaly.objects.get_or_create(anomaly_type=pac,
-                                        generic_number=gn)
-                                    if created:
-                                        self.logger.info('Created protein anomaly {}'.format(pa))
-                                except IntegrityError:
-                                    pa, created = ProteinAnomaly.objects.get(anomaly_type=pac, generic_number=gn)
-
-                                s.protein_anomalies.add(pa)
-
-                    # stabilizing agents, FIXME - redesign this!
-                    # fusion proteins moved to constructs, use this for G-proteins and other agents?
-                    aux_proteins = []
-                    if 'signaling_protein' in sd and sd['signaling_protein'] and sd['signaling_protein'] != 'None':
-                        aux_proteins.append('signaling_protein')
-                    if 'auxiliary_protein' in sd and sd['auxiliary_protein'] and sd['auxiliary_protein'] != 'None':
-                        aux_proteins.append('auxiliary_protein')
-                    for index in aux_proteins:
-                        if isinstance(sd[index], list):
-                            aps = sd[index]
-                        else:
-                            aps = [sd[index]]
-                        for aux_protein in aps:
-                            aux_protein_slug = slugify(aux_protein)[:50]
+                    for segment, bulges in all_bulges.items():
+                        for bulge in bulges:
                             try:
-                                sa, created = StructureStabilizingAgent.objects.get_or_create(
-                                    slug=aux_protein_slug, defaults={'name': aux_protein})
+                                gn, created = ResidueGenericNumber.objects.get_or_create(label=bulge,
+                                    scheme=scheme, defaults={'protein_segment': ProteinSegment.objects.get(
+                                    slug=segment)})
+                                if created:
+                                    self.logger.info('Created generic number {}'.format(gn))
                             except IntegrityError:
-                                sa = StructureStabilizingAgent.objects.get(slug=aux_protein_slug)
-                            s.stabilizing_agents.add(sa)
+                                gn =  ResidueGenericNumber.objects.get(label=bulge, scheme=scheme)
 
-                    # save structure
-                    s.save()
+                            try:
+                                pa, created = ProteinAnomaly.objects.get_or_create(anomaly_type=pab,
+                                    generic_number=gn)
+                                if created:
+                                    self.logger.info('Created protein anomaly {}'.format(pa))
+                            except IntegrityError:
+                                pa, created = ProteinAnomaly.objects.get(anomaly_type=pab, generic_number=gn)
 
-                    #Delete previous interaction data to prevent errors.
-                    ResidueFragmentInteraction.objects.filter(structure_ligand_pair__structure=s).delete()
-                    #Remove previous Rotamers/Residues to prepare repopulate
-                    Fragment.objects.filter(structure=s).delete()
-                    Rotamer.objects.filter(structure=s).delete()
-                    Residue.objects.filter(protein_conformation=s.protein_conformation).delete()
+                            s.protein_anomalies.add(pa)
+                if len(all_constrictions)>0:
+                    pa_slug = 'constriction'
+                    try:
+                        pac, created = ProteinAnomalyType.objects.get_or_create(slug=pa_slug, defaults={
+                            'name': 'Constriction'})
+                        if created:
+                            self.logger.info('Created protein anomaly type {}'.format(pac))
+                    except IntegrityError:
+                        pac = ProteinAnomalyType.objects.get(slug=pa_slug)
 
-                    d = {}
+                    for segment, constrictions in all_constrictions.items():
+                        for constriction in constrictions:
+                            try:
+                                gn, created = ResidueGenericNumber.objects.get_or_create(label=constriction,
+                                    scheme=scheme, defaults={'protein_segment': ProteinSegment.objects.get(
+                                    slug=segment)})
+                                if created:
+                                    self.logger.info('Created generic number {}'.format(gn))
+                            except IntegrityError:
+                                gn =  ResidueGenericNumber.objects.get(label=constriction, scheme=scheme)
 
+                            try:
+                                pa, created = ProteinAnomaly.objects.get_or_create(anomaly_type=pac,
+                                    generic_number=gn)
+                                if created:
+                                    self.logger.info('Created protein anomaly {}'.format(pa))
+                            except IntegrityError:
+                                pa, created = ProteinAnomaly.objects.get(anomaly_type=pac, generic_number=gn)
+
+                            s.protein_anomalies.add(pa)
+
+                # stabilizing agents, FIXME - redesign this!
+                # fusion proteins moved to constructs, use this for G-proteins and other agents?
+                aux_proteins = []
+                if 'signaling_protein' in sd and sd['signaling_protein'] and sd['signaling_protein'] != 'None':
+                    aux_proteins.append('signaling_protein')
+                if 'auxiliary_protein' in sd and sd['auxiliary_protein'] and sd['auxiliary_protein'] != 'None':
+                    aux_proteins.append('auxiliary_protein')
+                for index in aux_proteins:
+                    if isinstance(sd[index], list):
+                        aps = sd[index]
+                    else:
+                        aps = [sd[index]]
+                    for aux_protein in aps:
+                        aux_protein_slug = slugify(aux_protein)[:50]
+                        try:
+                            sa, created = StructureStabilizingAgent.objects.get_or_create(
+                                slug=aux_protein_slug, defaults={'name': aux_protein})
+                        except IntegrityError:
+                            sa = StructureStabilizingAgent.objects.get(slug=aux_protein_slug)
+                        s.stabilizing_agents.add(sa)
+
+                # save structure
+                s.save()
+
+                #Delete previous interaction data to prevent errors.
+                ResidueFragmentInteraction.objects.filter(structure_ligand_pair__structure=s).delete()
+                #Remove previous Rotamers/Residues to prepare repopulate
+                Fragment.objects.filter(structure=s).delete()
+                Rotamer.objects.filter(structure=s).delete()
+                Residue.objects.filter(protein_conformation=s.protein_conformation).delete()
+
+                d = {}
+
+                try:
+                    current = time.time()
+                    #protein = Protein.objects.filter(entry_name=s.protein_conformation).get()
+                    d = fetch_pdb_info(sd['pdb'],con)
+                    #delete before adding new
+                    #Construct.objects.filter(name=d['construct_crystal']['pdb_name']).delete()
+                    # add_construct(d)
+                    end = time.time()
+                    diff = round(end - current,1)
+                    self.logger.info('construction calculations done for {}. {} seconds.'.format(
+                                s.protein_conformation.protein.entry_name, diff))
+                except Exception as msg:
+                    print(msg)
+                    print('ERROR WITH CONSTRUCT FETCH {}'.format(sd['pdb']))
+                    self.logger.error('ERROR WITH CONSTRUCT FETCH for {}'.format(sd['pdb']))
+
+                try:
+                    current = time.time()
+                    self.create_rotamers(s,pdb_path,d)
+                    end = time.time()
+                    diff = round(end - current,1)
+                    self.logger.info('Create resides/rotamers done for {}. {} seconds.'.format(
+                                s.protein_conformation.protein.entry_name, diff))
+                except Exception as msg:
+                    print(msg)
+                    print('ERROR WITH ROTAMERS {}'.format(sd['pdb']))
+                    self.logger.error('Error with rotamers for {}'.format(sd['pdb']))
+
+                try:
+                    s.protein_conformation.generate_sites()
+                except:
+                    pass
+
+                if self.run_contactnetwork:
                     try:
                         current = time.time()
-                        #protein = Protein.objects.filter(entry_name=s.protein_conformation).get()
-                        d = fetch_pdb_info(sd['pdb'],con)
-                        #delete before adding new
-                        #Construct.objects.filter(name=d['construct_crystal']['pdb_name']).delete()
-                        # add_construct(d)
+                        self.build_contact_network(s,sd['pdb'])
                         end = time.time()
                         diff = round(end - current,1)
-                        self.logger.info('construction calculations done for {}. {} seconds.'.format(
+                        self.logger.info('Create contactnetwork done for {}. {} seconds.'.format(
                                     s.protein_conformation.protein.entry_name, diff))
                     except Exception as msg:
                         print(msg)
-                        print('ERROR WITH CONSTRUCT FETCH {}'.format(sd['pdb']))
-                        self.logger.error('ERROR WITH CONSTRUCT FETCH for {}'.format(sd['pdb']))
+                        print('ERROR WITH CONTACTNETWORK {}'.format(sd['pdb']))
+                        self.logger.error('Error with contactnetwork for {}'.format(sd['pdb']))
 
                     try:
                         current = time.time()
-                        self.create_rotamers(s,pdb_path,d)
+                        results = runcalculation(sd['pdb'],peptide_chain)
+
+                        parsecalculation(sd['pdb'],False,results=results)
                         end = time.time()
                         diff = round(end - current,1)
-                        self.logger.info('Create resides/rotamers done for {}. {} seconds.'.format(
+                        self.logger.info('Interaction calculations done for {}. {} seconds.'.format(
                                     s.protein_conformation.protein.entry_name, diff))
                     except Exception as msg:
                         print(msg)
-                        print('ERROR WITH ROTAMERS {}'.format(sd['pdb']))
-                        self.logger.error('Error with rotamers for {}'.format(sd['pdb']))
-
-                    try:
-                        s.protein_conformation.generate_sites()
-                    except:
-                        pass
-
-                    if self.run_contactnetwork:
-                        try:
-                            current = time.time()
-                            self.build_contact_network(s,sd['pdb'])
-                            end = time.time()
-                            diff = round(end - current,1)
-                            self.logger.info('Create contactnetwork done for {}. {} seconds.'.format(
-                                        s.protein_conformation.protein.entry_name, diff))
-                        except Exception as msg:
-                            print(msg)
-                            print('ERROR WITH CONTACTNETWORK {}'.format(sd['pdb']))
-                            self.logger.error('Error with contactnetwork for {}'.format(sd['pdb']))
-
-                        try:
-                            current = time.time()
-                            mypath = '/tmp/interactions/results/' + sd['pdb'] + '/output'
-                            # if not os.path.isdir(mypath):
-                            #     #Only run calcs, if not already in temp
-                            runcalculation(sd['pdb'],peptide_chain)
-
-                            parsecalculation(sd['pdb'],False)
-                            end = time.time()
-                            diff = round(end - current,1)
-                            self.logger.info('Interaction calculations done for {}. {} seconds.'.format(
-                                        s.protein_conformation.protein.entry_name, diff))
-                        except Exception as msg:
-                            try:
-                                current = time.time()
-                                mypath = '/tmp/interactions/results/' + sd['pdb'] + '/output'
-                                # if not os.path.isdir(mypath):
-                                #     #Only run calcs, if not already in temp
-                                runcalculation(sd['pdb'],peptide_chain)
-
-                                parsecalculation(sd['pdb'],False)
-                                end = time.time()
-                                diff = round(end - current,1)
-                                self.logger.info('Interaction calculations done (again) for {}. {} seconds.'.format(
-                                            s.protein_conformation.protein.entry_name, diff))
-                            except Exception as msg:
-
-                                print(msg)
-                                print('ERROR WITH INTERACTIONS {}'.format(sd['pdb']))
-                                self.logger.error('Error parsing interactions output for {}'.format(sd['pdb']))
+                        print('ERROR WITH INTERACTIONS {}'.format(sd['pdb']))
+                        self.logger.error('Error parsing interactions output for {}'.format(sd['pdb']))
 
 
 
 
-                    # print('{} done'.format(sd['pdb']))
+                # print('{} done'.format(sd['pdb']))
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from common.alignment import Alignment
+from common.template_similarity import STORE_DIR, HELIX_SEGMENTS, COUNTS_DTYPE, template_family_slug, write_store
+from protein.models import Protein, ProteinSegment
+from structure.models import Structure
+
+from collections import OrderedDict
+import logging
+import numpy as np
+
+
+class Command(BaseCommand):
+    help = 'Precomputes the similarities of receptors to all template proteins for building homology models'
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path',
+            type=str,
+            action='store',
+            dest='path',
+            default=STORE_DIR,
+            help='Directory of the template similarity store')
+
+    def handle(self, *args, **options):
+        try:
+            self.logger.info('CREATING TEMPLATE SIMILARITY STORE')
+            self.build_store(options['path'])
+            self.logger.info('COMPLETED CREATING TEMPLATE SIMILARITY STORE')
+        except Exception as msg:
+            print(msg)
+            self.logger.error(msg)
+
+    def build_store(self, path):
+        # template proteins (parents of the structures usable as templates) per receptor class
+        templates = OrderedDict()
+        for s in Structure.objects.filter(annotated=True).exclude(refined=True).select_related(
+            'protein_conformation__protein__parent__family').order_by('protein_conformation__protein__parent__entry_name'):
+            parent = s.protein_conformation.protein.parent
+            templates.setdefault(parent.family.slug[:3], OrderedDict())[parent.entry_name] = parent
+
+        # receptors that homology models are built for (see build_homology_models), and receptors of structures
+        receptors = OrderedDict()
+        for r in Protein.objects.filter(parent__isnull=True, accession__isnull=False, species__common_name='Human').filter(
+            Q(family__slug__istartswith='001') | Q(family__slug__istartswith='002') |
+            Q(family__slug__istartswith='003') | Q(family__slug__istartswith='004') |
+            Q(family__slug__istartswith='005') | Q(family__slug__istartswith='006')).select_related('family').order_by(
+            'entry_name'):
+            receptors[r.entry_name] = r
+        for class_templates in templates.values():
+            for entry_name, p in class_templates.items():
+                receptors[entry_name] = p
+
+        receptor_names = list(receptors)
+        template_names = sorted(set([t for class_templates in templates.values() for t in class_templates]))
+        receptor_index = dict([(r, i) for i, r in enumerate(receptor_names)])
+        template_index = dict([(t, i) for i, t in enumerate(template_names)])
+        counts = np.zeros((len(receptor_names), len(template_names)), dtype=COUNTS_DTYPE)
+        counts['total'] = -1
+
+        # one alignment per template class, pairwise similarities do not depend on the other aligned proteins
+        segments = list(ProteinSegment.objects.filter(slug__in=HELIX_SEGMENTS))
+        for class_slug, class_templates in templates.items():
+            class_receptors = [r for r in receptors.values() if template_family_slug(r.family.slug)==class_slug]
+            if not class_receptors:
+                continue
+            self.logger.info('Calculating similarities of {} receptors to {} templates of class {}'.format(
+                len(class_receptors), len(class_templates), class_slug))
+
+            a = Alignment()
+            a.use_matrix_engine = True
+            a.load_proteins(class_receptors + list(class_templates.values()))
+            a.load_segments(segments)
+            if a.build_alignment() == 'Too large':
+                raise CommandError('Alignment of class {} is too large'.format(class_slug))
+            m = a.get_matrix()
+
+            rows = dict([(label, i) for i, label in reversed(list(enumerate(m.labels)))])
+            template_rows = [rows[t] for t in class_templates if t in rows]
+            template_columns = [template_index[m.labels[i]] for i in template_rows]
+            for r in class_receptors:
+                if r.entry_name not in rows:
+                    continue
+                total, identical, similar, score = m.similarity_to(rows[r.entry_name], rows=template_rows)
+                row = counts[receptor_index[r.entry_name]]
+                row['total'][template_columns] = total
+                row['identical'][template_columns] = identical
+                row['similar'][template_columns] = similar
+                row['score'][template_columns] = score
+
+        write_store(path, receptor_names, template_names, counts, HELIX_SEGMENTS)
+        self.logger.info('Stored similarities of {} receptors to {} templates in {}'.format(len(receptor_names),
+            len(template_names), path))
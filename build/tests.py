@@ -1,3 +1,118 @@
-from django.test import TestCase
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from build.management.commands import base_build, build_all
+
+from multiprocessing import Lock, Value
+from unittest import mock
+import json
+import os
+import queue
+import tempfile
+
+
+class BuildStepsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.steps = build_all.Command().get_steps({'proc': 1, 'test': False})
+
+    def test_order(self):
+        # every step is listed after the steps it depends on
+        built = set()
+        for name, command, step_args, step_options, dependencies in self.steps:
+            self.assertFalse(set(dependencies) - built, name)
+            built.add(name)
+
+    def test_ligand_steps(self):
+        # the ligand steps create ligands and may not run at the same time
+        dependencies = dict([(s[0], s[4]) for s in self.steps])
+        self.assertEqual(dependencies['build_ligand_assays'], ['build_ligands_from_cache'])
+        self.assertEqual(dependencies['build_mutant_data'], ['build_ligand_assays'])
+
+    def test_crystal_interactions(self):
+        # the interactions of new structures are added once the structures are built
+        steps = dict([(s[0], s) for s in self.steps])
+        name, command, step_args, step_options, dependencies = steps['build_crystal_interactions']
+        self.assertEqual(dependencies, ['build_structures'])
+        self.assertTrue(step_options['incremental'])
+        self.assertLess([s[0] for s in self.steps].index('build_structures'),
+            [s[0] for s in self.steps].index('build_crystal_interactions'))
+
+
+class ItemCommand(base_build.Command):
+    process_items = True
+
+    def __init__(self, failures=None):
+        super(ItemCommand, self).__init__()
+        self.options = {'retries': 1, 'task_report': False}
+        # number of times an item fails before it is processed
+        self.failures = failures or {}
+        self.processed = []
+
+    def process_item(self, item, iteration):
+        if self.failures.get(item):
+            self.failures[item] -= 1
+            raise ValueError('Failed {}'.format(item))
+        self.processed.append(item)
+
+    def run_item_workers(self, proc, items, indices, iteration):
+        # one worker in this process
+        results = queue.Queue()
+        self.item_worker(items, indices, iteration, 1, Value('i', 0), Lock(), results)
+        return [r for r in iter(results.get, None)]
+
+
+class ProcessItemsTestCase(SimpleTestCase):
+
+    def test_scheduler(self):
+        # commands with process_items set are run with the batch scheduler, the others with main_func
+        command = ItemCommand()
+        with mock.patch.object(command, 'schedule_items') as schedule_items:
+            command.prepare_input(2, ['2rh1', '3sn6'])
+            schedule_items.assert_called_once_with(2, ['2rh1', '3sn6'], 1)
+
+    def test_not_implemented(self):
+        command = base_build.Command()
+        command.process_items = True
+        with mock.patch.object(command, 'schedule_items') as schedule_items:
+            with self.assertRaises(CommandError):
+                command.prepare_input(2, ['2rh1', '3sn6'])
+            schedule_items.assert_not_called()
+
+    def test_batches(self):
+        # the batches claimed by a worker get smaller towards the end of the list
+        command = ItemCommand()
+        command.item_batch_size = 4
+        items = ['item{}'.format(i) for i in range(20)]
+        lock = mock.MagicMock()
+        results = queue.Queue()
+        command.item_worker(items, list(range(20)), 1, 2, Value('i', 0), lock, results)
+        self.assertEqual(command.processed, items)
+        self.assertEqual([r['index'] for r in iter(results.get, None)], list(range(20)))
+        # batches of 4, 4, 3, 2 and 7 of 1, then the claim of the finished list
+        self.assertEqual(lock.__enter__.call_count, 12)
+
+    def test_retry(self):
+        command = ItemCommand({'3sn6': 1, '4ldo': 2})
+        with self.assertLogs(command.logger):
+            command.prepare_input(2, ['2rh1', '3sn6', '4ldo'])
+        self.assertEqual(command.processed, ['2rh1', '3sn6'])
+        items = command.task_reports[-1]['items']
+        self.assertEqual([(r['item'], r['attempt'], bool(r['error'])) for r in items], [('2rh1', 1, False),
+            ('3sn6', 2, False), ('4ldo', 2, True)])
+
+    def test_task_report(self):
+        path = os.path.join(tempfile.mkdtemp(), 'report.json')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.remove, path)
+        command = ItemCommand({'3sn6': 2})
+        command.options['task_report'] = path
+        with self.assertLogs(command.logger) as logs:
+            command.prepare_input(2, ['2rh1', '3sn6'])
+        self.assertTrue([l for l in logs.output if 'Processed 2 items' in l and '1 retried, 1 failed' in l])
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report[0]['command'], 'tests')
+        self.assertEqual([r['item'] for r in report[0]['items']], ['2rh1', '3sn6'])
+        self.assertIn('ValueError', report[0]['items'][1]['error'])
+        self.assertTrue(all([r['seconds'] >= 0 for r in report[0]['items']]))
@@ -0,0 +1,5 @@
+from build.management.commands.build_alignment_rows import Command as BuildAlignmentRows
+
+
+class Command(BuildAlignmentRows):
+    pass
\ No newline at end of file
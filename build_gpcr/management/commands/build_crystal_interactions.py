@@ -0,0 +1,5 @@
+from build.management.commands.build_crystal_interactions import Command as BuildCrystalInteractions
+
+
+class Command(BuildCrystalInteractions):
+    pass
\ No newline at end of file
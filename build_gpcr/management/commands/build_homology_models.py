@@ -4,7 +4,7 @@ from django.db.models import Q
 from django.conf import settings
 
 from protein.models import Protein, ProteinConformation, ProteinAnomaly, ProteinState, ProteinSegment
-from residue.models import Residue
+from residue.models import Residue, ResidueGenericNumberEquivalent
 from residue.functions import dgn, ggn
 from structure.models import *
 from structure.functions import HSExposureCB, PdbStateIdentifier
@@ -726,7 +726,8 @@ class HomologyModeling(object):
             @param order_by: str, order results by identity, similarity or simscore
         '''
         alignment = AlignedReferenceTemplate()
-        alignment.run_hommod_alignment(self.reference_protein, segments, query_states, order_by, complex_model=self.complex, force_main_temp=self.force_main_temp)
+        alignment.run_hommod_alignment(self.reference_protein, segments, query_states, order_by, complex_model=self.complex, force_main_temp=self.force_main_temp,
+                                       similarity_only=not core_alignment)
         main_pdb_array = OrderedDict()
         if core_alignment==True:
             if self.debug:
@@ -4519,6 +4520,86 @@ class Constrictions(Bulges):
         return None
         
         
+class TemplateResidueIndex(object):
+    ''' Rotamers of a template structure, loaded with one query and indexed by generic number and residue number.
+        Indices are kept in an LRU, so that each template is only loaded once by a worker, for all models it builds.
+    '''
+    cache = OrderedDict()
+    cache_size = 64
+    # default generic numbers of the equivalent generic numbers, per numbering scheme
+    equivalents = {}
+
+    def __init__(self, structure):
+        self.preferred_chain = structure.preferred_chain
+        self.scheme_id = structure.protein_conformation.protein.residue_numbering_scheme_id
+        self.pdbs = OrderedDict()
+        self.by_sequence_number = OrderedDict()
+        self.by_display_gn = OrderedDict()
+        self.display_gns = {}
+        self.generic_to_display = {}
+        self.parsed = {}
+        rotamers = Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation,
+            structure__preferred_chain=structure.preferred_chain).values_list('pk', 'residue__sequence_number',
+            'residue__generic_number__label', 'residue__display_generic_number__label', 'pdbdata__pdb').order_by('pk')
+        for pk, sequence_number, generic_number, display_gn, pdb in rotamers:
+            self.pdbs[pk] = pdb
+            self.by_sequence_number.setdefault(sequence_number, []).append(pk)
+            self.display_gns[sequence_number] = display_gn
+            if display_gn:
+                self.by_display_gn.setdefault(display_gn, []).append(pk)
+                if generic_number:
+                    self.generic_to_display.setdefault(generic_number, display_gn)
+
+    @classmethod
+    def get(cls, structure):
+        key = (structure.protein_conformation_id, structure.preferred_chain)
+        if key in cls.cache:
+            cls.cache.move_to_end(key)
+        else:
+            cls.cache[key] = cls(structure)
+            while len(cls.cache) > cls.cache_size:
+                cls.cache.popitem(last=False)
+        return cls.cache[key]
+
+    def default_generic_number(self, gn):
+        ''' Same conversion as the first step of dgn
+        '''
+        if self.scheme_id not in self.equivalents:
+            self.equivalents[self.scheme_id] = dict(ResidueGenericNumberEquivalent.objects.filter(
+                scheme_id=self.scheme_id).values_list('label', 'default_generic_number__label'))
+        return self.equivalents[self.scheme_id].get(gn)
+
+    def select_rotamer(self, pks):
+        ''' Pick a rotamer like fetch_residues_from_pdb, returns None if there is no valid choice
+        '''
+        if not pks:
+            return None
+        if len(pks)>1:
+            for pk in pks:
+                pdb = self.pdbs[pk]
+                if pdb.startswith('COMPND')==False and pdb[21] in self.preferred_chain:
+                    return pk
+            return None
+        return pks[0]
+
+    def fetch(self, gn):
+        ''' Returns a copy of the parsed rotamer and the display generic number of its residue, or (None, None) if
+            the generic number or residue number is not in the index.
+        '''
+        if 'x' in str(gn):
+            display_gn = self.generic_to_display.get(self.default_generic_number(gn))
+            pk = self.select_rotamer(self.by_display_gn.get(display_gn))
+        else:
+            display_gn = self.display_gns.get(gn)
+            pk = self.select_rotamer(self.by_sequence_number.get(gn))
+        if pk is None:
+            return None, None
+        if pk not in self.parsed:
+            self.parsed[pk] = PDB.PDBParser(QUIET=True).get_structure('structure', StringIO(self.pdbs[pk]))[0]
+        # callers move the atoms, so every fetch gets its own copy
+        return deepcopy(self.parsed[pk]), display_gn
+
+
 class GPCRDBParsingPDB(object):
     ''' Class to manipulate cleaned pdb files of GPCRs.
     '''
@@ -4576,31 +4657,41 @@ class GPCRDBParsingPDB(object):
         '''
         output = OrderedDict()
         atoms_list = []
+        index = TemplateResidueIndex.get(structure)
         for gn in generic_numbers:
-            rotamer=None
-            if 'x' in str(gn):      
-                rotamer = list(Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation, 
-                        residue__display_generic_number__label=dgn(gn,structure.protein_conformation), 
-                        structure__preferred_chain=structure.preferred_chain))
-            else:
-                rotamer = list(Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation, 
-                        residue__sequence_number=gn, structure__preferred_chain=structure.preferred_chain))
-                if just_nums==False:
+            rota_struct, display_gn = index.fetch(gn)
+            if rota_struct is not None:
+                if 'x' not in str(gn) and just_nums==False:
                     try:
-                        gn = ggn(Residue.objects.get(protein_conformation=structure.protein_conformation,
-                                                    sequence_number=gn).display_generic_number.label)
+                        gn = ggn(display_gn)
                     except:
                         pass
-            if len(rotamer)>1:
-                for i in rotamer:
-                    if i.pdbdata.pdb.startswith('COMPND')==False:
-                        if i.pdbdata.pdb[21] in structure.preferred_chain:
-                            rotamer = i
-                            break
             else:
-                rotamer = rotamer[0]
-            io = StringIO(rotamer.pdbdata.pdb)
-            rota_struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
+                # not in the index, query the rotamer
+                rotamer=None
+                if 'x' in str(gn):      
+                    rotamer = list(Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation, 
+                            residue__display_generic_number__label=dgn(gn,structure.protein_conformation), 
+                            structure__preferred_chain=structure.preferred_chain))
+                else:
+                    rotamer = list(Rotamer.objects.filter(structure__protein_conformation=structure.protein_conformation, 
+                            residue__sequence_number=gn, structure__preferred_chain=structure.preferred_chain))
+                    if just_nums==False:
+                        try:
+                            gn = ggn(Residue.objects.get(protein_conformation=structure.protein_conformation,
+                                                        sequence_number=gn).display_generic_number.label)
+                        except:
+                            pass
+                if len(rotamer)>1:
+                    for i in rotamer:
+                        if i.pdbdata.pdb.startswith('COMPND')==False:
+                            if i.pdbdata.pdb[21] in structure.preferred_chain:
+                                rotamer = i
+                                break
+                else:
+                    rotamer = rotamer[0]
+                io = StringIO(rotamer.pdbdata.pdb)
+                rota_struct = PDB.PDBParser(QUIET=True).get_structure('structure', io)[0]
             for chain in rota_struct:
                 for residue in chain:
                     for atom in residue:
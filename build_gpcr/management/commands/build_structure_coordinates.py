@@ -0,0 +1,5 @@
+from build.management.commands.build_structure_coordinates import Command as BuildStructureCoordinates
+
+
+class Command(BuildStructureCoordinates):
+    pass
\ No newline at end of file
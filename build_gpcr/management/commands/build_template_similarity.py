@@ -0,0 +1,5 @@
+from build.management.commands.build_template_similarity import Command as BuildTemplateSimilarity
+
+
+class Command(BuildTemplateSimilarity):
+    pass
\ No newline at end of file
@@ -3,6 +3,9 @@ from django.conf import settings
 from alignment.functions import prepare_aa_group_preference
 from common.selection import Selection
 from common.definitions import *
+from common.alignment_matrix import AlignedResidue, AlignmentMatrix, MAX_RESIDUES, format_similarity
+from common.alignment_store import AlignmentRowStore
+from common.template_similarity import TemplateSimilarityStore
 from protein.models import Protein, ProteinConformation, ProteinState, ProteinSegment, ProteinFusionProtein, ProteinFamily
 from residue.models import Residue
 from residue.models import ResidueGenericNumber, ResidueGenericNumberEquivalent
@@ -52,6 +55,14 @@ class Alignment:
         self.normalized_scores = OrderedDict()
         self.zscales = OrderedDict()
 
+        # when true, residues are fetched as values instead of ORM objects and the alignment is encoded into a
+        # (proteins x positions) matrix that is used for statistics and similarity calculations
+        self.use_matrix_engine = False
+        self.matrix = None
+
+        # when true (and using the matrix engine), residues are read from the precomputed row store if available
+        self.use_row_store = True
+
         # refers to which ProteinConformation attribute to order by (identity, similarity or similarity score)
         self.order_by = 'similarity'
 
@@ -308,8 +319,14 @@ class Alignment:
                     'protein_conformation__state', 'protein_segment', 'generic_number__scheme',
                     'display_generic_number__scheme')
 
+        if self.use_matrix_engine:
+            rs = self.fetch_residue_records(rs)
+            residue_limit = MAX_RESIDUES
+        else:
+            residue_limit = 120000 #300 receptors, 400 residues limit
+
         self.number_of_residues_total = len(rs)
-        if self.number_of_residues_total>120000: #300 receptors, 400 residues limit
+        if self.number_of_residues_total>residue_limit:
             return "Too large"
 
         # create a dict of proteins, segments and residues
@@ -579,6 +596,51 @@ class Alignment:
         self.merge_generic_numbers()
         self.clear_empty_positions()
 
+        if self.use_matrix_engine:
+            self.matrix = AlignmentMatrix.from_alignment(self)
+
+    def fetch_residue_records(self, rs):
+        """Fetch the residues of a queryset as lightweight records instead of ORM objects"""
+        alternatives = not self.ignore_alternative_residue_numbering_schemes and len(self.numbering_schemes) > 1
+
+        # use the precomputed row store when it covers all proteins (no database access needed)
+        if self.use_row_store:
+            store = AlignmentRowStore.load()
+            if store and store.covers(self.proteins):
+                return store.fetch_residue_records(self.proteins, self.segments, self.segments_only_alignable,
+                    alternatives)
+
+        values = list(rs.prefetch_related(None).values_list('pk', 'protein_conformation_id', 'protein_segment_id',
+            'generic_number_id', 'display_generic_number_id', 'amino_acid', 'sequence_number'))
+
+        # related objects are shared between residues, so they are fetched once each
+        pconfs = dict([(pc.pk, pc) for pc in self.proteins])
+        segments = ProteinSegment.objects.in_bulk(set([v[2] for v in values]))
+        gn_ids = set([v[3] for v in values]) | set([v[4] for v in values])
+
+        alternative_gns = {}
+        if alternatives:
+            through = Residue.alternative_generic_numbers.through
+            for residue_id, gn_id in through.objects.filter(residue__in=rs.values('pk')).values_list('residue_id',
+                'residuegenericnumber_id'):
+                alternative_gns.setdefault(residue_id, []).append(gn_id)
+                gn_ids.add(gn_id)
+        gn_ids.discard(None)
+        gns = ResidueGenericNumber.objects.select_related('scheme').in_bulk(gn_ids)
+
+        records = []
+        for pk, pconf_id, segment_id, gn_id, dgn_id, amino_acid, sequence_number in values:
+            records.append(AlignedResidue(pconfs[pconf_id], segments.get(segment_id), gns.get(gn_id),
+                gns.get(dgn_id), amino_acid, sequence_number, [gns[x] for x in alternative_gns.get(pk, [])]))
+        return records
+
+    def get_matrix(self):
+        """Return the encoded alignment matrix, (re-)encoding it if the protein list has changed"""
+        if self.matrix is None or len(self.matrix) != len(self.proteins) or self.matrix.labels != [
+            pc.protein.entry_name for pc in self.proteins]:
+            self.matrix = AlignmentMatrix.from_alignment(self)
+        return self.matrix
+
     def clear_empty_positions(self):
         """Remove empty columns from the segments and matrix"""
         # segments
@@ -645,6 +707,10 @@ class Alignment:
 
     def calculate_statistics(self):
         """Calculate consesus sequence and amino acid and feature frequency"""
+        if self.use_matrix_engine:
+            self.calculate_statistics_matrix()
+            return
+
         feature_count = OrderedDict()
         most_freq_aa = OrderedDict()
         amino_acids = OrderedDict([(a, 0) for a in AMINO_ACIDS]) # from common.definitions
@@ -709,6 +775,45 @@ class Alignment:
                         for feature in AMINO_ACID_GROUPS_AA[amino_acid]:
                             feature_count[j][generic_number][feature] += self.aa_count[j][generic_number][amino_acid]
 
+        self.summarize_statistics(most_freq_aa, feature_count)
+
+    def calculate_statistics_matrix(self):
+        """Calculate consesus sequence and amino acid and feature frequency from the encoded alignment matrix"""
+        m = self.get_matrix()
+        aa_counts = m.aa_counts()
+        feature_counts = m.feature_counts(aa_counts)
+        observed = aa_counts.sum(axis=0) > 0
+        aa_list = list(AMINO_ACIDS.keys())
+        feature_list = list(AMINO_ACID_GROUPS.keys())
+        self.amino_acids = aa_list
+        self.features_combo = [(x, y['display_name_short'], y['length']) for x,y in zip(list(AMINO_ACID_GROUP_NAMES.values()), list(AMINO_ACID_GROUP_PROPERTIES.values()))]
+        self.features = list(AMINO_ACID_GROUP_NAMES.values())
+
+        feature_count = OrderedDict()
+        most_freq_aa = OrderedDict()
+        for segment in self.proteins[0].alignment:
+            columns = m.segments.get(segment, slice(0, 0))
+            self.aa_count[segment] = OrderedDict()
+            feature_count[segment] = OrderedDict()
+            most_freq_aa[segment] = OrderedDict()
+            for col in range(columns.start, columns.stop):
+                if not observed[col]:
+                    continue
+                generic_number = m.positions[col][1]
+                counts = aa_counts[:, col].tolist()
+                self.aa_count[segment][generic_number] = OrderedDict(zip(aa_list, counts))
+                self.aa_count_with_protein[generic_number] = m.column_members(col)
+                feature_count[segment][generic_number] = OrderedDict(zip(feature_list,
+                    feature_counts[:, col].tolist()))
+
+                max_count = max(counts)
+                most_freq_aa[segment][generic_number] = [[aa for aa, c in zip(aa_list, counts) if c == max_count],
+                    max_count]
+
+        self.summarize_statistics(most_freq_aa, feature_count)
+
+    def summarize_statistics(self, most_freq_aa, feature_count):
+        """Create the consensus sequences and frequency tables from per position amino acid and feature counts"""
         # merge the amino acid counts into a consensus sequence
         num_proteins = len(self.proteins)
         sequence_counter = 1
@@ -861,6 +966,11 @@ class Alignment:
 
     def calculate_similarity(self, normalized=False):
         """Calculate the sequence identity/similarity of every selected protein compared to a selected reference"""
+        if self.use_matrix_engine and not normalized:
+            self.calculate_similarity_vectorized()
+            self.order_by_similarity()
+            return
+
         for i, protein in enumerate(self.proteins):
             # skip the first row, as it is the reference
             if i == 0:
@@ -896,6 +1006,20 @@ class Alignment:
                 self.proteins[i].similarity_score = similarity_score
                 i+=1
 
+        self.order_by_similarity()
+
+    def calculate_similarity_vectorized(self):
+        """Calculate identity/similarity to the reference for all proteins at once using the alignment matrix"""
+        m = self.get_matrix()
+        total, identical, similar, score = m.similarity_to(0)
+        for i in range(1, len(self.proteins)):
+            calc_values = format_similarity(total[i], identical[i], similar[i], score[i])
+            self.proteins[i].identity = calc_values[0]
+            self.proteins[i].similarity = calc_values[1]
+            self.proteins[i].similarity_score = calc_values[2]
+
+    def order_by_similarity(self):
+        """Order the protein list (except the reference) by the attribute in self.order_by"""
         # order protein list by similarity score
         ref = self.proteins.pop(0)
         order_by_value = int(getattr(self.proteins[0], self.order_by))
@@ -903,8 +1027,10 @@ class Alignment:
             self.proteins.sort(key=lambda x: getattr(x, self.order_by), reverse=True)
         self.proteins.insert(0, ref)
 
-    def calculate_similarity_matrix(self):
-        """Calculate a matrix of sequence identity/similarity for every selected protein"""
+    def calculate_similarity_matrix(self, processes=1):
+        """Calculate a matrix of sequence identity/similarity for every selected protein
+
+        With the matrix engine all pairs are calculated at once, optionally split over a pool of processes"""
 
         # Init results matrix
         self.similarity_matrix = OrderedDict()
@@ -913,6 +1039,9 @@ class Alignment:
             protein_name = "[" + protein.protein.species.common_name + "] " + protein.protein.name
             self.similarity_matrix[protein_key] = {'name': protein_name, 'values': [None] * len(self.proteins)}
 
+        if self.use_matrix_engine:
+            total, identical, similar, score = self.get_matrix().similarity_matrices(processes=processes)
+
         # similarity comparisons
         for i, protein in enumerate(self.proteins):
             protein_key = protein.protein.entry_name
@@ -920,7 +1049,10 @@ class Alignment:
 
             for k in range(i+1, len(self.proteins)):
                 # calculate identity, similarity and similarity score to the reference
-                calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
+                if self.use_matrix_engine:
+                    calc_values = format_similarity(total[i][k], identical[i][k], similar[i][k], score[i][k])
+                else:
+                    calc_values = self.pairwise_similarity(self.proteins[i], self.proteins[k])
 
                 # Identity
                 value = calc_values[1].strip()
@@ -1135,7 +1267,10 @@ class AlignedReferenceTemplate(Alignment):
 
     def run_hommod_alignment(self, reference_protein, segments, query_states, order_by, provide_main_template_structure=None,
                              provide_similarity_table=None, main_pdb_array=None, provide_alignment=None, only_output_alignment=None,
-                             complex_model=False, force_main_temp=False):
+                             complex_model=False, force_main_temp=False, similarity_only=False):
+        ''' @param similarity_only: only the similarity table is needed, the alignment is not built if the
+            similarities are in the template similarity store.
+        '''
         self.logger = logging.getLogger('homology_modeling')
         self.segment_labels = segments
         self.complex = complex_model
@@ -1156,8 +1291,18 @@ class AlignedReferenceTemplate(Alignment):
             else:
                 self.load_proteins_by_structure()
             self.load_segments(ProteinSegment.objects.filter(slug__in=segments))
-            self.build_alignment()
-            self.calculate_similarity()
+            similarities = None
+            if only_output_alignment==None:
+                store = TemplateSimilarityStore.load()
+                if store:
+                    similarities = store.similarities(self.proteins[0].protein.entry_name,
+                                                      [p.protein.entry_name for p in self.proteins[1:]], segments)
+            if similarities==None or not similarity_only:
+                self.build_alignment()
+            if similarities==None:
+                self.calculate_similarity()
+            else:
+                self.load_similarities(similarities)
             self.reference_protein = self.proteins[0]
             self.main_template_protein = None
             self.ordered_proteins = []
@@ -1185,6 +1330,13 @@ class AlignedReferenceTemplate(Alignment):
             self.changes_on_db = []
             self.main_template_structure = self.get_main_template()
 
+    def load_similarities(self, similarities):
+        ''' Sets precomputed similarities of the template proteins to the reference, instead of calculate_similarity.
+        '''
+        for protein in self.proteins[1:]:
+            protein.identity, protein.similarity, protein.similarity_score = similarities[protein.protein.entry_name]
+        self.order_by_similarity()
+
     def local_pairwise_alignment(self, reference, template, segment):
         '''
         '''
@@ -1255,9 +1407,14 @@ class AlignedReferenceTemplate(Alignment):
         temp_list = []
         self.ordered_proteins = [self.proteins[0]]
         similarity_table = OrderedDict()
+        # structures grouped by protein, fetched in one query
+        structures = OrderedDict()
+        if hasattr(self, 'structures_data'):
+            for s in self.structures_data.select_related('pdb_code', 'protein_conformation__protein__parent'):
+                structures.setdefault(s.protein_conformation.protein.parent_id, []).append(s)
         for protein in self.proteins:
             try:
-                matches = self.structures_data.filter(protein_conformation__protein__parent=protein.protein)
+                matches = structures.get(protein.protein.id, [])
                 for m in matches:
                     if m.protein_conformation.protein.parent==self.reference_protein.protein and int(protein.similarity)==0:
                         continue
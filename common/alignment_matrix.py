@@ -0,0 +1,251 @@
+from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS
+
+from collections import OrderedDict
+from Bio.SubsMat import MatrixInfo
+from multiprocessing import Pool
+import numpy as np
+
+
+# residue codes used in the alignment matrix. The first part is identical to AMINO_ACIDS (including the gap), padding,
+# unknown residues and the other amino acids (pyrrolysine and selenocysteine) are appended at the end
+ALPHABET = list(AMINO_ACIDS.keys()) + ['_', 'X', 'O', 'U']
+AA_CODES = OrderedDict([(aa, i) for i, aa in enumerate(ALPHABET)])
+GAP = AA_CODES['-']
+PADDING = AA_CODES['_']
+UNKNOWN = AA_CODES['X']
+
+# number of codes that are counted in alignment statistics (padding is merged into gaps, other codes are skipped)
+NUM_COUNTED = len(AMINO_ACIDS)
+
+# residue limit for alignments built with the matrix engine (the ORM engine stops at 120000)
+MAX_RESIDUES = 1200000
+
+# byte -> residue code lookup, anything unrecognized is treated as an unknown residue
+BYTE_LOOKUP = np.full(256, UNKNOWN, dtype=np.uint8)
+for aa, code in AA_CODES.items():
+    BYTE_LOOKUP[ord(aa)] = code
+
+# feature membership of each residue code (features x codes)
+FEATURE_MATRIX = np.zeros((len(AMINO_ACID_GROUPS), len(ALPHABET)), dtype=np.int64)
+for i, members in enumerate(AMINO_ACID_GROUPS.values()):
+    for aa in members:
+        FEATURE_MATRIX[i][AA_CODES[aa]] = 1
+
+
+def substitution_table(matrix=MatrixInfo.blosum62):
+    """Convert a Biopython substitution matrix into a symmetric code x code lookup table"""
+    table = np.zeros((len(ALPHABET), len(ALPHABET)), dtype=np.int64)
+    for (aa1, aa2), score in matrix.items():
+        if aa1 in AA_CODES and aa2 in AA_CODES:
+            table[AA_CODES[aa1]][AA_CODES[aa2]] = score
+            table[AA_CODES[aa2]][AA_CODES[aa1]] = score
+    return table
+
+BLOSUM62 = substitution_table()
+
+
+def encode_sequence(sequence):
+    """Convert a string of one letter codes into an array of residue codes"""
+    return BYTE_LOOKUP[np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)]
+
+
+def format_percentage(value):
+    """Format a percentage the same way as Alignment.pairwise_similarity"""
+    return "{:10.0f}".format(value)
+
+
+def format_similarity(total, identical, similar, score):
+    """Format counts as the (identity, similarity, similarity score) tuple returned by
+    Alignment.pairwise_similarity"""
+    if total:
+        return (format_percentage(identical / total * 100), format_percentage(similar / total * 100), int(score))
+    else:
+        return format_percentage(-1), format_percentage(-1), 0
+
+
+def one_hot(matrix):
+    """One-hot encoding (rows x positions x codes) of the residues in an encoded matrix, gaps are all zero"""
+    rows, positions = matrix.shape
+    encoded = np.zeros((rows, positions, len(ALPHABET)), dtype=np.float32)
+    encoded[np.arange(rows)[:, None], np.arange(positions)[None, :], matrix] = 1
+    encoded[:, :, GAP] = 0
+    encoded[:, :, PADDING] = 0
+    return encoded
+
+
+def _similarity_block(chunk, encoded, tables):
+    """Sum of table lookups for every pair of a chunk of rows and all rows"""
+    flat = encoded.reshape(encoded.shape[0], -1)
+    sums = []
+    for table in tables:
+        if table is None:
+            projected = chunk
+        else:
+            projected = chunk.dot(table)
+        sums.append(projected.reshape(chunk.shape[0], -1).dot(flat.T))
+    return sums
+
+# shared state of similarity pool workers, set by the pool initializer
+_worker_data = {}
+
+def _init_similarity_worker(encoded, tables):
+    _worker_data['encoded'] = encoded
+    _worker_data['tables'] = tables
+
+def _similarity_chunk(bounds):
+    start, stop = bounds
+    encoded = _worker_data['encoded']
+    return start, _similarity_block(encoded[start:stop], encoded, _worker_data['tables'])
+
+
+def similarity_matrices(matrix, table=BLOSUM62, processes=1, chunk_size=200):
+    """All-vs-all (total, identical, similar, score) count matrices of an encoded alignment
+
+    Each pairwise value follows the rules of Alignment.pairwise_similarity (except that unknown residues are never
+    identical), but all pairs are computed with matrix products of the one-hot encoded alignment. Rows are processed in chunks of chunk_size, which are distributed over
+    a process pool when processes > 1."""
+    rows, positions = matrix.shape
+    gaps = ((matrix == GAP) | (matrix == PADDING)).astype(np.float32)
+    unknowns = (matrix == UNKNOWN).astype(np.float32)
+    encoded = one_hot(matrix)
+
+    # lookup tables for identity (None = identity matrix), positive substitution scores and the scores themselves
+    positive = table > 0
+    tables = [None, positive.astype(np.float32), np.where(positive, table, 0).astype(np.float32)]
+
+    sums = [np.zeros((rows, rows), dtype=np.float32) for t in tables]
+    chunks = [(start, min(start + chunk_size, rows)) for start in range(0, rows, chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with Pool(processes, initializer=_init_similarity_worker, initargs=(encoded, tables)) as pool:
+            results = pool.map(_similarity_chunk, chunks)
+    else:
+        results = [(start, _similarity_block(encoded[start:stop], encoded, tables)) for start, stop in chunks]
+    for start, block in results:
+        for i, values in enumerate(block):
+            sums[i][start:start + values.shape[0]] = values
+
+    # columns where both residues are gaps are not counted
+    total = positions - np.rint(gaps.dot(gaps.T))
+    # unknown residues (any unrecognized character) are not identical to each other
+    sums[0] -= unknowns.dot(unknowns.T)
+    identical, similar, score = [np.rint(x) for x in sums]
+    return total.astype(np.int64), identical.astype(np.int64), similar.astype(np.int64), score.astype(np.int64)
+
+
+class _RelatedList(list):
+    """List that mimics a related manager for code written against ORM objects"""
+    def all(self):
+        return self
+
+
+class AlignedResidue:
+    """A lightweight stand-in for residue.models.Residue, used when building matrix based alignments"""
+    __slots__ = ('protein_conformation', 'protein_segment', 'generic_number', 'display_generic_number',
+        'alternative_generic_numbers', 'amino_acid', 'sequence_number')
+
+    def __init__(self, protein_conformation, protein_segment, generic_number, display_generic_number, amino_acid,
+        sequence_number, alternative_generic_numbers=None):
+        self.protein_conformation = protein_conformation
+        self.protein_segment = protein_segment
+        self.generic_number = generic_number
+        self.display_generic_number = display_generic_number
+        self.amino_acid = amino_acid
+        self.sequence_number = sequence_number
+        self.alternative_generic_numbers = _RelatedList(alternative_generic_numbers or [])
+
+    def __str__(self):
+        return self.amino_acid + str(self.sequence_number)
+
+
+class AlignmentMatrix:
+    """A dense (proteins x aligned positions) matrix of residue codes with an index of the aligned positions"""
+    def __init__(self, labels, positions):
+        self.labels = list(labels) # one label (entry name) per row
+        self.positions = list(positions) # one (segment, position label) tuple per column
+        self.position_index = dict([(p, i) for i, p in enumerate(self.positions)])
+        self.segments = OrderedDict()
+        for i, (segment, position) in enumerate(self.positions):
+            if segment not in self.segments:
+                self.segments[segment] = [i, i]
+            self.segments[segment][1] = i + 1
+        self.segments = OrderedDict([(s, slice(*b)) for s, b in self.segments.items()])
+        self.matrix = np.full((len(self.labels), len(self.positions)), PADDING, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def from_alignment(cls, alignment):
+        """Encode the rows of a built Alignment"""
+        if not alignment.proteins:
+            return cls([], [])
+
+        positions = [(segment, p[0]) for segment, s in alignment.proteins[0].alignment.items() for p in s]
+        m = cls([pc.protein.entry_name for pc in alignment.proteins], positions)
+        for i, pc in enumerate(alignment.proteins):
+            row = encode_sequence(''.join([p[2] for s in pc.alignment.values() for p in s]))
+            if len(row) == len(positions):
+                m.matrix[i] = row
+        return m
+
+    def counts(self):
+        """Number of occurences of every residue code in every column (codes x positions)"""
+        num_codes = len(ALPHABET)
+        num_positions = len(self.positions)
+        if not num_positions:
+            return np.zeros((num_codes, 0), dtype=np.int64)
+        index = self.matrix.astype(np.int64) + num_codes * np.arange(num_positions)
+        return np.bincount(index.ravel(), minlength=num_codes * num_positions).reshape(num_positions,
+            num_codes).T
+
+    def aa_counts(self):
+        """Amino acid counts per column in AMINO_ACIDS order, with padding counted as gaps and unknowns ignored"""
+        counts = self.counts()
+        aa_counts = counts[:NUM_COUNTED].copy()
+        aa_counts[GAP] += counts[PADDING]
+        return aa_counts
+
+    def feature_counts(self, aa_counts=None):
+        """Feature counts per column in AMINO_ACID_GROUPS order"""
+        if aa_counts is None:
+            aa_counts = self.aa_counts()
+        return FEATURE_MATRIX[:, :NUM_COUNTED].dot(aa_counts)
+
+    def column_members(self, column):
+        """Labels of the rows per residue code in a column, in order of first occurrence"""
+        values = self.matrix[:, column]
+        values = np.where(values == PADDING, GAP, values)
+        codes, first = np.unique(values, return_index=True)
+        labels = np.array(self.labels, dtype=object)
+        members = OrderedDict()
+        for code in codes[np.argsort(first)]:
+            if code == UNKNOWN:
+                continue
+            members[ALPHABET[code]] = set(labels[values == code])
+        return members
+
+    def similarity_to(self, reference, rows=None, matrix=BLOSUM62):
+        """Identity, similarity and similarity score of rows compared to a reference row
+
+        Uses the same rules as Alignment.pairwise_similarity: columns where both residues are gaps are skipped,
+        similarity is the fraction of columns with a positive substitution score. Unknown residues are never
+        identical."""
+        ref = self.matrix[reference]
+        others = self.matrix if rows is None else self.matrix[rows]
+
+        ref_gap = (ref == GAP) | (ref == PADDING)
+        gaps = (others == GAP) | (others == PADDING)
+        counted = ~(gaps & ref_gap)
+        aligned = ~(gaps | ref_gap)
+
+        total = counted.sum(axis=1)
+        identical = ((others == ref) & ~gaps & (others != UNKNOWN)).sum(axis=1)
+        scores = np.where(aligned, matrix[others, ref], 0)
+        positive = scores > 0
+        similar = positive.sum(axis=1)
+        score = np.where(positive, scores, 0).sum(axis=1)
+        return total, identical, similar, score
+
+    def similarity_matrices(self, matrix=BLOSUM62, processes=1, chunk_size=200):
+        """All-vs-all identity/similarity counts, see similarity_matrices()"""
+        return similarity_matrices(self.matrix, matrix, processes, chunk_size)
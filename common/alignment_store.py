@@ -0,0 +1,195 @@
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+from common.alignment_matrix import AlignedResidue
+from protein.models import ProteinSegment
+from residue.models import Residue, ResidueGenericNumber, ResidueNumberingScheme
+
+import json
+import logging
+import os
+import shutil
+import time
+import numpy as np
+
+
+# location of the row store, written by the build_alignment_rows command
+STORE_DIR = getattr(settings, 'ALIGNMENT_ROW_STORE_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'alignment_rows']))
+
+# one record per residue, ordered by protein conformation and sequence number. Segments and generic numbers are
+# indices into the tables in index.json (-1 when not set)
+RESIDUE_DTYPE = np.dtype([
+    ('segment', np.int16),
+    ('generic_number', np.int32),
+    ('display_generic_number', np.int32),
+    ('amino_acid', 'S1'),
+    ('sequence_number', np.int16),
+])
+
+INDEX_FILE = 'index.json'
+RESIDUE_FILE = 'residues.npy'
+ALTERNATIVE_OFFSETS_FILE = 'alternative_offsets.npy'
+ALTERNATIVES_FILE = 'alternatives.npy'
+
+# seconds between checks whether the residues in the database still match the store
+STAMP_CHECK_INTERVAL = 60
+
+
+def current_stamp():
+    """Build stamp of the residues in the database, a list of the highest residue id, the number of residues and
+    alternative generic numbers, and checksums (sums) of their segments, generic numbers and sequence numbers
+
+    Added and removed residues change the id or count, residues updated in place (e.g. generic numbers assigned
+    again) change the checksums."""
+    stamp = Residue.objects.aggregate(Max('id'), Count('id'), Sum('protein_segment'), Sum('generic_number'),
+        Sum('display_generic_number'), Sum('sequence_number'))
+    alternatives = Residue.alternative_generic_numbers.through.objects.aggregate(Count('id'),
+        Sum('residuegenericnumber'))
+    return [stamp['id__max'], stamp['id__count'], stamp['protein_segment__sum'], stamp['generic_number__sum'],
+        stamp['display_generic_number__sum'], stamp['sequence_number__sum'], alternatives['id__count'],
+        alternatives['residuegenericnumber__sum']]
+
+
+def write_store(path, conformations, residues, alternative_offsets, alternatives, segments, generic_numbers,
+    schemes, stamp=None):
+    """Write a row store to a directory, replacing any existing store
+
+    @param conformations: dict of protein conformation id -> (entry name, state slug, first row, last row + 1)
+    @param residues: structured array of RESIDUE_DTYPE
+    @param alternative_offsets: array (number of residues + 1) of offsets into alternatives
+    @param alternatives: array of generic number indices (alternative generic numbers of each residue)
+    @param segments: list of segment field dicts (id, slug, name, category, fully_aligned, partial, proteinfamily)
+    @param generic_numbers: list of (id, label, scheme index, segment index) tuples
+    @param schemes: list of scheme field dicts (id, slug, short_name, name)
+    @param stamp: build stamp (see current_stamp) of the residues, read before fetching them
+    """
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    np.save(os.sep.join([tmp_path, RESIDUE_FILE]), residues)
+    np.save(os.sep.join([tmp_path, ALTERNATIVE_OFFSETS_FILE]), alternative_offsets)
+    np.save(os.sep.join([tmp_path, ALTERNATIVES_FILE]), alternatives)
+    index = {
+        'conformations': dict([(str(k), v) for k, v in conformations.items()]),
+        'segments': segments,
+        'generic_numbers': generic_numbers,
+        'schemes': schemes,
+        'stamp': stamp,
+    }
+    with open(os.sep.join([tmp_path, INDEX_FILE]), 'w') as f:
+        json.dump(index, f)
+
+    # swap in the new store
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class AlignmentRowStore:
+    """Read access to the precomputed per protein conformation residue rows
+
+    The residue arrays are memory mapped, so only the rows of the requested protein conformations are read."""
+    _instance = None
+    _instance_mtime = None
+
+    logger = logging.getLogger('protwis')
+
+    def __init__(self, path):
+        with open(os.sep.join([path, INDEX_FILE])) as f:
+            index = json.load(f)
+        self.conformations = dict([(int(k), v) for k, v in index['conformations'].items()])
+        self.stamp = index.get('stamp')
+        self._stamp_checked = None
+        self._current = False
+        self.residues = np.load(os.sep.join([path, RESIDUE_FILE]), mmap_mode='r')
+        self.alternative_offsets = np.load(os.sep.join([path, ALTERNATIVE_OFFSETS_FILE]), mmap_mode='r')
+        self.alternatives = np.load(os.sep.join([path, ALTERNATIVES_FILE]), mmap_mode='r')
+
+        # unsaved model instances, so that no database access is needed when building alignments
+        self.schemes = [ResidueNumberingScheme(**s) for s in index['schemes']]
+        self.segments = [ProteinSegment(**s) for s in index['segments']]
+        # segment slugs are only unique per protein family
+        self.segment_index = dict([((s.slug, s.proteinfamily), i) for i, s in enumerate(self.segments)])
+        self.generic_numbers = []
+        for gn_id, label, scheme, segment in index['generic_numbers']:
+            self.generic_numbers.append(ResidueGenericNumber(id=gn_id, label=label, scheme=self.schemes[scheme],
+                protein_segment=self.segments[segment] if segment >= 0 else None))
+
+    @classmethod
+    def load(cls, path=STORE_DIR):
+        """Return the store for this process, reloading it if it has been rebuilt. Returns None if there is no store"""
+        index_path = os.sep.join([path, INDEX_FILE])
+        try:
+            mtime = os.path.getmtime(index_path)
+        except OSError:
+            return None
+        if cls._instance is None or cls._instance_mtime != mtime:
+            try:
+                cls._instance = cls(path)
+                cls._instance_mtime = mtime
+            except Exception as msg:
+                cls.logger.error('Failed loading alignment row store: {}'.format(msg))
+                cls._instance = None
+        return cls._instance
+
+    def is_current(self):
+        """Check whether the residues in the database are those the store was built from, at most once per
+        STAMP_CHECK_INTERVAL seconds. Stores without a stamp are never current"""
+        now = time.time()
+        if self._stamp_checked is None or now - self._stamp_checked > STAMP_CHECK_INTERVAL:
+            self._current = self.stamp is not None and self.stamp == current_stamp()
+            self._stamp_checked = now
+            if not self._current:
+                self.logger.warning('Alignment row store is out of date, residues are read from the database')
+        return self._current
+
+    def covers(self, protein_conformations):
+        """Check whether the store is current and all protein conformations are in it"""
+        return self.is_current() and all([pc.pk in self.conformations for pc in protein_conformations])
+
+    def segment_indices(self, slugs):
+        """Indices of the segments with one of the slugs, in any protein family (like the residue query)"""
+        return np.array([i for (slug, family), i in self.segment_index.items() if slug in slugs], dtype=np.int16)
+
+    def fetch_residue_records(self, protein_conformations, segments, only_alignable=[], alternatives=False):
+        """Assemble residue records of protein conformations in a set of segments
+
+        Mirrors the residue query in Alignment.build_alignment, including the exclusion of residues without generic
+        numbers in segments flagged to only include alignable residues."""
+        wanted_segments = self.segment_indices(set(segments))
+        alignable_segments = self.segment_indices(set(only_alignable))
+
+        pconfs = []
+        rows = []
+        for pc in protein_conformations:
+            first, last = self.conformations[pc.pk][2:4]
+            rows.append(np.arange(first, last))
+            pconfs.append(np.full(last - first, len(pconfs), dtype=np.int32))
+        if not rows:
+            return []
+        rows = np.concatenate(rows)
+        pconfs = np.concatenate(pconfs)
+        residues = self.residues[rows]
+
+        keep = np.isin(residues['segment'], wanted_segments)
+        keep &= ~(np.isin(residues['segment'], alignable_segments) & (residues['generic_number'] < 0))
+
+        # residues are ordered by sequence number, like the Residue model
+        selected = np.nonzero(keep)[0]
+        selected = selected[np.argsort(residues['sequence_number'][selected], kind='stable')]
+
+        records = []
+        for i in selected.tolist():
+            r = residues[i]
+            alt_gns = []
+            if alternatives:
+                row = rows[i]
+                alt_gns = [self.generic_numbers[x] for x in
+                    self.alternatives[self.alternative_offsets[row]:self.alternative_offsets[row + 1]].tolist()]
+            records.append(AlignedResidue(protein_conformations[pconfs[i]], self.segments[r['segment']],
+                self.generic_numbers[r['generic_number']] if r['generic_number'] >= 0 else None,
+                self.generic_numbers[r['display_generic_number']] if r['display_generic_number'] >= 0 else None,
+                r['amino_acid'].decode('ascii'), int(r['sequence_number']), alt_gns))
+        return records
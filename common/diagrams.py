@@ -1,4 +1,6 @@
-﻿from math import cos, sin, tan, pi, sqrt, pow
+﻿from django.utils.safestring import mark_safe
+
+from math import cos, sin, tan, pi, sqrt, pow
 import string, time, math, random
 
 def uniqid(prefix='', more_entropy=False):
@@ -479,3 +481,30 @@ class Diagram:
             ori['y']*-2})
 
         return points
+
+
+
+class CachedDiagram(Diagram):
+    """Drawn content of a diagram, which can be stored and rendered again with other buttons
+
+    Drawing a diagram (residue positions, loop curves) only depends on the residues, so the content is drawn once and
+    only the colour panel is added when rendering."""
+    def __init__(self, diagram_type, receptor_id, content, sizex, sizey, nobuttons=None):
+        self.type = diagram_type
+        self.receptorId = receptor_id
+        self.content = content
+        self.sizex = sizex
+        self.sizey = sizey
+        self.nobuttons = nobuttons
+
+    @classmethod
+    def from_diagram(cls, diagram):
+        content, sizex, sizey = diagram.draw()
+        return cls(diagram.type, diagram.receptorId, content, sizex, sizey, diagram.nobuttons)
+
+    def render(self, nobuttons=None):
+        """Copy rendered with the given buttons"""
+        return CachedDiagram(self.type, self.receptorId, self.content, self.sizex, self.sizey, nobuttons)
+
+    def __str__(self):
+        return mark_safe(self.create(self.content, self.sizex, self.sizey, self.type, self.nobuttons))
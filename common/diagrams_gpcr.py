@@ -130,10 +130,14 @@ class DrawSnakePlot(Diagram):
         self.drawSnakePlotLoops()
         self.drawSnakePlotTerminals()
 
-    def __str__(self):
-
+    def draw(self):
+        """SVG content and size of the plot"""
         self.output_final = "<g id=snake transform='translate(0, " + str(-self.low+ self.offsetY) + ")'>" + self.traceoutput+self.output+self.helixoutput+self.drawToolTip() + "</g>"; #for resizing height
-        return mark_safe(self.create(self.output_final,self.maxX['right']+30,self.high-self.low+self.offsetY*2,"snakeplot", self.nobuttons))
+        return self.output_final, self.maxX['right']+30, self.high-self.low+self.offsetY*2
+
+    def __str__(self):
+        content, sizex, sizey = self.draw()
+        return mark_safe(self.create(content,sizex,sizey,"snakeplot", self.nobuttons))
 
     def drawSnakePlotHelix(self, helix_num):
         rs = self.segments['TM'+str(helix_num)]
@@ -941,8 +945,13 @@ class DrawHelixBox(Diagram):
                 print('failed helix',i,msg)
                 pass
 
+    def draw(self):
+        """SVG content and size of the plot"""
+        return self.output+self.drawToolTip(), 595, 430
+
     def __str__(self):
-        return mark_safe(self.create(self.output+self.drawToolTip(),595,430,"helixbox", self.nobuttons))
+        content, sizex, sizey = self.draw()
+        return mark_safe(self.create(content,sizex,sizey,"helixbox", self.nobuttons))
 
     def DrawHelix(self, startX,startY,residuelist,radius,direction,helixNum,helixTopResidue,rotation):
         sequence = {}
@@ -1,37 +1,258 @@
 from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+
+from collections import deque
+from logging.handlers import WatchedFileHandler
+import time,datetime,os,threading,logging
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# requests slower than this (seconds) are logged to stats_slow.log and kept in the slow request sample
+SLOW_REQUEST = 5
+
+# number of slow requests kept in the rolling sample
+SLOW_SAMPLE_SIZE = 100
+
+# seconds between flushes of the buffered requests
+FLUSH_INTERVAL = 5
+
+def percentile_from_histogram(buckets, counts, fraction):
+    """Estimate a percentile from cumulative bucket counts by linear interpolation within the bucket"""
+    total = counts[-1]
+    if not total:
+        return None
+    rank = fraction * total
+    lower = 0
+    previous = 0
+    for bound, count in zip(buckets, counts):
+        if count >= rank:
+            if bound == float('inf'):
+                # unbounded bucket, the lower bound is the best estimate
+                return lower
+            if count == previous:
+                return bound
+            return lower + (bound - lower) * (rank - previous) / (count - previous)
+        lower = bound
+        previous = count
+    return lower
+
+
+class ViewStats:
+    """Aggregated timings of one view"""
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.queries = 0
+        self.query_time = 0
+        self.response_bytes = 0
+        self.errors = 0
+
+    def add(self, r):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and r['time'] > LATENCY_BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total_time += r['time']
+        self.max_time = max(self.max_time, r['time'])
+        self.queries += r['queries']
+        self.query_time += r['query_time']
+        self.response_bytes += r['size']
+        if r['status'] >= 500:
+            self.errors += 1
+
+    def cumulative(self):
+        counts = []
+        total = 0
+        for c in self.buckets:
+            total += c
+            counts.append(total)
+        return counts
+
+    def as_dict(self):
+        cumulative = self.cumulative()
+        bounds = list(LATENCY_BUCKETS) + [float('inf')]
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'time_total': round(self.total_time, 4),
+            'time_mean': round(self.total_time / self.count, 4) if self.count else None,
+            'time_max': round(self.max_time, 4),
+            'time_p50': percentile_from_histogram(bounds, cumulative, 0.5),
+            'time_p95': percentile_from_histogram(bounds, cumulative, 0.95),
+            'queries_total': self.queries,
+            'queries_mean': round(self.queries / self.count, 2) if self.count else None,
+            'query_time_total': round(self.query_time, 4),
+            'response_bytes_total': self.response_bytes,
+            'latency_buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], cumulative)),
+        }
+
+
+class RequestStats:
+    """Buffered request metrics of this process
+
+    Requests are appended to an in-memory buffer, a background thread aggregates them per view and writes the log
+    files, so that no disk I/O happens in the request thread. All worker processes append to the same log files,
+    which are rotated externally (e.g. by logrotate), each process reopens a file once it has been moved."""
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.views = {}
+        self.slow_requests = deque(maxlen=SLOW_SAMPLE_SIZE)
+        self.started = time.time()
+        self.loggers = {}
+        self.thread = None
+
+    def get_logger(self, name):
+        if name not in self.loggers:
+            logger = logging.getLogger('protwis.stats.' + name)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            if not logger.handlers:
+                logger.addHandler(WatchedFileHandler(os.path.join(self.log_dir, name + '.log')))
+            self.loggers[name] = logger
+        return self.loggers[name]
+
+    def start(self):
+        """Start the flushing thread (once per process)"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='request-stats', daemon=True)
+            self.thread.start()
+
+    def record(self, **r):
+        # only appending happens in the request thread, everything else happens in the flushing thread
+        with self.lock:
+            self.buffer.append(r)
+        self.start()
+
+    def run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as msg:
+                logging.getLogger('protwis').error('Failed flushing request stats: {}'.format(msg))
+
+    def flush(self):
+        """Aggregate and log all buffered requests"""
+        with self.lock:
+            # swap in an empty buffer, requests recorded meanwhile are flushed next time
+            records = self.buffer
+            self.buffer = deque()
+            for r in records:
+                if r['kind'] == 'request':
+                    self.views.setdefault(r['view'], ViewStats()).add(r)
+                    if r['time'] > SLOW_REQUEST:
+                        self.slow_requests.append(r)
+
+        for r in records:
+            if r['kind'] == 'request':
+                line = '%s %s %s %s %s %s %s %s %s %s' % (r['date'], round(r['time'],2), r['ip'], r['method'], r['path'],
+                    r['view'], r['status'], r['queries'], round(r['query_time'],2), r['size'])
+                self.get_logger('stats').info(line)
+                if r['time'] > SLOW_REQUEST:
+                    # If slower than 5 seconds
+                    self.get_logger('stats_slow').info(line)
+            else:
+                self.get_logger('errors').info('%s %s %s %s "%s"' % (r['date'], r['ip'], r['method'], r['path'],
+                    r['exception']))
+
+    def snapshot(self):
+        """Aggregated metrics per view and the slow request sample"""
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'since': datetime.datetime.utcfromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S"),
+                'buffered': len(self.buffer),
+                'views': dict([(name, s.as_dict()) for name, s in self.views.items()]),
+                'slow_requests': list(self.slow_requests),
+            }
+
+    def prometheus(self):
+        """Aggregated metrics per view in the Prometheus text exposition format"""
+        lines = [
+            '# HELP protwis_request_duration_seconds Request latency per view',
+            '# TYPE protwis_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            views = sorted(self.views.items())
+            for name, s in views:
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                for bound, count in zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], s.cumulative()):
+                    lines.append('protwis_request_duration_seconds_bucket{view="%s",le="%s"} %d' % (label, bound,
+                        count))
+                lines.append('protwis_request_duration_seconds_sum{view="%s"} %f' % (label, s.total_time))
+                lines.append('protwis_request_duration_seconds_count{view="%s"} %d' % (label, s.count))
+            for metric, attribute, kind, description in (
+                ('protwis_request_queries_total', 'queries', 'counter', 'Database queries per view'),
+                ('protwis_request_query_seconds_total', 'query_time', 'counter', 'Database query time per view'),
+                ('protwis_response_bytes_total', 'response_bytes', 'counter', 'Response size per view'),
+                ('protwis_request_errors_total', 'errors', 'counter', 'Server errors per view')):
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s %s' % (metric, kind))
+                for name, s in views:
+                    label = name.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append('%s{view="%s"} %s' % (metric, label, getattr(s, attribute)))
+        return '\n'.join(lines) + '\n'
+
+
+request_stats = RequestStats(os.path.join(settings.BASE_DIR, "logs"))
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries and query time of a request"""
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.time() - start
 
-import time,datetime,os
 
 class StatsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
+        request_stats.start()
 
     def __call__(self, request):
         # Code to be executed for each request before
         # the view (and later middleware) are called.
         start_time = time.time()
+        queries = QueryCounter()
 
-        response = self.get_response(request)
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
 
         # Code to be executed for each request/response after
         # the view is called.
         total = time.time() - start_time
 
-        text_file = open(os.path.join(settings.BASE_DIR, "logs/stats.log"), "a")
-        text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total,2),request.META.get('REMOTE_ADDR'), request.method, request.path ))
-        text_file.close()
+        if response.streaming:
+            size = 0
+        else:
+            size = len(response.content)
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
 
-        if total>5:
-            # If slower than 5 seconds
-            text_file = open(os.path.join(settings.BASE_DIR, "logs/stats_slow.log"), "a")
-            text_file.write('%s %s %s %s %s\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), round(total,2),request.META.get('REMOTE_ADDR'), request.method, request.path ))
-            text_file.close()
+        request_stats.record(kind='request', date=datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            time=total, ip=request.META.get('REMOTE_ADDR'), method=request.method, path=request.path, view=view,
+            status=response.status_code, queries=queries.count, query_time=queries.time, size=size)
 
         return response
 
     def process_exception(self, request, exception):
-        text_file = open(os.path.join(settings.BASE_DIR, "logs/errors.log"), "a")
-        text_file.write('%s %s %s %s "%s"\n' % (datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),request.META.get('REMOTE_ADDR'), request.method, request.path,str(exception) ))
-        text_file.close()
-        return HttpResponse('Exception caught')
\ No newline at end of file
+        request_stats.record(kind='exception', date=datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            ip=request.META.get('REMOTE_ADDR'), method=request.method, path=request.path, exception=str(exception))
+        return HttpResponse('Exception caught')
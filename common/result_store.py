@@ -0,0 +1,104 @@
+from django.conf import settings
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import re
+import time
+import uuid
+import zipfile
+import numpy as np
+
+
+# location of the stored analysis results, referenced by id from the session
+STORE_DIR = getattr(settings, 'RESULT_STORE_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'results']))
+
+# seconds a result is kept after it was last written, by default as long as the session
+RESULT_TIMEOUT = getattr(settings, 'RESULT_STORE_TIMEOUT', settings.SESSION_COOKIE_AGE)
+
+# bytes of compressed results kept on disk, the oldest results are removed first when exceeded
+MAX_STORE_SIZE = getattr(settings, 'RESULT_STORE_MAX_SIZE', 2 * 1024**3)
+
+RESULT_ID = re.compile('^[0-9a-f]{32}$')
+
+logger = logging.getLogger('protwis')
+
+
+# name of the array holding the JSON encoded values of a result
+META_KEY = 'meta'
+
+
+def result_path(kind, result_id):
+    return os.sep.join([STORE_DIR, '{}_{}.npz'.format(kind, result_id)])
+
+
+def save_result(kind, arrays, meta=None):
+    """Store the result of an analysis and return its id
+
+    Arrays (e.g. ids and scores, one entry per protein) are written as columns of a compressed npz file, the other
+    values (labels, generic numbers) as JSON. Neither is pickled, model instances have to be replaced by their ids."""
+    if META_KEY in arrays:
+        raise ValueError('{} is reserved for the JSON values of a result'.format(META_KEY))
+    arrays = dict([(name, np.asarray(array)) for name, array in arrays.items()])
+    for name, array in arrays.items():
+        if array.dtype.hasobject:
+            raise ValueError('Array {} of a {} result holds objects'.format(name, kind))
+    arrays[META_KEY] = np.array(json.dumps(meta or {}))
+
+    result_id = uuid.uuid4().hex
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = result_path(kind, result_id)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+    evict_results()
+    return result_id
+
+
+def load_result(kind, result_id):
+    """Return the arrays and the JSON values of a stored result, None if the id is unknown or the result has
+    expired"""
+    if not isinstance(result_id, str) or not RESULT_ID.match(result_id):
+        return None
+    path = result_path(kind, result_id)
+    try:
+        if time.time() - os.path.getmtime(path) > RESULT_TIMEOUT:
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            arrays = dict([(name, data[name]) for name in data.files])
+        meta = json.loads(str(arrays.pop(META_KEY)), object_pairs_hook=OrderedDict)
+        return arrays, meta
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as msg:
+        logger.error('Failed reading result {}: {}'.format(path, msg))
+        return None
+
+
+def evict_results():
+    """Remove expired results, then the oldest results until the store is below its size limit"""
+    try:
+        entries = [e for e in os.scandir(STORE_DIR) if e.is_file() and e.name.endswith('.npz')]
+    except FileNotFoundError:
+        return
+
+    now = time.time()
+    results = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        results.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum([r[1] for r in results])
+    for mtime, size, path in sorted(results):
+        if now - mtime <= RESULT_TIMEOUT and total_size <= MAX_STORE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
@@ -0,0 +1,114 @@
+from django.conf import settings
+
+from common.alignment_matrix import format_similarity
+
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+
+# location of the similarity store, written by the build_template_similarity command
+STORE_DIR = getattr(settings, 'TEMPLATE_SIMILARITY_DIR', os.sep.join([settings.BUILD_CACHE_DIR,
+    'template_similarity']))
+
+# segments of the core alignment of homology models (HomologyModeling.run_alignment)
+HELIX_SEGMENTS = ['TM1','ICL1','TM2','ECL1','TM3','ICL2','TM4','TM5','TM6','TM7','H8']
+
+# one record per receptor and template protein, with the counts of AlignmentMatrix.similarity_to. Pairs that were not
+# computed have a total of -1
+COUNTS_DTYPE = np.dtype([
+    ('total', np.int32),
+    ('identical', np.int32),
+    ('similar', np.int32),
+    ('score', np.int32),
+])
+
+INDEX_FILE = 'index.json'
+COUNTS_FILE = 'counts.npy'
+
+
+def template_family_slug(family_slug):
+    """Slug of the receptor class used for templates of a receptor family, see
+    AlignedReferenceTemplate.load_proteins_by_structure"""
+    if family_slug.startswith('003'):
+        return '002'
+    elif family_slug.startswith('006'):
+        return '001'
+    return family_slug[:3]
+
+
+def write_store(path, receptors, templates, counts, segments):
+    """Write a similarity store to a directory, replacing any existing store
+
+    @param receptors: list of receptor entry names (rows of counts)
+    @param templates: list of template protein entry names (columns of counts)
+    @param counts: array (receptors x templates) of COUNTS_DTYPE
+    @param segments: list of segment slugs the similarities were calculated on
+    """
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    np.save(os.sep.join([tmp_path, COUNTS_FILE]), counts)
+    with open(os.sep.join([tmp_path, INDEX_FILE]), 'w') as f:
+        json.dump({'receptors': receptors, 'templates': templates, 'segments': segments}, f)
+
+    # swap in the new store
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class TemplateSimilarityStore:
+    """Read access to the precomputed receptor x template protein similarities
+
+    Similarities of a pair of proteins only depend on their residues in the aligned segments, so they are calculated
+    once per release instead of for every homology model."""
+    _instance = None
+    _instance_mtime = None
+
+    logger = logging.getLogger('protwis')
+
+    def __init__(self, path):
+        with open(os.sep.join([path, INDEX_FILE])) as f:
+            index = json.load(f)
+        self.receptors = dict([(r, i) for i, r in enumerate(index['receptors'])])
+        self.templates = dict([(t, i) for i, t in enumerate(index['templates'])])
+        self.segments = index['segments']
+        self.counts = np.load(os.sep.join([path, COUNTS_FILE]), mmap_mode='r')
+
+    @classmethod
+    def load(cls, path=STORE_DIR):
+        """Return the store for this process, reloading it if it has been rebuilt. Returns None if there is no store"""
+        index_path = os.sep.join([path, INDEX_FILE])
+        try:
+            mtime = os.path.getmtime(index_path)
+        except OSError:
+            return None
+        if cls._instance is None or cls._instance_mtime != mtime:
+            try:
+                cls._instance = cls(path)
+                cls._instance_mtime = mtime
+            except Exception as msg:
+                cls.logger.error('Failed loading template similarity store: {}'.format(msg))
+                cls._instance = None
+        return cls._instance
+
+    def similarities(self, reference, templates, segments):
+        """(identity, similarity, similarity score) of template proteins compared to a reference protein, formatted
+        like Alignment.pairwise_similarity. Returns None unless all pairs are in the store for these segments"""
+        if sorted(segments) != sorted(self.segments) or reference not in self.receptors:
+            return None
+        if any([t not in self.templates for t in templates]):
+            return None
+        row = self.counts[self.receptors[reference]]
+        values = {}
+        for t in templates:
+            c = row[self.templates[t]]
+            if c['total'] < 0:
+                return None
+            values[t] = format_similarity(int(c['total']), int(c['identical']), int(c['similar']), int(c['score']))
+        return values
@@ -1,3 +1,325 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from common import alignment_store, diagrams, result_store, template_similarity
+from common.alignment_matrix import AA_CODES, GAP, UNKNOWN, AlignmentMatrix, encode_sequence, format_similarity, \
+    similarity_matrices, substitution_table
+from common.alignment_store import AlignmentRowStore, RESIDUE_DTYPE, write_store
+from common.diagrams import CachedDiagram
+from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
+from common.middleware.stats import RequestStats, percentile_from_histogram
+from common.template_similarity import COUNTS_DTYPE, TemplateSimilarityStore
+
+from collections import namedtuple
+from itertools import count
+from types import SimpleNamespace
+from unittest import mock
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+
+Conformation = namedtuple('Conformation', ['pk'])
+
+# highest residue id, number of residues, segment, generic number, display generic number and sequence number sums,
+# number of alternative generic numbers and their sum
+STAMP = [5, 5, 6, 3, 3, 211, 1, 2]
+
+# a small substitution matrix, pairs that are not listed score 0
+TABLE = substitution_table({('A', 'A'): 4, ('S', 'S'): 4, ('W', 'W'): 11, ('A', 'S'): 1, ('A', 'W'): -3})
+
+
+def alignment_matrix(rows):
+    m = AlignmentMatrix(['row{}'.format(i) for i in range(len(rows))], [('TM1', '1x50'), ('TM1', '1x51'),
+        ('TM2', '2x50'), ('TM2', '2x51')])
+    for i, row in enumerate(rows):
+        m.matrix[i] = encode_sequence(row)
+    return m
+
+
+class AlignmentMatrixTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.m = alignment_matrix(['AS-W', 'SS-A', 'A--_'])
+
+    def test_encode_sequence(self):
+        self.assertEqual(encode_sequence('A-?').tolist(), [AA_CODES['A'], GAP, UNKNOWN])
+
+    def test_segments(self):
+        self.assertEqual(list(self.m.segments.items()), [('TM1', slice(0, 2)), ('TM2', slice(2, 4))])
+
+    def test_counts(self):
+        # padding is counted as a gap
+        aa_counts = self.m.aa_counts()
+        self.assertEqual(aa_counts[:, 3].sum(), 3)
+        self.assertEqual(aa_counts[GAP].tolist(), [0, 1, 3, 1])
+        self.assertEqual(aa_counts[AA_CODES['A']].tolist(), [2, 0, 0, 1])
+
+    def test_column_members(self):
+        self.assertEqual(list(self.m.column_members(0).items()), [('A', {'row0', 'row2'}), ('S', {'row1'})])
+        self.assertEqual(self.m.column_members(3)['-'], {'row2'})
+
+    def test_similarity_to(self):
+        # columns where both residues are gaps are skipped, similar residues have a positive score
+        total, identical, similar, score = self.m.similarity_to(0, matrix=TABLE)
+        self.assertEqual(total.tolist(), [3, 3, 3])
+        self.assertEqual(identical.tolist(), [3, 1, 1])
+        self.assertEqual(similar.tolist(), [3, 2, 1])
+        self.assertEqual(score.tolist(), [19, 5, 4])
+        self.assertEqual(format_similarity(3, 1, 2, 5), ('        33', '        67', 5))
+        self.assertEqual(format_similarity(0, 0, 0, 0), ('        -1', '        -1', 0))
+
+    def test_similarity_matrices(self):
+        # the all-vs-all matrices match the pairwise comparisons, with any chunk size
+        for chunk_size in [1, 2, 200]:
+            matrices = similarity_matrices(self.m.matrix, TABLE, chunk_size=chunk_size)
+            for row in range(len(self.m)):
+                for matrix, expected in zip(matrices, self.m.similarity_to(row, matrix=TABLE)):
+                    self.assertEqual(matrix[row].tolist(), expected.tolist())
+
+    def test_unknown_residues(self):
+        # the other amino acids and ambiguous residues have their own codes, unknown residues are never identical
+        self.assertEqual(len(set(encode_sequence('UOBZX?').tolist())), 5)
+        m = alignment_matrix(['UBXA', 'UB?A', 'CDXA'])
+        total, identical, similar, score = m.similarity_to(0, matrix=TABLE)
+        self.assertEqual(identical.tolist(), [3, 3, 1])
+        matrices = similarity_matrices(m.matrix, TABLE)
+        for row in range(len(m)):
+            for matrix, expected in zip(matrices, m.similarity_to(row, matrix=TABLE)):
+                self.assertEqual(matrix[row].tolist(), expected.tolist())
+
+
+class AlignmentRowStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        # TM1 exists in two protein families
+        segments = [
+            {'id': 1, 'slug': 'TM1', 'name': 'Transmembrane helix 1', 'category': 'helix', 'fully_aligned': True,
+                'partial': False, 'proteinfamily': 'GPCR'},
+            {'id': 2, 'slug': 'TM1', 'name': 'Transmembrane helix 1', 'category': 'helix', 'fully_aligned': True,
+                'partial': False, 'proteinfamily': 'Other'},
+            {'id': 3, 'slug': 'ICL1', 'name': 'Intracellular loop 1', 'category': 'loop', 'fully_aligned': False,
+                'partial': False, 'proteinfamily': 'GPCR'},
+        ]
+        schemes = [{'id': 1, 'parent_id': None, 'slug': 'gpcrdb', 'short_name': 'GPCRdb', 'name': 'GPCRdb'}]
+        generic_numbers = [(10, '1x50', 0, 0), (11, '1x51', 0, 0), (12, '1x50', 0, 1)]
+        residues = np.array([
+            (0, 1, 1, b'L', 51),
+            (0, 0, 0, b'N', 50),
+            (2, -1, -1, b'K', 60),
+            (1, 2, 2, b'A', 20),
+            (2, -1, -1, b'G', 30),
+        ], dtype=RESIDUE_DTYPE)
+        conformations = {1: ['adrb2_human', 'inactive', 0, 3], 2: ['other_human', 'inactive', 3, 5]}
+        alternative_offsets = np.array([0, 1, 1, 1, 1, 1])
+        alternatives = np.array([2], dtype=np.int32)
+        write_store(self.path, conformations, residues, alternative_offsets, alternatives, segments, generic_numbers,
+            schemes, stamp=STAMP)
+
+        patch = mock.patch.object(alignment_store, 'current_stamp', return_value=STAMP)
+        self.current_stamp = patch.start()
+        self.addCleanup(patch.stop)
+        self.store = AlignmentRowStore(self.path)
+
+    def test_segments_of_all_families(self):
+        records = self.store.fetch_residue_records([Conformation(1), Conformation(2)], ['TM1'])
+        self.assertEqual([(r.protein_conformation.pk, str(r)) for r in records], [(2, 'A20'), (1, 'N50'), (1, 'L51')])
+        self.assertEqual([r.protein_segment.proteinfamily for r in records], ['Other', 'GPCR', 'GPCR'])
+        self.assertEqual(records[1].generic_number.label, '1x50')
+
+    def test_only_alignable(self):
+        records = self.store.fetch_residue_records([Conformation(1)], ['TM1', 'ICL1'])
+        self.assertEqual([str(r) for r in records], ['N50', 'L51', 'K60'])
+        records = self.store.fetch_residue_records([Conformation(1)], ['TM1', 'ICL1'], only_alignable=['ICL1'])
+        self.assertEqual([str(r) for r in records], ['N50', 'L51'])
+
+    def test_alternatives(self):
+        records = self.store.fetch_residue_records([Conformation(1)], ['TM1'], alternatives=True)
+        self.assertEqual([len(r.alternative_generic_numbers.all()) for r in records], [0, 1])
+
+    def test_covers(self):
+        self.assertTrue(self.store.covers([Conformation(1), Conformation(2)]))
+        self.assertFalse(self.store.covers([Conformation(1), Conformation(3)]))
+
+    def test_out_of_date(self):
+        # generic numbers assigned again
+        self.current_stamp.return_value = STAMP[:3] + [6] + STAMP[4:]
+        store = AlignmentRowStore(self.path)
+        self.assertFalse(store.covers([Conformation(1)]))
+        # the stamp is checked once per interval
+        self.current_stamp.return_value = STAMP
+        self.assertFalse(store.covers([Conformation(1)]))
+        store._stamp_checked -= alignment_store.STAMP_CHECK_INTERVAL + 1
+        self.assertTrue(store.covers([Conformation(1)]))
+
+
+class TemplateSimilarityStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.path = os.sep.join([tempfile.mkdtemp(), 'template_similarity'])
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.path))
+        self.addCleanup(setattr, TemplateSimilarityStore, '_instance', None)
+        counts = np.array([[(4, 2, 3, 10), (-1, 0, 0, 0)]], dtype=COUNTS_DTYPE)
+        template_similarity.write_store(self.path, ['adrb2_human'], ['adrb1_human', 'opsd_bovin'], counts,
+            ['TM1', 'TM2'])
+
+    def test_similarities(self):
+        store = TemplateSimilarityStore.load(self.path)
+        self.assertEqual(store.similarities('adrb2_human', ['adrb1_human'], ['TM2', 'TM1']),
+            {'adrb1_human': ('        50', '        75', 10)})
+
+    def test_missing(self):
+        store = TemplateSimilarityStore.load(self.path)
+        # pairs that were not computed, other segments and unknown proteins are not in the store
+        self.assertIsNone(store.similarities('adrb2_human', ['adrb1_human', 'opsd_bovin'], ['TM1', 'TM2']))
+        self.assertIsNone(store.similarities('adrb2_human', ['adrb1_human'], ['TM1']))
+        self.assertIsNone(store.similarities('drd2_human', ['adrb1_human'], ['TM1', 'TM2']))
+        self.assertIsNone(TemplateSimilarityStore.load(self.path + '_missing'))
+
+
+def request_record(view, time, status=200):
+    return {'kind': 'request', 'date': '2020-01-01 00:00:00', 'time': time, 'ip': '127.0.0.1', 'method': 'GET',
+        'path': '/' + view, 'view': view, 'status': status, 'queries': 2, 'query_time': 0.01, 'size': 100}
+
+
+class RequestStatsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.stats = RequestStats(tempfile.gettempdir())
+        # no flushing thread and no log files
+        self.stats.start = mock.Mock()
+        self.stats.get_logger = mock.Mock()
+
+    def test_flush(self):
+        self.stats.record(**request_record('home', 0.2))
+        self.stats.record(**request_record('home', 6, status=500))
+        self.stats.record(**request_record('browse', 0.01))
+        self.stats.flush()
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot['buffered'], 0)
+        self.assertEqual(snapshot['views']['home']['count'], 2)
+        self.assertEqual(snapshot['views']['home']['errors'], 1)
+        self.assertEqual(snapshot['views']['browse']['queries_total'], 2)
+        self.assertEqual([r['path'] for r in snapshot['slow_requests']], ['/home'])
+        self.assertEqual([c[0][0] for c in self.stats.get_logger.call_args_list], ['stats', 'stats', 'stats_slow',
+            'stats'])
+
+    def test_record_during_flush(self):
+        # a request recorded while the buffered ones are aggregated goes to the new buffer
+        self.stats.record(**request_record('home', 0.2))
+        logger = self.stats.get_logger.return_value
+        logger.info.side_effect = lambda line: self.stats.record(**request_record('late', 0.2)) if (
+            '/home' in line) else None
+        self.stats.flush()
+        self.assertEqual(len(self.stats.buffer), 1)
+        self.assertEqual(list(self.stats.snapshot()['views']), ['home'])
+        self.stats.flush()
+        self.assertEqual(sorted(self.stats.snapshot()['views']), ['home', 'late'])
+
+    def test_rotated_log(self):
+        # a log file moved away by another process or logrotate is reopened
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        logger = RequestStats(log_dir).get_logger('stats_rotation')
+        for handler in logger.handlers:
+            self.addCleanup(logger.removeHandler, handler)
+            self.addCleanup(handler.close)
+        logger.info('first')
+        os.rename(os.path.join(log_dir, 'stats_rotation.log'), os.path.join(log_dir, 'stats_rotation.log.1'))
+        logger.info('second')
+        for handler in logger.handlers:
+            handler.flush()
+        with open(os.path.join(log_dir, 'stats_rotation.log.1')) as f:
+            self.assertEqual(f.read(), 'first\n')
+        with open(os.path.join(log_dir, 'stats_rotation.log')) as f:
+            self.assertEqual(f.read(), 'second\n')
+
+    def test_percentile(self):
+        bounds = [0.1, 0.5, float('inf')]
+        self.assertIsNone(percentile_from_histogram(bounds, [0, 0, 0], 0.5))
+        self.assertAlmostEqual(percentile_from_histogram(bounds, [2, 4, 4], 0.5), 0.1)
+        self.assertAlmostEqual(percentile_from_histogram(bounds, [2, 4, 4], 0.75), 0.3)
+        self.assertEqual(percentile_from_histogram(bounds, [2, 4, 8], 0.95), 0.5)
+
+
+class ResultStoreTestCase(SimpleTestCase):
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        patch = mock.patch.object(result_store, 'STORE_DIR', path)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_round_trip(self):
+        result_id = result_store.save_result('signature', {'ids': np.array([3, 1]), 'scores': np.eye(2)},
+            {'segments': {'TM1': ['1x50', '1x51'], 'TM2': []}})
+        arrays, meta = result_store.load_result('signature', result_id)
+        self.assertEqual(arrays['ids'].tolist(), [3, 1])
+        self.assertEqual(arrays['scores'].tolist(), [[1, 0], [0, 1]])
+        self.assertEqual(list(meta['segments'].items()), [('TM1', ['1x50', '1x51']), ('TM2', [])])
+        # results are stored per kind
+        self.assertIsNone(result_store.load_result('signature_match', result_id))
+
+    def test_objects(self):
+        # model instances and other objects would have to be pickled
+        with self.assertRaises(ValueError):
+            result_store.save_result('signature', {'proteins': np.array([object()])})
+
+    def test_unknown_ids(self):
+        self.assertIsNone(result_store.load_result('signature', None))
+        self.assertIsNone(result_store.load_result('signature', '../signature'))
+        self.assertIsNone(result_store.load_result('signature', '0' * 32))
+
+    def test_expired(self):
+        result_id = result_store.save_result('signature', {'ids': np.arange(3)})
+        path = result_store.result_path('signature', result_id)
+        mtime = time.time() - result_store.RESULT_TIMEOUT - 1
+        os.utime(path, (mtime, mtime))
+        self.assertIsNone(result_store.load_result('signature', result_id))
+        result_store.evict_results()
+        self.assertFalse(os.path.exists(path))
+
+    def test_size_limit(self):
+        first = result_store.save_result('signature', {'ids': np.arange(1000)})
+        os.utime(result_store.result_path('signature', first), (time.time() - 10, time.time() - 10))
+        with mock.patch.object(result_store, 'MAX_STORE_SIZE', os.path.getsize(result_store.result_path('signature',
+                first)) + 1):
+            second = result_store.save_result('signature', {'ids': np.arange(1000)})
+        # the oldest result is removed first
+        self.assertIsNone(result_store.load_result('signature', first))
+        self.assertIsNotNone(result_store.load_result('signature', second))
+
+
+def diagram_residues():
+    """Residues of a receptor with short helices and loops"""
+    residues = []
+    for segment, helix in [('N-term', None), ('TM1', 1), ('ICL1', None), ('TM2', 2), ('ECL1', None), ('TM3', 3),
+        ('ICL2', None), ('TM4', 4), ('ECL2', None), ('TM5', 5), ('ICL3', None), ('TM6', 6), ('ECL3', None),
+        ('TM7', 7), ('H8', 8), ('C-term', None)]:
+        for i in range(8 if helix else 3):
+            gn = SimpleNamespace(label='{}x{}'.format(helix, 45 + i)) if helix else None
+            residues.append(SimpleNamespace(protein_segment=SimpleNamespace(slug=segment), amino_acid='ACDEFGHI'[i],
+                sequence_number=len(residues) + 1, generic_number=gn, display_generic_number=gn))
+    return residues
+
+
+class CachedDiagramTestCase(SimpleTestCase):
+
+    def draw(self, diagram_class, nobuttons=None):
+        # the gradients of the helix box get time based ids
+        ids = count()
+        with mock.patch.object(diagrams, 'uniqid', side_effect=lambda: 'gradient{}'.format(next(ids))):
+            return diagram_class(diagram_residues(), 'Class A', 'adrb2_human', nobuttons=nobuttons)
+
+    def test_same_as_drawn(self):
+        # the content does not depend on the buttons, one drawing is rendered with and without them
+        for diagram_class in [DrawSnakePlot, DrawHelixBox]:
+            drawn = [self.draw(diagram_class), self.draw(diagram_class, 1)]
+            cached = CachedDiagram.from_diagram(drawn[1])
+            self.assertEqual(str(cached.render()), str(drawn[0]))
+            self.assertEqual(str(cached.render(1)), str(drawn[1]))
@@ -1627,3 +1627,19 @@ def ImportExcel(request, **response_kwargs):
     jsondata = json.dumps(o)
     response_kwargs['content_type'] = 'application/json'
     return HttpResponse(jsondata, **response_kwargs)
+
+def RequestStats(request):
+    """Request metrics of this server process as JSON, or in Prometheus text format with ?format=prometheus. Only
+    served to local and internal addresses"""
+    from common.middleware.stats import request_stats
+
+    internal_ips = getattr(settings, 'INTERNAL_IPS', ())
+    if isinstance(internal_ips, str):
+        internal_ips = (internal_ips,)
+    if request.META.get('REMOTE_ADDR') not in ('127.0.0.1', '::1') + tuple(internal_ips):
+        return HttpResponse('Forbidden', status=403)
+
+    request_stats.flush()
+    if request.GET.get('format') == 'prometheus':
+        return HttpResponse(request_stats.prometheus(), content_type='text/plain; version=0.0.4')
+    return HttpResponse(json.dumps(request_stats.snapshot()), content_type='application/json')
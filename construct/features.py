@@ -0,0 +1,92 @@
+from django.core.cache import cache
+from django.db.models import Max, Min
+
+from common.models import ReleaseNotes
+from construct.models import Construct
+from protein.models import Protein
+from residue.models import Residue
+
+
+# seconds to keep feature data, the keys include the release so that a new release invalidates them
+FEATURE_TIMEOUT = 60*60*24*30
+
+# segments and generic numbers whose positions the deletion reports of the construct tool are relative to
+BOUNDARY_SEGMENTS = ['TM1', 'TM3', 'TM4', 'TM5', 'TM6', 'C-term']
+BOUNDARY_GNS = ['3x50', '4x50', '5x50', '6x50']
+
+
+def release_version():
+    """Version of the loaded data, the date of the latest release"""
+    version = cache.get('CD_release_version')
+    if version is None:
+        version = str(ReleaseNotes.objects.aggregate(Max('date'))['date__max'])
+        cache.set('CD_release_version', version, 60*60)
+    return version
+
+
+def cached_feature(key, build):
+    """Return feature data from the cache of this release, or build and cache it"""
+    key = 'CD_features_{}_{}'.format(release_version(), key)
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, FEATURE_TIMEOUT)
+    return data
+
+
+def receptor_info(slug):
+    """Family slug and sequence of a receptor"""
+    return cached_feature('receptor_' + slug, lambda: Protein.objects.filter(entry_name=slug).values_list(
+        'family__slug', 'sequence').get())
+
+
+def receptor_residues(slug):
+    """(sequence number, amino acid, segment slug, generic number, display generic number) of the residues of a
+    receptor, ordered by sequence number"""
+    return cached_feature('residues_' + slug, lambda: list(Residue.objects.filter(
+        protein_conformation__protein__entry_name=slug).order_by('sequence_number').values_list('sequence_number',
+        'amino_acid', 'protein_segment__slug', 'generic_number__label', 'display_generic_number__label')))
+
+
+def construct_bounds():
+    """Segment start and end and the positions of reference generic numbers of all proteins with constructs
+
+    Returns a dict of entry name -> {'segments': {segment slug: (start, end)}, 'gns': {generic number: position}}"""
+    def build():
+        proteins = Construct.objects.values_list('protein', flat=True)
+        bounds = {}
+        # no default ordering, it would add sequence_number to the GROUP BY
+        segments = Residue.objects.order_by().filter(protein_conformation__protein__in=proteins,
+            protein_segment__slug__in=BOUNDARY_SEGMENTS).values_list('protein_conformation__protein__entry_name',
+            'protein_segment__slug').annotate(start=Min('sequence_number'), end=Max('sequence_number'))
+        for entry_name, segment, start, end in segments:
+            bounds.setdefault(entry_name, {'segments': {}, 'gns': {}})['segments'][segment] = (start, end)
+        gns = Residue.objects.filter(protein_conformation__protein__in=proteins,
+            generic_number__label__in=BOUNDARY_GNS).values_list('protein_conformation__protein__entry_name',
+            'generic_number__label', 'sequence_number')
+        for entry_name, gn, sequence_number in gns:
+            bounds.setdefault(entry_name, {'segments': {}, 'gns': {}})['gns'][gn] = sequence_number
+        return bounds
+    return cached_feature('construct_bounds', build)
+
+
+def construct_records():
+    """Receptor, structure, fusion and deletions of all constructs, as read by the deletion reports"""
+    def build():
+        records = []
+        cons = Construct.objects.all().prefetch_related('crystal', 'protein__family', 'deletions', 'structure__state',
+            'insertions__insert_type')
+        for c in cons:
+            fusion, f_results, linkers = c.fusion()
+            records.append({
+                'entry_name': c.protein.entry_name,
+                'family': c.protein.family.slug,
+                'pdb': c.crystal.pdb_code,
+                'state': c.structure.state.slug,
+                'fusion': str(fusion),
+                'f_protein': f_results[0][2] if fusion else '',
+                'deletions': [(d.start, d.end) for d in c.deletions.all()],
+            })
+        return records
+    return cached_feature('construct_records', build)
+
@@ -1,3 +1,108 @@
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory, SimpleTestCase
 
-# Create your tests here.
+from construct import features, tool
+
+from collections import OrderedDict
+from unittest import mock
+import json
+
+
+BOUNDS = {
+    'adrb2_human': {
+        'segments': {'TM1': (29, 60), 'TM5': (197, 229), 'TM6': (267, 298), 'C-term': (342, 413)},
+        'gns': {'5x50': 211, '6x50': 288},
+    },
+}
+
+RECORDS = [{
+    'entry_name': 'adrb2_human',
+    'family': '001_001_003_008',
+    'pdb': '2RH1',
+    'state': 'inactive',
+    'fusion': 'icl3',
+    'f_protein': 'T4L',
+    'deletions': [(1, 28), (231, 262), (366, 413)],
+}]
+
+
+class DeletionReportTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(tool, 'receptor_info', return_value=('001_001_003_008', '')),
+            mock.patch.object(tool, 'construct_bounds', return_value=BOUNDS),
+            mock.patch.object(tool, 'construct_records', return_value=RECORDS),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_nterm(self):
+        self.assertEqual(tool.nterm_data('adrb2_human')['Receptor'],
+            {'adrb2_human': {'2RH1': [1, 27, 0, 'inactive', 'icl3', 'T4L']}})
+
+    def test_icl3(self):
+        self.assertEqual(tool.icl3_data('adrb2_human')['Receptor'],
+            {'adrb2_human': {'2RH1': [19, 25, 'inactive', 'icl3', 'T4L']}})
+
+    def test_cterm(self):
+        self.assertEqual(tool.cterm_data('adrb2_human')['Receptor'],
+            {'adrb2_human': {'2RH1': [366, 413, 24, 'inactive', 'icl3', 'T4L']}})
+
+    def test_missing_segment(self):
+        # the receptor has no TM3/TM4 bounds, its deletions are left out
+        self.assertEqual(tool.icl2_data('adrb2_human')['Receptor'], {})
+
+
+class FeatureBundleTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(features, 'cache', LocMemCache('construct-tests', {})),
+            mock.patch.object(features, 'release_version', return_value='2020-01-01'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def get_response(self, parts, query='', slug='adrb2_human'):
+        request = RequestFactory().get('/construct/tool/json/bundle/{}/{}'.format(slug, query))
+        with mock.patch.object(tool, 'FEATURE_DATA', parts):
+            return tool.json_bundle(request, slug)
+
+    def get_bundle(self, parts, query=''):
+        return json.loads(self.get_response(parts, query).content.decode('utf-8'))
+
+    def test_parts(self):
+        parts = OrderedDict([('nterm', lambda slug: {'slug': slug}), ('cterm', lambda slug: [1, 2])])
+        self.assertEqual(self.get_bundle(parts), {'nterm': {'slug': 'adrb2_human'}, 'cterm': [1, 2]})
+        self.assertEqual(self.get_bundle(parts, '?parts=cterm,unknown'), {'cterm': [1, 2]})
+
+    def test_failing_part(self):
+        def failing(slug):
+            raise KeyError(slug)
+        parts = OrderedDict([('nterm', lambda slug: {'slug': slug}), ('cterm', failing)])
+        with self.assertLogs('protwis'):
+            response = self.get_response(parts)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'nterm': {'slug': 'adrb2_human'},
+            'cterm': {}})
+        # the response is not cached, and the failed part is built again
+        self.assertNotIn('Cache-Control', response)
+        parts['cterm'] = lambda slug: [1, 2]
+        response = self.get_response(parts)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['cterm'], [1, 2])
+        self.assertIn('max-age=86400', response['Cache-Control'])
+
+    def test_cached_parts(self):
+        nterm = mock.Mock(side_effect=lambda slug: {'slug': slug})
+        parts = OrderedDict([('nterm', nterm)])
+        self.get_bundle(parts)
+        self.get_bundle(parts, '?parts=nterm')
+        self.assertEqual(nterm.call_count, 1)
+        # per receptor and release
+        self.get_response(parts, slug='adrb1_human')
+        self.assertEqual(nterm.call_count, 2)
+        with mock.patch.object(features, 'release_version', return_value='2020-06-01'):
+            self.get_bundle(parts)
+        self.assertEqual(nterm.call_count, 3)
@@ -1,18 +1,22 @@
 from django.shortcuts import render
 from django.http import HttpResponse
-from django.db.models import Min, Count, Max
+from django.db.models import Count
 from django.conf import settings
+from django.utils.cache import patch_cache_control
 from django.views.decorators.cache import cache_page
 from django import forms
 
 from construct.models import *
+from construct.features import cached_feature, construct_bounds, construct_records, receptor_info, receptor_residues
 from structure.models import Structure
-from protein.models import ProteinConformation, Protein, ProteinSegment, ProteinFamily
+from protein.models import Protein, ProteinSegment, ProteinFamily
+from alignment.consensus import ConsensusCache, ConsensusData
 from alignment.models import AlignmentConsensus
 from common.definitions import AMINO_ACIDS, AMINO_ACID_GROUPS, STRUCTURAL_RULES, STRUCTURAL_SWITCHES
 
 import json
 from collections import OrderedDict
+import logging
 import re
 import xlrd
 import yaml
@@ -22,6 +26,8 @@ import pickle
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
+logger = logging.getLogger('protwis')
+
 class FileUploadForm(forms.Form):
     file_source = forms.FileField()
 
@@ -284,91 +290,66 @@ def tool(request):
 
     return render(request,'tool.html',context)
 
-@cache_page(60 * 60 * 24)
-def json_fusion(request, slug, **response_kwargs):
-
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
-    #proteins = Construct.objects.all().values_list('protein', flat = True)
-    cons = Construct.objects.all().prefetch_related('crystal', 'protein__family','deletions')
-
-    jsondata = "glyco"
-    jsondata = json.dumps(jsondata)
+def json_response(data, **response_kwargs):
     response_kwargs['content_type'] = 'application/json'
-    return HttpResponse(jsondata, **response_kwargs)
+    return HttpResponse(json.dumps(data), **response_kwargs)
+
+def fusion_data(slug):
+    return "glyco"
 
 @cache_page(60 * 60 * 24)
-def json_palmi(request, slug, **response_kwargs):
+def json_fusion(request, slug, **response_kwargs):
+    return json_response(fusion_data(slug), **response_kwargs)
 
-    start_time = time.time()
-    seq = Protein.objects.filter(entry_name=slug).values_list('sequence', flat = True).get()
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug,protein_segment__slug__in=['H8','C-term']).order_by('sequence_number').prefetch_related('protein_segment')
+def palmi_data(slug):
     residues = {}
     seq = ''
     end_h8 = 0
     start_h8 = 0
-    for r in rs:
-        if not start_h8 and r.protein_segment.slug == 'H8':
-            start_h8 = r.sequence_number
-        if not end_h8 and r.protein_segment.slug == 'C-term':
-            end_h8 = r.sequence_number-1 #end_h8 was prev residue
-        elif end_h8 and r.sequence_number-10>end_h8:
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        if segment not in ['H8','C-term']:
+            continue
+        if not start_h8 and segment == 'H8':
+            start_h8 = sequence_number
+        if not end_h8 and segment == 'C-term':
+            end_h8 = sequence_number-1 #end_h8 was prev residue
+        elif end_h8 and sequence_number-10>end_h8:
             continue
-        seq += r.amino_acid
-        residues[r.sequence_number] = r.protein_segment.slug
+        seq += amino_acid
+        residues[sequence_number] = segment
 
     #No proline!
     p = re.compile("C")
-    #print('all')
     mutations_all = []
     for m in p.finditer(seq):
         mutations_all.append([m.start()+start_h8,"A",'','',m.group(),residues[m.start()+start_h8]])
 
-
     palmi = OrderedDict()
     palmi['']= mutations_all
-
-    jsondata = palmi
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("palmi",diff)
-    return HttpResponse(jsondata, **response_kwargs)
-
+    return palmi
 
 @cache_page(60 * 60 * 24)
-def json_glyco(request, slug, **response_kwargs):
-    start_time = time.time()
+def json_palmi(request, slug, **response_kwargs):
+    return json_response(palmi_data(slug), **response_kwargs)
 
-    seq = Protein.objects.filter(entry_name=slug).values_list('sequence', flat = True).get()
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment')
+def glyco_data(slug):
+    level, seq = receptor_info(slug)
     residues = {}
-    for r in rs:
-        residues[r.sequence_number] = r.protein_segment.slug
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        residues[sequence_number] = segment
 
-    #No proline!
-    p = re.compile("N[^P][TS]")
-    #print('all')
     mutations_all = []
     matches = re.finditer(r'(?=([N][^P][TS]))',seq)
     matches_seq = re.findall(r'(?=([N][^P][TS]))',seq)
     #{"all": [[39, "Q", "", "", "NTS", "N-term"], [203, "Q", "", "", "NNT", "ECL2"]], "mammalian": [[205, "V", 206, "V", "TTCVLNDPN", "ECL2"]]}
     for i,m in enumerate(matches):
-        #print(matches_seq[i],m.start())
-        #print(m.start(), m.group())
         if residues[m.start()+1] in ['N-term','ECL1','ECL2','ECL3']:
             mutations_all.append([m.start()+1,"Q",'','',matches_seq[i],residues[m.start()+1]])
 
-    #print('mamalian')
-    #p = re.compile("[TS]{2}[A-Z]{1,11}[N]", overlapped=True)
-
     matches = re.finditer(r'(?=([TS]{2}[A-Z]{1,10}[N]))',seq)
     matches_seq = re.findall(r'(?=([TS]{2}[A-Z]{1,10}[N]))',seq)
-    #matches = re.findall(r'(?=(\w\w))', seq)
-    #print(matches)
     mutations_mammalian = []
     for i,m in enumerate(matches):
-        #print(matches_seq[i],m.start())
         if matches_seq[i][0]=="T":
             pos0 = "V"
         if matches_seq[i][1]=="T":
@@ -384,281 +365,96 @@ def json_glyco(request, slug, **response_kwargs):
     glyco = OrderedDict()
     glyco['n-linked']= mutations_all
     glyco['o-linked'] = mutations_mammalian
-
-    jsondata = glyco
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("glyco",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+    return glyco
 
 @cache_page(60 * 60 * 24)
-def json_icl3(request, slug, **response_kwargs):
-    start_time = time.time()
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
+def json_glyco(request, slug, **response_kwargs):
+    return json_response(glyco_data(slug), **response_kwargs)
 
-    ##PREPARE TM1 LOOKUP DATA
-    proteins = Construct.objects.all().values_list('protein', flat = True)
-    tm5_start = {}
-    tm5_end = {}
-    tm6_start = {}
-    tm6_end = {}
-    tm5_50 = {}
-    tm6_50 = {}
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='TM5').annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm5_start[pc.protein.entry_name] = pc.start
-        tm5_end[pc.protein.entry_name] = pc.end
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='TM6').annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm6_start[pc.protein.entry_name] = pc.start
-        tm6_end[pc.protein.entry_name] = pc.end
-
-
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__generic_number__label__in=['5x50','6x50']).annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm5_50[pc.protein.entry_name] = pc.start
-        tm6_50[pc.protein.entry_name] = pc.end
+def deletions_data(slug, deletion_row):
+    """Deletions of constructs grouped by how closely their receptor is related to the target receptor
 
+    deletion_row(bounds, start, end) returns the report row of a deletion, or None if it is not in the region"""
+    level = receptor_info(slug)[0]
+    bounds = construct_bounds()
 
-    cons = Construct.objects.all().prefetch_related('crystal', 'protein__family','deletions','structure__state','insertions__insert_type')
-    
     deletions = OrderedDict()
     deletions['Receptor'] = {}
     deletions['Receptor Family'] = {}
     deletions['Ligand Type'] = {}
     deletions['Class'] = {}
     deletions['Different Class'] = {}
-    states = {}
-    for c in cons:
-        p = c.protein
-        entry_name = p.entry_name
-        p_level = p.family.slug
-        d_level, d_level_name = compare_family_slug(level,p_level)
-        if d_level==-1: continue
-        pdb = c.crystal.pdb_code
-        state = c.structure.state.slug
-        if pdb not in states:
-            states[pdb] = state
-        fusion, f_results, linkers = c.fusion()
-        if fusion:
-            f_protein = f_results[0][2]
-        else:
-            f_protein = ""
-        for deletion in c.deletions.all():
-            #print(pdb,deletion.start,deletion.end)
-            if deletion.start > tm5_start[entry_name] and deletion.start < tm6_end[entry_name]:
-                if p.entry_name not in deletions[d_level_name]:
-                    deletions[d_level_name][entry_name] = {}
-                #deletions[entry_name][pdb] = [tm5_end[entry_name],tm6_start[entry_name],deletion.start,deletion.end,deletion.start-tm5_end[entry_name],tm6_start[entry_name]-deletion.end]
-                deletions[d_level_name][entry_name][pdb] = [deletion.start-tm5_50[entry_name]-1,tm6_50[entry_name]-deletion.end-1,state,str(fusion),f_protein]
-                # if (str(fusion)=='icl3'):
-                #     print(entry_name,pdb,50+deletion.start-tm5_50[entry_name],50-(tm6_50[entry_name]-deletion.end-1),str(fusion),f_protein)
-
-    # for pdb,state in sorted(states.items()):
-    #     print(pdb,"\t",state)
-
-    jsondata = deletions
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("icl3",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+    for c in construct_records():
+        entry_name = c['entry_name']
+        d_level, d_level_name = compare_family_slug(level,c['family'])
+        if d_level==-1 or entry_name not in bounds: continue
+        for start, end in c['deletions']:
+            try:
+                row = deletion_row(bounds[entry_name], start, end)
+            except KeyError:
+                # receptor without the segment or generic number
+                continue
+            if row is None:
+                continue
+            if entry_name not in deletions[d_level_name]:
+                deletions[d_level_name][entry_name] = {}
+            deletions[d_level_name][entry_name][c['pdb']] = row + [c['state'],c['fusion'],c['f_protein']]
+    return deletions
+
+def icl3_data(slug):
+    def deletion_row(bounds, start, end):
+        if start > bounds['segments']['TM5'][0] and start < bounds['segments']['TM6'][1]:
+            return [start-bounds['gns']['5x50']-1,bounds['gns']['6x50']-end-1]
+    return deletions_data(slug, deletion_row)
 
 @cache_page(60 * 60 * 24)
-def json_icl2(request, slug, **response_kwargs):
-    start_time = time.time()
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
+def json_icl3(request, slug, **response_kwargs):
+    return json_response(icl3_data(slug), **response_kwargs)
 
-    ##PREPARE TM1 LOOKUP DATA
-    proteins = Construct.objects.all().values_list('protein', flat = True)
-    tm3_start = {}
-    tm3_end = {}
-    tm4_start = {}
-    tm4_end = {}
-    tm3_50 = {}
-    tm4_50 = {}
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='TM3').annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm3_start[pc.protein.entry_name] = pc.start
-        tm3_end[pc.protein.entry_name] = pc.end
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='TM4').annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm4_start[pc.protein.entry_name] = pc.start
-        tm4_end[pc.protein.entry_name] = pc.end
-
-
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__generic_number__label__in=['3x50','4x50']).annotate(start=Min('residue__sequence_number'), end=Max('residue__sequence_number'))
-    for pc in pconfs:
-        tm3_50[pc.protein.entry_name] = pc.start
-        tm4_50[pc.protein.entry_name] = pc.end
+def icl2_data(slug):
+    def deletion_row(bounds, start, end):
+        if start > bounds['segments']['TM3'][0] and start < bounds['segments']['TM4'][1]:
+            return [start-bounds['gns']['3x50']-1,bounds['gns']['4x50']-end-1]
+    return deletions_data(slug, deletion_row)
 
+@cache_page(60 * 60 * 24)
+def json_icl2(request, slug, **response_kwargs):
+    return json_response(icl2_data(slug), **response_kwargs)
 
-    cons = Construct.objects.all().prefetch_related('crystal', 'protein__family','deletions','structure__state','insertions__insert_type')
-    
-    deletions = OrderedDict()
-    deletions['Receptor'] = {}
-    deletions['Receptor Family'] = {}
-    deletions['Ligand Type'] = {}
-    deletions['Class'] = {}
-    deletions['Different Class'] = {}
-    states = {}
-    for c in cons:
-        p = c.protein
-        entry_name = p.entry_name
-        p_level = p.family.slug
-        d_level, d_level_name = compare_family_slug(level,p_level)
-        if d_level==-1: continue
-        pdb = c.crystal.pdb_code
-        state = c.structure.state.slug
-        if pdb not in states:
-            states[pdb] = state
-        fusion, f_results, linkers = c.fusion()
-        if fusion:
-            f_protein = f_results[0][2]
-        else:
-            f_protein = ""
-        for deletion in c.deletions.all():
-            #print(pdb,deletion.start,deletion.end)
-            if deletion.start > tm3_start[entry_name] and deletion.start < tm4_end[entry_name]:
-                if p.entry_name not in deletions[d_level_name]:
-                    deletions[d_level_name][entry_name] = {}
-                #deletions[entry_name][pdb] = [tm5_end[entry_name],tm6_start[entry_name],deletion.start,deletion.end,deletion.start-tm5_end[entry_name],tm6_start[entry_name]-deletion.end]
-                deletions[d_level_name][entry_name][pdb] = [deletion.start-tm3_50[entry_name]-1,tm4_50[entry_name]-deletion.end-1,state,str(fusion),f_protein]
-
-    # for pdb,state in sorted(states.items()):
-    #     print(pdb,"\t",state)
-
-    jsondata = deletions
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("icl2",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+def nterm_data(slug):
+    def deletion_row(bounds, start, end):
+        tm1_start = bounds['segments']['TM1'][0]
+        if start < tm1_start:
+            return [start,end-1,tm1_start-end-1]
+    return deletions_data(slug, deletion_row)
 
 @cache_page(60 * 60 * 24)
 def json_nterm(request, slug, **response_kwargs):
-    start_time = time.time()
+    return json_response(nterm_data(slug), **response_kwargs)
 
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
-
-    ##PREPARE TM1 LOOKUP DATA
-    proteins = Construct.objects.all().values_list('protein', flat = True)
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='TM1').annotate(start=Min('residue__sequence_number'))
-    #pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).filter(residue__generic_number__label__in=['1x50']).values_list('protein__entry_name','residue__sequence_number','residue__generic_number__label')
-    tm1_start = {}
-    for pc in pconfs:
-        tm1_start[pc.protein.entry_name] = pc.start
-
-    cons = Construct.objects.all().prefetch_related('crystal', 'protein__family','deletions','structure__state','insertions__insert_type')
-    deletions = OrderedDict()
-    deletions['Receptor'] = {}
-    deletions['Receptor Family'] = {}
-    deletions['Ligand Type'] = {}
-    deletions['Class'] = {}
-    deletions['Different Class'] = {}
-    for c in cons:
-        p = c.protein
-        entry_name = p.entry_name
-        p_level = p.family.slug
-        d_level, d_level_name = compare_family_slug(level,p_level)
-        if d_level==-1: continue
-        pdb = c.crystal.pdb_code
-        state = c.structure.state.slug
-        fusion, f_results, linkers = c.fusion()
-        if fusion:
-            f_protein = f_results[0][2]
-        else:
-            f_protein = ""
-        for deletion in c.deletions.all():
-            if deletion.start < tm1_start[entry_name]:
-                if p.entry_name not in deletions[d_level_name]:
-                    deletions[d_level_name][entry_name] = {}
-                deletions[d_level_name][entry_name][pdb] = [deletion.start,deletion.end-1, tm1_start[entry_name]-deletion.end-1,state,str(fusion),f_protein]
-
-    jsondata = deletions
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("nterm",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+def cterm_data(slug):
+    def deletion_row(bounds, start, end):
+        cterm_start = bounds['segments']['C-term'][0]
+        if start >= cterm_start:
+            return [start,end,start-cterm_start]
+    return deletions_data(slug, deletion_row)
 
 @cache_page(60 * 60 * 24)
 def json_cterm(request, slug, **response_kwargs):
+    return json_response(cterm_data(slug), **response_kwargs)
 
-    start_time = time.time()
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
-
-    ##PREPARE TM1 LOOKUP DATA
-    proteins = Construct.objects.all().values_list('protein', flat = True)
-    # pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).filter(residue__protein_segment__slug='C-term').annotate(start=Min('residue__sequence_number'))
-    # cterm_start = {}
-    # for pc in pconfs:
-    #     cterm_start[pc.protein.entry_name] = pc.start
-    # pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).filter(residue__protein_segment__slug='C-term').annotate(start=Min('residue__sequence_number')).values_list('protein__entry_name','start','residue__generic_number__label')
-    #pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).filter(residue__generic_number__label__in=['8x50']).values_list('protein__entry_name','residue__sequence_number','residue__generic_number__label')
-    pconfs = ProteinConformation.objects.filter(protein_id__in=proteins).prefetch_related('protein').filter(residue__protein_segment__slug='C-term').annotate(start=Min('residue__sequence_number'))
-    cterm_start = {}
-    for pc in pconfs:
-        cterm_start[pc.protein.entry_name] = pc.start
-
-
-    cons = Construct.objects.all().prefetch_related('crystal', 'protein__family','deletions','structure__state','insertions__insert_type')
-    
-    deletions = OrderedDict()
-    deletions['Receptor'] = {}
-    deletions['Receptor Family'] = {}
-    deletions['Ligand Type'] = {}
-    deletions['Class'] = {}
-    deletions['Different Class'] = {}
-    for c in cons:
-        p = c.protein
-        entry_name = p.entry_name
-        p_level = p.family.slug
-        d_level, d_level_name = compare_family_slug(level,p_level)
-        if d_level==-1: continue
-        pdb = c.crystal.pdb_code
-        state = c.structure.state.slug
-        fusion, f_results, linkers = c.fusion()
-        if fusion:
-            f_protein = f_results[0][2]
-        else:
-            f_protein = ""
-        for deletion in c.deletions.all():
-            if deletion.start >= cterm_start[entry_name]:
-                if p.entry_name not in deletions[d_level_name]:
-                    deletions[d_level_name][entry_name] = {}
-                deletions[d_level_name][entry_name][pdb] = [deletion.start,deletion.end, deletion.start-cterm_start[entry_name],state,str(fusion),f_protein]
-
-    jsondata = deletions
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
-    end_time = time.time()
-    diff = round(end_time - start_time,1)
-    print("cterm",diff)
-    return HttpResponse(jsondata, **response_kwargs)
-
-@cache_page(60 * 60 * 24)
-def thermostabilising(request, slug, **response_kwargs):
+def termo_data(slug):
 
     start_time = time.time()
 
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment','display_generic_number','generic_number')
-
     wt_lookup = {}
     wt_lookup_pos = {}
-    for r in rs:
-        if r.generic_number:
-            gn = r.generic_number.label
-            wt_lookup[gn] = [r.amino_acid, r.sequence_number]
-        pos = r.sequence_number
-        wt_lookup_pos[pos] = [r.amino_acid]
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        if gn:
+            wt_lookup[gn] = [amino_acid, sequence_number]
+        wt_lookup_pos[sequence_number] = [amino_acid]
 
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
+    level = receptor_info(slug)[0]
     if level.split("_")[0]=='001':
         c_level = 'A'
     elif level.split("_")[0]=='002':
@@ -673,7 +469,7 @@ def thermostabilising(request, slug, **response_kwargs):
         c_level = ''
 
     path = os.sep.join([settings.DATA_DIR, 'structure_data', 'construct_data', 'termo.xlsx'])
-    d = parse_excel(path)
+    d = cached_feature('termo', lambda: parse_excel(path))
     if c_level in d:
         termo = d[c_level]
     else:
@@ -754,31 +550,27 @@ def thermostabilising(request, slug, **response_kwargs):
     results['4'] = temp_single
 
 
-    jsondata = results
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
     end_time = time.time()
     diff = round(end_time - start_time,1)
     print("termo",diff)
-    return HttpResponse(jsondata, **response_kwargs)
-
+    return results
 
 @cache_page(60 * 60 * 24)
-def structure_rules(request, slug, **response_kwargs):
-    start_time = time.time()
+def thermostabilising(request, slug, **response_kwargs):
+    return json_response(termo_data(slug), **response_kwargs)
 
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment','display_generic_number','generic_number')
+
+def struc_rules_data(slug):
+    start_time = time.time()
 
     wt_lookup = {}
     wt_lookup_pos = {}
-    for r in rs:
-        if r.generic_number:
-            gn = r.generic_number.label
-            wt_lookup[gn] = [r.amino_acid, r.sequence_number]
-        pos = r.sequence_number
-        wt_lookup_pos[pos] = [r.amino_acid]
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        if gn:
+            wt_lookup[gn] = [amino_acid, sequence_number]
+        wt_lookup_pos[sequence_number] = [amino_acid]
 
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
+    level = receptor_info(slug)[0]
     if level.split("_")[0]=='001':
         c_level = 'A'
     elif level.split("_")[0]=='002':
@@ -924,17 +716,17 @@ def structure_rules(request, slug, **response_kwargs):
     # results['3'] = temp
 
 
-    jsondata = results
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
     end_time = time.time()
     diff = round(end_time - start_time,1)
     print("rules",diff)
-    return HttpResponse(jsondata, **response_kwargs)
-
+    return results
 
 @cache_page(60 * 60 * 24)
-def mutations(request, slug, **response_kwargs):
+def structure_rules(request, slug, **response_kwargs):
+    return json_response(struc_rules_data(slug), **response_kwargs)
+
+
+def mutations_data(slug):
     from django.db import connection
     start_time = time.time()
     print('hi')
@@ -970,24 +762,23 @@ def mutations(request, slug, **response_kwargs):
         cache.set(key,mutations,60*60*24)
 
     # Build current target residue GN mapping
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug, generic_number__isnull=False).prefetch_related('generic_number', 'protein_segment')
+    rs = [r for r in receptor_residues(slug) if r[3]]
     
     # Build a dictionary to know how far a residue is from segment end/start
     # Used for propensity removals
     start_end_segments = {}
-    for r in rs:
-        if r.protein_segment.slug not in start_end_segments:
-            start_end_segments[r.protein_segment.slug] = {'start':r.sequence_number}
-        start_end_segments[r.protein_segment.slug]['end'] = r.sequence_number
+    for sequence_number, amino_acid, segment, gn, display_gn in rs:
+        if segment not in start_end_segments:
+            start_end_segments[segment] = {'start':sequence_number}
+        start_end_segments[segment]['end'] = sequence_number
 
     wt_lookup = {}
     GP_residues_in_target = []
-    for r in rs:
-        gn = r.generic_number.label
-        from_start = r.sequence_number-start_end_segments[r.protein_segment.slug]['start']
-        from_end = start_end_segments[r.protein_segment.slug]['end'] - r.sequence_number
-        wt_lookup[gn] = [r.amino_acid, r.sequence_number,r.protein_segment.slug, r.display_generic_number.label]
-        if r.amino_acid in ["G","P"] and from_start>=4 and from_end>=4:
+    for sequence_number, amino_acid, segment, gn, display_gn in rs:
+        from_start = sequence_number-start_end_segments[segment]['start']
+        from_end = start_end_segments[segment]['end'] - sequence_number
+        wt_lookup[gn] = [amino_acid, sequence_number,segment, display_gn]
+        if amino_acid in ["G","P"] and from_start>=4 and from_end>=4:
             # build a list of potential GP removals (ignore those close to helix borders)
             GP_residues_in_target.append(gn)
 
@@ -1355,11 +1146,10 @@ def mutations(request, slug, **response_kwargs):
                     print("problem with",r, e)
 
     # GLYCO
-    seq = Protein.objects.filter(entry_name=slug).values_list('sequence', flat = True).get()
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug).prefetch_related('protein_segment')
+    seq = receptor_info(slug)[1]
     residues = {}
-    for r in rs:
-        residues[r.sequence_number] = r.protein_segment.slug
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        residues[sequence_number] = segment
 
     #No proline!
     p = re.compile("N[^P][TS]")
@@ -1421,20 +1211,21 @@ def mutations(request, slug, **response_kwargs):
 
     #PALMI
     definition_matches = [int(3),"palmitoylation removal"]
-    rs = Residue.objects.filter(protein_conformation__protein__entry_name=slug,protein_segment__slug__in=['H8','C-term']).order_by('sequence_number').prefetch_related('protein_segment')
     residues = {}
     seq = ''
     end_h8 = 0
     start_h8 = 0
-    for r in rs:
-        if not start_h8 and r.protein_segment.slug == 'H8':
-            start_h8 = r.sequence_number
-        if not end_h8 and r.protein_segment.slug == 'C-term':
-            end_h8 = r.sequence_number-1 #end_h8 was prev residue
-        elif end_h8 and r.sequence_number-10>end_h8:
+    for sequence_number, amino_acid, segment, gn, display_gn in receptor_residues(slug):
+        if segment not in ['H8','C-term']:
+            continue
+        if not start_h8 and segment == 'H8':
+            start_h8 = sequence_number
+        if not end_h8 and segment == 'C-term':
+            end_h8 = sequence_number-1 #end_h8 was prev residue
+        elif end_h8 and sequence_number-10>end_h8:
             continue
-        seq += r.amino_acid
-        residues[r.sequence_number] = r.protein_segment.slug
+        seq += amino_acid
+        residues[sequence_number] = segment
 
     #No proline!
     p = re.compile("C")
@@ -1460,15 +1251,15 @@ def mutations(request, slug, **response_kwargs):
         val['definitions'] = list(set([x[1] for x in val['definitions']]))
         # print(val)
 
-    jsondata = simple_list
-    jsondata = json.dumps(jsondata)
-    response_kwargs['content_type'] = 'application/json'
     diff = round(time.time() - start_time,1)
     print("muts",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+    return simple_list
 
 @cache_page(60 * 60 * 24)
-def cons_strucs(request, slug, **response_kwargs):
+def mutations(request, slug, **response_kwargs):
+    return json_response(mutations_data(slug), **response_kwargs)
+
+def cons_strucs_data(slug):
     start_time = time.time()
 
     level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
@@ -1528,63 +1319,41 @@ def cons_strucs(request, slug, **response_kwargs):
         gn = r.generic_number.label
         if r.amino_acid!=potentials[gn][0]:
             results[gn] = [r.amino_acid, r.sequence_number,potentials[gn][0],potentials[gn][1]]
-    jsondata = json.dumps(results)
-    response_kwargs['content_type'] = 'application/json'
     end_time = time.time()
     diff = round(end_time - start_time,1)
     print("cons_strucs",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+    return results
 
 @cache_page(60 * 60 * 24)
-def cons_rf(request, slug, **response_kwargs):
-    start_time = time.time()
-
-    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
-    ##PREPARE TM1 LOOKUP DATA
-    #c_proteins = Construct.objects.filter(protein__family__slug__startswith = level.split("_")[0]).all().values_list('protein__pk', flat = True).distinct()
-    rf_proteins = Protein.objects.filter(family__slug__startswith="_".join(level.split("_")[0:3]), source__name='SWISSPROT',species__common_name='Human')
-    align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
-
-    amino_acids_stats = {}
-    amino_acids_groups_stats = {}
-        
-
-    print(len(rf_proteins))
-
-    try:
+def cons_strucs(request, slug, **response_kwargs):
+    return json_response(cons_strucs_data(slug), **response_kwargs)
 
-        # Load alignment 
-        a = pickle.loads(AlignmentConsensus.objects.get(slug="_".join(level.split("_")[0:3])).alignment)
-    except:
+def family_consensus(slug, proteins):
+    """Consensus data of a family, from the stored consensus or by aligning the proteins if there is none"""
+    consensus = ConsensusCache.get(slug)
+    if consensus is None:
         print('failed!')
+        align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
         a = Alignment()
-
-        a.load_proteins(rf_proteins)
-
+        a.load_proteins(proteins)
         a.load_segments(align_segments) #get all segments to make correct diagrams
-
         # build the alignment data matrix
         a.build_alignment()
-
         # calculate consensus sequence + amino acid and feature frequency
         a.calculate_statistics()
+        consensus = ConsensusData.from_alignment(a)
+    return consensus
 
-    s_id = 0
-    a_id = 0
-    for ns, segments in a.generic_numbers.items():
-        for s, num in segments.items():
-            for n, dn in num.items():
-                temp = []
-                temp2 = []
-                for i, aa in enumerate(AMINO_ACIDS):
-                    temp.append(a.amino_acid_stats[i][s_id][a_id])
+def cons_rf_data(slug):
+    start_time = time.time()
 
-                for i, aa in enumerate(AMINO_ACID_GROUPS):
-                    temp2.append(a.feature_stats[i][s_id][a_id])
-                amino_acids_stats[n] = temp
-                amino_acids_groups_stats[n] = temp2
-            a_id += 1
-        s_id += 1
+    level = Protein.objects.filter(entry_name=slug).values_list('family__slug', flat = True).get()
+    ##PREPARE TM1 LOOKUP DATA
+    #c_proteins = Construct.objects.filter(protein__family__slug__startswith = level.split("_")[0]).all().values_list('protein__pk', flat = True).distinct()
+    rf_proteins = Protein.objects.filter(family__slug__startswith="_".join(level.split("_")[0:3]), source__name='SWISSPROT',species__common_name='Human')
+
+    # Load consensus
+    a = family_consensus("_".join(level.split("_")[0:3]), rf_proteins)
 
     potentials = {}
     for seg, aa_list in a.consensus.items():
@@ -1600,12 +1369,52 @@ def cons_rf(request, slug, **response_kwargs):
         gn = r.generic_number.label
         if r.amino_acid!=potentials[gn][0]:
             results[gn] = [r.amino_acid, r.sequence_number,potentials[gn][0],potentials[gn][1]]
-    jsondata = json.dumps(results)
-    response_kwargs['content_type'] = 'application/json'
     end_time = time.time()
     diff = round(end_time - start_time,1)
     print("cons_rf",diff)
-    return HttpResponse(jsondata, **response_kwargs)
+    return results
+
+@cache_page(60 * 60 * 24)
+def cons_rf(request, slug, **response_kwargs):
+    return json_response(cons_rf_data(slug), **response_kwargs)
+
+# data functions of the JSON endpoints, by the name used in bundle requests
+FEATURE_DATA = OrderedDict([
+    ('nterm', nterm_data),
+    ('cterm', cterm_data),
+    ('icl3', icl3_data),
+    ('icl2', icl2_data),
+    ('glyco', glyco_data),
+    ('palmi', palmi_data),
+    ('fusion', fusion_data),
+    ('termo', termo_data),
+    ('struc_rules', struc_rules_data),
+    ('mutations', mutations_data),
+    ('cons_strucs', cons_strucs_data),
+    ('cons_rf', cons_rf_data),
+])
+
+def json_bundle(request, slug, **response_kwargs):
+    """Data of several JSON endpoints in one response. The endpoints are given as comma separated names in the
+    parts parameter, all by default
+
+    The data of each part is cached per receptor and release. A response with a failed part is not cached, so
+    that it is built again by the next request."""
+    parts = [x for x in request.GET.get('parts', ','.join(FEATURE_DATA.keys())).split(',') if x in FEATURE_DATA]
+    bundle = OrderedDict()
+    failed = False
+    for part in parts:
+        try:
+            bundle[part] = cached_feature('{}_{}'.format(part, slug), lambda: FEATURE_DATA[part](slug))
+        except Exception as msg:
+            # a failing part is left empty, so that the other menus are still built
+            logger.error('Failed building construct tool data {} for {}: {}'.format(part, slug, msg))
+            bundle[part] = {}
+            failed = True
+    response = json_response(bundle, **response_kwargs)
+    if not failed:
+        patch_cache_control(response, max_age=60 * 60 * 24)
+    return response
 
 @cache_page(60 * 60 * 24)
 def cons_rf_and_class(request, slug, **response_kwargs):
@@ -1615,44 +1424,9 @@ def cons_rf_and_class(request, slug, **response_kwargs):
     ##PREPARE TM1 LOOKUP DATA
     #c_proteins = Construct.objects.filter(protein__family__slug__startswith = level.split("_")[0]).all().values_list('protein__pk', flat = True).distinct()
     rf_proteins = Protein.objects.filter(family__slug__startswith="_".join(level.split("_")[0:3]), source__name='SWISSPROT',species__common_name='Human')
-    align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
-
-    amino_acids_stats = {}
-    amino_acids_groups_stats = {}
-        
-    try:
-        # Load alignment 
-        a = pickle.loads(AlignmentConsensus.objects.get(slug="_".join(level.split("_")[0:3])).alignment)
-    except:
-        print('failed!')
-        a = Alignment()
-
-        a.load_proteins(rf_proteins)
-
-        a.load_segments(align_segments) #get all segments to make correct diagrams
-
-        # build the alignment data matrix
-        a.build_alignment()
-
-        # calculate consensus sequence + amino acid and feature frequency
-        a.calculate_statistics()
-
-    s_id = 0
-    a_id = 0
-    for ns, segments in a.generic_numbers.items():
-        for s, num in segments.items():
-            for n, dn in num.items():
-                temp = []
-                temp2 = []
-                for i, aa in enumerate(AMINO_ACIDS):
-                    temp.append(a.amino_acid_stats[i][s_id][a_id])
 
-                for i, aa in enumerate(AMINO_ACID_GROUPS):
-                    temp2.append(a.feature_stats[i][s_id][a_id])
-                amino_acids_stats[n] = temp
-                amino_acids_groups_stats[n] = temp2
-            a_id += 1
-        s_id += 1
+    # Load consensus
+    a = family_consensus("_".join(level.split("_")[0:3]), rf_proteins)
 
     potentials = {}
     for seg, aa_list in a.consensus.items():
@@ -1664,45 +1438,9 @@ def cons_rf_and_class(request, slug, **response_kwargs):
 
     if potentials2==None:
         class_proteins = Protein.objects.filter(family__slug__startswith="_".join(level.split("_")[0:1]), source__name='SWISSPROT',species__common_name='Human')
-        align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
-
-        amino_acids_stats = {}
-        amino_acids_groups_stats = {}
-            
-        try:
-            # Load alignment 
-            a = pickle.loads(AlignmentConsensus.objects.get(slug="_".join(level.split("_")[0:1])).alignment)
-        except:
-            print('failed!')
-
-            a = Alignment()
-
-            a.load_proteins(class_proteins)
-
-            a.load_segments(align_segments) #get all segments to make correct diagrams
-
-            # build the alignment data matrix
-            a.build_alignment()
-
-            # calculate consensus sequence + amino acid and feature frequency
-            a.calculate_statistics()
-
-        s_id = 0
-        a_id = 0
-        for ns, segments in a.generic_numbers.items():
-            for s, num in segments.items():
-                for n, dn in num.items():
-                    temp = []
-                    temp2 = []
-                    for i, aa in enumerate(AMINO_ACIDS):
-                        temp.append(a.amino_acid_stats[i][s_id][a_id])
 
-                    for i, aa in enumerate(AMINO_ACID_GROUPS):
-                        temp2.append(a.feature_stats[i][s_id][a_id])
-                    amino_acids_stats[n] = temp
-                    amino_acids_groups_stats[n] = temp2
-                a_id += 1
-            s_id += 1
+        # Load consensus
+        a = family_consensus("_".join(level.split("_")[0:1]), class_proteins)
 
         potentials2 = {}
         for seg, aa_list in a.consensus.items():
@@ -1791,33 +1529,25 @@ def cons_rm_GP(request, slug, **response_kwargs):
 
 def calculate_conservation(proteins = None, slug = None):
     # Return a a dictionary of each generic number and the conserved residue and its frequency
-    # Can either be used on a list of proteins or on a slug. If slug then use the cached alignment object.
-
-    amino_acids_stats = {}
-    amino_acids_groups_stats = {}
+    # Can either be used on a list of proteins or on a slug. If slug then use the stored consensus.
 
+    stored = False
     if slug:
-        try: 
-            # Load alignment 
-            alignment_consensus = AlignmentConsensus.objects.get(slug=slug)
-            if alignment_consensus.gn_consensus:
-                alignment_consensus = pickle.loads(alignment_consensus.gn_consensus)
+        gn_consensus = AlignmentConsensus.objects.filter(slug=slug).values_list('gn_consensus', flat=True).first()
+        if gn_consensus:
+            try:
+                gn_consensus = pickle.loads(gn_consensus)
                 # make sure it has this value, so it's newest version
-                test = alignment_consensus['1x50'][2]
-                return alignment_consensus
-            a = pickle.loads(alignment_consensus.alignment)
-        except: 
+                test = gn_consensus['1x50'][2]
+                return gn_consensus
+            except:
+                pass
+        a = ConsensusCache.get(slug)
+        stored = a is not None
+        if not stored:
             print('no saved alignment')
             proteins = Protein.objects.filter(family__slug__startswith=slug, source__name='SWISSPROT',species__common_name='Human')
-            align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
-            a = Alignment()
-            a.load_proteins(proteins)
-            a.load_segments(align_segments) 
-            a.build_alignment()
-            # calculate consensus sequence + amino acid and feature frequency
-            a.calculate_statistics()
-            alignment_consensus = None
-    elif proteins:
+    if not stored:
         align_segments = ProteinSegment.objects.all().filter(slug__in = list(settings.REFERENCE_POSITIONS.keys())).prefetch_related()
         a = Alignment()
         a.load_proteins(proteins)
@@ -1825,8 +1555,9 @@ def calculate_conservation(proteins = None, slug = None):
         a.build_alignment()
         # calculate consensus sequence + amino acid and feature frequency
         a.calculate_statistics()
+        a = ConsensusData.from_alignment(a)
 
-    num_proteins = len(a.proteins)
+    num_proteins = a.num_proteins
     # print(a.aa_count)
     consensus = {}
     for seg, aa_list in a.consensus.items():
@@ -1837,8 +1568,7 @@ def calculate_conservation(proteins = None, slug = None):
                     aa_count_dict[aa] = (num,round(num/num_proteins,3))
             if 'x' in gn: # only takes those GN positions that are actual 1x50 etc
                 consensus[gn] = [aal[0],aal[1],aa_count_dict]
-    if slug and alignment_consensus:
-        alignment_consensus.gn_consensus = pickle.dumps(consensus)
-        alignment_consensus.save()
+    if stored:
+        AlignmentConsensus.objects.filter(slug=slug).update(gn_consensus=pickle.dumps(consensus))
 
     return consensus
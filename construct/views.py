@@ -3,6 +3,7 @@ from django.views.generic import TemplateView, View
 from django.http import HttpResponse
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_exempt
+from django.db.models import Min, Max
 from django.conf import settings
 
 
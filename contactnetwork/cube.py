@@ -1,6 +1,6 @@
-from Bio.PDB import Selection, PDBParser
-from Bio.PDB.NeighborSearch import NeighborSearch
+from Bio.PDB import PDBParser
 
+from contactnetwork.grid import InteractionGrid
 from contactnetwork.interaction import *
 from contactnetwork.pdb import *
 
@@ -10,36 +10,22 @@ from structure.models import Structure
 NUM_SKIP_RESIDUES = 4
 
 
-def compute_interactions(pdb_name):
+def compute_interactions(pdb_name, structure=None, pdb_data=None):
     # Ensure that the PDB name is lowercase
     pdb_name = pdb_name.lower()
 
     # Get the pdb structure
-    s = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
+    if structure is None:
+        structure = Structure.objects.get(protein_conformation__protein__entry_name=pdb_name)
 
     # Get the preferred chain
-    preferred_chain = s.preferred_chain.split(',')[0]
+    preferred_chain = structure.preferred_chain.split(',')[0]
 
-    # Get the Biopython structure for the PDB
-    s = pdb_get_structure(pdb_name)
+    # Get the Biopython structure for the PDB, from the provided PDB data or from RCSB
+    if pdb_data:
+        s = pdb_structure_from_data(pdb_name, pdb_data)
+    else:
+        s = pdb_get_structure(pdb_name)
 
-    # Get all atoms
-    atom_list = Selection.unfold_entities(s[0][preferred_chain], 'A')
-
-    # Search for all neighbouring residues
-    ns = NeighborSearch(atom_list)
-    all_neighbors = ns.search_all(4.5, "R")
-
-    # Filter all pairs containing non AA residues
-    all_aa_neighbors = [pair for pair in all_neighbors if is_aa(pair[0]) and is_aa(pair[1])]
-
-    # Only include contacts between residues less that NUM_SKIP_RESIDUES sequence steps apart
-    all_aa_neighbors = [pair for pair in all_aa_neighbors if abs(pair[0].id[1] - pair[1].id[1]) > NUM_SKIP_RESIDUES]
-
-    # For each pair of interacting residues, determine the type of interaction
-    interactions = [InteractingPair(res_pair[0], res_pair[1], get_interactions(res_pair[0], res_pair[1])) for res_pair in all_aa_neighbors]
-
-    # Split unto classified and unclassified.
-    classified = [interaction for interaction in interactions if len(interaction.get_interactions()) > 0]
-
-    return classified
+    # Classify all contacts of the preferred chain
+    return InteractionGrid(s[0][preferred_chain]).get_interacting_pairs(NUM_SKIP_RESIDUES)
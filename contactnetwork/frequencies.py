@@ -0,0 +1,236 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from contactnetwork.models import Interaction, InteractionFact
+from protein.models import Protein, ProteinSegment
+from residue.models import Residue
+
+from collections import OrderedDict
+import hashlib
+import time
+
+
+# seconds to keep aggregated interaction data, bumping the version (see invalidate) expires it immediately
+CACHE_TIMEOUT = 60*60*24*7
+VERSION_KEY = 'interaction_facts_version'
+
+
+def invalidate():
+    """Expire all cached aggregations, called after the interaction facts have been (re)built"""
+    cache.set(VERSION_KEY, str(time.time()), None)
+
+
+def cache_key(pdbs, segments, i_types, generic):
+    """Cache key of an aggregation, independent of the order of the PDBs, segments and interaction types"""
+    key = '|'.join([str(cache.get(VERSION_KEY, '')), ','.join(sorted(set(pdbs))), ','.join(sorted(set(segments))),
+        ','.join(sorted(set(i_types))), str(generic)])
+    return 'interaction_frequencies_' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def maps_key(pdbs, generic):
+    """Cache key of the consensus maps of a PDB set"""
+    key = '|'.join([str(cache.get(VERSION_KEY, '')), ','.join(sorted(set(pdbs))), str(generic)])
+    return 'interaction_maps_' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def generic_number_key(label):
+    """Sort key of generic number labels (e.g. 3x50), compares the parts before and after the x"""
+    return label.split('x')
+
+
+def interaction_fact(structure, pair, interaction):
+    """Fact row of an interaction of a residue pair, written next to the Interaction rows"""
+    res1 = pair.res1
+    res2 = pair.res2
+    return InteractionFact(structure=structure, pdb=structure.protein_conformation.protein.entry_name,
+        interaction_type=interaction._meta.model_name, res1_seq=res1.sequence_number,
+        res2_seq=res2.sequence_number, gn1=res1.generic_number.label if res1.generic_number else None,
+        gn2=res2.generic_number.label if res2.generic_number else None, segment1=res1.protein_segment.slug,
+        segment2=res2.protein_segment.slug, aa1=res1.amino_acid, aa2=res2.amino_acid)
+
+
+def fact_pdbs(pdbs):
+    """PDBs of a set that have interaction fact rows"""
+    return set(InteractionFact.objects.filter(pdb__in=pdbs).values_list('pdb', flat=True).distinct())
+
+
+def fact_rows(pdbs, segments=[], i_types=[]):
+    """Interaction fact rows of a set of PDBs, optionally limited to interactions within segments and of types"""
+    facts = InteractionFact.objects.filter(pdb__in=pdbs)
+    if segments:
+        facts = facts.filter(segment1__in=segments, segment2__in=segments)
+    if i_types:
+        facts = facts.filter(interaction_type__in=i_types)
+    return list(facts.values_list('pdb', 'interaction_type', 'res1_seq', 'res2_seq', 'gn1', 'gn2', 'segment1',
+        'segment2', 'aa1', 'aa2'))
+
+
+def pair_rows(pdbs, segments=[], i_types=[]):
+    """Rows in the format of fact_rows read from the interacting residue pairs, for structures without facts"""
+    interactions = Interaction.objects.filter(
+        interacting_pair__referenced_structure__protein_conformation__protein__entry_name__in=pdbs)
+    if segments:
+        interactions = interactions.filter(interacting_pair__res1__protein_segment__slug__in=segments,
+            interacting_pair__res2__protein_segment__slug__in=segments)
+    if i_types:
+        interactions = interactions.filter(polymorphic_ctype__model__in=i_types)
+    return list(interactions.values_list(
+        'interacting_pair__referenced_structure__protein_conformation__protein__entry_name',
+        'polymorphic_ctype__model',
+        'interacting_pair__res1__sequence_number',
+        'interacting_pair__res2__sequence_number',
+        'interacting_pair__res1__generic_number__label',
+        'interacting_pair__res2__generic_number__label',
+        'interacting_pair__res1__protein_segment__slug',
+        'interacting_pair__res2__protein_segment__slug',
+        'interacting_pair__res1__amino_acid',
+        'interacting_pair__res2__amino_acid',
+    ))
+
+
+def fetch_facts(pdbs, segments=[], i_types=[]):
+    """Interaction rows of a set of PDBs, from the fact table or from the residue pairs of structures whose facts
+    have not been built"""
+    with_facts = fact_pdbs(pdbs)
+    rows = fact_rows(list(with_facts), segments, i_types) if with_facts else []
+    without_facts = [pdb for pdb in pdbs if pdb not in with_facts]
+    if without_facts:
+        rows += pair_rows(without_facts, segments, i_types)
+    return rows
+
+
+def aggregate_facts(facts, generic=True):
+    """Aggregate interaction fact rows into the residue pair matrix used by the contact browser
+
+    Residues are identified by generic number (pairs without generic numbers are skipped) or by sequence number.
+    Besides the interaction types per pair and PDB, 'frequencies' holds the number of PDBs with each interaction
+    type per pair."""
+    data = {
+        'interactions': {},
+        'frequencies': {},
+        'pdbs': set(),
+        'segments': set(),
+        'segment_map': {},
+        'aa_map': {},
+    }
+    if not generic:
+        data['generic_map'] = {}
+
+    # residue numbers in use
+    numbers = set()
+
+    for pdb_name, model, res1_seq, res2_seq, res1_gen, res2_gen, res1_seg, res2_seg, res1_aa, res2_aa in facts:
+        data['pdbs'].add(pdb_name)
+        if generic and (not res1_gen or not res2_gen):
+            continue
+
+        if generic:
+            res1 = res1_gen
+            res2 = res2_gen
+        else:
+            res1 = res1_seq
+            res2 = res2_seq
+            if res1_gen:
+                data['generic_map'][res1] = res1_gen
+            if res2_gen:
+                data['generic_map'][res2] = res2_gen
+
+        data['segment_map'][res1] = res1_seg
+        data['segment_map'][res2] = res2_seg
+        data['segments'] |= {res1_seg, res2_seg}
+
+        aa_map = data['aa_map'].setdefault(pdb_name, {})
+        aa_map[res1] = res1_aa
+        aa_map[res2] = res2_aa
+
+        numbers |= {res1, res2}
+
+        if res1 < res2:
+            coord = str(res1) + ',' + str(res2)
+        else:
+            coord = str(res2) + ',' + str(res1)
+        data['interactions'].setdefault(coord, {}).setdefault(pdb_name, []).append(model)
+
+    # number of PDBs with each interaction type per pair
+    for coord, pdb_interactions in data['interactions'].items():
+        frequencies = {}
+        for models in pdb_interactions.values():
+            for model in set(models):
+                frequencies[model] = frequencies.get(model, 0) + 1
+        data['frequencies'][coord] = frequencies
+
+    if generic:
+        data['sequence_numbers'] = sorted(numbers, key=generic_number_key)
+    else:
+        data['sequence_numbers'] = sorted(numbers)
+    data['segments'] = list(data['segments'])
+    data['pdbs'] = list(data['pdbs'])
+    return data
+
+
+def interaction_frequencies(pdbs, segments=[], i_types=[], generic=True):
+    """Aggregated interaction data of a set of PDBs, cached per (PDB set, segments, interaction types, numbering)"""
+    key = cache_key(pdbs, segments, i_types, generic)
+    data = cache.get(key)
+    if data is None:
+        data = aggregate_facts(fetch_facts(pdbs, segments, i_types), generic)
+        cache.set(key, data, CACHE_TIMEOUT)
+    return data
+
+
+def build_consensus_maps(pdbs, generic=True):
+    """Residue maps of the receptors of a set of PDBs, shown along the contact browser diagrams
+
+    For several receptors the maps hold the consensus amino acid and segment of each generic number (gn_map,
+    segment_map_full_gn) and sequence number (pos_map). For a single receptor without generic numbering they hold the
+    amino acid, segment and generic number of each sequence number."""
+    Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
+
+    excluded_segment = ['C-term','N-term']
+    segments = ProteinSegment.objects.all().exclude(slug__in = excluded_segment)
+    proteins =  Protein.objects.filter(protein__entry_name__in=pdbs).all()
+
+    data = OrderedDict()
+    data['gn_map'] = OrderedDict()
+    data['pos_map'] = OrderedDict()
+    data['segment_map_full'] = OrderedDict()
+    data['segment_map_full_gn'] = OrderedDict()
+    data['generic_map_full'] = OrderedDict()
+
+    if len(proteins)>1:
+        a = Alignment()
+        a.use_matrix_engine = True
+        a.ignore_alternative_residue_numbering_schemes = True;
+        a.load_proteins(proteins)
+        a.load_segments(segments) #get all segments to make correct diagrams
+        # build the alignment data matrix
+        a.build_alignment()
+        # calculate consensus sequence + amino acid and feature frequency
+        a.calculate_statistics()
+        consensus = a.full_consensus
+
+        for aa in consensus:
+            if 'x' in aa.family_generic_number:
+                data['gn_map'][aa.family_generic_number] = aa.amino_acid
+                data['pos_map'][aa.sequence_number] = aa.amino_acid
+                data['segment_map_full_gn'][aa.family_generic_number] = aa.segment_slug
+    elif proteins:
+        rs = Residue.objects.filter(protein_conformation__protein=proteins[0]).prefetch_related('protein_segment','display_generic_number','generic_number')
+        for r in rs:
+            if (not generic):
+                data['pos_map'][r.sequence_number] = r.amino_acid
+                data['segment_map_full'][r.sequence_number] = r.protein_segment.slug
+                if r.display_generic_number:
+                    data['generic_map_full'][r.sequence_number] = r.short_display_generic_number()
+    return data
+
+
+def consensus_maps(pdbs, generic=True):
+    """Residue maps of a set of PDBs (see build_consensus_maps), cached per (PDB set, numbering) next to the
+    aggregated interactions"""
+    key = maps_key(pdbs, generic)
+    data = cache.get(key)
+    if data is None:
+        data = build_consensus_maps(pdbs, generic)
+        cache.set(key, data, CACHE_TIMEOUT)
+    return data
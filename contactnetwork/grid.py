@@ -0,0 +1,216 @@
+from contactnetwork.interaction import *
+
+import math
+import numpy as np
+
+
+# Maximum atom distance between interacting residues (same cutoff as the neighbour search in cube.py)
+CONTACT_DISTANCE = 4.5
+
+# Maximum donor-acceptor distance of H-bonds (see has_hbond_interaction)
+HBOND_DISTANCE = 3.5
+
+# All 27 cells surrounding (and including) a grid cell
+NEIGHBOUR_CELLS = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)]
+
+
+class InteractionGrid:
+    """Vectorised contact detection between all residues of a chain
+
+    All atoms are loaded into coordinate, element and name arrays once. Candidate residue pairs are found with a
+    uniform grid on the residue centres, and every classification of a pair (as in interaction.get_interactions) is
+    computed from a single atom distance block."""
+    def __init__(self, residues, cutoff=CONTACT_DISTANCE):
+        self.residues = list(residues)
+        self.cutoff = cutoff
+
+        coords = []
+        elements = []
+        names = []
+        self.bounds = []
+        for res in self.residues:
+            start = len(coords)
+            for atom in res.child_list:
+                coords.append(atom.coord)
+                elements.append(atom.element)
+                names.append(atom.name)
+            self.bounds.append((start, len(coords)))
+
+        self.coords = np.array(coords, dtype=float).reshape(-1, 3)
+        self.elements = np.array(elements, dtype=object)
+        self.names = np.array(names, dtype=object)
+
+        # atom roles
+        self.carbon = self.elements == 'C'
+        self.polar = np.isin(self.elements, ['N', 'O', 'S'])
+        self.sidechain_polar = (((self.elements == 'N') & (self.names != 'N'))
+            | ((self.elements == 'O') & (self.names != 'O')) | (self.elements == 'S'))
+        self.backbone_polar = (self.names == 'N') | (self.names == 'O')
+        self.radii = np.array([VDW_RADII.get(e, np.nan) for e in elements], dtype=float)
+
+        # residue centres and radii for the grid, ring descriptors for aromatic interactions
+        self.centers = np.zeros((len(self.residues), 3))
+        self.radius = np.zeros(len(self.residues))
+        self.rings = []
+        for i, res in enumerate(self.residues):
+            start, end = self.bounds[i]
+            if end > start:
+                self.centers[i] = self.coords[start:end].mean(axis=0)
+                self.radius[i] = np.sqrt(((self.coords[start:end] - self.centers[i]) ** 2).sum(axis=1)).max()
+            self.rings.append([(np.asarray(c), np.asarray(n)) for c, n in get_ring_descriptors(res)])
+
+    def candidate_pairs(self):
+        """Residue index pairs (i < j) whose atoms can be within the cutoff distance"""
+        if not self.residues:
+            return []
+        cell_size = self.cutoff + 2 * self.radius.max()
+        cells = [tuple(c) for c in np.floor(self.centers / cell_size).astype(int)]
+        grid = {}
+        for i, cell in enumerate(cells):
+            grid.setdefault(cell, []).append(i)
+
+        pairs = []
+        for i, cell in enumerate(cells):
+            for offset in NEIGHBOUR_CELLS:
+                neighbour = (cell[0] + offset[0], cell[1] + offset[1], cell[2] + offset[2])
+                for j in grid.get(neighbour, []):
+                    if j > i and (np.linalg.norm(self.centers[i] - self.centers[j])
+                        <= self.radius[i] + self.radius[j] + self.cutoff):
+                        pairs.append((i, j))
+        return pairs
+
+    def get_interacting_pairs(self, skip_residues=0):
+        """InteractingPair objects for all classified contacts between amino acids more than skip_residues apart"""
+        interacting_pairs = []
+        for i, j in self.candidate_pairs():
+            res1 = self.residues[i]
+            res2 = self.residues[j]
+            if not (is_aa(res1) and is_aa(res2)) or abs(res1.id[1] - res2.id[1]) <= skip_residues:
+                continue
+
+            # same orientation as the pairs returned by NeighborSearch
+            if res2.id < res1.id:
+                i, j = j, i
+
+            d = self.distances(i, j)
+            if not d.size or d.min() > self.cutoff:
+                continue
+
+            interactions = self.get_interactions(i, j, d)
+            if interactions:
+                interacting_pairs.append(InteractingPair(self.residues[i], self.residues[j], interactions))
+        return interacting_pairs
+
+    def distances(self, i, j):
+        """Atom distance block between two residues"""
+        start1, end1 = self.bounds[i]
+        start2, end2 = self.bounds[j]
+        diff = self.coords[start1:end1, None, :] - self.coords[None, start2:end2, :]
+        return np.sqrt((diff ** 2).sum(axis=2))
+
+    def _close(self, d, i, j, mask1, mask2, cutoff):
+        """Check if any atom of residue i in mask1 is within cutoff of any atom of residue j in mask2"""
+        block = d[mask1[slice(*self.bounds[i])]][:, mask2[slice(*self.bounds[j])]]
+        return block.size > 0 and bool((block <= cutoff).any())
+
+    def _has_atoms(self, i, names):
+        return all([n in self.residues[i].child_dict for n in names])
+
+    def get_interactions(self, i, j, d):
+        """Interactions between residues i and j, in the same order as interaction.get_interactions"""
+        res1 = self.residues[i]
+        res2 = self.residues[j]
+        interactions = []
+
+        # Aromatic interactions
+        interactions += self.get_aromatic_interactions(i, j)
+
+        # Hydrophobic interactions
+        if self._close(d, i, j, self.carbon, self.carbon, 4.5):
+            interactions.append(HydrophobicInteraction())
+
+        # Polar interactions
+        charged1 = is_charged(res1)
+        charged2 = is_charged(res2)
+        if self._has_atoms(i, ['N', 'O']) and self._close(d, i, j, self.backbone_polar, self.sidechain_polar, 4.5):
+            interactions.append(PolarBackboneSidechainInteraction(charged1, charged2))
+        if self._has_atoms(j, ['N', 'O']) and self._close(d, i, j, self.sidechain_polar, self.backbone_polar, 4.5):
+            interactions.append(PolarSideChainBackboneInteraction(charged1, charged2))
+        if self._close(d, i, j, self.sidechain_polar, self.sidechain_polar, 4.5):
+            interactions.append(PolarSidechainSidechainInteraction(charged1, charged2))
+        if (is_water(res1) or is_water(res2)) and self._close(d, i, j, self.polar, self.polar, 4.5):
+            interactions.append(PolarWaterInteraction())
+
+        # only pairs with polar atoms within H-bond distance need the (expensive) hydrogen placement
+        if self._close(d, i, j, self.polar, self.polar, HBOND_DISTANCE) and has_hbond_interaction(res1, res2):
+            interactions.append(HydrogenBondInteraction())
+
+        # Van der Waals interactions
+        start1, end1 = self.bounds[i]
+        start2, end2 = self.bounds[j]
+        vdw_cutoff = (self.radii[start1:end1, None] + self.radii[None, start2:end2]) * VDW_TRESHOLD_FACTOR
+        if (d <= vdw_cutoff).any():
+            interactions.append(VanDerWaalsInteraction())
+
+        return interactions
+
+    # The legacy checks iterate a zip object returned by get_ring_descriptors inside nested comprehensions, which only
+    # compares the first ring of the first residue (and only the first charged atom for pi-cation). The same
+    # selection is used here to keep the results identical.
+    def _ring_pairs(self, i, j):
+        """Distances between ring centres and acute angles between ring planes (first ring of i x rings of j)"""
+        rings1 = self.rings[i][:1]
+        rings2 = self.rings[j]
+        if not rings1 or not rings2:
+            return np.zeros(0), np.zeros(0)
+        c1 = np.array([r[0] for r in rings1])
+        n1 = np.array([r[1] for r in rings1])
+        c2 = np.array([r[0] for r in rings2])
+        n2 = np.array([r[1] for r in rings2])
+        distances = np.sqrt(((c1[:, None, :] - c2[None, :, :]) ** 2).sum(axis=2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n1 = n1 / np.linalg.norm(n1, axis=1)[:, None]
+            n2 = n2 / np.linalg.norm(n2, axis=1)[:, None]
+            angles = np.arccos(np.clip(np.abs(n1.dot(n2.T)), -1.0, 1.0))
+        return distances.ravel(), np.degrees(angles).ravel()
+
+    def _has_face_to_face(self, i, j):
+        distances, angles = self._ring_pairs(i, j)
+        return bool(((angles <= 20) & (distances <= 5.0)).any())
+
+    def _has_edge_to_face(self, i, j):
+        distances, angles = self._ring_pairs(i, j)
+        return bool(((np.abs(angles - math.degrees(1.5707963267)) <= 30) & (distances <= 5.2)).any())
+
+    def _has_pi_cation(self, i, j):
+        rings = self.rings[i]
+        atom_names = get_pos_charged_atom_names(self.residues[j])
+        if not rings or not atom_names or atom_names[0] not in self.residues[j].child_dict:
+            return False
+        charged = self.residues[j].child_dict[atom_names[0]].coord
+        return any([np.linalg.norm(charged - r[0]) <= 6 for r in rings])
+
+    def get_aromatic_interactions(self, i, j):
+        res1 = self.residues[i]
+        res2 = self.residues[j]
+        interactions = []
+
+        if is_aromatic_aa(res1) and is_aromatic_aa(res2):
+            if self._has_face_to_face(i, j):
+                interactions.append(FaceToFaceInteraction())
+
+            if self._has_edge_to_face(i, j):
+                interactions.append(EdgeToFaceInteraction())
+
+            if self._has_edge_to_face(j, i):
+                interactions.append(FaceToEdgeInteraction())
+
+        if is_aromatic_aa(res1) and is_pos_charged(res2):
+            if self._has_pi_cation(i, j):
+                interactions.append(PiCationInteraction())
+
+        if is_pos_charged(res1) and is_aromatic_aa(res2):
+            if self._has_pi_cation(j, i):
+                interactions.append(CationPiInteraction())
+
+        return interactions
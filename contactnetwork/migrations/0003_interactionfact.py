@@ -0,0 +1,43 @@
+# Generated by Django 2.0.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('structure', '0001_initial'),
+        ('contactnetwork', '0002_auto_20180117_1457'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InteractionFact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pdb', models.CharField(max_length=20)),
+                ('interaction_type', models.CharField(max_length=50)),
+                ('res1_seq', models.IntegerField()),
+                ('res2_seq', models.IntegerField()),
+                ('gn1', models.CharField(max_length=12, null=True)),
+                ('gn2', models.CharField(max_length=12, null=True)),
+                ('segment1', models.CharField(max_length=20)),
+                ('segment2', models.CharField(max_length=20)),
+                ('aa1', models.CharField(max_length=1)),
+                ('aa2', models.CharField(max_length=1)),
+                ('structure', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='structure.Structure')),
+            ],
+            options={
+                'db_table': 'interaction_fact',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='interactionfact',
+            index=models.Index(fields=['pdb', 'interaction_type'], name='interaction_fact_pdb_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interactionfact',
+            index=models.Index(fields=['pdb', 'segment1', 'segment2'], name='interaction_fact_pdb_seg_idx'),
+        ),
+    ]
@@ -93,3 +93,25 @@ class PiCationInteraction(AromaticInteraction):
 
     class Meta():
         db_table = 'interaction_aromatic_pi_cation'
+
+
+class InteractionFact(models.Model):
+    """Denormalised copy of the interactions of a structure, one row per interaction, for fast aggregation"""
+    structure = models.ForeignKey('structure.Structure', on_delete=models.CASCADE)
+    pdb = models.CharField(max_length=20) # entry name of the structure protein
+    interaction_type = models.CharField(max_length=50) # model name, as polymorphic_ctype__model
+    res1_seq = models.IntegerField()
+    res2_seq = models.IntegerField()
+    gn1 = models.CharField(max_length=12, null=True)
+    gn2 = models.CharField(max_length=12, null=True)
+    segment1 = models.CharField(max_length=20)
+    segment2 = models.CharField(max_length=20)
+    aa1 = models.CharField(max_length=1)
+    aa2 = models.CharField(max_length=1)
+
+    class Meta():
+        db_table = 'interaction_fact'
+        indexes = [
+            models.Index(fields=['pdb', 'interaction_type'], name='interaction_fact_pdb_type_idx'),
+            models.Index(fields=['pdb', 'segment1', 'segment2'], name='interaction_fact_pdb_seg_idx'),
+        ]
@@ -27,3 +27,8 @@ def pdb_get_structure(pdb_name):
     # Return the structure
     p = PDBParser(QUIET=True)
     return p.get_structure(pdb_name, f)
+
+# Parse PDB data (e.g. the PdbData stored for a structure) without downloading it.
+def pdb_structure_from_data(pdb_name, pdb_data):
+    p = PDBParser(QUIET=True)
+    return p.get_structure(pdb_name, StringIO(pdb_data))
@@ -1,3 +1,212 @@
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory, SimpleTestCase
 
-# Create your tests here.
+from contactnetwork import frequencies, views
+from contactnetwork.grid import CONTACT_DISTANCE, InteractionGrid
+from contactnetwork.models import HydrophobicInteraction, InteractingResiduePair, PolarSidechainSidechainInteraction
+from protein.models import Protein, ProteinConformation, ProteinSegment
+from residue.models import Residue, ResidueGenericNumber
+from structure.models import Structure
+
+from Bio.PDB.Atom import Atom
+from Bio.PDB.Chain import Chain
+from Bio.PDB.NeighborSearch import NeighborSearch
+from Bio.PDB.Residue import Residue as PDBResidue
+from unittest import mock
+import json
+import numpy as np
+
+
+FACTS = [
+    ('2rh1', 'ionic', 131, 268, '3x50', '6x30', 'TM3', 'TM6', 'R', 'E'),
+    ('2rh1', 'hydrophobic', 131, 268, '3x50', '6x30', 'TM3', 'TM6', 'R', 'E'),
+    ('3sn6', 'ionic', 131, 268, '3x50', '6x30', 'TM3', 'TM6', 'R', 'E'),
+    ('3sn6', 'polar', 79, 320, '2x50', None, 'TM2', 'TM7', 'D', 'N'),
+]
+
+
+class AggregateFactsTestCase(SimpleTestCase):
+
+    def test_generic(self):
+        data = frequencies.aggregate_facts(FACTS)
+        self.assertEqual(sorted(data['pdbs']), ['2rh1', '3sn6'])
+        # pairs without generic numbers are skipped
+        self.assertEqual(list(data['interactions']), ['3x50,6x30'])
+        self.assertEqual(data['interactions']['3x50,6x30'], {'2rh1': ['ionic', 'hydrophobic'], '3sn6': ['ionic']})
+        self.assertEqual(data['frequencies']['3x50,6x30'], {'ionic': 2, 'hydrophobic': 1})
+        self.assertEqual(data['sequence_numbers'], ['3x50', '6x30'])
+
+    def test_sequence_numbers(self):
+        data = frequencies.aggregate_facts(FACTS, generic=False)
+        self.assertEqual(sorted(data['interactions']), ['131,268', '79,320'])
+        self.assertEqual(data['generic_map'], {131: '3x50', 268: '6x30', 79: '2x50'})
+        self.assertEqual(data['sequence_numbers'], [79, 131, 268, 320])
+        self.assertEqual(data['aa_map']['3sn6'][320], 'N')
+
+    def test_generic_number_order(self):
+        self.assertEqual(sorted(['6x30', '12x50', '3x50', '3x49'], key=frequencies.generic_number_key),
+            ['12x50', '3x49', '3x50', '6x30'])
+
+
+class ConsensusMapsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        # a private cache instead of the configured one
+        patch = mock.patch.object(frequencies, 'cache', LocMemCache('contactnetwork-tests', {}))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_cached_per_pdb_set(self):
+        maps = {'gn_map': {'3x50': 'R'}, 'pos_map': {131: 'R'}}
+        with mock.patch.object(frequencies, 'build_consensus_maps', return_value=maps) as build:
+            self.assertEqual(frequencies.consensus_maps(['2rh1', '3sn6']), maps)
+            self.assertEqual(frequencies.consensus_maps(['3sn6', '2rh1', '3sn6']), maps)
+            self.assertEqual(build.call_count, 1)
+            frequencies.consensus_maps(['2rh1', '3sn6'], generic=False)
+            self.assertEqual(build.call_count, 2)
+
+    def test_invalidate(self):
+        with mock.patch.object(frequencies, 'build_consensus_maps', return_value={}) as build:
+            frequencies.consensus_maps(['2rh1'])
+            frequencies.invalidate()
+            frequencies.consensus_maps(['2rh1'])
+            self.assertEqual(build.call_count, 2)
+
+
+def residue(sequence_number, amino_acid, segment, label=None):
+    return Residue(sequence_number=sequence_number, amino_acid=amino_acid, protein_segment=ProteinSegment(slug=segment),
+        generic_number=ResidueGenericNumber(label=label) if label else None)
+
+
+def pair_row(structure, pair, interaction):
+    """Row of an interaction as read from the pair tables by frequencies.pair_rows"""
+    return (structure.protein_conformation.protein.entry_name, interaction._meta.model_name,
+        pair.res1.sequence_number, pair.res2.sequence_number,
+        pair.res1.generic_number.label if pair.res1.generic_number else None,
+        pair.res2.generic_number.label if pair.res2.generic_number else None,
+        pair.res1.protein_segment.slug, pair.res2.protein_segment.slug, pair.res1.amino_acid, pair.res2.amino_acid)
+
+
+def fact_row(fact):
+    """Row of a fact as read by frequencies.fact_rows"""
+    return (fact.pdb, fact.interaction_type, fact.res1_seq, fact.res2_seq, fact.gn1, fact.gn2, fact.segment1,
+        fact.segment2, fact.aa1, fact.aa2)
+
+
+class InteractionDataTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(frequencies, 'cache', LocMemCache('contactnetwork-tests', {}))
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch.object(frequencies, 'consensus_maps', return_value={})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        # interacting pairs as built by build_contact_network
+        self.structure = Structure(protein_conformation=ProteinConformation(protein=Protein(entry_name='adrb2_human')))
+        r131 = residue(131, 'R', 'TM3', '3x50')
+        e268 = residue(268, 'E', 'TM6', '6x30')
+        n320 = residue(320, 'N', 'TM7')
+        pairs = [InteractingResiduePair(referenced_structure=self.structure, res1=r131, res2=e268),
+            InteractingResiduePair(referenced_structure=self.structure, res1=e268, res2=n320)]
+        self.interactions = [
+            (pairs[0], PolarSidechainSidechainInteraction(interacting_pair=pairs[0], is_charged_res1=True,
+                is_charged_res2=True)),
+            (pairs[0], HydrophobicInteraction(interacting_pair=pairs[0])),
+            (pairs[1], HydrophobicInteraction(interacting_pair=pairs[1])),
+        ]
+
+    def interaction_data(self, generic=True):
+        request = RequestFactory().get('/contactnetwork/interactiondata', {'pdbs[]': ['ADRB2_HUMAN'],
+            'generic': str(generic)})
+        return json.loads(views.InteractionData(request).content.decode('utf-8'))
+
+    def test_pairs_without_facts(self):
+        rows = [pair_row(self.structure, pair, i) for pair, i in self.interactions]
+        with mock.patch.object(frequencies, 'fact_pdbs', return_value=set()), \
+                mock.patch.object(frequencies, 'pair_rows', return_value=rows) as pair_rows:
+            data = self.interaction_data()
+            pair_rows.assert_called_once_with(['adrb2_human'], [], [])
+            self.assertEqual(data['interactions'], {'3x50,6x30': {'adrb2_human': ['polarsidechainsidechaininteraction',
+                'hydrophobicinteraction']}})
+            frequencies.invalidate()
+            self.assertEqual(sorted(self.interaction_data(generic=False)['interactions']), ['131,268', '268,320'])
+
+    def test_facts_of_built_pairs(self):
+        # the facts written next to the pairs give the same data
+        facts = [frequencies.interaction_fact(self.structure, pair, i) for pair, i in self.interactions]
+        rows = [pair_row(self.structure, pair, i) for pair, i in self.interactions]
+        self.assertEqual([fact_row(f) for f in facts], rows)
+        with mock.patch.object(frequencies, 'fact_pdbs', return_value={'adrb2_human'}), \
+                mock.patch.object(frequencies, 'fact_rows', return_value=[fact_row(f) for f in facts]), \
+                mock.patch.object(frequencies, 'pair_rows') as pair_rows:
+            data = self.interaction_data()
+            self.assertFalse(pair_rows.called)
+        self.assertEqual(list(data['interactions']), ['3x50,6x30'])
+        self.assertEqual(data['aa_map'], {'adrb2_human': {'3x50': 'R', '6x30': 'E'}})
+
+    def test_some_pdbs_without_facts(self):
+        with mock.patch.object(frequencies, 'fact_pdbs', return_value={'2rh1'}), \
+                mock.patch.object(frequencies, 'fact_rows', return_value=[FACTS[0]]) as fact_rows, \
+                mock.patch.object(frequencies, 'pair_rows', return_value=[FACTS[2]]) as pair_rows:
+            rows = frequencies.fetch_facts(['2rh1', '3sn6'])
+        fact_rows.assert_called_once_with(['2rh1'], [], [])
+        pair_rows.assert_called_once_with(['3sn6'], [], [])
+        self.assertEqual(rows, [FACTS[0], FACTS[2]])
+
+
+def pdb_residue(sequence_number, atoms):
+    """Alanine with atoms given as (name, element, coordinates)"""
+    res = PDBResidue((' ', sequence_number, ' '), 'ALA', ' ')
+    for name, element, coord in atoms:
+        res.add(Atom(name, np.array(coord, dtype=float), 0.0, 1.0, ' ', name.center(4), sequence_number, element))
+    return res
+
+
+class InteractionGridTestCase(SimpleTestCase):
+
+    def contact_pairs(self, residues):
+        """Sequence numbers of residue pairs within the cutoff, found with the grid and with NeighborSearch (as
+        before the grid)"""
+        chain = Chain('A')
+        for res in residues:
+            chain.add(res)
+        grid = InteractionGrid(chain)
+        grid_pairs = set([tuple(sorted([grid.residues[i].id[1], grid.residues[j].id[1]])) for i, j in
+            grid.candidate_pairs() if grid.distances(i, j).min() <= CONTACT_DISTANCE])
+        atoms = [atom for res in chain for atom in res]
+        legacy_pairs = set([tuple(sorted([r1.id[1], r2.id[1]])) for r1, r2 in
+            NeighborSearch(atoms).search_all(CONTACT_DISTANCE, 'R')])
+        return grid_pairs, legacy_pairs
+
+    def test_cutoff(self):
+        # atoms exactly at the cutoff are in contact, atoms just beyond it are not
+        grid_pairs, legacy_pairs = self.contact_pairs([
+            pdb_residue(1, [('CA', 'C', (0, 0, 0))]),
+            pdb_residue(2, [('CA', 'C', (CONTACT_DISTANCE, 0, 0))]),
+            pdb_residue(3, [('CA', 'C', (0, 0, 20))]),
+            pdb_residue(4, [('CA', 'C', (0, 0, 20 + CONTACT_DISTANCE + 0.001))]),
+        ])
+        self.assertEqual(grid_pairs, set([(1, 2)]))
+        self.assertEqual(grid_pairs, legacy_pairs)
+
+    def test_neighbouring_cells(self):
+        # single atoms, so the grid cells are as large as the cutoff; the atoms are in neighbouring (also diagonal)
+        # cells, some exactly at the cutoff
+        grid_pairs, legacy_pairs = self.contact_pairs([pdb_residue(n + 1, [('CA', 'C', coord)]) for n, coord in
+            enumerate([(4.25, 4.25, 4.25), (4.75, 4.75, 4.75), (8.75, 4.25, 4.25), (4.25, 4.25, -0.25),
+            (13.25, 4.25, 4.25)])])
+        self.assertEqual(grid_pairs, set([(1, 2), (1, 3), (1, 4), (2, 3), (3, 5)]))
+        self.assertEqual(grid_pairs, legacy_pairs)
+
+    def test_random_residues(self):
+        random = np.random.RandomState(1)
+        residues = []
+        for n in range(150):
+            center = random.uniform(0, 40, 3)
+            residues.append(pdb_residue(n + 1, [(name, name[0], center + random.uniform(-2, 2, 3)) for name in
+                ['N', 'CA', 'C', 'O', 'CB'][:random.randint(1, 6)]]))
+        grid_pairs, legacy_pairs = self.contact_pairs(residues)
+        self.assertTrue(len(grid_pairs) > 100)
+        self.assertEqual(grid_pairs, legacy_pairs)
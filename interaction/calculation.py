@@ -0,0 +1,672 @@
+from contactnetwork.residue import ANGLE_REFERENCES, ACCEPTING_REFERENCES
+from structure.coordinates import StructureCoordinates
+
+from collections import OrderedDict
+import logging
+import re
+import numpy as np
+
+try:
+    from openbabel import pybel
+except ImportError:
+    try:
+        import pybel
+    except ImportError:
+        # InChIKeys and SMILES of ligands are left empty, ligand chemistry is perceived from the geometry
+        pybel = None
+
+
+# distance cutoffs (in Å) and angles (in degrees) of the interaction types
+CONTACT_DISTANCE = 5
+HYDROPHOBIC_DISTANCE = 4.5
+SCORE_DISTANCE = 4.5
+HBOND_DISTANCE = 3.3
+HYDROGEN_ACCEPTOR_DISTANCE = 2.5
+HYDROGEN_ANGLE = 60
+AROMATIC_DISTANCE = 5
+EDGE_DISTANCE = 4.5
+CATION_DISTANCE = 4.2
+
+# maximum angle between the antecedent -> donor and donor -> acceptor vectors, used when hydrogens are not in the
+# structure
+ANTECEDENT_ANGLE = 120
+
+# sodium and water are not ligands
+IGNORE_HET = ['NA', 'HOH', 'WAT']
+
+AA = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
+      'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+      'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K',
+      'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+      'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'}
+HYDROPHOBIC_AA = {'A', 'C', 'F', 'I', 'L', 'M', 'P', 'V', 'W', 'Y'}
+AROMATIC_AA = {'TYR', 'TRP', 'PHE', 'HIS'}
+CHARGED_AA = {'ARG', 'LYS', 'ASP', 'GLU'}
+POSITIVE_AA = {'HIS', 'LYS', 'ARG'}
+NEGATIVE_AA = {'ASP', 'GLU'}
+
+# aromatic rings of amino acids, the normal is calculated from the first and third atom
+RESIDUE_RINGS = {
+    'PHE': [['CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ']],
+    'TYR': [['CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ']],
+    'TRP': [['CG', 'CD1', 'CD2', 'CE2', 'NE1'], ['CD2', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2']],
+    'HIS': [['CG', 'ND1', 'CD2', 'CE1', 'NE2']],
+}
+
+# geometry based perception of ligand chemistry
+COVALENT_RADII = {'H': 0.31, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'F': 0.57, 'P': 1.07, 'S': 1.05, 'CL': 1.02,
+    'BR': 1.2, 'I': 1.39}
+DEFAULT_COVALENT_RADIUS = 0.8
+BOND_TOLERANCE = 0.45
+RING_PLANARITY = 0.15 # maximum distance of ring atoms to the ring plane
+RING_ELEMENTS = ['C', 'N', 'O', 'S']
+SINGLE_CN_BOND = 1.42 # shorter C-N bonds are (partial) double bonds
+DOUBLE_BOND = 1.38
+HYDROXYL_BOND = 1.3 # longer C-O bonds are single bonds
+
+# pH at which Open Babel protonates ligands
+LIGAND_PH = 7.4
+
+logger = logging.getLogger('protwis')
+
+
+def angle(v1, v2):
+    """Angle between two vectors in degrees"""
+    norm = np.linalg.norm(v1) * np.linalg.norm(v2)
+    if not norm:
+        return 0.0
+    return float(np.degrees(np.arccos(np.clip(np.dot(v1, v2) / norm, -1, 1))))
+
+
+def ring_descriptor(coords):
+    """Center and normal of a ring"""
+    center = coords.mean(axis=0)
+    return center, np.cross(center - coords[0], center - coords[2])
+
+
+def hbond_geometry(donor, hydrogens, antecedent, acceptor):
+    """Whether the donor can make an H-bond to the acceptor, from the hydrogen positions if known"""
+    if len(hydrogens):
+        for hydrogen in hydrogens:
+            binding = acceptor - hydrogen
+            if (np.linalg.norm(binding) <= HYDROGEN_ACCEPTOR_DISTANCE
+                and angle(hydrogen - donor, binding) <= HYDROGEN_ANGLE):
+                return True
+        return False
+    if antecedent is None:
+        return True
+    return angle(donor - antecedent, acceptor - donor) <= ANTECEDENT_ANGLE
+
+
+def is_carboxyl_oxygen(atom):
+    """OBAtom.IsCarboxylOxygen, which was removed in Open Babel 3"""
+    if hasattr(atom, 'IsCarboxylOxygen'):
+        return atom.IsCarboxylOxygen()
+    if atom.GetAtomicNum() != 8 or atom.GetHvyDegree() != 1:
+        return False
+    for carbon in pybel.ob.OBAtomAtomIter(atom):
+        if carbon.GetAtomicNum() != 6 or carbon.GetHvyDegree() != 3:
+            return False
+        oxygens = [a for a in pybel.ob.OBAtomAtomIter(carbon) if a.GetAtomicNum() == 8 and a.GetHvyDegree() == 1]
+        return len(oxygens) == 2
+    return False
+
+
+def split_fragment(pdb):
+    """Ligand fragment and residue (rotamer) PDB text of an interaction fragment"""
+    fragment_pdb = ''
+    rotamer_pdb = ''
+    for line in pdb.splitlines(True):
+        if line.startswith('HETATM') or line.startswith('CONECT') or line.startswith('MASTER') or line.startswith('END'):
+            fragment_pdb += line
+        elif line.startswith('ATOM'):
+            rotamer_pdb += line
+        else:
+            fragment_pdb += line
+            rotamer_pdb += line
+    return fragment_pdb, rotamer_pdb
+
+
+class LigandChemistry:
+    """Bonds, aromatic rings, charged atoms and H-bond donors/acceptors of a ligand
+
+    Rings, charges and H-bond atoms are perceived by Open Babel when it is available, and guessed from the geometry
+    otherwise."""
+    def __init__(self, coords, elements, pdb=None):
+        """
+        @param coords: array (atoms x 3) of ligand coordinates
+        @param elements: array of the element symbols of the atoms
+        @param pdb: PDB text of the ligand atoms in the same order, read by Open Babel
+        """
+        self.coords = coords
+        self.elements = elements
+        n = len(coords)
+        radii = np.array([COVALENT_RADII.get(e, DEFAULT_COVALENT_RADIUS) for e in elements])
+        self.distances = np.sqrt(((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2))
+        self.bonds = (self.distances < radii[:, None] + radii[None, :] + BOND_TOLERANCE) & (self.distances > 0.4)
+        self.hydrogen = elements == 'H'
+        heavy_bonds = self.bonds & ~self.hydrogen[:, None] & ~self.hydrogen[None, :]
+        self.neighbours = [np.nonzero(heavy_bonds[i])[0].tolist() for i in range(n)]
+        self.hydrogens = [np.nonzero(self.bonds[i] & self.hydrogen)[0].tolist() if not self.hydrogen[i] else []
+            for i in range(n)]
+
+        if not (pdb and pybel and self.perceive_openbabel(pdb)):
+            self.perceive_geometry()
+        self.ring_descriptors = [ring_descriptor(coords[ring]) for ring in self.rings]
+
+    def perceive_openbabel(self, pdb):
+        """Aromatic rings, charges and H-bond atoms of the ligand protonated by Open Babel, returns False if the
+        molecule could not be read or does not match the ligand atoms"""
+        n = len(self.coords)
+        try:
+            mol = pybel.readstring('pdb', pdb)
+            atoms = mol.atoms
+            if len(atoms) != n or not np.allclose([a.coords for a in atoms], self.coords, atol=0.01):
+                logger.debug('Open Babel atoms do not match the ligand atoms')
+                return False
+            mol.OBMol.AddHydrogens(False, True, LIGAND_PH)
+            # the added hydrogens follow the ligand atoms
+            atoms = mol.atoms
+
+            # ring atoms in atom order, their first and third atom define the ring normal
+            self.rings = [[a.idx - 1 for a in atoms[:n] if ring.IsMember(a.OBAtom)]
+                for ring in mol.OBMol.GetSSSR() if ring.IsAromatic()]
+            self.ring_atoms = set([a for ring in self.rings for a in ring])
+
+            self.charges = OrderedDict()
+            self.donors = OrderedDict()
+            self.acceptors = set()
+            for i, atom in enumerate(atoms[:n]):
+                if atom.formalcharge:
+                    self.charges[i] = atom.formalcharge
+                if is_carboxyl_oxygen(atom.OBAtom):
+                    self.charges[i] = -1
+                if atom.OBAtom.IsHbondDonor():
+                    self.donors[i] = np.array([atoms[h.GetIdx() - 1].coords for h in
+                        pybel.ob.OBAtomAtomIter(atom.OBAtom) if h.GetAtomicNum() == 1]).reshape(-1, 3)
+                if atom.OBAtom.IsHbondAcceptor():
+                    self.acceptors.add(i)
+        except Exception as msg:
+            logger.debug('Open Babel perception of ligand failed: {}'.format(msg))
+            return False
+        return True
+
+    def perceive_geometry(self):
+        """Aromatic rings, charges and H-bond atoms guessed from bond lengths and planarity"""
+        self.rings = self.find_rings()
+        self.ring_atoms = set([a for ring in self.rings for a in ring])
+        self.charges = self.find_charges()
+        self.donors, self.acceptors = self.find_hbond_atoms()
+
+    def find_rings(self):
+        """Planar 5 and 6 membered rings (considered aromatic) as lists of atom indices"""
+        cycles = []
+        seen = set()
+
+        def extend(path):
+            for n in self.neighbours[path[-1]]:
+                if n == path[0] and len(path) >= 5:
+                    if frozenset(path) not in seen:
+                        seen.add(frozenset(path))
+                        cycles.append(list(path))
+                elif n > path[0] and n not in path and len(path) < 6:
+                    extend(path + [n])
+
+        for i in range(len(self.coords)):
+            if not self.hydrogen[i]:
+                extend([i])
+
+        rings = []
+        for cycle in cycles:
+            if any([self.elements[a] not in RING_ELEMENTS for a in cycle]):
+                continue
+            centered = self.coords[cycle] - self.coords[cycle].mean(axis=0)
+            normal = np.linalg.svd(centered)[2][-1]
+            if np.abs(centered.dot(normal)).max() < RING_PLANARITY:
+                rings.append(cycle)
+        return rings
+
+    def is_terminal_oxygen(self, i):
+        return self.elements[i] == 'O' and len(self.neighbours[i]) == 1
+
+    def is_unsaturated(self, i):
+        """Whether a carbon is aromatic or has a double bond"""
+        return i in self.ring_atoms or any([self.distances[i, j] < (HYDROXYL_BOND if self.elements[j] == 'O'
+            else DOUBLE_BOND) for j in self.neighbours[i]])
+
+    def find_charges(self):
+        """Formal charges by atom index: -1 for carboxylate, phosphate and sulfonate oxygens, 1 for amine, quaternary
+        and amidine/guanidine nitrogens (protonation states at pH 7.4)"""
+        charges = OrderedDict()
+        elements = self.elements
+        for i, element in enumerate(elements):
+            oxygens = [j for j in self.neighbours[i] if self.is_terminal_oxygen(j)]
+            if ((element == 'C' and len(oxygens) == 2 and len(self.neighbours[i]) == 3)
+                or (element in ('P', 'S') and len(oxygens) >= 3)):
+                for j in oxygens:
+                    charges[j] = -1
+
+        for i, element in enumerate(elements):
+            if element != 'N' or i in self.ring_atoms:
+                continue
+            neighbours = self.neighbours[i]
+            if len(neighbours) == 4:
+                charges[i] = 1
+            elif (neighbours and all([elements[j] == 'C' and self.distances[i, j] >= SINGLE_CN_BOND
+                and not self.is_unsaturated(j) for j in neighbours])):
+                charges[i] = 1
+
+        for i, element in enumerate(elements):
+            if element != 'C' or i in self.ring_atoms or len(self.neighbours[i]) != 3:
+                continue
+            nitrogens = [j for j in self.neighbours[i] if elements[j] == 'N' and j not in self.ring_atoms]
+            if len(nitrogens) >= 2 and not any([elements[j] == 'O' for j in self.neighbours[i]]):
+                for j in nitrogens:
+                    charges[j] = 1
+        return charges
+
+    def find_hbond_atoms(self):
+        """H-bond donors (atom index -> hydrogen coordinates) and acceptors (atom indices)"""
+        donors = OrderedDict()
+        acceptors = set()
+        has_hydrogens = self.hydrogen.any()
+        for i, element in enumerate(self.elements):
+            if element not in ('N', 'O'):
+                continue
+            neighbours = self.neighbours[i]
+            if has_hydrogens:
+                donor = bool(self.hydrogens[i])
+            elif element == 'O':
+                # hydroxyl groups
+                donor = (len(neighbours) == 1 and self.distances[i, neighbours[0]] > HYDROXYL_BOND
+                    and i not in self.charges)
+            else:
+                # nitrogens with hydrogens, except in six membered aromatic rings
+                donor = len(neighbours) < 3 and not any([i in ring and len(ring) == 6 for ring in self.rings])
+                donor = donor or self.charges.get(i) == 1
+            if donor:
+                donors[i] = self.coords[self.hydrogens[i]].reshape(-1, 3)
+
+            if element == 'O':
+                acceptors.add(i)
+            elif (len(neighbours) < 3 and self.charges.get(i) != 1 and not any([self.elements[j] == 'C'
+                and any([self.is_terminal_oxygen(k) for k in self.neighbours[j]]) for j in neighbours])):
+                # not in amides
+                acceptors.add(i)
+        return donors, acceptors
+
+    def antecedent(self, i):
+        """Mean position of the heavy atom neighbours of an atom"""
+        if not self.neighbours[i]:
+            return None
+        return self.coords[self.neighbours[i]].mean(axis=0)
+
+    def within_bonds(self, i, steps=2):
+        """Mask of the atoms at most steps bonds away from an atom"""
+        mask = np.zeros(len(self.coords), dtype=bool)
+        mask[i] = True
+        for step in range(steps):
+            mask |= self.bonds[mask].any(axis=0)
+        return mask
+
+
+class InteractionCalculation:
+    """Interactions between the ligands (or a peptide chain) and the receptor of a parsed structure
+
+    Follows the earlier file based calculation: the same interaction types and cutoffs, and the same order in which
+    interactions replace each other. Distances are computed as arrays per ligand, and fragments are cut from the PDB
+    text in memory."""
+    def __init__(self, coordinates, peptide=None):
+        self.coordinates = coordinates
+        self.peptide = peptide or None
+
+        atoms = coordinates.atoms
+        self.coords = np.asarray(atoms['coord'], dtype=float)
+        self.names = np.array([n.decode('ascii', 'replace').strip() for n in atoms['name']], dtype=object)
+        self.resnames = np.array([n.decode('ascii', 'replace').strip() for n in atoms['resname']], dtype=object)
+        self.chains = np.array([c.decode('ascii', 'replace') for c in atoms['chain']], dtype=object)
+        self.resseq = np.asarray(atoms['resseq'])
+        self.icodes = np.array([c.decode('ascii', 'replace') for c in atoms['icode']], dtype=object)
+        elements = [e.decode('ascii', 'replace').strip() for e in atoms['element']]
+        self.elements = np.array([e or re.sub('[^A-Z]', '', n)[:1] for e, n in zip(elements, self.names)],
+            dtype=object)
+        self.first_model = np.asarray(atoms['model']) == 0
+        self.hetatm = np.asarray(atoms['hetatm'])
+        self.lines = np.asarray(atoms['line'])
+
+        # receptor atoms and their residues
+        receptor = self.first_model & ~self.hetatm
+        if self.peptide:
+            receptor &= self.chains != self.peptide
+        self.receptor = np.nonzero(receptor)[0]
+        self.residue_keys = []
+        self.residue_atoms = []
+        residue_index = {}
+        self.atom_residue = np.full(len(self.coords), -1, dtype=int)
+        for i in self.receptor.tolist():
+            key = (self.chains[i], int(self.resseq[i]), self.icodes[i])
+            if key not in residue_index:
+                residue_index[key] = len(self.residue_keys)
+                self.residue_keys.append(key)
+                self.residue_atoms.append([])
+            self.residue_atoms[residue_index[key]].append(i)
+            self.atom_residue[i] = residue_index[key]
+
+    def find_ligands(self):
+        """Atom indices of each ligand, the first residue of each HET group or all atoms of the peptide chain"""
+        ligands = OrderedDict()
+        if self.peptide:
+            atoms = np.nonzero(self.first_model & (self.chains == self.peptide))[0]
+            if len(atoms):
+                ligands['pep'] = atoms
+            return ligands
+
+        first_residue = {}
+        for i in np.nonzero(self.first_model & self.hetatm)[0].tolist():
+            name = self.resnames[i]
+            if name in IGNORE_HET:
+                continue
+            residue = (self.chains[i], int(self.resseq[i]), self.icodes[i])
+            if name not in first_residue:
+                first_residue[name] = residue
+                ligands[name] = []
+            if first_residue[name] == residue:
+                ligands[name].append(i)
+        return OrderedDict([(name, np.array(atoms)) for name, atoms in ligands.items()])
+
+    def hetsyn_names(self):
+        names = {}
+        text = self.coordinates.text.tobytes().decode('utf-8')
+        for line in text.split('\n'):
+            if line.startswith('HETSYN'):
+                m = re.match("HETSYN[\s]+([\w]{3})[\s]+(.+)", line)
+                if m:
+                    names[m.group(1)] = m.group(2).strip()
+        return names
+
+    def pdb_text(self, atoms):
+        """PDB text of the lines of the given atoms"""
+        mask = np.zeros(len(self.coordinates.lines), dtype=bool)
+        mask[self.lines[atoms]] = True
+        return self.coordinates.pdb_text(mask) + '\nEND\n'
+
+    def residue_atom(self, residue, name):
+        for i in self.residue_atoms[residue]:
+            if self.names[i] == name:
+                return i
+        return None
+
+    def residue_name(self, residue):
+        chain, resseq, icode = self.residue_keys[residue]
+        return self.resnames[self.residue_atoms[residue][0]] + str(resseq) + chain
+
+    def run(self):
+        """Results of all ligands with receptor contacts, as written by the earlier file based calculation"""
+        results = OrderedDict()
+        hetsyn = self.hetsyn_names()
+        for ligand, atoms in self.find_ligands().items():
+            result = self.ligand_interactions(atoms)
+            if result is None:
+                continue
+            if ligand in hetsyn:
+                result['prettyname'] = hetsyn[ligand]
+            results[ligand] = result
+        return results
+
+    def ligand_interactions(self, ligand_atoms):
+        """Interactions and score of a ligand, None if no receptor atom is within the contact distance"""
+        ligand_pdb = self.pdb_text(ligand_atoms)
+        chemistry = LigandChemistry(self.coords[ligand_atoms], self.elements[ligand_atoms], ligand_pdb)
+        ligand_coords = self.coords[ligand_atoms]
+        ligand_names = self.names[ligand_atoms]
+        ligand_carbon = np.array([n.startswith('C') for n in ligand_names], dtype=bool)
+        ligand_hydrogen = np.array([n.startswith('H') for n in ligand_names], dtype=bool)
+
+        # receptor atoms that can be within the contact distance
+        center = ligand_coords.mean(axis=0)
+        radius = np.sqrt(((ligand_coords - center) ** 2).sum(axis=1)).max()
+        near = self.receptor[np.sqrt(((self.coords[self.receptor] - center) ** 2).sum(axis=1))
+            <= radius + CONTACT_DISTANCE]
+        distances = np.sqrt(((ligand_coords[:, None, :] - self.coords[near][None, :, :]) ** 2).sum(axis=2))
+        if not (distances < CONTACT_DISTANCE).any():
+            return None
+
+        self.interactions = []
+        contacts = []
+        residues = []
+        near_residues = self.atom_residue[near]
+        for residue in OrderedDict.fromkeys(near_residues[(distances < CONTACT_DISTANCE).any(axis=0)].tolist()):
+            columns = np.nonzero(near_residues == residue)[0]
+            block = distances[:, columns]
+            atoms = near[columns]
+            names = self.names[atoms]
+            resname = self.resnames[atoms[0]]
+            aaname = self.residue_name(residue)
+            residues.append(residue)
+
+            residue_hydrogen = np.array([n.startswith('H') or e == 'H' for n, e in zip(names,
+                self.elements[atoms])], dtype=bool)
+            contact = (block < CONTACT_DISTANCE) & ~ligand_hydrogen[:, None] & ~residue_hydrogen[None, :]
+            pairs = [(i, atoms[j], round(float(block[i, j]), 2)) for i, j in np.argwhere(contact).tolist()]
+            contacts.append((residue, aaname, resname, pairs))
+
+            # accessible
+            if ((block < CONTACT_DISTANCE) & ~np.isin(names, ['C', 'O', 'N'])[None, :]).any():
+                self.interactions.append([aaname, self.pdb_text(self.residue_atoms[residue]), 'acc', 'accessible',
+                    'hidden', ''])
+
+            # hydrophobic, min 3 ligand carbons in contact with residue carbons
+            residue_carbon = np.array([n.startswith('C') for n in names], dtype=bool)
+            hydrophobic_count = ((block < HYDROPHOBIC_DISTANCE) & residue_carbon[None, :]).any(axis=1)[ligand_carbon].sum()
+            if hydrophobic_count > 2 and AA.get(resname) in HYDROPHOBIC_AA:
+                self.interactions.append([aaname, self.pdb_text(self.residue_atoms[residue]), 'hyd', 'hydrophobic',
+                    'hydrophobic', ''])
+
+            if len(pairs) > 1 and resname in AROMATIC_AA:
+                self.aromatic_interactions(residue, aaname, resname, ligand_atoms, chemistry)
+
+        score = 0
+        for residue, aaname, resname, pairs in contacts:
+            score += self.polar_interactions(residue, aaname, resname, pairs, ligand_atoms, chemistry)
+
+        binding_residues = set([i[0] for i in self.interactions])
+        complex_atoms = list(ligand_atoms)
+        for residue in residues:
+            if self.residue_name(residue) in binding_residues:
+                complex_atoms += self.residue_atoms[residue]
+
+        inchikey = ''
+        smiles = ''
+        if pybel:
+            try:
+                mol = pybel.readstring('pdb', ligand_pdb)
+                inchikey = mol.write('inchikey').strip()
+                smiles = mol.write('smi').split('\t')[0].strip()
+            except Exception:
+                pass
+
+        return OrderedDict([
+            ('interactions', self.interactions),
+            ('score', score),
+            ('inchikey', inchikey),
+            ('smiles', smiles),
+            ('pdb', self.pdb_text(complex_atoms)),
+        ])
+
+    def remove_hydrophobic(self, aaname):
+        self.interactions = [i for i in self.interactions if not (i[0] == aaname and i[2] in ('HYD', 'hyd'))]
+
+    def check_other_aromatic(self, aaname, info):
+        """Remove an earlier aromatic interaction of the residue if the new one is closer, returns whether the new one
+        should be added"""
+        kept = []
+        check = True
+        for i in self.interactions:
+            if i[0] == aaname and i[4] == 'aromatic':
+                if info['Distance'] > i[6]['Distance']:
+                    kept.append(i)
+                    check = False
+            else:
+                kept.append(i)
+        self.interactions = kept
+        return check
+
+    def aromatic_interactions(self, residue, aaname, resname, ligand_atoms, chemistry):
+        for ring_names in RESIDUE_RINGS[resname]:
+            ring_atoms = [self.residue_atom(residue, name) for name in ring_names]
+            if None in ring_atoms:
+                continue
+            ring_coords = self.coords[ring_atoms]
+            center, normal = ring_descriptor(ring_coords)
+
+            for count, (ring, (ligand_center, ligand_normal)) in enumerate(zip(chemistry.rings,
+                chemistry.ring_descriptors), 1):
+                ligand_ring_coords = chemistry.coords[ring]
+                shortest_het_center_to_res_atom = min(10, np.sqrt(((ring_coords - ligand_center) ** 2).sum(axis=1)).min())
+                shortest_res_center_to_het_atom = min(10, np.sqrt(((ligand_ring_coords - center) ** 2).sum(axis=1)).min())
+                angles = [round(angle(center - ligand_center, ligand_normal), 1),
+                    round(angle(center - ligand_center, normal), 1), round(angle(ligand_normal, normal), 1)]
+                distance = round(float(np.linalg.norm(center - ligand_center)), 2)
+                info = OrderedDict([('Distance', distance),
+                    ('ResAtom to center', round(float(shortest_het_center_to_res_atom), 2)),
+                    ('LigAtom to center', round(float(shortest_res_center_to_het_atom), 2)), ('Angles', angles)])
+
+                if distance < AROMATIC_DISTANCE and (angles[2] < 20 or abs(angles[2] - 180) < 20):
+                    interaction = ['aro_ff', 'aromatic (face-to-face)', 'aromatic', 'none']
+                elif (shortest_res_center_to_het_atom < EDGE_DISTANCE and abs(angles[0] - 90) < 30
+                    and abs(angles[2] - 90) < 30):
+                    interaction = ['aro_fe_protein', 'aromatic (face-to-edge)', 'aromatic', 'protein']
+                elif (shortest_het_center_to_res_atom < EDGE_DISTANCE and abs(angles[1] - 90) < 30
+                    and abs(angles[2] - 90) < 30):
+                    interaction = ['aro_ef_protein', 'aromatic (edge-to-face)', 'aromatic', 'protein']
+                else:
+                    continue
+
+                if self.check_other_aromatic(aaname, info):
+                    fragment = self.pdb_text(list(ligand_atoms[ring]) + self.residue_atoms[residue])
+                    self.interactions.append([aaname, fragment] + interaction + [info])
+                    self.remove_hydrophobic(aaname)
+
+            # pi-cation with positively charged ligand atoms
+            for i, charge in chemistry.charges.items():
+                distance = round(float(np.linalg.norm(center - chemistry.coords[i])), 2)
+                if distance < CATION_DISTANCE and charge > 0:
+                    fragment = self.pdb_text([ligand_atoms[i]] + self.residue_atoms[residue])
+                    self.interactions.append([aaname, fragment, 'aro_ion_protein', 'aromatic (pi-cation)', 'aromatic',
+                        'protein', {'Distance': distance}])
+                    self.remove_hydrophobic(aaname)
+
+    def residue_donor(self, residue, resname, name):
+        """Antecedent atom name of a residue H-bond donor (None without reference) or False if not a donor"""
+        if name == 'N':
+            return 'CA' if resname != 'PRO' else False
+        if resname in ANGLE_REFERENCES and name in ANGLE_REFERENCES[resname]:
+            references = ANGLE_REFERENCES[resname][name]
+            return references[0][0] if references else None
+        return False
+
+    def residue_hydrogens(self, residue, donor):
+        return [self.coords[i] for i in self.residue_atoms[residue] if self.elements[i] == 'H'
+            and np.linalg.norm(self.coords[i] - self.coords[donor]) < 1.2]
+
+    def polar_interactions(self, residue, aaname, resname, pairs, ligand_atoms, chemistry):
+        """Add the polar interactions of a residue, returns the contact score of the residue"""
+        score = 0
+        for i, atom, distance in pairs:
+            ligand_name = self.names[ligand_atoms[i]]
+            name = self.names[atom]
+            if distance < HBOND_DISTANCE and not (ligand_name.startswith('C') or name.startswith('C')):
+                ligand_coord = chemistry.coords[i]
+                residue_coord = self.coords[atom]
+                hbond_confirmed = []
+                hydrogen_match = False
+                res_is_donor = False
+                res_is_acceptor = False
+
+                antecedent = self.residue_donor(residue, resname, name)
+                if antecedent is not False:
+                    res_is_donor = True
+                    res_is_acceptor = (name in ACCEPTING_REFERENCES.get(resname, {}))
+                    antecedent_atom = self.residue_atom(residue, antecedent) if antecedent else None
+                    if hbond_geometry(residue_coord, self.residue_hydrogens(residue, atom),
+                        self.coords[antecedent_atom] if antecedent_atom is not None else None, ligand_coord):
+                        hydrogen_match = True
+                        hbond_confirmed.append('D')
+
+                found_donor = i in chemistry.donors
+                if found_donor and hbond_geometry(ligand_coord, chemistry.donors[i],
+                    chemistry.antecedent(i), residue_coord):
+                    hydrogen_match = True
+                    hbond_confirmed.append('A')
+
+                found_acceptor = i in chemistry.acceptors
+                if found_acceptor and not found_donor and res_is_donor:
+                    hydrogen_match = True
+                    hbond_confirmed.append('D')
+                if not found_acceptor and found_donor and res_is_acceptor:
+                    hydrogen_match = True
+                    hbond_confirmed.append('A')
+                if found_acceptor and found_donor:
+                    if res_is_donor and not res_is_acceptor:
+                        hydrogen_match = True
+                        hbond_confirmed.append('D')
+                    elif not res_is_donor and res_is_acceptor:
+                        hydrogen_match = True
+                        hbond_confirmed.append('A')
+
+                charged_check = False
+                double_charge_check = False
+                charge_value = chemistry.charges.get(i, 0)
+                res_charge_value = 0
+                if charge_value:
+                    charged_check = True
+                    hydrogen_match = False
+                if resname in CHARGED_AA:
+                    double_charge_check = charged_check
+                    charged_check = True
+                    hydrogen_match = False
+                    res_charge_value = 1 if resname in POSITIVE_AA else -1
+
+                fragment = self.pdb_text(list(ligand_atoms[chemistry.within_bonds(i)]) + self.residue_atoms[residue])
+                details = [ligand_name, name, distance]
+                if name in ('N', 'O'):
+                    # backbone
+                    interaction = ['polar_backbone', 'polar (hydrogen bond with backbone)', 'polar', 'protein']
+                elif hydrogen_match:
+                    if hbond_confirmed[0] == 'D':
+                        interaction = ['polar_donor_protein', 'polar (hydrogen bond)', 'polar', 'protein']
+                    else:
+                        interaction = ['polar_acceptor_protein', 'polar (hydrogen bond)', 'polar', 'protein']
+                elif charged_check:
+                    if double_charge_check:
+                        if res_charge_value > 0:
+                            interaction = ['polar_double_pos_protein', 'polar (charge-charge)', 'polar', '']
+                        else:
+                            interaction = ['polar_double_neg_protein', 'polar (charge-charge)', 'polar', '']
+                    elif charge_value > 0:
+                        interaction = ['polar_pos_ligand', 'polar (charge-assisted hydrogen bond)', 'polar', 'ligand']
+                    elif charge_value < 0:
+                        interaction = ['polar_neg_ligand', 'polar (charge-assisted hydrogen bond)', 'polar', 'ligand']
+                    elif res_charge_value > 0:
+                        interaction = ['polar_pos_protein', 'polar (charge-assisted hydrogen bond)', 'polar',
+                            'protein']
+                    else:
+                        interaction = ['polar_neg_protein', 'polar (charge-assisted hydrogen bond)', 'polar',
+                            'protein']
+                else:
+                    interaction = ['polar_unspecified', 'polar (hydrogen bond)', 'polar', '']
+                self.interactions.append([aaname, fragment] + interaction + details)
+                self.remove_hydrophobic(aaname)
+
+            if distance < SCORE_DISTANCE:
+                score += SCORE_DISTANCE - distance
+        return round(score, 2)
+
+
+def calculate_interactions(pdb, peptide=None):
+    """Interactions of all ligands (or the peptide chain) with the receptor in PDB text
+
+    Returns an OrderedDict of ligand -> result with the interactions, score, InChIKey, SMILES and HETSYN name (if
+    known) as written by the earlier file based calculation. Each interaction has the PDB text of its fragment instead
+    of a fragment file, and the ligand with its binding residues is included as 'pdb'."""
+    return InteractionCalculation(StructureCoordinates.from_pdb(pdb), peptide).run()
@@ -1,3 +1,105 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from interaction import calculation
+from interaction.calculation import LigandChemistry, calculate_interactions
+
+from unittest import mock, skipUnless
+import numpy as np
+
+
+# 4-(2-aminoethyl)benzoic acid, without hydrogens as in crystal structures
+LIGAND = [
+    'HETATM    1  C1  AEB A 401       1.390   0.000   0.000  1.00  0.00           C',
+    'HETATM    2  C2  AEB A 401       0.695   1.204   0.000  1.00  0.00           C',
+    'HETATM    3  C3  AEB A 401      -0.695   1.204   0.000  1.00  0.00           C',
+    'HETATM    4  C4  AEB A 401      -1.390   0.000   0.000  1.00  0.00           C',
+    'HETATM    5  C5  AEB A 401      -0.695  -1.204   0.000  1.00  0.00           C',
+    'HETATM    6  C6  AEB A 401       0.695  -1.204   0.000  1.00  0.00           C',
+    'HETATM    7  C7  AEB A 401       2.890   0.000   0.000  1.00  0.00           C',
+    'HETATM    8  O1  AEB A 401       3.520   1.091   0.000  1.00  0.00           O',
+    'HETATM    9  O2  AEB A 401       3.520  -1.091   0.000  1.00  0.00           O',
+    'HETATM   10  C8  AEB A 401      -2.900   0.000   0.000  1.00  0.00           C',
+    'HETATM   11  C9  AEB A 401      -3.400   1.425   0.000  1.00  0.00           C',
+    'HETATM   12  N1  AEB A 401      -4.870   1.425   0.000  1.00  0.00           N',
+]
+
+# aspartate in salt bridge distance of the amine
+RESIDUE = [
+    'ATOM     13  CB  ASP A 100      -7.650   3.820   0.000  1.00  0.00           C',
+    'ATOM     14  CG  ASP A 100      -8.400   2.516   0.000  1.00  0.00           C',
+    'ATOM     15  OD1 ASP A 100      -7.770   1.425   0.000  1.00  0.00           O',
+    'ATOM     16  OD2 ASP A 100      -9.660   2.516   0.000  1.00  0.00           O',
+]
+
+
+def ligand_chemistry(pdb_lines):
+    coords = np.array([[float(l[30:38]), float(l[38:46]), float(l[46:54])] for l in pdb_lines])
+    elements = np.array([l[76:78].strip() for l in pdb_lines], dtype=object)
+    return LigandChemistry(coords, elements, '\n'.join(pdb_lines) + '\nEND\n')
+
+
+def legacy_perception(pdb):
+    """Rings, charges, donors and acceptors as perceived with Open Babel by the earlier file based calculation"""
+    pybel = calculation.pybel
+    mol = pybel.readstring('pdb', pdb)
+    mol.OBMol.AddHydrogens(False, True, 7.4)
+    rings = []
+    for ring in mol.OBMol.GetSSSR():
+        if ring.IsAromatic():
+            rings.append([atom.idx - 1 for atom in mol if ring.IsMember(atom.OBAtom)])
+    charges = {}
+    donors = {}
+    acceptors = set()
+    for atom in mol:
+        if atom.formalcharge != 0:
+            charges[atom.idx - 1] = atom.formalcharge
+        if calculation.is_carboxyl_oxygen(atom.OBAtom):
+            charges[atom.idx - 1] = -1
+        if atom.OBAtom.IsHbondDonor():
+            donors[atom.idx - 1] = len([n for n in pybel.ob.OBAtomAtomIter(atom.OBAtom) if n.GetAtomicNum() == 1])
+        if atom.OBAtom.IsHbondAcceptor():
+            acceptors.add(atom.idx - 1)
+    return rings, charges, donors, acceptors
+
+
+class LigandChemistryTestCase(SimpleTestCase):
+
+    def test_geometry(self):
+        with mock.patch.object(calculation, 'pybel', None):
+            chemistry = ligand_chemistry(LIGAND)
+        self.assertEqual(chemistry.rings, [[0, 1, 2, 3, 4, 5]])
+        # carboxylate and protonated amine at pH 7.4
+        self.assertEqual(dict(chemistry.charges), {7: -1, 8: -1, 11: 1})
+        self.assertEqual(list(chemistry.donors), [11])
+        self.assertEqual(chemistry.donors[11].shape, (0, 3))
+        self.assertEqual(chemistry.acceptors, {7, 8})
+        self.assertEqual(np.nonzero(chemistry.within_bonds(11))[0].tolist(), [9, 10, 11])
+
+    @skipUnless(calculation.pybel, 'Open Babel is not installed')
+    def test_legacy_perception(self):
+        chemistry = ligand_chemistry(LIGAND)
+        rings, charges, donors, acceptors = legacy_perception('\n'.join(LIGAND) + '\nEND\n')
+        self.assertEqual(chemistry.rings, rings)
+        self.assertEqual(dict(chemistry.charges), charges)
+        self.assertEqual(dict([(i, len(h)) for i, h in chemistry.donors.items()]), donors)
+        self.assertEqual(chemistry.acceptors, acceptors)
+
+    def test_mismatching_pdb(self):
+        # Open Babel reads other atoms than the ligand atoms, the geometry is used
+        coords = np.array([[float(l[30:38]), float(l[38:46]), float(l[46:54])] for l in LIGAND])
+        elements = np.array([l[76:78].strip() for l in LIGAND], dtype=object)
+        chemistry = LigandChemistry(coords, elements, '\n'.join(LIGAND[:6]) + '\nEND\n')
+        self.assertEqual(chemistry.rings, [[0, 1, 2, 3, 4, 5]])
+        self.assertEqual(dict(chemistry.charges), {7: -1, 8: -1, 11: 1})
+
+
+class InteractionCalculationTestCase(SimpleTestCase):
+
+    def test_salt_bridge(self):
+        results = calculate_interactions('\n'.join(RESIDUE + LIGAND + ['END']))
+        self.assertEqual(list(results), ['AEB'])
+        interactions = results['AEB']['interactions']
+        self.assertEqual([i[0] for i in interactions], ['ASP100A', 'ASP100A'])
+        self.assertEqual([i[2] for i in interactions], ['acc', 'polar_double_neg_protein'])
+        self.assertEqual(interactions[1][6:], ['N1', 'OD1', 2.9])
+        self.assertIn('HETATM', results['AEB']['pdb'])
@@ -9,6 +9,7 @@ from django.views.decorators.cache import cache_page
 
 from interaction.models import *
 from interaction.forms import PDBform
+from interaction.calculation import calculate_interactions, split_fragment
 from ligand.models import Ligand
 from ligand.models import LigandType
 from ligand.models import LigandRole, LigandProperities
@@ -27,14 +28,12 @@ from common.alignment import Alignment
 from protein.models import Protein, ProteinFamily, ProteinGProtein, ProteinGProteinPair
 
 import os
-from os import listdir, devnull, makedirs
-import yaml
+from os import makedirs
 from operator import itemgetter
 from datetime import datetime
 import re
 import json
 import logging
-from subprocess import call, Popen, DEVNULL
 import urllib
 import collections
 from collections import OrderedDict
@@ -51,6 +50,9 @@ AA = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D',
       'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
       'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V'}
 
+# seconds to keep the interactions of uploaded structures in the cache
+USER_CALCULATION_TIMEOUT = 60*60*24
+
 
 def regexaa(aa):
     aaPattern = re.compile(r'^(\w{3})(\d+)([\w\s]+)$')
@@ -266,11 +268,8 @@ def StructureDetails(request, pdbname):
     context['data'] = flattened_data
     context['number_of_schemes'] = len(numbering_schemes)
 
-    residuelist = Residue.objects.filter(protein_conformation__protein=p).prefetch_related('protein_segment','display_generic_number','generic_number')
-    HelixBox = DrawHelixBox(
-                residuelist, p.get_protein_class(), str(p), nobuttons=1)
-    SnakePlot = DrawSnakePlot(
-                residuelist, p.get_protein_class(), str(p), nobuttons=1)
+    HelixBox = p.get_helical_box_no_buttons()
+    SnakePlot = p.get_snake_plot_no_buttons()
 
     return render(request, 'interaction/structure.html', {'pdbname': pdbname, 'structures': structures,
                                                           'crystal': crystal, 'protein': p, 'helixbox' : HelixBox, 'snakeplot': SnakePlot, 'residues': residues_browser, 'residues_lookup': residues_lookup, 'display_res': display_res, 'annotated_resn':
@@ -368,14 +367,14 @@ def updateall(request):
 
         if check.count() == 0:
             t1 = datetime.now()
-            runcalculation(pdbname)
+            results = runcalculation(pdbname)
             t2 = datetime.now()
             delta = t2 - t1
             seconds = delta.total_seconds()
             print("Calculation: Total time " +
                   str(seconds) + " seconds for " + pdbname)
             t1 = datetime.now()
-            results = parsecalculation(pdbname, False)
+            results = parsecalculation(pdbname, False, results=results)
             t2 = datetime.now()
             delta = t2 - t1
             seconds = delta.total_seconds()
@@ -391,67 +390,104 @@ def updateall(request):
     # pdbname, 'structures': structures})
 
 
+def fetch_pdb(pdbname):
+    """PDB text of a structure, from the database or downloaded from the PDB"""
+    structure = Structure.objects.filter(pdb_code__index=pdbname).select_related('pdb_data').first()
+    if structure and structure.pdb_data:
+        return structure.pdb_data.pdb
+    url = 'http://www.rcsb.org/pdb/files/%s.pdb' % pdbname
+    return urllib.request.urlopen(url).read().decode('utf-8')
+
+
 def runcalculation(pdbname, peptide=""):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
-    call(["python", calc_script, "-p", pdbname, "-c", peptide],
-         stdout=open(devnull, 'wb'), stderr=open(devnull, 'wb'))
-    return None
-
-
-def check_residue(protein, pos, aa):
-    residue = Residue.objects.filter(
-        protein_conformation=protein, sequence_number=pos)
-    if residue.exists():
-        residue = Residue.objects.get(
-            protein_conformation=protein, sequence_number=pos)
-        if residue.amino_acid != aa:
-            residue.amino_acid = aa
-            residue.save()
-    else:
-        residue, created = Residue.objects.get_or_create(
-            protein_conformation=protein, sequence_number=pos, amino_acid=aa)
-        # continue #SKIP THESE -- mostly fusion residues that aren't mapped
-        # yet.
-    return residue
-
-
-def extract_fragment_rotamer(f, residue, structure, ligand):
-    if os.path.isfile(f):
-        f_in = open(f, 'r')
-        rotamer_pdb = ''
-        fragment_pdb = ''
-        for line in f_in:
-            if line.startswith('HETATM') or line.startswith('CONECT') or line.startswith('MASTER') or line.startswith('END'):
-                fragment_pdb += line
-            elif line.startswith('ATOM'):
-                rotamer_pdb += line
-            else:
-                fragment_pdb += line
-                rotamer_pdb += line
-        f_in.close()
-
-        rotamer_data, created = PdbData.objects.get_or_create(pdb=rotamer_pdb)
-        rotamer, created = Rotamer.objects.get_or_create(
-            residue=residue, structure=structure, pdbdata=rotamer_data)
-
-        fragment_data, created = PdbData.objects.get_or_create(
-            pdb=fragment_pdb)
-        fragment, created = Fragment.objects.get_or_create(
-            ligand=ligand, structure=structure, pdbdata=fragment_data, residue=residue)
-    else:
-        #quit("Could not find " + residue)
-        return None, None
+    return calculate_interactions(fetch_pdb(pdbname), peptide)
+
 
-    return fragment, rotamer
+def format_results(pdbname, results):
+    """Calculation results as [pdbname, ligand, [output], score, inchikey, smiles], best scoring ligand first"""
+    rows = []
+    for ligand, output in results.items():
+        if 'prettyname' not in output:
+            # use hetsyn name if possible, others 3letter
+            output['prettyname'] = ligand
+        rows.append([pdbname, ligand, [output], round(output['score']), output['inchikey'].strip(),
+            output['smiles'].strip()])
+    return sorted(rows, key=itemgetter(3), reverse=True)
+
+
+def get_residues(protein, interactions):
+    """Residues of the interactions by sequence number, missing residues are created (mostly fusion residues that
+    aren't mapped yet)"""
+    amino_acids = OrderedDict()
+    for interaction in interactions:
+        aa, pos, chain = regexaa(interaction[0])
+        amino_acids[int(pos)] = aa
+
+    residues = {}
+    for residue in Residue.objects.filter(protein_conformation=protein, sequence_number__in=list(amino_acids)):
+        residues.setdefault(residue.sequence_number, residue)
+    for pos, aa in amino_acids.items():
+        if pos not in residues:
+            residues[pos] = Residue.objects.create(protein_conformation=protein, sequence_number=pos, amino_acid=aa)
+        elif residues[pos].amino_acid != aa:
+            residues[pos].amino_acid = aa
+            residues[pos].save()
+    return residues
+
+
+def save_interactions(structure, protein, structureligandinteraction, ligand, interactions):
+    """Bulk create the fragments, rotamers and residue fragment interactions of a ligand"""
+    residues = get_residues(protein, interactions)
+
+    # rotamer and fragment PDB data
+    rows = []
+    for interaction in interactions:
+        aa, pos, chain = regexaa(interaction[0])
+        fragment_pdb, rotamer_pdb = split_fragment(interaction[1])
+        rows.append((residues[int(pos)].id, fragment_pdb, rotamer_pdb, interaction))
+    texts = set([r[1] for r in rows] + [r[2] for r in rows])
+    pdbdata = dict(PdbData.objects.filter(pdb__in=texts).values_list('pdb', 'id'))
+    new_pdbdata = PdbData.objects.bulk_create([PdbData(pdb=t) for t in texts if t not in pdbdata])
+    pdbdata.update([(p.pdb, p.id) for p in new_pdbdata])
+
+    rotamer_keys = set([(r[0], pdbdata[r[2]]) for r in rows])
+    rotamers = {}
+    for r in Rotamer.objects.filter(structure=structure, residue_id__in=[k[0] for k in rotamer_keys]).order_by('id'):
+        rotamers.setdefault((r.residue_id, r.pdbdata_id), r.id)
+    new_rotamers = Rotamer.objects.bulk_create([Rotamer(residue_id=k[0], pdbdata_id=k[1], structure=structure)
+        for k in rotamer_keys if k not in rotamers])
+    rotamers.update([((r.residue_id, r.pdbdata_id), r.id) for r in new_rotamers])
+
+    fragment_keys = set([(r[0], pdbdata[r[1]]) for r in rows])
+    fragments = {}
+    for f in Fragment.objects.filter(structure=structure, ligand=ligand,
+        residue_id__in=[k[0] for k in fragment_keys]).order_by('id'):
+        fragments.setdefault((f.residue_id, f.pdbdata_id), f.id)
+    new_fragments = Fragment.objects.bulk_create([Fragment(residue_id=k[0], pdbdata_id=k[1], structure=structure,
+        ligand=ligand) for k in fragment_keys if k not in fragments])
+    fragments.update([((f.residue_id, f.pdbdata_id), f.id) for f in new_fragments])
+
+    interaction_types = {}
+    for interaction in interactions:
+        if interaction[2] not in interaction_types:
+            interaction_types[interaction[2]], created = ResidueFragmentInteractionType.objects.get_or_create(
+                slug=interaction[2], defaults={'name': interaction[3], 'type': interaction[4],
+                'direction': interaction[5]})
+
+    fragment_interactions = OrderedDict()
+    for residue_id, fragment_pdb, rotamer_pdb, interaction in rows:
+        key = (interaction_types[interaction[2]].id, fragments[(residue_id, pdbdata[fragment_pdb])],
+            rotamers[(residue_id, pdbdata[rotamer_pdb])])
+        fragment_interactions[key] = ResidueFragmentInteraction(structure_ligand_pair=structureligandinteraction,
+            interaction_type_id=key[0], fragment_id=key[1], rotamer_id=key[2])
+    ResidueFragmentInteraction.objects.bulk_create(list(fragment_interactions.values()))
 
 
 # consider skipping non hetsym ligands FIXME
-def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
+def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False, peptide="", results=None):
     logger = logging.getLogger('build')
-    mypath = '/tmp/interactions/results/' + pdbname + '/output'
-    module_dir = '/tmp/interactions'
-    results = []
+    if results is None:
+        results = runcalculation(pdbname, peptide)
     web_resource, created = WebResource.objects.get_or_create(
         slug='pdb', url='http://www.rcsb.org/pdb/explore/explore.do?structureId=$index')
     web_link, created = WebLink.objects.get_or_create(
@@ -464,178 +500,108 @@ def parsecalculation(pdbname, debug=True, ignore_ligand_preset=False):
         structure = Structure.objects.get(pdb_code=web_link)
 
         if structure.pdb_data is None:
-            f = module_dir + "/pdbs/" + pdbname + ".pdb"
-            if os.path.isfile(f):
-                pdbdata, created = PdbData.objects.get_or_create(
-                    pdb=open(f, 'r').read())  # does this close the file?
-            else:
-                print('quitting due to no pdb in filesystem')
-                quit()
+            pdbdata, created = PdbData.objects.get_or_create(pdb=fetch_pdb(pdbname))
             structure.pdb_data = pdbdata
             structure.save()
 
         protein = structure.protein_conformation
 
-        for f in listdir(mypath):
-            if os.path.isfile(os.path.join(mypath, f)):
-                annotated = 0
-                #print(mypath + "/" +f)
-                result = yaml.load(open(mypath + "/" + f, 'rb'))
-                output = result
-                temp = f.replace('.yaml', '').split("_")
-                temp.append([output])
-                temp.append(round(output['score']))
-                temp.append((output['inchikey']).strip())
-                temp.append((output['smiles']).strip())
-
-                results.append(temp)
-
-                if 'prettyname' not in output:
-                    # use hetsyn name if possible, others 3letter
-                    output['prettyname'] = temp[1]
-
-                f = module_dir + "/results/" + pdbname + "/interaction" + \
-                    "/" + pdbname + "_" + temp[1] + ".pdb"
-                if os.path.isfile(f):
-                    pdbdata, created = PdbData.objects.get_or_create(
-                        pdb=open(f, 'r').read())  # does this close the file?
-                    if debug:
-                        print("Found file" + f)
-                else:
-                    print('quitting due to no pdb for fragment in filesystem', f)
-                    quit()
-
-                structureligandinteraction = StructureLigandInteraction.objects.filter(
-                    pdb_reference=temp[1], structure=structure, annotated=True) #, pdb_file=None
-                if structureligandinteraction.exists():  # if the annotated exists
-                    annotated_found = 1
-                    annotated = 1
-                    try:
-                        structureligandinteraction = structureligandinteraction.get()
-                        structureligandinteraction.pdb_file = pdbdata
-                        ligand = structureligandinteraction.ligand
-                        if structureligandinteraction.ligand.properities.inchikey is None:
-                            structureligandinteraction.ligand.properities.inchikey = output['inchikey'].strip()
-                        elif structureligandinteraction.ligand.properities.inchikey != output['inchikey'].strip():
-                            logger.error(
-                                'Ligand/PDB inchikey mismatch (PDB:' + pdbname + ' LIG:' + output['prettyname'] + '): '+structureligandinteraction.ligand.properities.inchikey+' vs '+ output['inchikey'].strip())
-                    except Exception as msg:
-                        print('error with dublication structureligand',temp[1],msg)
-                        break
-                elif StructureLigandInteraction.objects.filter(pdb_reference=temp[1], structure=structure).exists():
-                    try:
-                        structureligandinteraction = StructureLigandInteraction.objects.filter(
-                            pdb_reference=temp[1], structure=structure).get()
-                        structureligandinteraction.pdb_file = pdbdata
-                    except: #already there
-                        structureligandinteraction = StructureLigandInteraction.objects.filter(
-                            pdb_reference=temp[1], structure=structure, pdb_file=pdbdata).get()
+        for pdb_reference, output in results.items():
+            annotated = 0
+            if 'prettyname' not in output:
+                # use hetsyn name if possible, others 3letter
+                output['prettyname'] = pdb_reference
+
+            pdbdata, created = PdbData.objects.get_or_create(pdb=output['pdb'])
+
+            structureligandinteraction = StructureLigandInteraction.objects.filter(
+                pdb_reference=pdb_reference, structure=structure, annotated=True) #, pdb_file=None
+            if structureligandinteraction.exists():  # if the annotated exists
+                annotated_found = 1
+                annotated = 1
+                try:
+                    structureligandinteraction = structureligandinteraction.get()
+                    structureligandinteraction.pdb_file = pdbdata
                     ligand = structureligandinteraction.ligand
-                else:  # create ligand and pair
-
-                    ligand = Ligand.objects.filter(
-                        name=output['prettyname'], canonical=True)
-
-                    if ligand.exists():  # if ligand with name (either hetsyn or 3 letter) exists use that.
-                        ligand = ligand.get()
-                    else:  # create it
-                        default_ligand_type = 'N/A'
-                        lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
-                                                                       defaults={'name': default_ligand_type})
-
-                        ligand = Ligand()
-                        ligand = ligand.load_from_pubchem(
-                            'inchikey', output['inchikey'].strip(), lt, output['prettyname'])
-                        try:
-                            ligand.save()
-                        except:
-                            #print('ligand save failed, empty ligand?',output['prettyname'])
-                            continue
-
-                    ligandrole, created = LigandRole.objects.get_or_create(
-                        name='unknown', slug='unknown')
-                    structureligandinteraction = StructureLigandInteraction()
-                    structureligandinteraction.ligand = ligand
-                    structureligandinteraction.structure = structure
-                    structureligandinteraction.ligand_role = ligandrole
+                    if structureligandinteraction.ligand.properities.inchikey is None:
+                        structureligandinteraction.ligand.properities.inchikey = output['inchikey'].strip()
+                    elif output['inchikey'] and structureligandinteraction.ligand.properities.inchikey != output['inchikey'].strip():
+                        logger.error(
+                            'Ligand/PDB inchikey mismatch (PDB:' + pdbname + ' LIG:' + output['prettyname'] + '): '+structureligandinteraction.ligand.properities.inchikey+' vs '+ output['inchikey'].strip())
+                except Exception as msg:
+                    print('error with dublication structureligand',pdb_reference,msg)
+                    break
+            elif StructureLigandInteraction.objects.filter(pdb_reference=pdb_reference, structure=structure).exists():
+                try:
+                    structureligandinteraction = StructureLigandInteraction.objects.filter(
+                        pdb_reference=pdb_reference, structure=structure).get()
                     structureligandinteraction.pdb_file = pdbdata
-                    structureligandinteraction.pdb_reference = temp[1]
-
-                structureligandinteraction.save()
-
-                ResidueFragmentInteraction.objects.filter(structure_ligand_pair=structureligandinteraction).delete()
-
-                for interaction in output['interactions']:
-                    # print(interaction)
-                    aa = interaction[0]
-                    aa, pos, chain = regexaa(aa)
-                    residue = check_residue(protein, pos, aa)
-                    f = interaction[1]
-
-                    fragment, rotamer = extract_fragment_rotamer(
-                                    f, residue, structure, ligand)
-
-                    # print(interaction[2],interaction[3],interaction[4],interaction[5])
-                    if fragment!=None:
-                        interaction_type, created = ResidueFragmentInteractionType.objects.get_or_create(
-                                        slug=interaction[2], name=interaction[3], type=interaction[4], direction=interaction[5])
-                        fragment_interaction, created = ResidueFragmentInteraction.objects.get_or_create(
-                                        structure_ligand_pair=structureligandinteraction, interaction_type=interaction_type, fragment=fragment, rotamer=rotamer)
-                #print("Inserted",len(output['interactions']),"interactions","ligand",temp[1],"annotated",annotated)
+                except: #already there
+                    structureligandinteraction = StructureLigandInteraction.objects.filter(
+                        pdb_reference=pdb_reference, structure=structure, pdb_file=pdbdata).get()
+                ligand = structureligandinteraction.ligand
+            else:  # create ligand and pair
+
+                ligand = Ligand.objects.filter(
+                    name=output['prettyname'], canonical=True)
+
+                if ligand.exists():  # if ligand with name (either hetsyn or 3 letter) exists use that.
+                    ligand = ligand.get()
+                else:  # create it
+                    default_ligand_type = 'N/A'
+                    lt, created = LigandType.objects.get_or_create(slug=slugify(default_ligand_type),
+                                                                   defaults={'name': default_ligand_type})
+
+                    ligand = Ligand()
+                    ligand = ligand.load_from_pubchem(
+                        'inchikey', output['inchikey'].strip(), lt, output['prettyname'])
+                    try:
+                        ligand.save()
+                    except:
+                        #print('ligand save failed, empty ligand?',output['prettyname'])
+                        continue
+
+                ligandrole, created = LigandRole.objects.get_or_create(
+                    name='unknown', slug='unknown')
+                structureligandinteraction = StructureLigandInteraction()
+                structureligandinteraction.ligand = ligand
+                structureligandinteraction.structure = structure
+                structureligandinteraction.ligand_role = ligandrole
+                structureligandinteraction.pdb_file = pdbdata
+                structureligandinteraction.pdb_reference = pdb_reference
+
+            structureligandinteraction.save()
+
+            ResidueFragmentInteraction.objects.filter(structure_ligand_pair=structureligandinteraction).delete()
+            save_interactions(structure, protein, structureligandinteraction, ligand, output['interactions'])
+            #print("Inserted",len(output['interactions']),"interactions","ligand",pdb_reference,"annotated",annotated)
         # if not annotated_found:
         #     print("No interactions for annotated ligand")
 
     else:
         if debug:
             logger.info("Structure not in DB?!??!")
-        for f in listdir(mypath):
-            if os.path.isfile(os.path.join(mypath, f)):
-                result = yaml.load(open(mypath + "/" + f, 'rb'))
-                output = result
 
-                temp = f.replace('.yaml', '').split("_")
-                temp.append([output])
-                temp.append(round(output['score'][0][0]))
-                temp.append((output['inchikey']).strip())
-                temp.append((output['smiles']).strip())
-                results.append(temp)
+    return format_results(pdbname, results)
 
-    results = sorted(results, key=itemgetter(3), reverse=True)
 
-    return results
+def user_calculation_key(pdbname, session):
+    return 'interactions_{}_{}'.format(session, pdbname)
 
 
 def runusercalculation(filename, session):
-    calc_script = os.sep.join(
-        [os.path.dirname(__file__), 'legacy_functions.py'])
-    call(["python", calc_script, "-p", filename, "-s", session])
-    return None
+    """Calculate the interactions of an uploaded (or downloaded) structure of a session, results are cached"""
+    pdb = open('/tmp/interactions/' + session + '/pdbs/' + filename + '.pdb', 'r').read()
+    results = calculate_interactions(pdb)
+    cache.set(user_calculation_key(filename, session), results, USER_CALCULATION_TIMEOUT)
+    return results
 
 
-# consider skipping non hetsym ligands FIXME
 def parseusercalculation(pdbname, session, debug=True, ignore_ligand_preset=False, ):
-    logger = logging.getLogger('build')
-    mypath = '/tmp/interactions/' + session + '/results/' + pdbname + '/output'
-    module_dir = '/tmp/interactions/' + session
-    results = []
-
-    for f in listdir(mypath):
-        if os.path.isfile(os.path.join(mypath, f)):
-            result = yaml.load(open(mypath + "/" + f, 'rb'))
-            output = result
-
-            temp = f.replace('.yaml', '').split("_")
-            temp.append([output])
-            temp.append(round(output['score']))
-            temp.append((output['inchikey']).strip())
-            temp.append((output['smiles']).strip())
-            results.append(temp)
-
-            if 'prettyname' not in output:
-                output['prettyname'] = temp[1]
-
-    results = sorted(results, key=itemgetter(3), reverse=True)
-    return results
+    results = cache.get(user_calculation_key(pdbname, session))
+    if results is None:
+        results = runusercalculation(pdbname, session)
+    return format_results(pdbname, results)
 
 def showcalculation(request):
 
@@ -1017,9 +983,10 @@ def download(request):
 
     if session:
         session = request.session.session_key
-        pdbdata = open('/tmp/interactions/' + session + '/results/' + pdbname +
-                       '/interaction/' + pdbname + '_' + ligand + '.pdb', 'r').read()
-        response = HttpResponse(pdbdata, content_type='text/plain')
+        results = cache.get(user_calculation_key(pdbname, session))
+        if results is None:
+            results = runusercalculation(pdbname, session)
+        response = HttpResponse(results[ligand]['pdb'], content_type='text/plain')
     else:
 
         pair = StructureLigandInteraction.objects.filter(structure__pdb_code__index=pdbname).filter(
@@ -1029,10 +1029,8 @@ def showcalculation(request):
 
     residues = Residue.objects.filter(protein_conformation__protein=context['proteins'][0]).prefetch_related('protein_segment','display_generic_number','generic_number')
 
-    HelixBox = DrawHelixBox(
-                residues, context['proteins'][0], str(p), nobuttons=1)
-    SnakePlot = DrawSnakePlot(
-                residues, context['proteins'][0], str(p), nobuttons=1)
+    HelixBox = context['proteins'][0].get_helical_box_no_buttons()
+    SnakePlot = context['proteins'][0].get_snake_plot_no_buttons()
 
     lookup = {}
     lookup_with_pos = {}
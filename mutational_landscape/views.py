@@ -220,8 +220,12 @@ def render_variants(request, protein=None, family=None, download=None, receptor_
     # jsondata_cancer_mutations['color'] = linear_gradient(start_hex="#d8baff", finish_hex="#422d65", n=max_cancer_pos)
     # jsondata_disease_mutations['color'] = linear_gradient(start_hex="#ffa1b1", finish_hex="#6e000b", n=max_disease_pos)
     #
-    SnakePlot = DrawSnakePlot(residuelist, "Class A", protein, nobuttons=1)
-    HelixBox = DrawHelixBox(residuelist, 'Class A', protein, nobuttons=1)
+    if target_type == 'family':
+        SnakePlot = DrawSnakePlot(residuelist, "Class A", protein, nobuttons=1)
+        HelixBox = DrawHelixBox(residuelist, 'Class A', protein, nobuttons=1)
+    else:
+        SnakePlot = proteins[0].get_snake_plot_no_buttons()
+        HelixBox = proteins[0].get_helical_box_no_buttons()
 
     # EXCEL TABLE EXPORT
     if download:
@@ -0,0 +1,446 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from common.alignment_matrix import AA_CODES, AMINO_ACIDS, GAP
+
+from collections import Counter
+from multiprocessing import Pool
+import hashlib
+import os
+import numpy as np
+
+
+# residue codes compared in distances, gaps and unknown residues are skipped like in protdist
+DISTANCE_AMINO_ACIDS = [aa for aa in AMINO_ACIDS if AA_CODES[aa] != GAP]
+DISTANCE_CODES = [AA_CODES[aa] for aa in DISTANCE_AMINO_ACIDS]
+
+# distance of pairs that are too different for the distance model (or have no comparable positions)
+MAX_DISTANCE = 10.0
+
+# Jones, Taylor and Thornton (1992) amino acid exchangeabilities (lower triangle) and frequencies, the default model
+# of protdist
+JTT_AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+JTT_EXCHANGEABILITIES = [
+    [56], # C
+    [81, 10], # D
+    [105, 5, 767], # E
+    [15, 78, 4, 5], # F
+    [179, 59, 130, 119, 5], # G
+    [27, 69, 112, 26, 40, 23], # H
+    [36, 17, 11, 12, 89, 6, 16], # I
+    [35, 7, 26, 181, 4, 27, 45, 21], # K
+    [30, 23, 7, 9, 248, 6, 56, 229, 14], # L
+    [54, 31, 15, 18, 43, 14, 33, 479, 65, 388], # M
+    [54, 34, 528, 58, 10, 81, 391, 47, 263, 12, 30], # N
+    [194, 14, 15, 18, 17, 24, 115, 10, 21, 102, 16, 15], # P
+    [57, 9, 49, 323, 4, 26, 597, 9, 292, 72, 43, 86, 164], # Q
+    [58, 113, 16, 29, 5, 137, 328, 22, 646, 38, 44, 45, 74, 310], # R
+    [378, 223, 59, 30, 92, 201, 73, 40, 47, 59, 29, 503, 285, 53, 101], # S
+    [475, 42, 38, 32, 12, 33, 46, 245, 103, 25, 226, 232, 118, 51, 64, 477], # T
+    [298, 62, 31, 45, 62, 47, 11, 961, 14, 180, 323, 16, 23, 20, 17, 38, 112], # V
+    [9, 115, 4, 10, 53, 55, 8, 9, 10, 52, 24, 8, 6, 18, 126, 35, 12, 25], # W
+    [11, 209, 46, 7, 536, 8, 573, 32, 8, 24, 18, 70, 10, 24, 20, 63, 21, 16, 71], # Y
+]
+JTT_FREQUENCIES = [0.076748, 0.019803, 0.051544, 0.061830, 0.040126, 0.073152, 0.022944, 0.053761, 0.058676,
+    0.091904, 0.023826, 0.042645, 0.050901, 0.040752, 0.051691, 0.068765, 0.058565, 0.066005, 0.014261, 0.032102]
+
+# columns of the JTT amino acids in the encoded residues, ambiguous amino acids are not compared
+JTT_COLUMNS = [DISTANCE_AMINO_ACIDS.index(aa) for aa in JTT_AMINO_ACIDS]
+
+# Newton-Raphson iterations of the maximum likelihood distances
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-6
+MIN_DISTANCE = 1e-8
+
+# rows compared with all other rows at a time when counting residue pairs
+PAIR_BLOCK = 32
+
+# seed of the bootstrap replicates, as used with seqboot
+BOOTSTRAP_SEED = 77
+
+# seconds to keep computed trees in the cache
+CACHE_TIMEOUT = 60*60*24*7
+
+# number of processes computing bootstrap replicates
+PROCESSES = getattr(settings, 'TREE_PROCESSES', os.cpu_count() or 1)
+
+
+def encode_residues(matrix):
+    """One-hot encoding (rows x positions*codes) of the compared residues and the comparable positions (rows x
+    positions) of an alignment matrix"""
+    rows, positions = matrix.shape
+    encoded = np.zeros((rows, positions, len(DISTANCE_CODES)), dtype=np.float32)
+    for i, code in enumerate(DISTANCE_CODES):
+        encoded[:, :, i] = matrix == code
+    return encoded.reshape(rows, -1), encoded.sum(axis=2)
+
+
+def kimura_distances(encoded, comparable, weights=None):
+    """Kimura protein distances between all rows, optionally with a weight (number of samples) per position
+
+    Positions where either residue is a gap or unknown are not compared, like in protdist."""
+    if weights is None:
+        total = comparable.dot(comparable.T)
+        identical = encoded.dot(encoded.T)
+    else:
+        weights = weights.astype(np.float32)
+        total = (comparable * weights).dot(comparable.T)
+        identical = (encoded * np.repeat(weights, len(DISTANCE_CODES))).dot(encoded.T)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = 1 - identical / total
+        x = 1 - p - 0.2 * p * p
+        distances = np.where((total > 0) & (x > 0), -np.log(np.where(x > 0, x, 1)), MAX_DISTANCE)
+    distances = np.minimum(distances, MAX_DISTANCE)
+    np.fill_diagonal(distances, 0)
+    return distances.astype(np.float64)
+
+
+def jtt_model():
+    """Eigenvalues and terms of the JTT transition probabilities, scaled to one expected substitution per position
+
+    Returns (eigenvalues, terms) such that pi_k * P_kl(t) = terms[i].dot(exp(eigenvalues * t)) for the i-th amino
+    acid pair (k <= l) of np.triu_indices, which is symmetric in k and l."""
+    n = len(JTT_AMINO_ACIDS)
+    exchangeabilities = np.zeros((n, n))
+    for i, row in enumerate(JTT_EXCHANGEABILITIES, 1):
+        exchangeabilities[i, :i] = row
+    exchangeabilities += exchangeabilities.T
+    pi = np.array(JTT_FREQUENCIES) / sum(JTT_FREQUENCIES)
+
+    rates = exchangeabilities * pi[None, :]
+    np.fill_diagonal(rates, -rates.sum(axis=1))
+    # one expected substitution per position
+    rates /= -(pi * np.diag(rates)).sum()
+
+    # symmetric form pi^1/2 Q pi^-1/2 = U diag(eigenvalues) U^T
+    root = np.sqrt(pi)
+    eigenvalues, vectors = np.linalg.eigh(root[:, None] * rates / root[None, :])
+    k, l = np.triu_indices(n)
+    terms = (root[k] * root[l])[:, None] * vectors[k] * vectors[l]
+    return eigenvalues, terms
+
+
+JTT_EIGENVALUES, JTT_TERMS = jtt_model()
+JTT_PAIRS = np.triu_indices(len(JTT_AMINO_ACIDS))
+JTT_IDENTICAL = JTT_PAIRS[0] == JTT_PAIRS[1]
+
+# log likelihood terms of each amino acid pair at a grid of distances, the starting points of the iterations
+JTT_GRID = np.geomspace(0.001, MAX_DISTANCE, 48)
+JTT_GRID_TERMS = np.log(np.maximum(np.exp(JTT_GRID[:, None] * JTT_EIGENVALUES[None, :]).dot(JTT_TERMS.T), 1e-300))
+
+
+def jtt_pair_counts(encoded, comparable, weights=None):
+    """Counts of the amino acid pairs (k <= l, as in JTT_PAIRS) at the positions of each pair of rows (i < j)
+
+    Returns (row pairs, counts)."""
+    rows = comparable.shape[0]
+    residues = encoded.reshape(rows, -1, len(DISTANCE_CODES))[:, :, JTT_COLUMNS]
+    positions = residues.shape[1]
+    n = len(JTT_AMINO_ACIDS)
+    weighted = residues if weights is None else residues * weights.astype(np.float32)[None, :, None]
+    flat = residues.transpose(1, 0, 2).reshape(positions, rows * n)
+
+    pairs = []
+    counts = []
+    for start in range(0, rows - 1, PAIR_BLOCK):
+        end = min(start + PAIR_BLOCK, rows - 1)
+        block = weighted[start:end].transpose(0, 2, 1).reshape((end - start) * n, positions)
+        # rows of the block x amino acid x compared rows x amino acid
+        c = block.dot(flat[:, start * n:]).reshape(end - start, n, rows - start, n).transpose(0, 2, 1, 3)
+        i, j = np.nonzero(np.arange(start, end)[:, None] < np.arange(start, rows)[None, :])
+        c = c[i, j]
+        # both orders of different amino acids are one pair
+        counts.append(c[:, JTT_PAIRS[0], JTT_PAIRS[1]] + np.where(JTT_IDENTICAL, 0, c[:, JTT_PAIRS[1], JTT_PAIRS[0]]))
+        pairs.append((i + start, j + start))
+    if not pairs:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int)), np.zeros((0, len(JTT_IDENTICAL)))
+    return ((np.concatenate([p[0] for p in pairs]), np.concatenate([p[1] for p in pairs])),
+        np.concatenate(counts).astype(np.float64))
+
+
+def jtt_likelihood_distances(counts):
+    """Distances with the maximum JTT likelihood of amino acid pair counts (pairs x JTT_PAIRS), found with
+    Newton-Raphson iterations starting from the most likely distance of JTT_GRID"""
+    distances = np.zeros(len(counts))
+    total = counts.sum(axis=1)
+    different = counts[:, ~JTT_IDENTICAL].sum(axis=1)
+    distances[total == 0] = MAX_DISTANCE
+
+    # identical sequences are at distance 0
+    active = np.nonzero((total > 0) & (different > 0))[0]
+    c = counts[active]
+    t = JTT_GRID[np.argmax(c.dot(JTT_GRID_TERMS.T), axis=1)]
+    for iteration in range(MAX_ITERATIONS):
+        if not len(active):
+            break
+        # first and second derivative of the log likelihood
+        e = np.exp(t[:, None] * JTT_EIGENVALUES[None, :])
+        f = np.maximum(e.dot(JTT_TERMS.T), 1e-300)
+        f1 = (e * JTT_EIGENVALUES).dot(JTT_TERMS.T)
+        f2 = (e * JTT_EIGENVALUES ** 2).dot(JTT_TERMS.T)
+        r = c / f
+        d1 = np.einsum('ij,ij->i', r, f1)
+        d2 = np.einsum('ij,ij->i', r, f2) - np.einsum('ij,ij->i', r * f1, f1 / f)
+
+        # Newton step at a maximum, otherwise move towards the higher likelihood
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(d2 < 0, -d1 / d2, np.where(d1 > 0, t, -t / 2))
+        updated = np.clip(t + step, MIN_DISTANCE, MAX_DISTANCE)
+        converged = np.abs(updated - t) < TOLERANCE
+        t = updated
+        distances[active[converged]] = t[converged]
+        active = active[~converged]
+        t = t[~converged]
+        c = c[~converged]
+    distances[active] = t
+    return distances
+
+
+def jtt_distances(encoded, comparable, weights=None):
+    """Maximum likelihood JTT protein distances between all rows (as protdist without rate variation), optionally
+    with a weight (number of samples) per position
+
+    Positions where either residue is a gap, unknown or ambiguous are not compared."""
+    rows = comparable.shape[0]
+    (i, j), counts = jtt_pair_counts(encoded, comparable, weights)
+    distances = np.zeros((rows, rows))
+    distances[i, j] = jtt_likelihood_distances(counts)
+    distances[j, i] = distances[i, j]
+    distances = np.minimum(distances, MAX_DISTANCE)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+# distance models by name, JTT is the default of protdist
+DISTANCE_MODELS = {
+    'jtt': jtt_distances,
+    'kimura': kimura_distances,
+}
+
+
+def neighbor_joining(distances):
+    """Neighbour-joining tree of a distance matrix
+
+    Nodes are leaf indices or lists of (node, branch length) tuples. The last three nodes are joined at the root,
+    giving an unrooted tree as written by neighbor."""
+    d = distances.copy()
+    nodes = list(range(len(d)))
+    while len(nodes) > 3:
+        n = len(nodes)
+        r = d.sum(axis=1)
+        q = (n - 2) * d - r[:, None] - r[None, :]
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+        length_i = 0.5 * d[i, j] + (r[i] - r[j]) / (2 * (n - 2))
+        length_j = d[i, j] - length_i
+        joined = 0.5 * (d[i] + d[j] - d[i, j])
+
+        # the joined node replaces i, j is removed
+        d[i, :] = joined
+        d[:, i] = joined
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, 0), j, 1)
+        nodes[i] = [(nodes[i], length_i), (nodes[j], length_j)]
+        del nodes[j]
+
+    if len(nodes) == 3:
+        length_0 = 0.5 * (d[0, 1] + d[0, 2] - d[1, 2])
+        return [(nodes[0], length_0), (nodes[1], d[0, 1] - length_0), (nodes[2], d[0, 2] - length_0)]
+    return [(node, d[0, -1] / 2) for node in nodes]
+
+
+def upgma(distances):
+    """UPGMA tree of a distance matrix, nodes as in neighbor_joining"""
+    d = distances.copy()
+    nodes = list(range(len(d)))
+    sizes = [1] * len(d)
+    heights = [0.0] * len(d)
+    while len(nodes) > 1:
+        q = d.copy()
+        np.fill_diagonal(q, np.inf)
+        i, j = sorted(np.unravel_index(np.argmin(q), q.shape))
+        height = d[i, j] / 2
+        joined = (d[i] * sizes[i] + d[j] * sizes[j]) / (sizes[i] + sizes[j])
+
+        d[i, :] = joined
+        d[:, i] = joined
+        d[i, i] = 0
+        d = np.delete(np.delete(d, j, 0), j, 1)
+        nodes[i] = [(nodes[i], height - heights[i]), (nodes[j], height - heights[j])]
+        sizes[i] += sizes[j]
+        heights[i] = height
+        del nodes[j], sizes[j], heights[j]
+    return nodes[0]
+
+
+def to_newick(node, names, length_format='{:.5f}'):
+    """Newick string of a tree"""
+    def format_node(node):
+        if isinstance(node, list):
+            return '(' + ','.join([format_node(child) + ':' + length_format.format(length)
+                for child, length in node]) + ')'
+        return names[node]
+    return format_node(node) + ';'
+
+
+def tree_splits(node, num_leaves):
+    """Non-trivial splits of a tree as leaf bitmasks, oriented so that they do not contain the first leaf"""
+    full = (1 << num_leaves) - 1
+    splits = []
+
+    def collect(node):
+        if not isinstance(node, list):
+            return 1 << node
+        mask = 0
+        for child, length in node:
+            mask |= collect(child)
+        splits.append(mask)
+        return mask
+
+    collect(node)
+    oriented = set()
+    for mask in splits:
+        if mask & 1:
+            mask = full ^ mask
+        if 1 < bin(mask).count('1') < num_leaves - 1:
+            oriented.add(mask)
+    return oriented
+
+
+def consensus_tree(split_counts, num_leaves, replicates):
+    """Extended majority rule consensus of bootstrap splits, as computed by consense
+
+    Splits are added from the most to the least frequent when they are compatible with the splits already added. The
+    tree is rooted at the first leaf, branch lengths are the number of replicates containing the split."""
+    accepted = []
+    for mask, count in sorted(split_counts.items(), key=lambda x: (-x[1], x[0])):
+        if all([mask & a == 0 or mask & a == mask or mask & a == a for a, c in accepted]):
+            accepted.append((mask, count))
+
+    # the parent of each split is the smallest accepted split containing it
+    accepted.sort(key=lambda x: bin(x[0]).count('1'))
+    children = dict([(mask, []) for mask, count in accepted])
+    children[None] = []
+    for k, (mask, count) in enumerate(accepted):
+        parent = None
+        for larger, larger_count in accepted[k + 1:]:
+            if mask & larger == mask:
+                parent = larger
+                break
+        children[parent].append((mask, count))
+
+    def build(mask):
+        node = []
+        covered = 0
+        for child, count in children[mask]:
+            node.append((build(child), count))
+            covered |= child
+        leaves = (mask if mask is not None else (1 << num_leaves) - 1) ^ covered
+        for leaf in range(num_leaves):
+            if leaves & (1 << leaf):
+                node.append((leaf, replicates))
+        node.sort(key=lambda x: lowest_leaf(x[0]))
+        return node
+
+    def lowest_leaf(node):
+        if isinstance(node, list):
+            return min([lowest_leaf(child) for child, length in node])
+        return node
+
+    return build(None)
+
+
+def format_distances(distances, names):
+    """Distance matrix in the PHYLIP square format (as written by protdist)"""
+    lines = ['{:5d}'.format(len(names))]
+    for name, row in zip(names, distances):
+        lines.append('{:<10} '.format(name[:10]) + ' '.join(['{:.6f}'.format(v) for v in row]))
+    return '\n'.join(lines) + '\n'
+
+
+def format_splits(split_counts, names, replicates):
+    """Table of the bootstrap splits and the number of replicates containing them (as written by consense)"""
+    lines = ['Sets included in the consensus tree', '', 'Set ({} species)'.format(len(names)) + ' ' * 10 +
+        'How many times out of {}'.format(replicates), '']
+    for mask, count in sorted(split_counts.items(), key=lambda x: (-x[1], x[0])):
+        pattern = ''.join(['*' if mask & (1 << i) else '.' for i in range(len(names))])
+        lines.append('{}   {:.1f}'.format(pattern, count))
+    lines.append('')
+    lines.append('Species in order: ')
+    for i, name in enumerate(names):
+        lines.append('{:>4}. {}'.format(i + 1, name))
+    return '\n'.join(lines) + '\n'
+
+
+def make_tree(distances, use_upgma):
+    if use_upgma:
+        return upgma(distances)
+    return neighbor_joining(distances)
+
+
+# shared state of bootstrap pool workers, set by the pool initializer
+_worker_data = {}
+
+def _init_bootstrap_worker(encoded, comparable, use_upgma, model):
+    _worker_data['encoded'] = encoded
+    _worker_data['comparable'] = comparable
+    _worker_data['use_upgma'] = use_upgma
+    _worker_data['model'] = model
+
+def _bootstrap_replicates(replicates):
+    return bootstrap_splits(_worker_data['encoded'], _worker_data['comparable'], _worker_data['use_upgma'],
+        replicates, _worker_data['model'])
+
+
+def bootstrap_splits(encoded, comparable, use_upgma, replicates, model='jtt'):
+    """Split counts of the trees of bootstrap replicates (positions resampled with replacement)"""
+    rows, positions = comparable.shape
+    counts = Counter()
+    for replicate in replicates:
+        weights = np.random.RandomState(BOOTSTRAP_SEED + replicate).multinomial(positions,
+            np.full(positions, 1 / positions))
+        tree = make_tree(DISTANCE_MODELS[model](encoded, comparable, weights), use_upgma)
+        counts.update(tree_splits(tree, rows))
+    return counts
+
+
+def build_tree(matrix, names, bootstrap=0, use_upgma=False, model='jtt', processes=PROCESSES):
+    """Newick tree and report of an encoded alignment matrix (rows x positions), cached per alignment and settings
+
+    Distances are computed with a model of DISTANCE_MODELS (JTT by default, like protdist). Without bootstrap, the
+    tree is built from the distances of all positions and the report is the distance matrix. With bootstrap, the
+    Newick tree is the consensus of the replicate trees with the number of replicates containing each split as
+    branch lengths (as written to outtree by consense), and the report is the table of split counts."""
+    if model not in DISTANCE_MODELS:
+        raise ValueError('Unknown distance model {}'.format(model))
+    key = hashlib.md5()
+    key.update('|'.join(names + [str(bootstrap), str(use_upgma), model, str(matrix.shape)]).encode('utf-8'))
+    key.update(np.ascontiguousarray(matrix).tobytes())
+    cache_key = 'phylogenetic_tree_' + key.hexdigest()
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+
+    encoded, comparable = encode_residues(matrix)
+    if not bootstrap:
+        distances = DISTANCE_MODELS[model](encoded, comparable)
+        result = (to_newick(make_tree(distances, use_upgma), names), format_distances(distances, names))
+    else:
+        processes = min(processes, bootstrap)
+        chunks = [list(range(start, bootstrap, processes * 4)) for start in range(processes * 4)]
+        chunks = [c for c in chunks if c]
+        if processes > 1:
+            with Pool(processes, initializer=_init_bootstrap_worker, initargs=(encoded, comparable,
+                use_upgma, model)) as pool:
+                results = pool.map(_bootstrap_replicates, chunks)
+        else:
+            results = [bootstrap_splits(encoded, comparable, use_upgma, c, model) for c in chunks]
+        split_counts = Counter()
+        for counts in results:
+            split_counts.update(counts)
+        tree = consensus_tree(split_counts, len(names), bootstrap)
+        result = (to_newick(tree, names, '{:.1f}'), format_splits(split_counts, names, bootstrap))
+
+    cache.set(cache_key, result, CACHE_TIMEOUT)
+    return result
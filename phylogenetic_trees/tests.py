@@ -1,3 +1,129 @@
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from common.alignment_matrix import AA_CODES
+from phylogenetic_trees import engine
+
+from unittest import mock
+import re
+import numpy as np
+
+
+def alignment_matrix(sequences):
+    return np.array([[AA_CODES[aa] for aa in sequence] for sequence in sequences])
+
+
+def mutate(sequence, positions):
+    # replace residues by the next amino acid of the JTT order
+    sequence = list(sequence)
+    for i in positions:
+        sequence[i] = engine.JTT_AMINO_ACIDS[(engine.JTT_AMINO_ACIDS.index(sequence[i]) + 1) % 20]
+    return ''.join(sequence)
+
+
+SEQUENCE = engine.JTT_AMINO_ACIDS * 10
+
+
+class TreeTestCase(SimpleTestCase):
+
+    def test_neighbor_joining(self):
+        # additive distances of the tree ((A:1,B:2):1,C:3,D:4)
+        distances = np.array([
+            [0, 3, 5, 6],
+            [3, 0, 6, 7],
+            [5, 6, 0, 7],
+            [6, 7, 7, 0],
+        ], dtype=float)
+        tree = engine.neighbor_joining(distances)
+        self.assertEqual(engine.to_newick(tree, list('ABCD')), '((A:1.00000,B:2.00000):1.00000,C:3.00000,D:4.00000);')
+
+    def test_upgma(self):
+        distances = np.array([
+            [0, 2, 6],
+            [2, 0, 6],
+            [6, 6, 0],
+        ], dtype=float)
+        tree = engine.upgma(distances)
+        self.assertEqual(engine.to_newick(tree, list('ABC'), '{:.1f}'), '((A:1.0,B:1.0):2.0,C:3.0);')
+
+    def test_consensus(self):
+        # two replicates group A and B, one groups A and C
+        counts = {0b11100: 2, 0b11010: 1}
+        self.assertEqual(engine.tree_splits(engine.neighbor_joining(np.array([
+            [0, 3, 5, 6, 6],
+            [3, 0, 6, 7, 7],
+            [5, 6, 0, 7, 7],
+            [6, 7, 7, 0, 2],
+            [6, 7, 7, 2, 0],
+        ], dtype=float)), 5), {0b11100, 0b11000})
+        tree = engine.consensus_tree(counts, 5, 3)
+        self.assertEqual(engine.to_newick(tree, list('ABCDE'), '{:.1f}'), '(A:3.0,B:3.0,(C:3.0,D:3.0,E:3.0):2.0);')
+
+
+class DistanceTestCase(SimpleTestCase):
+
+    def distances(self, sequences, model='jtt', weights=None):
+        encoded, comparable = engine.encode_residues(alignment_matrix(sequences))
+        return engine.DISTANCE_MODELS[model](encoded, comparable, weights)
+
+    def test_jtt(self):
+        sequences = [SEQUENCE, SEQUENCE, mutate(SEQUENCE, range(0, 200, 20)), mutate(SEQUENCE, range(0, 200, 4))]
+        distances = self.distances(sequences)
+        self.assertTrue(np.allclose(distances, distances.T))
+        self.assertTrue(np.all(np.diag(distances) == 0))
+        self.assertEqual(distances[0, 1], 0)
+        # close to the fraction of different positions for similar sequences, larger for distant ones
+        self.assertAlmostEqual(distances[0, 2], 0.05, delta=0.01)
+        self.assertGreater(distances[0, 3], 0.25)
+        self.assertGreater(distances[2, 3], distances[0, 2])
+
+    def test_jtt_maximum_likelihood(self):
+        (i, j), counts = engine.jtt_pair_counts(*engine.encode_residues(alignment_matrix([SEQUENCE,
+            mutate(SEQUENCE, range(0, 200, 3))])))
+        distance = engine.jtt_likelihood_distances(counts)[0]
+
+        def likelihood(t):
+            return (counts[0] * np.log(np.exp(t * engine.JTT_EIGENVALUES).dot(engine.JTT_TERMS.T))).sum()
+        self.assertGreater(likelihood(distance), likelihood(distance * 1.01))
+        self.assertGreater(likelihood(distance), likelihood(distance * 0.99))
+
+    def test_not_comparable(self):
+        # gaps and ambiguous amino acids are not compared
+        distances = self.distances([SEQUENCE, '-' * 200, 'B' * 200])
+        self.assertEqual(distances[0, 1], engine.MAX_DISTANCE)
+        self.assertEqual(distances[0, 2], engine.MAX_DISTANCE)
+
+    def test_weights(self):
+        sequences = [SEQUENCE, mutate(SEQUENCE, range(100))]
+        weights = np.zeros(200, dtype=int)
+        weights[100:] = 2
+        # only the identical half is sampled
+        self.assertEqual(self.distances(sequences, weights=weights)[0, 1], 0)
+        self.assertEqual(self.distances(sequences, 'kimura', weights)[0, 1], 0)
+
+
+class BuildTreeTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(engine, 'cache', LocMemCache('phylogenetic-trees-tests', {}))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.matrix = alignment_matrix([SEQUENCE, mutate(SEQUENCE, range(0, 200, 10)),
+            mutate(SEQUENCE, range(0, 200, 5)), mutate(SEQUENCE, range(0, 200, 2))])
+        self.names = ['adrb1_human', 'adrb2_human', 'adrb3_human', 'drd2_human']
+
+    def test_tree(self):
+        tree, report = engine.build_tree(self.matrix, self.names, processes=1)
+        self.assertTrue(tree.startswith('(') and tree.endswith(');'))
+        self.assertEqual(report.split('\n')[0], '    4')
+        self.assertNotEqual(engine.build_tree(self.matrix, self.names, model='kimura', processes=1)[0], tree)
+        with self.assertRaises(ValueError):
+            engine.build_tree(self.matrix, self.names, model='dayhoff')
+
+    def test_bootstrap_newick(self):
+        # consensus tree in Newick format, branch lengths are the number of replicates as written by consense
+        tree, report = engine.build_tree(self.matrix, self.names, bootstrap=10, processes=1)
+        self.assertEqual(sorted(re.findall('[a-z0-9_]+(?=:)', tree)), self.names)
+        self.assertEqual(set(re.findall(':([0-9.]+)', tree)) - set(['{:.1f}'.format(i) for i in range(11)]), set())
+        self.assertTrue(tree.endswith(';'))
+        self.assertIn('How many times out of 10', report)
@@ -8,21 +8,14 @@ from common.views import AbsMiscSelection
 from common.selection import SelectionItem
 from mutation.models import *
 import math
-import os, shutil, subprocess, signal
+import os, shutil
 import uuid
 from phylogenetic_trees.PrepareTree import *
+from phylogenetic_trees.engine import build_tree
 from collections import OrderedDict
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
-def kill_phylo(): #FIXME, needs better way of handling this!
-    p = subprocess.Popen(['ps', '-A'], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    for line in out.splitlines():
-        if 'protdist' in str(line):
-            pid = int(line.split(None, 1)[0])
-            os.kill(pid, signal.SIGKILL)
-
 class TargetSelection(AbsTargetSelection):
     step = 1
     number_of_steps = 3
@@ -143,25 +136,18 @@ class Treeclass:
         if self.bootstrap!=0:
             self.bootstrap=pow(10,self.bootstrap)
         #### Create an alignment object
-        a.build_alignment()
+        if a.build_alignment() == 'Too large':
+            return "too big","too big","too big","too big","too big","too big","too big","too big"
         a.calculate_statistics()
         a.calculate_similarity()
         self.total = len(a.proteins)
-        total_length = 0
-        for chain in a.proteins[0].alignment:
-            total_length += len(a.proteins[0].alignment[chain])
         families = ProteinFamily.objects.all()
         self.famdict = {}
         for n in families:
             self.famdict[self.Tree.trans_0_2_A(n.slug)]=n.name
-        dirname = unique_filename = uuid.uuid4()
-        os.mkdir('/tmp/%s' %dirname)
-        infile = open('/tmp/%s/infile' %dirname,'w')
-        infile.write('    '+str(self.total)+'    '+str(total_length)+'\n')
         if len(a.proteins) < 3:
             return 'More_prots',None, None, None, None,None,None,None
         ####Get additional protein information
-        accesions = {}
         for n in a.proteins:
             fam = self.Tree.trans_0_2_A(n.protein.family.slug)
             if n.protein.sequence_type.slug == 'consensus':
@@ -184,81 +170,13 @@ class Treeclass:
             if len(name)>25:
                 name=name[:25]+'...'
             self.family[entry_name] = {'name':name,'family':fam,'description':desc,'species':spec,'class':'','accession':acc,'ligand':'','type':'','link': entry_name}
-            accesions[acc]=entry_name
-            ####Write PHYLIP input
-            sequence = ''
-            for chain in n.alignment:
-                for residue in n.alignment[chain]:
-                    sequence += residue[2].replace('_','-')
-            infile.write(acc+' '*9+sequence+'\n')
-        infile.close()
-        
-        ####Run bootstrap
-        if self.bootstrap:
-        ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('\n'.join(['r',str(self.bootstrap),'y','77','y'])+'\n')
-            inp.close()
-        ###
-            try:
-                subprocess.check_output(['phylip seqboot<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-                os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
-                return "too big","too big","too big","too big","too big","too big","too big","too big"
 
-        ### Write phylip input options
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-            inp.write('\n'.join(['m','d',str(self.bootstrap),'y'])+'\n')
-        else:
-            inp.write('y\n')
-        inp.close()
-        ###
-        try:
-            subprocess.check_output(['phylip protdist<temp>>log'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big"
-        os.rename('/tmp/%s/infile' %dirname, '/tmp/%s/dupa' %dirname)
-        os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-        inp = open('/tmp/%s/temp' %dirname,'w')
-        if self.bootstrap:
-        ### Write phylip input options
-            if self.UPGMA:
-                inp.write('\n'.join(['N','m',str(self.bootstrap),'111','y'])+'\n')
-            else:
-                inp.write('\n'.join(['m',str(self.bootstrap),'111','y'])+'\n')
-        else:
-            if self.UPGMA:
-                inp.write('N\ny\n')
-            else:
-                inp.write('y\n')
-        inp.close()
-        ###
-        try: 
-            subprocess.check_output(['phylip neighbor<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-        except:
-            kill_phylo() #FIXME, needs better way of handling this!
-            return "too big","too big","too big","too big","too big","too big","too big","too big"
-        if self.bootstrap:
-            os.rename('/tmp/%s/outfile' %dirname, '/tmp/%s/infile' %dirname)
-            os.rename('/tmp/%s/outtree' %dirname, '/tmp/%s/intree' %dirname)
-           ### Write phylip input options
-            inp = open('/tmp/%s/temp' %dirname,'w')
-            inp.write('y\n')
-            inp.close()
-        ###
-            try:
-                subprocess.check_output(['phylip consense<temp'], shell=True, cwd = '/tmp/%s' %dirname, timeout=60)
-            except:
-                kill_phylo() #FIXME, needs better way of handling this!
-                return "too big","too big","too big","too big","too big","too big","too big","too big"
-        self.phylip = open('/tmp/%s/outtree' %dirname).read()
-        for acc in accesions.keys():
-            self.phylip=self.phylip.replace(acc,accesions[acc])
-#        self.phylogeny_output = self.phylip
-        self.outtree = open('/tmp/%s/outfile' %dirname).read().lstrip()
+        ####Build the tree (distances, neighbour-joining or UPGMA, bootstrap consensus)
+        names = [n.protein.entry_name for n in a.proteins]
+        self.phylip, self.outtree = build_tree(a.get_matrix().matrix, names, self.bootstrap, self.UPGMA)
+
+        dirname = uuid.uuid4()
+        os.mkdir('/tmp/%s' %dirname)
         phylogeny_input = self.get_phylogeny('/tmp/%s/' %dirname)
         shutil.rmtree('/tmp/%s' %dirname)
         
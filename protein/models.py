@@ -1,12 +1,17 @@
 ﻿from django.utils.text import slugify
 from django.db import models
 from django.core.cache import cache
+from common.diagrams import CachedDiagram
 from common.diagrams_gpcr import DrawHelixBox, DrawSnakePlot
 from common.diagrams_gprotein import DrawGproteinPlot
 from common.diagrams_arrestin import DrawArrestinPlot
 
+from common.models import ReleaseNotes
 from residue.models import Residue, ResidueNumberingScheme, ResidueGenericNumberEquivalent, ResidueDataType, ResidueDataPoint
 
+# seconds to keep drawn diagrams in the cache, the cache key changes with each release
+DIAGRAM_CACHE_TIMEOUT = 60*60*24*30
+
 class Protein(models.Model):
     parent = models.ForeignKey('self', null=True, on_delete=models.CASCADE)
     family = models.ForeignKey('ProteinFamily', on_delete=models.CASCADE)
@@ -43,21 +48,30 @@ class Protein(models.Model):
             tmp = tmp.parent
         return tmp.name
 
+    def get_diagram(self, diagram_class, nobuttons=None):
+        """Snake plot or helix box of the protein
+
+        The diagram is drawn once per release and kept in the cache, only the buttons are added per request."""
+        release = ReleaseNotes.objects.values_list('date', flat=True).first()
+        cache_key = 'diagram_{}_{}_{}'.format(diagram_class.__name__, self.entry_name, release)
+        diagram = cache.get(cache_key)
+        if diagram is None:
+            residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
+            diagram = CachedDiagram.from_diagram(diagram_class(residuelist,self.get_protein_class(),str(self)))
+            cache.set(cache_key, diagram, DIAGRAM_CACHE_TIMEOUT)
+        return diagram.render(nobuttons)
+
     def get_helical_box(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
-        return DrawHelixBox(residuelist,self.get_protein_class(),str(self))
+        return self.get_diagram(DrawHelixBox)
 
     def get_snake_plot(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
-        return DrawSnakePlot(residuelist,self.get_protein_class(),str(self))
+        return self.get_diagram(DrawSnakePlot)
 
     def get_helical_box_no_buttons(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
-        return DrawHelixBox(residuelist,self.get_protein_class(),str(self), nobuttons=1)
-        
+        return self.get_diagram(DrawHelixBox, nobuttons=1)
+
     def get_snake_plot_no_buttons(self):
-        residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
-        return DrawSnakePlot(residuelist,self.get_protein_class(),str(self), nobuttons=1)
+        return self.get_diagram(DrawSnakePlot, nobuttons=1)
 
     def get_gprotein_plot(self):
         residuelist = Residue.objects.filter(protein_conformation__protein__entry_name=str(self)).prefetch_related('protein_segment','display_generic_number','generic_number')
@@ -0,0 +1,174 @@
+from django.db.models import Max
+
+from common.models import ReleaseNotes
+from protein.models import Protein, ProteinAlias, ProteinFamily
+
+import re
+import threading
+import time
+
+
+# seconds between checks whether the data has changed (new release or rebuilt tables)
+CHECK_INTERVAL = 60
+
+HTML_TAGS = re.compile('<[^>]+>')
+
+
+def strip_html(name):
+    return HTML_TAGS.sub('', name)
+
+
+def trigrams(text):
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class TextField:
+    """Lower case texts of all entries with a trigram index for substring (icontains) searches"""
+    def __init__(self, texts):
+        self.texts = [t.lower() if t else '' for t in texts]
+        self.postings = {}
+        for i, text in enumerate(self.texts):
+            for trigram in trigrams(text):
+                self.postings.setdefault(trigram, []).append(i)
+
+    def find(self, q):
+        """Indices of the entries containing q, in entry order"""
+        q = q.lower()
+        if len(q) < 3:
+            return [i for i, text in enumerate(self.texts) if q in text]
+        candidates = None
+        for postings in sorted([self.postings.get(t, []) for t in trigrams(q)], key=len):
+            candidates = set(postings) if candidates is None else candidates & set(postings)
+            if not candidates:
+                return []
+        return sorted([i for i in candidates if q in self.texts[i]])
+
+    def rank(self, i, q):
+        """0 for exact matches, 1 for prefix matches, 2 for matches at the start of a word, 3 otherwise"""
+        text = self.texts[i]
+        if text == q:
+            return 0
+        if text.startswith(q):
+            return 1
+        if re.search(r'(^|[^a-z0-9])' + re.escape(q), text):
+            return 2
+        return 3
+
+
+class SearchIndex:
+    """In-memory search index of protein names, entry names, accessions, aliases and family names
+
+    The index is built with a few queries and rebuilt when a new release is loaded, so that autocomplete requests do
+    not touch the database."""
+    _instance = None
+    _version = None
+    _checked = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.proteins = list(Protein.objects.values_list('id', 'name', 'entry_name', 'accession', 'species_id',
+            'species__common_name', 'source_id', 'source__name', 'family__slug', 'family__name').order_by('id'))
+        self.protein_index = dict([(p[0], i) for i, p in enumerate(self.proteins)])
+        self.protein_fields = {
+            'name': TextField([p[1] for p in self.proteins]),
+            'entry_name': TextField([p[2] for p in self.proteins]),
+            'family': TextField([p[9] for p in self.proteins]),
+            'stripped_name': TextField([strip_html(p[1]) for p in self.proteins]),
+        }
+        self.accessions = {}
+        for i, p in enumerate(self.proteins):
+            if p[3]:
+                self.accessions.setdefault(p[3], []).append(i)
+
+        # aliases, as (protein entry, name)
+        self.aliases = [(self.protein_index[a[0]], a[1]) for a in ProteinAlias.objects.values_list('protein_id',
+            'name').order_by('position', 'id') if a[0] in self.protein_index]
+        self.alias_field = TextField([a[1] for a in self.aliases])
+
+        self.families = list(ProteinFamily.objects.values_list('id', 'name', 'slug').order_by('id'))
+        self.family_fields = {
+            'name': TextField([f[1] for f in self.families]),
+            'stripped_name': TextField([strip_html(f[1]) for f in self.families]),
+        }
+
+    @staticmethod
+    def data_version():
+        return (ReleaseNotes.objects.aggregate(Max('date'))['date__max'], Protein.objects.count(),
+            ProteinAlias.objects.count(), ProteinFamily.objects.count())
+
+    @classmethod
+    def get(cls):
+        """Return the index of this process, rebuilding it when the data has changed"""
+        with cls._lock:
+            if cls._instance is None or time.time() - cls._checked > CHECK_INTERVAL:
+                version = cls.data_version()
+                if cls._instance is None or version != cls._version:
+                    cls._instance = cls()
+                    cls._version = version
+                cls._checked = time.time()
+            return cls._instance
+
+    def search(self, fields, q):
+        """Entries matching q in any of the fields, ordered by the best match rank and entry order"""
+        q = q.lower()
+        ranks = {}
+        for field in fields:
+            for i in field.find(q):
+                ranks[i] = min(ranks.get(i, 4), field.rank(i, q))
+        return [i for rank, i in sorted([(rank, i) for i, rank in ranks.items()])]
+
+    def find_proteins(self, q, fields, species=None, sources=None, exclusion_slug=None, accession=False,
+        limit=None):
+        """Protein rows matching q (case insensitive substring) in the given fields, or the exact accession
+
+        @param species: species ids, common name or None (no filter)
+        @param sources: protein source ids, name or None (no filter)
+        """
+        matches = self.search([self.protein_fields[f] for f in fields], q)
+        if accession:
+            exact = self.accessions.get(q, [])
+            matches = exact + [i for i in matches if i not in exact]
+
+        results = []
+        for i in matches:
+            p = self.proteins[i]
+            if not self.matches_filters(p, species, sources, exclusion_slug):
+                continue
+            results.append(p)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def find_aliases(self, q, species=None, sources=None, exclusion_slug=None, limit=None):
+        """Protein rows of aliases matching q"""
+        results = []
+        for i in self.search([self.alias_field], q):
+            p = self.proteins[self.aliases[i][0]]
+            if not self.matches_filters(p, species, sources, exclusion_slug):
+                continue
+            results.append(p)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def find_families(self, q, fields, exclusion_slug=None, limit=None):
+        """Family rows matching q in the given fields"""
+        results = []
+        for i in self.search([self.family_fields[f] for f in fields], q):
+            f = self.families[i]
+            if f[2] == '000' or (exclusion_slug and f[2].startswith(exclusion_slug)):
+                continue
+            results.append(f)
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    @staticmethod
+    def matches_filters(p, species, sources, exclusion_slug):
+        if species is not None and not (p[5] == species if isinstance(species, str) else p[4] in species):
+            return False
+        if sources is not None and not (p[7] == sources if isinstance(sources, str) else p[6] in sources):
+            return False
+        if exclusion_slug and p[8].startswith(exclusion_slug):
+            return False
+        return True
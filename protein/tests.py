@@ -1,3 +1,139 @@
-from django.test import TestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from common import diagrams
+from common.diagrams_gpcr import DrawHelixBox
+from common.tests import diagram_residues
+from protein import models, search_index
+from protein.models import Protein, ProteinFamily
+from protein.search_index import SearchIndex, TextField
+
+from unittest import mock
+
+
+# id, name, entry name, accession, species id, species, source id, source, family slug, family name
+PROTEINS = [
+    (1, '&beta;<sub>2</sub>-adrenoceptor', 'adrb2_human', 'P07550', 1, 'Human', 1, 'SWISSPROT', '001_001_003_008',
+        '&beta;<sub>2</sub>-adrenoceptors'),
+    (2, '&beta;<sub>1</sub>-adrenoceptor', 'adrb1_human', 'P08588', 1, 'Human', 1, 'SWISSPROT', '001_001_003_008',
+        '&beta;<sub>1</sub>-adrenoceptors'),
+    (3, '&beta;<sub>2</sub>-adrenoceptor', 'adrb2_mouse', 'P18762', 2, 'Mouse', 1, 'SWISSPROT', '001_001_003_008',
+        '&beta;<sub>2</sub>-adrenoceptors'),
+    (4, 'Rhodopsin', 'opsd_human', 'P08100', 1, 'Human', 2, 'TREMBL', '001_009_001_001', 'Opsins'),
+    (5, 'Glucagon receptor', 'glr_human', 'P47871', 1, 'Human', 1, 'SWISSPROT', '002_001_003_001', 'Glucagon'),
+]
+
+ALIASES = [(2, 'beta1AR'), (1, 'beta2AR'), (99, 'unknown protein')]
+
+FAMILIES = [(1, 'Parent family', '000'), (2, 'Adrenoceptors', '001_001_003'), (3, 'Opsins', '001_009_001')]
+
+
+def queryset(rows):
+    manager = mock.Mock()
+    manager.values_list.return_value.order_by.return_value = rows
+    return manager
+
+
+class TextFieldTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.field = TextField(['Rhodopsin', 'Opsin 3', None, 'Melanopsin'])
+
+    def test_find(self):
+        self.assertEqual(self.field.find('OPSIN'), [0, 1, 3])
+        self.assertEqual(self.field.find('op'), [0, 1, 3])
+        self.assertEqual(self.field.find('rhodopsine'), [])
+
+    def test_rank(self):
+        self.assertEqual([self.field.rank(i, 'opsin') for i in [0, 1, 3]], [3, 1, 3])
+        self.assertEqual(self.field.rank(1, 'opsin 3'), 0)
+        self.assertEqual(self.field.rank(1, '3'), 2)
+
+
+class SearchIndexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(search_index.Protein, 'objects', queryset(PROTEINS)),
+            mock.patch.object(search_index.ProteinAlias, 'objects', queryset(ALIASES)),
+            mock.patch.object(search_index.ProteinFamily, 'objects', queryset(FAMILIES)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.index = SearchIndex()
+
+    def entry_names(self, proteins):
+        return [p[2] for p in proteins]
+
+    def test_find_proteins(self):
+        # prefix matches of the entry name come first
+        self.assertEqual(self.entry_names(self.index.find_proteins('adrb2', ['name', 'entry_name'])),
+            ['adrb2_human', 'adrb2_mouse'])
+        self.assertEqual(self.entry_names(self.index.find_proteins('2-adrenoceptor', ['stripped_name'])),
+            ['adrb2_human', 'adrb2_mouse'])
+        self.assertEqual(self.entry_names(self.index.find_proteins('human', ['entry_name'], limit=2)),
+            ['adrb2_human', 'adrb1_human'])
+
+    def test_filters(self):
+        self.assertEqual(self.entry_names(self.index.find_proteins('adrb', ['entry_name'], species=[2])),
+            ['adrb2_mouse'])
+        self.assertEqual(self.entry_names(self.index.find_proteins('_human', ['entry_name'], species='Human',
+            sources='SWISSPROT', exclusion_slug='002')), ['adrb2_human', 'adrb1_human'])
+
+    def test_accession(self):
+        # the exact accession is listed before substring matches
+        self.assertEqual(self.entry_names(self.index.find_proteins('P08100', ['name'], accession=True)),
+            ['opsd_human'])
+        self.assertEqual(self.index.find_proteins('P08100', ['name']), [])
+
+    def test_find_aliases(self):
+        # aliases of unknown proteins are skipped
+        self.assertEqual(self.entry_names(self.index.find_aliases('beta')), ['adrb1_human', 'adrb2_human'])
+        self.assertEqual(self.entry_names(self.index.find_aliases('protein')), [])
+
+    def test_find_families(self):
+        self.assertEqual([f[2] for f in self.index.find_families('s', ['name'])], ['001_001_003', '001_009_001'])
+        # the root family is never listed
+        self.assertEqual(self.index.find_families('parent', ['name']), [])
+        self.assertEqual([f[2] for f in self.index.find_families('s', ['name'], exclusion_slug='001_009')],
+            ['001_001_003'])
+
+    def test_rebuilt_on_new_data(self):
+        self.addCleanup(setattr, SearchIndex, '_instance', None)
+        SearchIndex._instance = None
+        with mock.patch.object(SearchIndex, 'data_version', return_value=('2020-01-01', 5, 3, 3)):
+            index = SearchIndex.get()
+            self.assertIs(SearchIndex.get(), index)
+        SearchIndex._checked -= search_index.CHECK_INTERVAL + 1
+        with mock.patch.object(SearchIndex, 'data_version', return_value=('2020-06-01', 5, 3, 3)):
+            self.assertIsNot(SearchIndex.get(), index)
+
+
+class ProteinDiagramTestCase(SimpleTestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(models, 'cache', LocMemCache('protein-tests', {})),
+            mock.patch.object(models.ReleaseNotes, 'objects'),
+            mock.patch.object(models.Residue, 'objects'),
+            mock.patch.object(diagrams, 'uniqid', return_value='gradient'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        models.ReleaseNotes.objects.values_list.return_value.first.return_value = '2020-01-01'
+        models.Residue.objects.filter.return_value.prefetch_related.return_value = diagram_residues()
+        self.protein = Protein(entry_name='adrb2_human', family=ProteinFamily(name='Class A (Rhodopsin)',
+            parent=ProteinFamily(name='Root')))
+
+    def test_cached_helix_box(self):
+        plot = str(self.protein.get_helical_box_no_buttons())
+        self.assertEqual(plot, str(DrawHelixBox(diagram_residues(), 'Class A (Rhodopsin)', 'adrb2_human',
+            nobuttons=1)))
+        # the residues are only fetched once, the buttons are added to the cached drawing
+        self.assertIn('Properties', str(self.protein.get_helical_box()))
+        self.assertEqual(models.Residue.objects.filter.call_count, 1)
+        models.ReleaseNotes.objects.values_list.return_value.first.return_value = '2020-06-01'
+        self.protein.get_helical_box()
+        self.assertEqual(models.Residue.objects.filter.call_count, 2)
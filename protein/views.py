@@ -1,12 +1,12 @@
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views import generic
 from django.http import HttpResponse
-from django.db.models import Q, F, Func, Value
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page
 from django.urls import reverse
 
-from protein.models import Protein, ProteinConformation, ProteinAlias, ProteinFamily, Gene,ProteinGProteinPair
+from protein.models import Protein, ProteinConformation, ProteinAlias, Gene,ProteinGProteinPair
+from protein.search_index import SearchIndex
 from residue.models import Residue
 from structure.models import Structure, StructureModel
 from mutation.models import MutationExperiment
@@ -118,6 +118,16 @@ def detail(request, slug):
 
     return render(request, 'protein/protein_detail.html', context)
 
+def protein_json(p):
+    """Autocomplete entry of a protein row of the search index"""
+    p_json = {}
+    p_json['id'] = p[0]
+    p_json['label'] = p[1] + " [" + p[5] + "]"
+    p_json['slug'] = p[2]
+    p_json['type'] = 'protein'
+    p_json['category'] = 'Targets'
+    return p_json
+
 def SelectionAutocomplete(request):
 
     if request.is_ajax():
@@ -142,65 +152,55 @@ def SelectionAutocomplete(request):
         # species filter
         species_list = []
         for species in selection.species:
-            species_list.append(species.item)
+            species_list.append(species.item.id)
 
         # annotation filter
         protein_source_list = []
         for protein_source in selection.annotation:
-            protein_source_list.append(protein_source.item)
+            protein_source_list.append(protein_source.item.id)
+
+        q = q or ''
+        index = SearchIndex.get()
 
         # find proteins
         if type_of_selection!='navbar':
-            ps = Protein.objects.filter(Q(name__icontains=q) | Q(entry_name__icontains=q),
-                species__in=(species_list),
-                source__in=(protein_source_list)).exclude(family__slug__startswith=exclusion_slug)[:10]
+            ps = index.find_proteins(q, ['name', 'entry_name'], species=species_list, sources=protein_source_list,
+                exclusion_slug=exclusion_slug, limit=10)
         else:
-            ps = Protein.objects.filter(Q(name__icontains=q) | Q(entry_name__icontains=q) | Q(family__name__icontains=q) | Q(accession=q),
-                species__common_name='Human', source__name='SWISSPROT').exclude(family__slug__startswith=exclusion_slug)[:10]
+            ps = index.find_proteins(q, ['name', 'entry_name', 'family'], species='Human', sources='SWISSPROT',
+                exclusion_slug=exclusion_slug, accession=True, limit=10)
 
         # Try matching protein name after stripping html tags
-        if ps.count() == 0:
-            ps = Protein.objects.annotate(filtered=Func(F('name'), Value('<[^>]+>'), Value(''), Value('gi'), function='regexp_replace')).filter(Q(filtered__icontains=q), species__common_name='Human', source__name='SWISSPROT')
+        if not ps:
+            ps = index.find_proteins(q, ['stripped_name'], species='Human', sources='SWISSPROT')
 
         for p in ps:
-            p_json = {}
-            p_json['id'] = p.id
-            p_json['label'] = p.name + " [" + p.species.common_name + "]"
-            p_json['slug'] = p.entry_name
-            p_json['type'] = 'protein'
-            p_json['category'] = 'Targets'
-            results.append(p_json)
+            results.append(protein_json(p))
 
 
         if type_of_selection!='navbar':
             # find protein aliases
-            pas = ProteinAlias.objects.prefetch_related('protein').filter(name__icontains=q,
-                protein__species__in=(species_list),
-                protein__source__in=(protein_source_list)).exclude(protein__family__slug__startswith=exclusion_slug)[:10]
+            pas = index.find_aliases(q, species=species_list, sources=protein_source_list,
+                exclusion_slug=exclusion_slug, limit=10)
             for pa in pas:
-                pa_json = {}
-                pa_json['id'] = pa.protein.id
-                pa_json['label'] = pa.protein.name  + " [" + pa.protein.species.common_name + "]"
-                pa_json['slug'] = pa.protein.entry_name
-                pa_json['type'] = 'protein'
-                pa_json['category'] = 'Targets'
+                pa_json = protein_json(pa)
                 if pa_json not in results:
                     results.append(pa_json)
 
             # protein families
             if (type_of_selection == 'targets' or type_of_selection == 'browse' or type_of_selection == 'gproteins') and selection_only_receptors!="True":
                 # find protein families
-                pfs = ProteinFamily.objects.filter(name__icontains=q).exclude(slug='000').exclude(slug__startswith=exclusion_slug)[:10]
+                pfs = index.find_families(q, ['name'], exclusion_slug=exclusion_slug, limit=10)
 
                 # Try matching protein family name after stripping html tags
-                if pfs.count() == 0:
-                    pfs = ProteinFamily.objects.annotate(filtered=Func(F('name'), Value('<[^>]+>'), Value(''), Value('gi'), function='regexp_replace')).filter(filtered__icontains=q).exclude(slug='000').exclude(slug__startswith=exclusion_slug)[:10]
+                if not pfs:
+                    pfs = index.find_families(q, ['stripped_name'], exclusion_slug=exclusion_slug, limit=10)
 
                 for pf in pfs:
                     pf_json = {}
-                    pf_json['id'] = pf.id
-                    pf_json['label'] = pf.name
-                    pf_json['slug'] = pf.slug
+                    pf_json['id'] = pf[0]
+                    pf_json['label'] = pf[1]
+                    pf_json['slug'] = pf[2]
                     pf_json['type'] = 'family'
                     pf_json['category'] = 'Target families'
                     results.append(pf_json)
@@ -7,5 +7,6 @@ urlpatterns = [
     url(r'^targetselection', views.TargetSelection.as_view(), name='targetselection'),
     url(r'^residuetable$', views.ResidueTablesSelection.as_view(), name='residuetable'),
     url(r'^residuetabledisplay', views.ResidueTablesDisplay.as_view(), name='residuetable'),
+    url(r'^residuetabledownload', views.ResidueTablesDownload.as_view(), name='residuetabledownload'),
     url(r'^residuefunctionbrowser$', views.ResidueFunctionBrowser.as_view(), name='residue_function_browser'),
 ]
@@ -1,6 +1,7 @@
 ﻿from django.conf import settings
 from django.core.cache import cache
 from django.db.models import Count, F, Q
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.views.generic import TemplateView
 
@@ -25,9 +26,12 @@ from protein.models import ProteinSegment, Protein, ProteinGProtein, ProteinGPro
 from residue.models import Residue,ResidueNumberingScheme, ResiduePositionSet, ResidueSet
 
 from collections import OrderedDict
+from io import BytesIO
 
+import csv
 import re
 import time
+import xlsxwriter
 
 class TargetSelection(AbsTargetSelection):
     pass
@@ -59,25 +63,61 @@ class ResidueTablesSelection(AbsTargetSelection):
         }
 
 
+def residue_table(proteins, segments, numbering_schemes, default_scheme):
+    """
+    Rows of the residue numbering table per segment, each row has the labels of the numbering schemes followed by the
+    residue of each protein ('-' when missing). Rows are keyed by generic number and placed with a lookup of the protein
+    columns, the residues and their alternative generic numbers are fetched in two queries.
+    """
+    # the first column of each protein (a protein can be selected more than once)
+    columns = {}
+    for i, protein in enumerate(proteins):
+        columns.setdefault(protein.pk, i)
+    scheme_slugs = dict(ResidueNumberingScheme.objects.values_list('id', 'slug'))
+    is_default_numbering = default_scheme.slug == settings.DEFAULT_NUMBERING_SCHEME
+
+    residues = Residue.objects.filter(protein_segment__in=segments,
+        protein_conformation__protein__in=list(columns)).exclude(generic_number=None).values_list('id',
+        'protein_segment__slug', 'protein_conformation__protein_id', 'generic_number__label',
+        'generic_number__scheme_id', 'amino_acid', 'sequence_number')
+    alternatives = {}
+    for residue_id, label, scheme_id in Residue.alternative_generic_numbers.through.objects.filter(
+        residue__protein_segment__in=segments, residue__protein_conformation__protein__in=list(columns)).values_list(
+        'residue_id', 'residuegenericnumber__label', 'residuegenericnumber__scheme_id').order_by('id'):
+        alternatives.setdefault(residue_id, []).append((label, scheme_id))
+
+    # each helix has a dictionary of positions, the generic number is the key
+    # value is a dictionary of other gn positions and residues from selected proteins
+    data = OrderedDict([(segment.slug, {}) for segment in segments])
+    for residue_id, segment, protein_id, pos, pos_scheme_id, amino_acid, sequence_number in residues:
+        if pos not in data[segment]:
+            data[segment][pos] = {default_scheme.slug : pos, 'seq' : ['-']*len(proteins)}
+        row = data[segment][pos]
+        for label, scheme_id in alternatives.get(residue_id, []):
+            if not (is_default_numbering and scheme_id == pos_scheme_id):
+                slug = scheme_slugs[scheme_id]
+                if slug not in row:
+                    row[slug] = label
+                if label not in row[slug]:
+                    row[slug] += " "+label
+            row['seq'][columns[protein_id]] = amino_acid + str(sequence_number)
+
+    # Preparing the dictionary of list of lists. Dealing with tripple nested dictionary in django templates is a nightmare
+    return OrderedDict([(s, [[data[s][x].get(y.slug, '-') for y in numbering_schemes]+data[s][x]['seq']
+        for x in sorted(data[s])]) for s in data])
+
+
 class ResidueTablesDisplay(TemplateView):
     """
     A class rendering the residue numbering table.
     """
     template_name = 'residue_table.html'
 
-    def get_context_data(self, **kwargs):
+    def get_proteins(self, simple_selection):
         """
-        Get the selection data (proteins and numbering schemes) and prepare it for display.
+        Flatten the selected targets into individual proteins.
         """
-        context = super().get_context_data(**kwargs)
-
-        # get the user selection from session
-        simple_selection = self.request.session.get('selection', False)
-
-         # local protein list
         proteins = []
-
-        # flatten the selection into individual proteins
         for target in simple_selection.targets:
             if target.type == 'protein':
                 proteins.append(target.item)
@@ -102,23 +142,34 @@ class ResidueTablesDisplay(TemplateView):
 
                 for fp in family_proteins:
                     proteins.append(fp)
+        return proteins
 
-            longest_name = 0
-            species_list = {}
-            for protein in proteins:
-                if protein.species.common_name not in species_list:
-                    if len(protein.species.common_name)>10 and len(protein.species.common_name.split())>1:
-                        name = protein.species.common_name.split()[0][0]+". "+" ".join(protein.species.common_name.split()[1:])
-                        if len(" ".join(protein.species.common_name.split()[1:]))>11:
-                            name = protein.species.common_name.split()[0][0]+". "+" ".join(protein.species.common_name.split()[1:])[:8]+".."
-                    else:
-                        name = protein.species.common_name
-                    species_list[protein.species.common_name] = name
+    def get_table(self):
+        """
+        Get the selection data (proteins and numbering schemes) and build the table.
+        """
+        # get the user selection from session
+        simple_selection = self.request.session.get('selection', False)
+
+        # local protein list
+        proteins = self.get_proteins(simple_selection)
+
+        longest_name = 0
+        species_list = {}
+        for protein in proteins:
+            if protein.species.common_name not in species_list:
+                if len(protein.species.common_name)>10 and len(protein.species.common_name.split())>1:
+                    name = protein.species.common_name.split()[0][0]+". "+" ".join(protein.species.common_name.split()[1:])
+                    if len(" ".join(protein.species.common_name.split()[1:]))>11:
+                        name = protein.species.common_name.split()[0][0]+". "+" ".join(protein.species.common_name.split()[1:])[:8]+".."
                 else:
-                    name = species_list[protein.species.common_name]
+                    name = protein.species.common_name
+                species_list[protein.species.common_name] = name
+            else:
+                name = species_list[protein.species.common_name]
 
-                if len(re.sub('<[^>]*>', '', protein.name)+" "+name)>longest_name:
-                    longest_name = len(re.sub('<[^>]*>', '', protein.name)+" "+name)
+            if len(re.sub('<[^>]*>', '', protein.name)+" "+name)>longest_name:
+                longest_name = len(re.sub('<[^>]*>', '', protein.name)+" "+name)
 
         # get the selection from session
         selection = Selection()
@@ -128,66 +179,80 @@ class ResidueTablesDisplay(TemplateView):
         numbering_schemes = [x.item for x in selection.numbering_schemes]
 
         # # get the helices (TMs only at first)
-        segments = ProteinSegment.objects.filter(category='helix', proteinfamily='GPCR')
+        segments = list(ProteinSegment.objects.filter(category='helix', proteinfamily='GPCR'))
 
-        if ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME) in numbering_schemes:
-            default_scheme = ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME)
-        else:
+        default_scheme = ResidueNumberingScheme.objects.get(slug=settings.DEFAULT_NUMBERING_SCHEME)
+        if default_scheme not in numbering_schemes:
             default_scheme = numbering_schemes[0]
 
-        # prepare the dictionary
-        # each helix has a dictionary of positions
-        # default_generic_number or first scheme on the list is the key
-        # value is a dictionary of other gn positions and residues from selected proteins
-        data = OrderedDict()
-        for segment in segments:
-            data[segment.slug] = OrderedDict()
-            residues = Residue.objects.filter(protein_segment=segment, protein_conformation__protein__in=proteins).prefetch_related('protein_conformation__protein', 'protein_conformation__state', 'protein_segment',
-                'generic_number__scheme', 'display_generic_number__scheme', 'alternative_generic_numbers__scheme')
-            for scheme in numbering_schemes:
-                if scheme == default_scheme and scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                    for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                        data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-                elif scheme == default_scheme:
-                    for pos in list(set([x.generic_number.label for x in residues if x.protein_segment == segment])):
-                            data[segment.slug][pos] = {scheme.slug : pos, 'seq' : ['-']*len(proteins)}
-
-            for residue in residues:
-                alternatives = residue.alternative_generic_numbers.all()
-                pos = residue.generic_number
-                for alternative in alternatives:
-                    scheme = alternative.scheme
-                    if default_scheme.slug == settings.DEFAULT_NUMBERING_SCHEME:
-                        pos = residue.generic_number
-                        if scheme == pos.scheme:
-                            data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                        else:
-                            if scheme.slug not in data[segment.slug][pos.label].keys():
-                                data[segment.slug][pos.label][scheme.slug] = alternative.label
-                            if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                                data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                            data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-                    else:
-                        if scheme.slug not in data[segment.slug][pos.label].keys():
-                            data[segment.slug][pos.label][scheme.slug] = alternative.label
-                        if alternative.label not in data[segment.slug][pos.label][scheme.slug]:
-                            data[segment.slug][pos.label][scheme.slug] += " "+alternative.label
-                        data[segment.slug][pos.label]['seq'][proteins.index(residue.protein_conformation.protein)] = str(residue)
-
-        # Preparing the dictionary of list of lists. Dealing with tripple nested dictionary in django templates is a nightmare
-        flattened_data = OrderedDict.fromkeys([x.slug for x in segments], [])
-
-        for s in iter(flattened_data):
-            flattened_data[s] = [[data[s][x][y.slug] for y in numbering_schemes]+data[s][x]['seq'] for x in sorted(data[s])]
-
-        context['header'] = zip([x.short_name for x in numbering_schemes] + [x.name+" "+species_list[x.species.common_name] for x in proteins], [x.name for x in numbering_schemes] + [x.name for x in proteins],[x.name for x in numbering_schemes] + [x.entry_name for x in proteins])
-        context['segments'] = [x.slug for x in segments]
-        context['data'] = flattened_data
+        return {
+            'proteins': proteins,
+            'species_names': species_list,
+            'numbering_schemes': numbering_schemes,
+            'segments': segments,
+            'data': residue_table(proteins, segments, numbering_schemes, default_scheme),
+            'longest_name': longest_name,
+        }
+
+    def get_context_data(self, **kwargs):
+        """
+        Get the selection data (proteins and numbering schemes) and prepare it for display.
+        """
+        context = super().get_context_data(**kwargs)
+        table = self.get_table()
+        numbering_schemes = table['numbering_schemes']
+        proteins = table['proteins']
+
+        context['header'] = zip([x.short_name for x in numbering_schemes] + [x.name+" "+table['species_names'][x.species.common_name] for x in proteins], [x.name for x in numbering_schemes] + [x.name for x in proteins],[x.name for x in numbering_schemes] + [x.entry_name for x in proteins])
+        context['segments'] = [x.slug for x in table['segments']]
+        context['data'] = table['data']
         context['number_of_schemes'] = len(numbering_schemes)
-        context['longest_name'] = {'div' : longest_name*2, 'height': longest_name*2+80}
+        context['longest_name'] = {'div' : table['longest_name']*2, 'height': table['longest_name']*2+80}
 
         return context
 
+
+class Echo:
+    """
+    File-like object returning what is written, for streaming csv rows.
+    """
+    def write(self, value):
+        return value
+
+
+class ResidueTablesDownload(ResidueTablesDisplay):
+    """
+    The residue numbering table as a streamed CSV file, or an Excel file with ?format=xlsx.
+    """
+
+    def get_rows(self, table):
+        yield ['Segment'] + [x.short_name for x in table['numbering_schemes']] + [re.sub('<[^>]*>', '', x.name) + " " +
+            table['species_names'][x.species.common_name] for x in table['proteins']]
+        yield [''] * (len(table['numbering_schemes']) + 1) + [x.entry_name for x in table['proteins']]
+        for segment, rows in table['data'].items():
+            for row in rows:
+                yield [segment] + row
+
+    def get(self, request, *args, **kwargs):
+        table = self.get_table()
+
+        if request.GET.get('format') == 'xlsx':
+            output = BytesIO()
+            workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+            worksheet = workbook.add_worksheet()
+            for i, row in enumerate(self.get_rows(table)):
+                worksheet.write_row(i, 0, row)
+            workbook.close()
+            response = HttpResponse(output.getvalue(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            response['Content-Disposition'] = 'attachment; filename=GPCRdb_residue_table.xlsx'
+            return response
+
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse((writer.writerow(row) for row in self.get_rows(table)), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=GPCRdb_residue_table.csv'
+        return response
+
+
 class ResidueFunctionBrowser(TemplateView):
     """
     Per generic position summary of functional information
@@ -2,6 +2,7 @@
 A module for generating sequence signatures for the given two sets of proteins.
 """
 from django.conf import settings
+from django.core.cache import cache
 #from django.core import exceptions
 
 from alignment.functions import strip_html_tags, get_format_props, prepare_aa_group_preference
@@ -10,19 +11,85 @@ Alignment = getattr(__import__(
     fromlist=['Alignment']
     ), 'Alignment')
 
-from common.definitions import AA_ZSCALES, AMINO_ACIDS, AMINO_ACID_GROUPS, AMINO_ACID_GROUP_NAMES, AMINO_ACID_GROUP_PROPERTIES, ZSCALES
+from common.alignment_matrix import AA_CODES, ALPHABET, FEATURE_MATRIX, GAP, NUM_COUNTED, PADDING, UNKNOWN
+from common.definitions import AA_ZSCALES, AMINO_ACID_GROUPS, AMINO_ACID_GROUP_NAMES, AMINO_ACID_GROUP_PROPERTIES, ZSCALES
 from protein.models import Protein, ProteinConformation
 from residue.models import Residue
 
 
 from collections import OrderedDict
 from copy import deepcopy
+import hashlib
+import logging
 import numpy as np
 from operator import itemgetter
 import re
 from scipy.stats import t
 import time
 
+
+# feature display values in AMINO_ACID_GROUPS order
+FEATURE_KEYS = list(AMINO_ACID_GROUPS.keys())
+FEATURE_NAMES = list(AMINO_ACID_GROUP_NAMES.values())
+FEATURE_SHORT_NAMES = [x['display_name_short'] for x in AMINO_ACID_GROUP_PROPERTIES.values()]
+FEATURE_LENGTHS = [x['length'] for x in AMINO_ACID_GROUP_PROPERTIES.values()]
+
+# Z-scales of the counted residue codes (codes x scales), gaps have none
+ZSCALE_VALUES = np.zeros((NUM_COUNTED, len(ZSCALES)))
+ZSCALE_CODES = np.zeros(NUM_COUNTED, dtype=bool)
+for aa, values in AA_ZSCALES.items():
+    if aa in AA_CODES and AA_CODES[aa] < NUM_COUNTED:
+        ZSCALE_VALUES[AA_CODES[aa]] = values
+        ZSCALE_CODES[AA_CODES[aa]] = True
+ZSCALE_CODES[GAP] = False
+
+# seconds to keep the feature statistics of a protein set in the cache
+SET_STATISTICS_TIMEOUT = 60*60*24
+
+logger = logging.getLogger('protwis')
+
+
+def set_statistics(alignment):
+    """Feature frequencies and Z-scale distributions of the positions of a built alignment, cached per protein set
+
+    Returns a dict with the observed positions as (segment, generic number) tuples, the feature frequencies
+    (features x positions, rounded percentages as in Alignment.feature_stats) and the mean, standard deviation and
+    count of each Z-scale (scales x positions)."""
+    key = hashlib.md5()
+    key.update(repr(sorted([pc.pk for pc in alignment.proteins])).encode('utf-8'))
+    key.update(repr([(segment, list(positions)) for segment, positions in alignment.segments.items()]).encode('utf-8'))
+    key.update(repr([s[0] for s in alignment.numbering_schemes]).encode('utf-8'))
+    cache_key = 'seqsign_set_statistics_' + key.hexdigest()
+    statistics = cache.get(cache_key)
+    if statistics is not None:
+        return statistics
+
+    m = alignment.get_matrix()
+    aa_counts = m.aa_counts()
+    observed = aa_counts.sum(axis=0) > 0
+    num_proteins = max(len(m), 1)
+    features = np.array([[round(x) for x in row] for row in (m.feature_counts(aa_counts)[:, observed] / num_proteins
+        * 100).tolist()], dtype='int').reshape(len(FEATURE_KEYS), -1)
+
+    # Z-scale distributions of the residues (not gaps) at each position
+    counts = np.where(ZSCALE_CODES[:, None], aa_counts, 0)[:, observed].astype(float)
+    n = counts.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = counts.T.dot(ZSCALE_VALUES).T / n
+        squares = (counts[:, None, :] * (ZSCALE_VALUES[:, :, None] - mean[None, :, :]) ** 2).sum(axis=0)
+        std = np.where(n > 1, np.sqrt(squares / (n - 1)), np.where(n == 1, 0, np.nan))
+
+    statistics = {
+        'positions': [p for p, o in zip(m.positions, observed.tolist()) if o],
+        'features': features,
+        'zscale_mean': mean,
+        'zscale_std': std,
+        'zscale_count': n.astype(int),
+    }
+    cache.set(cache_key, statistics, SET_STATISTICS_TIMEOUT)
+    return statistics
+
+
 class SequenceSignature:
     """
     A class handling the sequence signature.
@@ -32,6 +99,8 @@ class SequenceSignature:
 
         self.aln_pos = Alignment()
         self.aln_neg = Alignment()
+        self.aln_pos.use_matrix_engine = True
+        self.aln_neg.use_matrix_engine = True
 
         self.features_normalized_pos = OrderedDict()
         self.features_normalized_neg = OrderedDict()
@@ -203,42 +272,49 @@ class SequenceSignature:
 
         self.setup_alignments(segments)
 
+    def _common_columns(self, statistics, columns, default):
+        """Rows of a statistic (rows x set positions) for the common columns, default values for missing positions"""
+        index = dict([(p, i) for i, p in enumerate(statistics['positions'])])
+        take = np.array([index.get(c, -1) for c in columns], dtype=int)
+        found = take >= 0
+        values = np.repeat(default[:, None], len(columns), axis=1)
+        values[:, found] = statistics['features'][:, take[found]]
+        return values
+
+    def _feature_row(self, pos, value):
+        return [FEATURE_SHORT_NAMES[pos], FEATURE_NAMES[pos], value, int(value/20)+5, FEATURE_LENGTHS[pos],
+            FEATURE_KEYS[pos]]
+
     def calculate_signature(self):
         """
         Calculates the feature frequency difference between two protein sets.
         Generates the full differential matrix as well as maximum difference for a position (for scatter plot).
-        """
-        for sid, segment in enumerate(self.aln_neg.segments):
-            self.features_normalized_pos[segment] = np.array(
-                [[x[0] for x in feat[sid]] for feat in self.aln_pos.feature_stats],
-                dtype='int'
-                )
-            self.features_normalized_neg[segment] = np.array(
-                [[x[0] for x in feat[sid]] for feat in self.aln_neg.feature_stats],
-                dtype='int'
-                )
 
-        for segment in self.aln_neg.segments:
-            #TODO: get the correct default numering scheme from settings
-            for idx, res in enumerate(self.common_gn[self.common_schemes[0][0]][segment].keys()):
-                if res not in self.aln_pos.generic_numbers[self.common_schemes[0][0]][segment].keys():
-                    self.features_normalized_pos[segment] = np.insert(self.features_normalized_pos[segment], idx, self.default_column, axis=1)
-                elif res not in self.aln_neg.generic_numbers[self.common_schemes[0][0]][segment].keys():
-                    self.features_normalized_neg[segment] = np.insert(self.features_normalized_neg[segment], idx, self.default_column, axis=1)
-
-            # now the difference
-            self.features_frequency_difference[segment] = np.subtract(
-                self.features_normalized_pos[segment],
-                self.features_normalized_neg[segment]
-                )
-
-        self._convert_feature_stats(self.features_normalized_pos, self.aln_pos)
-        self._convert_feature_stats(self.features_normalized_neg, self.aln_neg)
+        The feature frequencies of both sets are taken from their encoded alignment matrices (see set_statistics) and
+        mapped onto the common generic numbers in one pass, missing positions count as gaps.
+        """
+        #TODO: get the correct default numering scheme from settings
+        scheme = self.common_schemes[0][0]
+        segments = list(self.aln_neg.segments)
+        columns = [(segment, gn) for segment in segments for gn in self.common_gn[scheme][segment].keys()]
+        bounds = OrderedDict()
+        start = 0
+        for segment in segments:
+            bounds[segment] = slice(start, start + len(self.common_gn[scheme][segment]))
+            start = bounds[segment].stop
+
+        features_pos = self._common_columns(set_statistics(self.aln_pos), columns, self.default_column)
+        features_neg = self._common_columns(set_statistics(self.aln_neg), columns, self.default_column)
+        difference = features_pos - features_neg
+        for segment, columns in bounds.items():
+            self.features_normalized_pos[segment] = features_pos[:, columns]
+            self.features_normalized_neg[segment] = features_neg[:, columns]
+            self.features_frequency_difference[segment] = difference[:, columns]
 
         # Version with display data
-        for row in range(len(AMINO_ACID_GROUPS.keys())):
+        for row in range(len(FEATURE_KEYS)):
             tmp_row = []
-            for segment in self.aln_neg.segments:
+            for segment in segments:
                 #first item is the real value,
                 # second is the assignmnent of color (via css)
                 # 0 - red, 5 - yellow, 10 - green
@@ -246,71 +322,36 @@ class SequenceSignature:
                 tmp_row.append([[
                     x,
                     int(x/20)+5 if x!= 0 else -1,
-                    "{} - {}".format(
-                        self.features_normalized_pos[segment][row][y],
-                        self.features_normalized_neg[segment][row][y]
-                        )
-                    ] for y, x in enumerate(self.features_frequency_difference[segment][row])])
+                    "{} - {}".format(p, n)
+                    ] for x, p, n in zip(self.features_frequency_difference[segment][row].tolist(),
+                        self.features_normalized_pos[segment][row].tolist(),
+                        self.features_normalized_neg[segment][row].tolist())])
             self.features_frequency_diff_display.append(tmp_row)
 
-        self.signature = OrderedDict([(x, []) for x in self.aln_neg.segments])
-        for segment in self.aln_neg.segments:
-            tmp = np.array(self.features_frequency_difference[segment])
-            signature_map = np.absolute(tmp).argmax(axis=0)
-            #signature_map = tmp.argmax(axis=0)
+        self.signature = OrderedDict([(x, []) for x in segments])
+        self.features_consensus_pos = OrderedDict([(x, []) for x in segments])
+        self.features_consensus_neg = OrderedDict([(x, []) for x in segments])
+        for segment in segments:
+            diff = self.features_frequency_difference[segment]
+            signature_map = np.absolute(diff).argmax(axis=0)
             # Update mapping to prefer features with fewer amino acids
             signature_map = self._assign_preferred_features(signature_map, segment, self.features_frequency_difference)
+            for col, pos in enumerate(signature_map):
+                value = diff[pos][col]
+                row = self._feature_row(pos, value)
+                if value <= 0:
+                    # latest implementation of NOT... properties
+                    row[0] = '-' + row[0]
+                    row[1] = "Not " + row[1]
+                row.append(FEATURE_SHORT_NAMES[pos])
+                self.signature[segment].append(row)
+
+            for features, consensus in ((self.features_normalized_pos, self.features_consensus_pos),
+                (self.features_normalized_neg, self.features_consensus_neg)):
+                features_cons = self._assign_preferred_features(features[segment].argmax(axis=0), segment, features)
+                for col, pos in enumerate(features_cons):
+                    consensus[segment].append(self._feature_row(pos, features[segment][pos][col]))
 
-            self.signature[segment] = []
-            for col, pos in enumerate(list(signature_map)):
-                self.signature[segment].append([
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'] if self.features_frequency_difference[segment][pos][col] > 0 else '-' + list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'], # latest implementation of NOT... properties
-                    list(AMINO_ACID_GROUP_NAMES.values())[pos] if self.features_frequency_difference[segment][pos][col] > 0 else "Not " + list(AMINO_ACID_GROUP_NAMES.values())[pos], # latest implementation of NOT... properties
-                    self.features_frequency_difference[segment][pos][col],
-                    int(self.features_frequency_difference[segment][pos][col]/20)+5,
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
-                    list(AMINO_ACID_GROUPS.keys())[pos],
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short']
-                ])
-
-        features_pos = OrderedDict()
-        features_neg = OrderedDict()
-        self.features_consensus_pos = OrderedDict([(x, []) for x in self.aln_neg.segments])
-        self.features_consensus_neg = OrderedDict([(x, []) for x in self.aln_neg.segments])
-        for sid, segment in enumerate(self.aln_neg.segments):
-            features_pos[segment] = np.array(
-                [[x[0] for x in feat[sid]] for feat in self.aln_pos.feature_stats],
-                dtype='int'
-                )
-            features_neg[segment] = np.array(
-                [[x[0] for x in feat[sid]] for feat in self.aln_neg.feature_stats],
-                dtype='int'
-                )
-            features_cons_pos = features_pos[segment].argmax(axis=0)
-            features_cons_pos = self._assign_preferred_features(features_cons_pos, segment, features_pos)
-            features_cons_neg = features_neg[segment].argmax(axis=0)
-            features_cons_neg = self._assign_preferred_features(features_cons_neg, segment, features_neg)
-
-            for col, pos in enumerate(list(features_cons_pos)):
-                self.features_consensus_pos[segment].append([
-                    # list(AMINO_ACID_GROUPS.keys())[pos],
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'],
-                    list(AMINO_ACID_GROUP_NAMES.values())[pos],
-                    features_pos[segment][pos][col],
-                    int(features_pos[segment][pos][col]/20)+5,
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
-                    list(AMINO_ACID_GROUPS.keys())[pos]
-                ])
-            for col, pos in enumerate(list(features_cons_neg)):
-                self.features_consensus_neg[segment].append([
-                    # list(AMINO_ACID_GROUPS.keys())[pos],
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['display_name_short'],
-                    list(AMINO_ACID_GROUP_NAMES.values())[pos],
-                    features_neg[segment][pos][col],
-                    int(features_neg[segment][pos][col]/20)+5,
-                    list(AMINO_ACID_GROUP_PROPERTIES.values())[pos]['length'],
-                    list(AMINO_ACID_GROUPS.keys())[pos]
-                ])
         self._convert_feature_stats(self.features_normalized_pos, self.aln_pos)
         self._convert_feature_stats(self.features_normalized_neg, self.aln_neg)
 
@@ -318,56 +359,61 @@ class SequenceSignature:
         """
         Calculates the Z-scales (Z1-Z5) difference between two protein sets for each GN residue position
         Generates the full difference matrix and calculates the relevance (P-value) for each z-scale & position combination.
+
+        The t-tests of all shared positions of a segment are calculated at once from the cached set statistics.
         """
-        # Prepare zscales for both sets
-        self.aln_pos.calculate_zscales()
-        self.aln_neg.calculate_zscales()
+        stats_pos = set_statistics(self.aln_pos)
+        stats_neg = set_statistics(self.aln_neg)
+        index_pos = dict([(p, i) for i, p in enumerate(stats_pos['positions'])])
+        index_neg = dict([(p, i) for i, p in enumerate(stats_neg['positions'])])
+        segments = list(self.aln_pos.aa_count.keys())
+
+        def values(stats, i, z):
+            count = int(stats['zscale_count'][i])
+            std = stats['zscale_std'][z][i] if count != 1 else 0
+            return [stats['zscale_mean'][z][i], std, count]
 
         # Difference + p-value calculation for shared residues
         ZSCALES.sort()
-        for zscale in ZSCALES:
+        for z, zscale in enumerate(ZSCALES):
             self.zscales_signature[zscale] = OrderedDict()
-            for segment in self.aln_pos.zscales[ZSCALES[0]].keys():
+            for segment in segments:
                 self.zscales_signature[zscale][segment] = OrderedDict()
 
-                all_keys = set(self.aln_pos.zscales[zscale][segment].keys()).union(self.aln_neg.zscales[zscale][segment].keys())
-                shared_keys = set(self.aln_pos.zscales[zscale][segment].keys()).intersection(self.aln_neg.zscales[zscale][segment].keys())
-                for entry in sorted(all_keys):
-                    if entry in shared_keys:
-                        var1 = self.aln_pos.zscales[zscale][segment][entry]
-                        var2 = self.aln_neg.zscales[zscale][segment][entry]
-
-                        # Welch's t-test
-                        # One-liner alternative : sed = np.sqrt(var1[1]**2.0/var1[2] + var2[1]**2.0/var2[2])
-                        # se1 = var1[1]/np.sqrt(var1[2])
-                        # se2 = var2[1]/np.sqrt(var2[2])
-                        # sed = np.sqrt(se1**2.0 + se2**2.0)
-
-                        # Student t-test assuming similar variance different sample sizes
-                        sed = 0
-                        if var1[2] > 0 and var2[2] > 0 and (var1[2]+var2[2] - 2) > 0:
-                            sed = np.sqrt(((var1[2] - 1) * var1[1]**2.0 + (var2[2]-1)*var2[1]**2.0)/(var1[2]+var2[2]-2)) * np.sqrt(1/var1[2] + 1/var2[2])
-
-                        t_value = 1
+                keys_pos = set([p[1] for p in stats_pos['positions'] if p[0] == segment])
+                keys_neg = set([p[1] for p in stats_neg['positions'] if p[0] == segment])
+                shared_keys = sorted(keys_pos & keys_neg)
+                pos = np.array([index_pos[(segment, x)] for x in shared_keys], dtype=int)
+                neg = np.array([index_neg[(segment, x)] for x in shared_keys], dtype=int)
+
+                # Student t-test assuming similar variance different sample sizes
+                n1 = stats_pos['zscale_count'][pos].astype(float)
+                n2 = stats_neg['zscale_count'][neg].astype(float)
+                s1 = np.where(n1 > 1, stats_pos['zscale_std'][z][pos], 0)
+                s2 = np.where(n2 > 1, stats_neg['zscale_std'][z][neg], 0)
+                mean_diff = stats_pos['zscale_mean'][z][pos] - stats_neg['zscale_mean'][z][neg]
+                df = n1 + n2 - 2
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sed = np.where((n1 > 0) & (n2 > 0) & (df > 0), np.sqrt(((n1 - 1) * s1**2.0 + (n2 - 1) * s2**2.0) / df)
+                        * np.sqrt(1/n1 + 1/n2), 0)
+                    t_values = mean_diff / sed
+                    p_values = (1.0 - t.cdf(np.abs(t_values), df)) * 2.0
+                shared = dict([(x, i) for i, x in enumerate(shared_keys)])
+
+                for entry in sorted(keys_pos | keys_neg):
+                    if entry in shared:
+                        i = shared[entry]
+                        var1 = values(stats_pos, pos[i], z)
+                        var2 = values(stats_neg, neg[i], z)
+
                         p = 100
                         color = -1
-                        if sed != 0:
-                            mean_diff = var1[0] - var2[0]
-                            t_value = mean_diff / sed
-
-                            # Grab P-value
-                            df = var1[2] + var2[2] - 2
-                            p = (1.0 - t.cdf(abs(t_value), df)) * 2.0
-
-                            # Coloring based on statistical significance
-                            #if p <= 0.05:
-                            #    color = int(round(10 - 9 * p/0.05, 0))
-                            #else:
-                            #    color = 0
+                        if sed[i] != 0:
+                            p = p_values[i]
 
                             # Coloring difference Z-scale means when statistically significant
-                            if p <= 0.05 and abs(mean_diff) > 0.6:
-                                color = round(mean_diff / 4 * 5, 0)
+                            if p <= 0.05 and abs(mean_diff[i]) > 0.6:
+                                color = round(mean_diff[i] / 4 * 5, 0)
                                 if abs(color) > 5:
                                     color = color/abs(color) * 5
                                 color = int(color + 5)
@@ -380,12 +426,12 @@ class SequenceSignature:
                         self.zscales_signature[zscale][segment][entry] = [round(var1[0]-var2[0],1), color, tooltip] # diff, P-value, tooltip
                     else:
                         tooltip = entry + "<br/>Set 1: GAP<br/>"
-                        if entry in self.aln_pos.zscales[zscale][segment]:
-                            var1 = self.aln_pos.zscales[zscale][segment][entry]
+                        if entry in keys_pos:
+                            var1 = values(stats_pos, index_pos[(segment, entry)], z)
                             tooltip = entry + "<br/>Set 1: " + str(round(var1[0], 2)) + " ± " + str(round(var1[1], 2)) + " (" + str(var1[2]) + ")</br>"
 
-                        if entry in self.aln_neg.zscales[zscale][segment]:
-                            var2 = self.aln_neg.zscales[zscale][segment][entry]
+                        if entry in keys_neg:
+                            var2 = values(stats_neg, index_neg[(segment, entry)], z)
                             tooltip += "Set 2: " + str(round(var2[0], 2)) + " ± " + str(round(var2[1], 2)) + " (" + str(var2[2]) + ")</br>"
                         else:
                             tooltip += "Set 2: GAP<br/>"
@@ -414,14 +460,21 @@ class SequenceSignature:
         return options
 
     def prepare_session_data(self):
-
-        session_signature = {
+        """Arrays and JSON values of the signature for the result store, the difference matrices of the segments are
+        stored side by side"""
+        segments = list(self.features_frequency_difference)
+        arrays = {
+            'diff_matrix': np.hstack([self.features_frequency_difference[s] for s in segments]) if segments else
+                np.zeros((len(FEATURE_KEYS), 0)),
+            'diff_columns': np.array([self.features_frequency_difference[s].shape[1] for s in segments], dtype=int),
+        }
+        meta = {
             'common_positions': self.common_gn,
-            'diff_matrix': self.features_frequency_difference,
             'numbering_schemes': self.common_schemes,
             'common_segments': self.common_segments,
+            'diff_segments': segments,
         }
-        return session_signature
+        return arrays, meta
 
     def merge_numbering_schemes(self):
         """
@@ -750,18 +803,8 @@ class SignatureMatch():
         self.protein_signatures = OrderedDict()
         self.feature_preference = prepare_aa_group_preference()
 
-        print(self.schemes)
         self.find_relevant_gns()
-
-        self.residue_to_feat = dict(
-            [(x, set()) for x in AMINO_ACIDS.keys()]
-            )
-        for fidx, feat in enumerate(AMINO_ACID_GROUPS.items()):
-            for res in feat[1]:
-                try:
-                    self.residue_to_feat[res].add(fidx)
-                except KeyError:
-                    self.residue_to_feat['-'].add(fidx)
+        self._prepare_scoring()
 
         self._find_norm()
         self.scores_pos, self.signatures_pos, self.scored_proteins_pos = self.score_protein_set(self.protein_set_pos)
@@ -841,7 +884,8 @@ class SignatureMatch():
             # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
             signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
             signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
-            tmp = np.array(self.signature_matrix_filtered[segment])
+            # plain numbers, the signature is stored as JSON with the match results
+            tmp = self.signature_matrix_filtered[segment].tolist()
             for col, pos in enumerate(list(signature_map)):
                 signature[segment].append([
                     # list(AMINO_ACID_GROUPS.keys())[pos],
@@ -854,182 +898,193 @@ class SignatureMatch():
         self.signature_consensus = signature
 
 
-    def score_protein_class(self, pclass_slug='001'):
-
-        start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
-        class_proteins = Protein.objects.filter(
-            species__common_name='Human',
-            family__slug__startswith=pclass_slug
-            ).exclude(
-                id__in=[x.id for x in self.protein_set]
-                )
-        class_a_pcf = ProteinConformation.objects.order_by(
+    def _prepare_scoring(self):
+        """Flatten the signature map of the relevant positions into arrays, shared by all scored proteins"""
+        self.relevant_positions = []
+        features = []
+        values = []
+        for segment in self.relevant_segments:
+            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
+            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
+                self.relevant_positions.append((segment, pos))
+                features.append(signature_map[idx])
+                values.append(self.signature_matrix_filtered[segment][signature_map[idx]][idx])
+        self.position_features = np.array(features, dtype=int)
+        self.position_value_list = values
+        self.position_values = np.array(values, dtype=float)
+        self.position_gaps = np.array([FEATURE_NAMES[f] == 'Gap' for f in features], dtype=bool)
+
+    def _conformations(self, proteins):
+        return ProteinConformation.objects.order_by(
             'protein__family__slug',
             'protein__entry_name'
             ).filter(
-                protein__in=class_proteins,
+                protein__in=proteins,
                 protein__sequence_type__slug='wt'
-                ).exclude(protein__entry_name__endswith='-consensus')
-        for pcf in class_a_pcf:
-            p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            p_end = time.time()
-            print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
-        self.protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
-        for prot in self.protein_report.items():
-            self.protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        self.scored_proteins = list(self.protein_report.keys())
-        print("Total time: ", end - start)
-
-
-    def score_protein_set(self, protein_set):
-
+                ).exclude(protein__entry_name__endswith='-consensus').select_related(
+                    'protein__species', 'protein__family__parent__parent')
+
+    def residue_matrix(self, pcfs):
+        """Residue codes (proteins x relevant positions) of protein conformations, fetched in one query
+
+        Positions without a residue are PADDING."""
+        row_index = dict([(pcf.pk, i) for i, pcf in enumerate(pcfs)])
+        columns = {}
+        for i, (segment, pos) in enumerate(self.relevant_positions):
+            columns.setdefault(pos, []).append(i)
+        matrix = np.full((len(pcfs), len(self.relevant_positions)), PADDING, dtype=np.uint8)
+        if not pcfs or not columns:
+            return matrix
+
+        residues = Residue.objects.filter(
+            protein_conformation__in=list(row_index),
+            generic_number__label__in=list(columns)
+            ).values_list('protein_conformation_id', 'generic_number__label', 'amino_acid')
+        for pcf_id, label, amino_acid in residues:
+            code = AA_CODES.get(amino_acid, UNKNOWN)
+            for col in columns[label]:
+                matrix[row_index[pcf_id], col] = code
+        return matrix
+
+    def score_proteins(self, pcfs):
+        """Scores, normalized scores and signature matches of protein conformations, computed for all at once"""
+        pcfs = list(pcfs)
+        codes = self.residue_matrix(pcfs)
+        present = codes != PADDING
+        has_feature = FEATURE_MATRIX[self.position_features[None, :], codes] > 0
+        values = self.position_values[None, :]
+        positive = values > 0
+
+        # a matching feature adds a positive value, a missing feature subtracts a negative value and a missing residue
+        # adds the value of a gap feature
+        contributions = np.where(present & has_feature & positive, values, 0)
+        contributions -= np.where(present & ~has_feature & (values < 0), values, 0)
+        contributions += np.where(~present & self.position_gaps[None, :], values, 0)
+        scores = contributions.sum(axis=1)
+
+        # gray where the residue agrees with the signature, white otherwise
+        agrees = np.where(present, has_feature == positive, self.position_gaps[None, :] & positive)
+        feature_keys = [FEATURE_KEYS[f] for f in self.position_features.tolist()]
+        feature_names = [FEATURE_NAMES[f] for f in self.position_features.tolist()]
+        segments = list(self.relevant_segments)
+
+        results = []
+        for row, pcf in enumerate(pcfs):
+            consensus_match = OrderedDict([(x, []) for x in segments])
+            for col, (segment, pos) in enumerate(self.relevant_positions):
+                consensus_match[segment].append([
+                    feature_keys[col],
+                    feature_names[col],
+                    self.position_value_list[col],
+                    "#808080" if agrees[row, col] else "white",
+                    ALPHABET[codes[row, col]] if present[row, col] else '-',
+                    pos
+                    ])
+            score = float(scores[row])
+            results.append((pcf, score/100, score/self.norm*100, consensus_match))
+        return results
+
+    def _score_report(self, pcfs, label):
         start = time.time()
-        protein_scores = {}
-        protein_signature_match = {}
-        pcfs = ProteinConformation.objects.order_by(
-            'protein__family__slug',
-            'protein__entry_name'
-            ).filter(
-                protein__in=protein_set,
-                protein__sequence_type__slug='wt'
-                ).exclude(protein__entry_name__endswith='-consensus')
-        for pcf in pcfs:
-            p_start = time.time()
-            score, nscore, signature_match = self.score_protein(pcf)
-            protein_scores[pcf] = (score, nscore)
-            protein_signature_match[pcf] = signature_match
-            p_end = time.time()
-            print("Time elapsed for {}: ".format(pcf.protein.entry_name), p_end - p_start)
-        end = time.time()
+        results = self.score_proteins(pcfs)
+        protein_scores = dict([(r[0], (r[1], r[2])) for r in results])
+        protein_signature_match = dict([(r[0], r[3]) for r in results])
         protein_report = OrderedDict(sorted(protein_scores.items(), key=lambda x: x[1][0], reverse=True))
         protein_signatures = OrderedDict()
         for prot in protein_report.items():
             protein_signatures[prot[0]] = protein_signature_match[prot[0]]
-        scored_proteins = list(protein_report.keys())
-        print("Total time: ", end - start)
+        logger.info('Scored {} proteins ({}) against {} signature positions in {:.2f} seconds'.format(len(results),
+            label, len(self.relevant_positions), time.time() - start))
+        return (protein_report, protein_signatures, list(protein_report.keys()))
 
-        return (protein_report, protein_signatures, scored_proteins)
-
-    def score_protein(self, pcf):
-        prot_score = 0.0
-        #norm = 0.0
-        consensus_match = OrderedDict([(x, []) for x in self.relevant_segments])
+    def score_protein_class(self, pclass_slug='001'):
 
-        relevant_gns_total = []
-        for segment in  self.relevant_segments:
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                relevant_gns_total.append(pos)
+        class_proteins = Protein.objects.filter(
+            species__common_name='Human',
+            family__slug__startswith=pclass_slug
+            ).exclude(
+                id__in=[x.id for x in self.protein_set]
+                )
+        self.protein_report, self.protein_signatures, self.scored_proteins = self._score_report(
+            self._conformations(class_proteins), 'class ' + pclass_slug)
 
-        resi = Residue.objects.filter(
-            protein_conformation=pcf,
-            generic_number__label__in=relevant_gns_total
-            ).prefetch_related('generic_number')
-        resi_dict = {}
-        for r in resi:
-            if r.generic_number:
-                resi_dict[r.generic_number.label] = r
 
-        for segment in self.relevant_segments:
-            tmp = []
-            # signature_map = self.signature_matrix_filtered[segment].argmax(axis=0)
-            signature_map = np.absolute(self.signature_matrix_filtered[segment]).argmax(axis=0)
-            signature_map = self._assign_preferred_features(signature_map, segment, self.signature_matrix_filtered)
+    def score_protein_set(self, protein_set):
 
-            #norm += np.sum(np.amax(self.signature_matrix_filtered[segment], axis=0))
+        return self._score_report(self._conformations(protein_set), 'protein set')
 
-            for idx, pos in enumerate(self.relevant_gn[self.schemes[0][0]][segment].keys()):
-                feat = signature_map[idx]
-                feat_abr = list(AMINO_ACID_GROUPS.keys())[feat]
-                feat_name = list(AMINO_ACID_GROUP_NAMES.values())[feat]
-                val = self.signature_matrix_filtered[segment][feat][idx]
-                if pos in resi_dict:
-                    res = resi_dict[pos]
-                    if feat in self.residue_to_feat[res.amino_acid]:
-                        if val > 0:
-                            prot_score += val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            #"green",
-                            "#808080",
-                            res.amino_acid, pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                res.amino_acid,
-                                pos
-                                ])
-                    else:
-                        #David doesn't want the negative values in the score
-                        # prot_score -= val
-                        if val < 0:
-                            prot_score -= val #if a receptor does NOT have the negative property, add the score
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            res.amino_acid,
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                # "green",
-                                "#808080",
-                                res.amino_acid,
-                                pos
-                                ])
-                else:
-                    if feat_name == 'Gap':
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "green",
-                            "#808080",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-                        prot_score += val
-                    else:
-                        #David doesn't want the negative values in the score
-                        #prot_score -= val
-                        tmp.append([
-                            feat_abr,
-                            feat_name,
-                            val,
-                            # "red",
-                            "white",
-                            '-',
-                            pos
-                            ]) if val > 0 else tmp.append([
-                                feat_abr,
-                                feat_name,
-                                val,
-                                "white",
-                                '-',
-                                pos
-                                ])
-            consensus_match[segment] = tmp
-        return (prot_score/100, prot_score/self.norm*100, consensus_match)
+    def score_protein(self, pcf):
+        pcf, score, nscore, consensus_match = self.score_proteins([pcf])[0]
+        return (score, nscore, consensus_match)
+
+    def prepare_result_data(self):
+        """Arrays and JSON values of the scores and signature matches for the result store
+
+        Each scored set is stored as columns of protein conformation ids, scores (score, normalized score) and the
+        residue and agreement of every protein at the relevant positions (proteins x positions). The features of the
+        positions are shared by all proteins and stored once."""
+        arrays = {'position_values': self.position_values}
+        for name, scores, signatures in [('scores', self.protein_report, self.protein_signatures),
+            ('scores_pos', self.scores_pos, self.signatures_pos), ('scores_neg', self.scores_neg, self.signatures_neg)]:
+            matches = [[m for segment in signatures[pcf].values() for m in segment] for pcf in scores.keys()]
+            shape = (len(scores), len(self.relevant_positions))
+            arrays[name + '_ids'] = np.array([pcf.pk for pcf in scores.keys()], dtype=np.int64)
+            arrays[name] = np.array(list(scores.values()), dtype=float).reshape(len(scores), 2)
+            arrays[name + '_residues'] = np.array([[m[4] for m in row] for row in matches], dtype='U1').reshape(shape)
+            arrays[name + '_agrees'] = np.array([[m[3] != 'white' for m in row] for row in matches],
+                dtype=bool).reshape(shape)
+        meta = {
+            'signature_filtered': self.signature_consensus,
+            'relevant_gn': self.relevant_gn,
+            'relevant_segments': [(segment, list(positions)) for segment, positions in self.relevant_segments.items()],
+            'numbering_schemes': self.schemes,
+            'positions': [(segment, pos, FEATURE_KEYS[f], FEATURE_NAMES[f]) for (segment, pos), f in
+                zip(self.relevant_positions, self.position_features.tolist())],
+        }
+        return arrays, meta
+
+
+def signature_from_result(result):
+    """Common positions, numbering schemes, segments and difference matrices (the first arguments of SignatureMatch)
+    from a stored signature"""
+    arrays, meta = result
+    bounds = np.cumsum(arrays['diff_columns'])[:-1]
+    diff_matrix = OrderedDict(zip(meta['diff_segments'], np.split(arrays['diff_matrix'], bounds, axis=1)))
+    return meta['common_positions'], meta['numbering_schemes'], meta['common_segments'], diff_matrix
+
+
+def signature_match_from_result(result):
+    """Arguments of signature_score_excel from stored signature match data, with the protein conformations fetched in
+    one query"""
+    arrays, meta = result
+    pcf_ids = set([pk for name in ['scores', 'scores_pos', 'scores_neg'] for pk in arrays[name + '_ids'].tolist()])
+    pcfs = ProteinConformation.objects.filter(pk__in=pcf_ids).select_related('protein__species',
+        'protein__family__parent__parent').in_bulk()
+
+    values = arrays['position_values'].tolist()
+    data = {}
+    for name in ['scores', 'scores_pos', 'scores_neg']:
+        data[name] = OrderedDict()
+        data[name + '_signatures'] = OrderedDict()
+        for row, pk in enumerate(arrays[name + '_ids'].tolist()):
+            pcf = pcfs[pk]
+            data[name][pcf] = tuple(arrays[name][row].tolist())
+            consensus_match = OrderedDict([(segment, []) for segment, positions in meta['relevant_segments']])
+            for col, (segment, pos, feature_key, feature_name) in enumerate(meta['positions']):
+                consensus_match[segment].append([
+                    feature_key,
+                    feature_name,
+                    values[col],
+                    "#808080" if arrays[name + '_agrees'][row, col] else "white",
+                    str(arrays[name + '_residues'][row, col]),
+                    pos
+                    ])
+            data[name + '_signatures'][pcf] = consensus_match
+    relevant_segments = OrderedDict(meta['relevant_segments'])
+    return (data['scores'], data['scores_signatures'], meta['signature_filtered'], meta['relevant_gn'],
+        relevant_segments, meta['numbering_schemes'], data['scores_pos'], data['scores_neg'],
+        data['scores_pos_signatures'], data['scores_neg_signatures'])
 
 def signature_score_excel(workbook, scores, protein_signatures, signature_filtered, relevant_gn, relevant_segments, numbering_schemes, scores_positive=None, scores_negative=None, signatures_positive=None, signatures_negative=None):
 
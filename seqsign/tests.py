@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+
+from common import result_store
+from seqsign import sequence_signature
+from seqsign.sequence_signature import FEATURE_KEYS, SignatureMatch, signature_match_from_result
+
+from collections import OrderedDict, namedtuple
+from unittest import mock
+import shutil
+import tempfile
+import numpy as np
+
+
+# proteins stand in for their conformations
+Conformation = namedtuple('Conformation', ['pk', 'id'])
+
+SCHEMES = [('gpcrdb', 'GPCRdb')]
+
+POSITIONS = {'gpcrdb': OrderedDict([('TM1', OrderedDict([('1x50', '1.50x50'), ('1x51', '1.51x51'),
+    ('1x52', '1.52x52')]))])}
+
+
+class SignatureMatchResultTestCase(SimpleTestCase):
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        pcfs = [Conformation(1, 1), Conformation(2, 2), Conformation(3, 3)]
+        residues = [(1, '1x50', 'A'), (1, '1x51', 'L'), (2, '1x50', 'I'), (3, '1x51', 'I')]
+        patches = [
+            mock.patch.object(result_store, 'STORE_DIR', path),
+            mock.patch.object(SignatureMatch, '_conformations', side_effect=lambda proteins: proteins),
+            mock.patch.object(sequence_signature.Protein, 'objects'),
+            mock.patch.object(sequence_signature.Residue, 'objects'),
+            mock.patch.object(sequence_signature.ProteinConformation, 'objects'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        sequence_signature.Protein.objects.filter.return_value.exclude.return_value = pcfs
+        sequence_signature.Residue.objects.filter.side_effect = lambda protein_conformation__in, **kwargs: mock.Mock(
+            **{'values_list.return_value': [r for r in residues if r[0] in protein_conformation__in]})
+        sequence_signature.ProteinConformation.objects.filter.return_value.select_related.return_value.in_bulk. \
+            return_value = dict([(pcf.pk, pcf) for pcf in pcfs])
+
+        # integer frequency differences, the last position is below the cutoff
+        diff_matrix = np.zeros((len(FEATURE_KEYS), 3), dtype=np.int64)
+        diff_matrix[FEATURE_KEYS.index('A_1'), 0] = 80
+        diff_matrix[FEATURE_KEYS.index('I_'), 1] = -60
+        diff_matrix[FEATURE_KEYS.index('I_'), 2] = 10
+        self.match = SignatureMatch(POSITIONS, SCHEMES, ['TM1'], OrderedDict([('TM1', diff_matrix)]), pcfs[:1],
+            pcfs[1:2])
+        self.match.score_protein_class('001')
+
+    def test_round_trip(self):
+        arrays, meta = self.match.prepare_result_data()
+        result_id = result_store.save_result('signature_match', arrays, meta)
+        (scores, signatures, signature_filtered, relevant_gn, relevant_segments, schemes, scores_pos, scores_neg,
+            signatures_pos, signatures_neg) = signature_match_from_result(result_store.load_result('signature_match',
+            result_id))
+
+        self.assertEqual(signature_filtered, self.match.signature_consensus)
+        self.assertEqual([f[2] for f in signature_filtered['TM1']], [80, -60])
+        self.assertEqual(list(relevant_gn['gpcrdb']['TM1']), ['1x50', '1x51'])
+        self.assertEqual(list(relevant_segments['TM1']), ['1x50', '1x51'])
+        self.assertEqual(scores, self.match.protein_report)
+        self.assertEqual(list(scores), list(self.match.protein_report))
+        self.assertEqual(signatures, self.match.protein_signatures)
+        self.assertEqual(scores_pos, self.match.scores_pos)
+        self.assertEqual(signatures_neg, self.match.signatures_neg)
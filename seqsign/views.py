@@ -4,10 +4,11 @@ from django.http import HttpResponse
 
 
 from alignment.functions import get_proteins_from_selection
+from common.result_store import load_result, save_result
 from common.selection import Selection
 from common.views import AbsTargetSelection
 from common.views import AbsSegmentSelection
-from seqsign.sequence_signature import SequenceSignature, SignatureMatch, signature_score_excel
+from seqsign.sequence_signature import SequenceSignature, SignatureMatch, signature_from_result, signature_match_from_result, signature_score_excel
 
 Alignment = getattr(__import__('common.alignment_' + settings.SITE_NAME, fromlist=['Alignment']), 'Alignment')
 
@@ -135,8 +136,7 @@ def render_signature(request):
 
     # save for later
     # signature_map = feats_delta.argmax(axis=0)
-    request.session['signature'] = signature.prepare_session_data()
-    request.session.modified = True
+    request.session['signature'] = save_result('signature', *signature.prepare_session_data())
 
     return_html = render(
         request,
@@ -215,36 +215,27 @@ def render_signature_excel(request):
 
 def render_signature_match_scores(request, cutoff):
 
-    signature_data = request.session.get('signature')
+    signature_data = load_result('signature', request.session.get('signature'))
+    if signature_data is None:
+        return redirect('/seqsign/')
 
     # targets set #1
     ss_pos = request.session.get('targets_pos', False)
     # targets set #2
     ss_neg = request.session.get('selection', False)
 
+    common_positions, numbering_schemes, common_segments, diff_matrix = signature_from_result(signature_data)
     signature_match = SignatureMatch(
-        signature_data['common_positions'],
-        signature_data['numbering_schemes'],
-        signature_data['common_segments'],
-        signature_data['diff_matrix'],
+        common_positions,
+        numbering_schemes,
+        common_segments,
+        diff_matrix,
         get_proteins_from_selection(ss_pos),
         get_proteins_from_selection(ss_neg),
         cutoff = int(cutoff)
     )
     signature_match.score_protein_class(get_proteins_from_selection(ss_pos)[0].family.slug[:3])
-    request.session['signature_match'] = {
-        'scores': signature_match.protein_report,
-
-        'scores_pos': signature_match.scores_pos,
-        'scores_neg': signature_match.scores_neg,
-        'protein_signatures': signature_match.protein_signatures,
-        'signatures_pos': signature_match.signatures_pos,
-        'signatures_neg': signature_match.signatures_neg,
-        'signature_filtered': signature_match.signature_consensus,
-        'relevant_gn': signature_match.relevant_gn,
-        'relevant_segments': signature_match.relevant_segments,
-        'numbering_schemes': signature_match.schemes,
-    }
+    request.session['signature_match'] = save_result('signature_match', *signature_match.prepare_result_data())
 
     response = render(
         request,
@@ -255,25 +246,14 @@ def render_signature_match_scores(request, cutoff):
 
 def render_signature_match_excel(request):
 
-    scores_data = request.session.get('signature_match', False)
+    scores_data = load_result('signature_match', request.session.get('signature_match'))
+    if scores_data is None:
+        return redirect('/seqsign/')
 
     outstream = BytesIO()
     wb = xlsxwriter.Workbook(outstream, {'in_memory': True})
 
-    signature_score_excel(
-        wb,
-        scores_data['scores'],
-        scores_data['protein_signatures'],
-        scores_data['signature_filtered'],
-        scores_data['relevant_gn'],
-        scores_data['relevant_segments'],
-        scores_data['numbering_schemes'],
-        scores_data['scores_pos'],
-        scores_data['scores_neg'],
-        scores_data['signatures_pos'],
-        scores_data['signatures_neg'],
-
-    )
+    signature_score_excel(wb, *signature_match_from_result(scores_data))
     wb.close()
     outstream.seek(0)
     response = HttpResponse(
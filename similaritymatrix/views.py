@@ -51,6 +51,7 @@ def render_matrix(request):
 
     # create an alignment object
     a = Alignment()
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
@@ -75,6 +76,7 @@ def render_csv_matrix(request):
     # create an alignment object
     a = Alignment()
     a.show_padding = False
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_proteins_from_selection(simple_selection)
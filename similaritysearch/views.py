@@ -65,6 +65,7 @@ def render_alignment(request):
     
     # create an alignment object
     a = Alignment()
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_reference_protein_from_selection(simple_selection)
@@ -93,6 +94,7 @@ def render_fasta_alignment(request):
     # create an alignment object
     a = Alignment()
     a.show_padding = False
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_reference_protein_from_selection(simple_selection)
@@ -120,6 +122,7 @@ def render_csv_alignment(request):
     # create an alignment object
     a = Alignment()
     a.show_padding = False
+    a.use_matrix_engine = True
 
     # load data from selection into the alignment
     a.load_reference_protein_from_selection(simple_selection)
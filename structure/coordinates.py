@@ -0,0 +1,305 @@
+from django.conf import settings
+
+from Bio.PDB.StructureBuilder import StructureBuilder
+from Bio.PDB.PDBExceptions import PDBConstructionException, PDBConstructionWarning
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import shutil
+import warnings
+import numpy as np
+
+
+# location of the parsed structures, written by the build_structure_coordinates command
+STORE_DIR = getattr(settings, 'STRUCTURE_COORDINATES_DIR', os.sep.join([settings.BUILD_CACHE_DIR,
+    'structure_coordinates']))
+
+# number of parsed structures kept in memory per process
+CACHE_SIZE = 32
+
+# line kinds, matching the startswith checks of the PDB text filters in Structure
+OTHER_LINE = 0
+ATOM_LINE = 1 # starts with ATOM
+HET_LINE = 2 # starts with HET (HETATM, but also HET, HETNAM and HETSYN records)
+
+# one record per line of the PDB text
+LINE_DTYPE = np.dtype([
+    ('kind', np.uint8),
+    ('chain', 'S1'),
+    ('resname', 'S3'),
+])
+
+# one record per ATOM/HETATM line, with the fields read by Bio.PDB.PDBParser
+ATOM_DTYPE = np.dtype([
+    ('line', np.int32),
+    ('model', np.int16),
+    ('hetatm', np.bool_),
+    ('serial', np.int32),
+    ('name', 'S4'), # full name, including spaces
+    ('altloc', 'S1'),
+    ('resname', 'S3'),
+    ('chain', 'S1'),
+    ('resseq', np.int32),
+    ('icode', 'S1'),
+    ('coord', np.float32, (3,)),
+    ('occupancy', np.float32), # nan if not set
+    ('bfactor', np.float32),
+    ('segid', 'S4'),
+    ('element', 'S2'),
+    ('generic_number', np.int32), # index into generic_numbers, -1 if not set
+])
+
+WATERS = [b'HOH', b'WAT']
+
+INDEX_FILE = 'index.json'
+TEXT_FILE = 'text.npy'
+OFFSETS_FILE = 'offsets.npy'
+LINES_FILE = 'lines.npy'
+ATOMS_FILE = 'atoms.npy'
+
+
+def _field(line, start, end):
+    return line[start:end].encode('ascii', 'replace')
+
+
+def _float(value, default):
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+class StructureCoordinates:
+    """Parsed PDB data of a structure
+
+    The PDB text is parsed once into line and atom arrays, which can be stored and memory mapped. Filtered PDB text and
+    Biopython structures are produced from these arrays without parsing the text again."""
+    _cache = OrderedDict()
+
+    logger = logging.getLogger('protwis')
+
+    def __init__(self, text, offsets, lines, atoms, generic_numbers=None, pdb_data_id=None):
+        self.text = text # utf-8 encoded PDB text (uint8)
+        self.offsets = offsets # start of each line in text, and the end of the text
+        self.lines = lines
+        self.atoms = atoms
+        self.generic_numbers = generic_numbers or []
+        self.pdb_data_id = pdb_data_id
+
+    @classmethod
+    def from_pdb(cls, pdb, generic_numbers=None, pdb_data_id=None):
+        """Parse PDB text
+
+        @param generic_numbers: optional dict of chain -> {sequence number: generic number label}"""
+        text_lines = pdb.split('\n')
+        encoded = [l.encode('utf-8') for l in text_lines]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(l) + 1 for l in encoded])
+        text = np.frombuffer(b'\n'.join(encoded), dtype=np.uint8)
+
+        labels = []
+        label_index = {}
+        lines = np.zeros(len(text_lines), dtype=LINE_DTYPE)
+        atoms = []
+        model = 0
+        for i, line in enumerate(text_lines):
+            if line.startswith('ATOM'):
+                kind = ATOM_LINE
+            elif line.startswith('HET'):
+                kind = HET_LINE
+            else:
+                kind = OTHER_LINE
+            lines[i] = (kind, _field(line, 21, 22), _field(line, 17, 20))
+
+            if line.startswith('MODEL'):
+                model += 1
+            elif line.startswith('ATOM  ') or line.startswith('HETATM'):
+                try:
+                    resseq = int(line[22:26])
+                    serial = int(line[6:11]) if line[6:11].strip() else 0
+                    coord = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+                except ValueError:
+                    # not parseable, the line is only kept in the text
+                    continue
+                gn = -1
+                label = (generic_numbers or {}).get(line[21:22], {}).get(resseq)
+                if label:
+                    if label not in label_index:
+                        label_index[label] = len(labels)
+                        labels.append(label)
+                    gn = label_index[label]
+                atoms.append((i, max(model - 1, 0), line.startswith('HETATM'), serial, _field(line, 12, 16),
+                    _field(line, 16, 17), _field(line, 17, 20), _field(line, 21, 22), resseq, _field(line, 26, 27),
+                    coord, _float(line[54:60], np.nan), _float(line[60:66], 0.0), _field(line, 72, 76),
+                    line[76:78].strip().upper().encode('ascii', 'replace'), gn))
+
+        return cls(text, offsets, lines, np.array(atoms, dtype=ATOM_DTYPE), labels, pdb_data_id)
+
+    def save(self, path):
+        """Write the arrays to a directory, replacing earlier data"""
+        tmp_path = path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        np.save(os.sep.join([tmp_path, TEXT_FILE]), self.text)
+        np.save(os.sep.join([tmp_path, OFFSETS_FILE]), self.offsets)
+        np.save(os.sep.join([tmp_path, LINES_FILE]), self.lines)
+        np.save(os.sep.join([tmp_path, ATOMS_FILE]), self.atoms)
+        with open(os.sep.join([tmp_path, INDEX_FILE]), 'w') as f:
+            json.dump({'pdb_data_id': self.pdb_data_id, 'generic_numbers': self.generic_numbers}, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory map stored arrays"""
+        with open(os.sep.join([path, INDEX_FILE])) as f:
+            index = json.load(f)
+        return cls(np.load(os.sep.join([path, TEXT_FILE]), mmap_mode='r'),
+            np.load(os.sep.join([path, OFFSETS_FILE]), mmap_mode='r'),
+            np.load(os.sep.join([path, LINES_FILE]), mmap_mode='r'),
+            np.load(os.sep.join([path, ATOMS_FILE]), mmap_mode='r'),
+            index['generic_numbers'], index['pdb_data_id'])
+
+    @classmethod
+    def store_path(cls, structure):
+        return os.sep.join([STORE_DIR, structure.pdb_code.index])
+
+    @classmethod
+    def for_structure(cls, structure):
+        """Parsed PDB data of a structure, from the in-memory cache, the store or by parsing its PDB data"""
+        key = (structure.pk, structure.pdb_data_id)
+        if key in cls._cache:
+            cls._cache.move_to_end(key)
+            return cls._cache[key]
+
+        coordinates = None
+        path = cls.store_path(structure)
+        if os.path.isdir(path):
+            try:
+                coordinates = cls.load(path)
+            except Exception as msg:
+                cls.logger.error('Failed loading parsed structure {}: {}'.format(path, msg))
+            if coordinates and coordinates.pdb_data_id != structure.pdb_data_id:
+                coordinates = None
+        if coordinates is None:
+            coordinates = cls.from_pdb(structure.pdb_data.pdb, pdb_data_id=structure.pdb_data_id)
+
+        cls._cache[key] = coordinates
+        while len(cls._cache) > CACHE_SIZE:
+            cls._cache.popitem(last=False)
+        return coordinates
+
+    # line selection
+    def pdb_text(self, mask):
+        """PDB text of the selected lines"""
+        return '\n'.join([bytes(self.text[self.offsets[i]:self.offsets[i + 1] - 1]).decode('utf-8')
+            for i in np.nonzero(mask)[0].tolist()])
+
+    def cleaned_lines(self, chain, refined=False, pref_chain=True, remove_waters=True, ligands_to_keep=None):
+        """Line mask of Structure.get_cleaned_pdb"""
+        kind = self.lines['kind']
+        resname = self.lines['resname']
+        is_het = kind == HET_LINE
+        if pref_chain:
+            save = (kind != OTHER_LINE) & ((self.lines['chain'] == chain.encode('ascii', 'replace')) | refined)
+        else:
+            save = np.ones(len(kind), dtype=bool)
+        if remove_waters:
+            save &= ~(is_het & (resname == b'HOH'))
+        if ligands_to_keep:
+            ligands = is_het & (resname != b'HOH')
+            keep = np.isin(resname, [l.encode('ascii', 'replace') for l in ligands_to_keep if l])
+            save = (save & ~ligands) | (ligands & keep)
+        return save
+
+    def ligand_lines(self, chain, ligand):
+        """Line mask of Structure.get_ligand_pdb"""
+        return ((self.lines['kind'] == HET_LINE) & (self.lines['chain'] == chain.encode('ascii', 'replace'))
+            & (self.lines['resname'] != b'HOH') & (self.lines['resname'] == ligand.encode('ascii', 'replace')))
+
+    def chain_lines(self, chain):
+        """Line mask of Structure.get_preferred_chain_pdb"""
+        return (self.lines['kind'] != OTHER_LINE) & (self.lines['chain'] == chain.encode('ascii', 'replace'))
+
+    # atom selection
+    def select_atoms(self, chains=None, waters=True, ligands=True, lines=None):
+        """Atom mask by chain and type of residue, optionally limited to atoms on selected lines"""
+        mask = np.ones(len(self.atoms), dtype=bool)
+        if chains:
+            mask &= np.isin(self.atoms['chain'], [c.encode('ascii', 'replace') for c in chains])
+        water = self.atoms['hetatm'] & np.isin(self.atoms['resname'], WATERS)
+        if not waters:
+            mask &= ~water
+        if not ligands:
+            mask &= ~(self.atoms['hetatm'] & ~water)
+        if lines is not None:
+            mask &= lines[self.atoms['line']]
+        return mask
+
+    def residue_generic_numbers(self, chain):
+        """Generic number labels by sequence number of a chain"""
+        atoms = self.atoms[(self.atoms['chain'] == chain.encode('ascii', 'replace')) & (self.atoms['generic_number'] >= 0)]
+        return dict([(int(a['resseq']), self.generic_numbers[a['generic_number']]) for a in atoms])
+
+    def get_structure(self, structure_id, mask=None, quiet=True):
+        """Biopython structure of the selected atoms, built the same way as by PDBParser(PERMISSIVE=True)"""
+        with warnings.catch_warnings():
+            if quiet:
+                warnings.simplefilter('ignore', PDBConstructionWarning)
+            return self._build_structure(structure_id, self.atoms if mask is None else self.atoms[mask])
+
+    def _build_structure(self, structure_id, atoms):
+        builder = StructureBuilder()
+        builder.init_structure(structure_id)
+
+        current_model = None
+        current_chain = None
+        current_segid = None
+        current_residue = None
+        for a in atoms:
+            model = int(a['model'])
+            if model != current_model:
+                builder.init_model(model)
+                current_model = model
+                current_chain = None
+                current_segid = None
+                current_residue = None
+
+            resname = a['resname'].decode('ascii')
+            if a['hetatm']:
+                field = 'W' if resname in ('HOH', 'WAT') else 'H_' + resname
+            else:
+                field = ' '
+            icode = a['icode'].decode('ascii') or ' '
+            residue = (field, int(a['resseq']), icode, resname)
+
+            segid = a['segid'].decode('ascii')
+            if segid != current_segid:
+                current_segid = segid
+                builder.init_seg(segid)
+
+            try:
+                chain = a['chain'].decode('ascii') or ' '
+                if chain != current_chain:
+                    current_chain = chain
+                    builder.init_chain(chain)
+                    current_residue = residue
+                    builder.init_residue(resname, field, int(a['resseq']), icode)
+                elif residue != current_residue:
+                    current_residue = residue
+                    builder.init_residue(resname, field, int(a['resseq']), icode)
+
+                fullname = a['name'].decode('ascii')
+                occupancy = None if np.isnan(a['occupancy']) else float(a['occupancy'])
+                builder.init_atom(fullname.strip(), np.array(a['coord'], dtype='f'), float(a['bfactor']),
+                    occupancy, a['altloc'].decode('ascii') or ' ', fullname, int(a['serial']),
+                    a['element'].decode('ascii') or None)
+            except PDBConstructionException as message:
+                # permissive parsing, as PDBParser
+                warnings.warn('PDBConstructionException: {}'.format(message), PDBConstructionWarning)
+
+        return builder.get_structure()
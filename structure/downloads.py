@@ -0,0 +1,203 @@
+from django.conf import settings
+
+from structure.models import StructureComplexModel, StructureModelStatsRotamer, StructureComplexModelStatsRotamer
+
+from collections import namedtuple
+from itertools import groupby
+from datetime import datetime
+from operator import itemgetter
+import logging
+import os
+import struct
+import zipfile
+import zlib
+
+
+# location of the compressed model files, written when models are uploaded by build_homology_models_zip
+STORE_DIR = getattr(settings, 'MODEL_ARCHIVE_DIR', os.sep.join([settings.BUILD_CACHE_DIR, 'model_archives']))
+
+COMPRESSION_LEVEL = 6
+
+CLASS_NAMES = {'001':'A','002':'B1','003':'B2','004':'C','005':'F','006':'T','007':'O'}
+
+TEMPLATES_HEADER = 'Segment,Sequence_number,Generic_number,Backbone_template,Rotamer_template\n'
+
+# a deflated file of a ZIP archive, date_time as in zipfile.ZipInfo
+ZipEntry = namedtuple('ZipEntry', ['name', 'crc', 'size', 'data', 'date_time'])
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+UTF8_FLAG = 0x800
+
+logger = logging.getLogger('protwis')
+
+
+def compress_entry(name, data, date_time=(1980, 1, 1, 0, 0, 0)):
+    """Deflate the data (str or bytes) of a ZIP entry"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    return ZipEntry(name, zlib.crc32(data) & 0xffffffff, len(data), compressor.compress(data) + compressor.flush(),
+        tuple(date_time))
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive of deflated entries, one entry at a time
+
+    Only the central directory (names and offsets) is kept until the end, so the archive is never held in memory.
+    Archives are limited to 65535 entries and 4 GB (no ZIP64)."""
+    central = []
+    offset = 0
+    for entry in entries:
+        name = entry.name.encode('utf-8')
+        year, month, day, hour, minute, second = entry.date_time
+        dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        dos_date = ((year - 1980) << 9) | (month << 5) | day
+        header = LOCAL_HEADER.pack(0x04034b50, 20, UTF8_FLAG, zipfile.ZIP_DEFLATED, dos_time, dos_date, entry.crc,
+            len(entry.data), entry.size, len(name), 0)
+        central.append(CENTRAL_HEADER.pack(0x02014b50, 20, 20, UTF8_FLAG, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+            entry.crc, len(entry.data), entry.size, len(name), 0, 0, 0, 0, 0o644 << 16, offset) + name)
+        yield header + name
+        yield entry.data
+        offset += len(header) + len(name) + len(entry.data)
+
+    directory = b''.join(central)
+    yield directory + END_RECORD.pack(0x06054b50, 0, 0, len(central), len(central), len(directory), offset, 0)
+
+
+def model_file_name(hommod):
+    """PDB file name of a homology model or complex model in downloads"""
+    if isinstance(hommod, StructureComplexModel):
+        return 'Class{}_{}-{}_{}_{}_GPCRDB_complex.pdb'.format(CLASS_NAMES[hommod.receptor_protein.family.slug[:3]],
+            hommod.receptor_protein.entry_name, hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index,
+            hommod.version)
+    return 'Class{}_{}_{}_{}_{}_GPCRDB.pdb'.format(CLASS_NAMES[hommod.protein.family.slug[:3]],
+        hommod.protein.entry_name, hommod.state.name, hommod.main_template.pdb_code.index, hommod.version)
+
+
+def templates_csv(rows):
+    """Templates CSV of a model from (segment, sequence number, generic number, backbone template, rotamer template)
+    rows"""
+    return TEMPLATES_HEADER + ''.join(['{},{},{},{},{}\n'.format(segment, sequence_number, gn or '-', bt or '-',
+        rt or '-') for segment, sequence_number, gn, bt, rt in rows])
+
+
+def template_rows(model_class, pks):
+    """Yield (model id, rows) of the template statistics of models (ascending ids), fetched in one query"""
+    if model_class == StructureComplexModel:
+        rotamers = StructureComplexModelStatsRotamer.objects.order_by('homology_model_id', 'protein',
+            'residue__sequence_number')
+    else:
+        rotamers = StructureModelStatsRotamer.objects.order_by('homology_model_id', 'residue__sequence_number')
+    rotamers = rotamers.filter(homology_model_id__in=pks).values_list('homology_model_id',
+        'residue__protein_segment__slug', 'residue__sequence_number', 'residue__generic_number__label',
+        'backbone_template__pdb_code__index', 'rotamer_template__pdb_code__index')
+    for pk, rows in groupby(rotamers.iterator(), key=itemgetter(0)):
+        yield pk, [r[1:] for r in rows]
+
+
+def version_date(version):
+    """Date of a model version, which is still the string of the model name (YYYY-MM-DD) until the model is read
+    back from the database"""
+    if isinstance(version, str):
+        return datetime.strptime(version, '%Y-%m-%d').date()
+    return version
+
+
+def model_entries(hommod, pdb, rows):
+    """Compressed PDB and templates CSV entries of a model"""
+    name = model_file_name(hommod)
+    version = version_date(hommod.version)
+    date_time = (version.year, version.month, version.day, 0, 0, 0)
+    return [compress_entry(name, pdb, date_time), compress_entry(name[:-3] + 'templates.csv', templates_csv(rows),
+        date_time)]
+
+
+def archive_path(hommod):
+    prefix = 'complex' if isinstance(hommod, StructureComplexModel) else 'model'
+    return os.sep.join([STORE_DIR, '{}_{}.zip'.format(prefix, hommod.pk)])
+
+
+def save_model_archive(hommod):
+    """Store the compressed download files of a model, so that downloads do not compress (or query) them again"""
+    pks = [hommod.pk]
+    rows = next(template_rows(hommod.__class__, pks), (hommod.pk, []))[1]
+    entries = model_entries(hommod, hommod.pdb, rows)
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    path = archive_path(hommod)
+    with open(path + '.tmp', 'wb') as f:
+        for chunk in stream_zip(entries):
+            f.write(chunk)
+    os.replace(path + '.tmp', path)
+
+
+def remove_model_archive(hommod):
+    """Remove the stored download files of a model whose PDB or templates are changed, until they are saved again"""
+    try:
+        os.remove(archive_path(hommod))
+    except FileNotFoundError:
+        pass
+
+
+def read_model_archive(hommod, path):
+    """Compressed entries of a stored model archive, None if it is missing or was written for another version"""
+    name = model_file_name(hommod)
+    try:
+        with zipfile.ZipFile(path) as zipf:
+            infos = zipf.infolist()
+        if [i.filename for i in infos] != [name, name[:-3] + 'templates.csv']:
+            return None
+
+        entries = []
+        with open(path, 'rb') as f:
+            for info in infos:
+                if info.compress_type != zipfile.ZIP_DEFLATED:
+                    return None
+                f.seek(info.header_offset)
+                header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+                f.seek(info.header_offset + LOCAL_HEADER.size + header[9] + header[10])
+                entries.append(ZipEntry(info.filename, info.CRC, info.file_size, f.read(info.compress_size),
+                    info.date_time))
+        return entries
+    except (OSError, zipfile.BadZipFile) as msg:
+        logger.error('Failed reading model archive {}: {}'.format(path, msg))
+        return None
+
+
+def stream_models(hommodels):
+    """Yield the PDB and templates CSV entries of homology models or complex models
+
+    Stored archives are copied without recompressing. Models without an archive get their templates from one query
+    for all of them, and their PDB text is only fetched when the model is written."""
+    hommodels = sorted(hommodels, key=lambda h: h.pk)
+    if not hommodels:
+        return
+    model_class = hommodels[0].__class__
+
+    missing = []
+    for hommod in hommodels:
+        path = archive_path(hommod)
+        if not os.path.isfile(path):
+            missing.append(hommod.pk)
+    templates = template_rows(model_class, missing)
+    pending = next(templates, None)
+
+    for hommod in hommodels:
+        entries = None
+        if hommod.pk not in missing:
+            entries = read_model_archive(hommod, archive_path(hommod))
+        if entries is None:
+            if hommod.pk not in missing:
+                # stale archive, the templates are not in the bulk query
+                rows = next(template_rows(model_class, [hommod.pk]), (hommod.pk, []))[1]
+            elif pending and pending[0] == hommod.pk:
+                rows = pending[1]
+                pending = next(templates, None)
+            else:
+                rows = []
+            pdb = model_class.objects.filter(pk=hommod.pk).values_list('pdb', flat=True)[0]
+            entries = model_entries(hommod, pdb, rows)
+        for entry in entries:
+            yield entry
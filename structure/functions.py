@@ -4,12 +4,14 @@ from Bio.PDB.PDBIO import Select
 import Bio.PDB.Polypeptide as polypeptide
 from Bio.PDB.AbstractPropertyMap import AbstractPropertyMap
 from Bio.PDB.Polypeptide import CaPPBuilder, is_aa
+from Bio.SubsMat import MatrixInfo
 try:
     from Bio.PDB.vectors import rotaxis
 except:
     from Bio.PDB import rotaxis
 
 from django.conf import settings
+from django.core.cache import cache
 from common.selection import SimpleSelection
 from common.alignment import Alignment
 from protein.models import Protein, ProteinSegment, ProteinConformation, ProteinState
@@ -19,9 +21,11 @@ from structure.models import Structure, Rotamer
 
 from subprocess import Popen, PIPE
 from io import StringIO
+import hashlib
 import os
 import sys
 import tempfile
+import threading
 import logging
 import math
 import urllib
@@ -37,12 +41,79 @@ logger = logging.getLogger("protwis")
 ATOM_FORMAT_STRING="%s%5i %-4s%c%3s %c%4i%c   %8.3f%8.3f%8.3f%s%6.2f      %4s%2s%2s\n"
 
 #==============================================================================
+# fields of the tabular BLAST output, parsed into BlastHit and BlastHsp objects
+BLAST_FIELDS = ['qseqid', 'sseqid', 'stitle', 'score', 'bitscore', 'evalue', 'nident', 'positive', 'gaps', 'length',
+    'qstart', 'qend', 'sstart', 'send', 'qseq', 'sseq']
+
+# seconds to keep BLAST results in the cache, results are also invalidated when the database is rebuilt
+BLAST_CACHE_TIMEOUT = 60*60*24*30
+
+# maximum number of blastp processes running at the same time in this process
+BLAST_WORKERS = getattr(settings, 'BLAST_WORKERS', os.cpu_count() or 1)
+
+
+class BlastHsp(object):
+    """High scoring pair of a tabular BLAST result, with the attributes of Bio.Blast.Record.HSP"""
+    def __init__(self, row):
+        self.score = float(row['score'])
+        self.bits = float(row['bitscore'])
+        self.expect = float(row['evalue'])
+        self.identities = int(row['nident'])
+        self.positives = int(row['positive'])
+        self.gaps = int(row['gaps'])
+        self.align_length = int(row['length'])
+        self.query_start = int(row['qstart'])
+        self.query_end = int(row['qend'])
+        self.sbjct_start = int(row['sstart'])
+        self.sbjct_end = int(row['send'])
+        self.query = row['qseq']
+        self.sbjct = row['sseq']
+        # midline as in the XML output: identical residues, + for positive BLOSUM62 scores
+        match = []
+        for q, s in zip(self.query, self.sbjct):
+            if q == s:
+                match.append(q)
+            elif (q, s) in MatrixInfo.blosum62 and MatrixInfo.blosum62[(q, s)] > 0 or (
+                (s, q) in MatrixInfo.blosum62 and MatrixInfo.blosum62[(s, q)] > 0):
+                match.append('+')
+            else:
+                match.append(' ')
+        self.match = ''.join(match)
+
+
+class BlastHit(object):
+    """Hit of a tabular BLAST result, with the attributes of Bio.Blast.Record.Alignment"""
+    def __init__(self, hit_id, hit_def):
+        self.hit_id = hit_id
+        self.hit_def = hit_def
+        self.accession = hit_id
+        self.title = '{} {}'.format(hit_id, hit_def)
+        self.hsps = []
+
+
+def query_sequence(seq):
+    """Plain sequence of a BLAST query, from raw sequence text or FASTA
+
+    Only the first record of FASTA input is searched, whitespace is removed."""
+    lines = str(seq).strip().splitlines()
+    if lines and lines[0].startswith('>'):
+        lines = lines[1:]
+    sequence = []
+    for line in lines:
+        if line.startswith('>'):
+            break
+        sequence.append(''.join(line.split()))
+    return ''.join(sequence)
+
+
 # I have put it into separate class for the sake of future uses
 class BlastSearch(object):
 
+    # bounds the number of blastp processes, shared by all searches in this process
+    workers = threading.BoundedSemaphore(BLAST_WORKERS)
 
     def __init__ (self, blast_path='blastp',
-        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1):
+        blastdb=os.sep.join([settings.STATICFILES_DIRS[0], 'blast', 'protwis_blastdb']), top_results=1, batch_size=50):
 
         self.blast_path = blast_path
         self.blastdb = blastdb
@@ -50,35 +121,98 @@ class BlastSearch(object):
         #residues it is better to use more results to avoid getting sequence of
         #e.g.  different species
         self.top_results = top_results
+        # number of sequences searched by one blastp process
+        self.batch_size = batch_size
+        # results of this search object, also used when the cache is not available
+        self.results = {}
 
     #takes Bio.Seq sequence as an input and returns a list of tuples with the
     #alignments
     def run (self, input_seq):
-
-        output = []
-        #Windows has problems with Popen and PIPE
-        if sys.platform == 'win32':
-            tmp = tempfile.NamedTemporaryFile()
-            logger.debug("Running Blast with sequence: {}".format(input_seq))
-            tmp.write(bytes(str(input_seq) + '\n', 'latin1'))
-            tmp.seek(0)
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, stdin=tmp,
-                stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate()
-        else:
-        #Rest of the world:
-            blast = Popen('%s -db %s -outfmt 5' % (self.blast_path, self.blastdb), universal_newlines=True, shell=True,
-                stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            (blast_out, blast_err) = blast.communicate(input=str(input_seq))
+        return self.run_many([input_seq])[0]
+
+    def run_many(self, input_seqs):
+        """Search a list of sequences, returns a list of (hit id, hit) tuples per sequence
+
+        Results are cached per database and sequence, uncached sequences are searched in batches of batch_size
+        sequences per blastp process."""
+        seqs = [query_sequence(s) for s in input_seqs]
+        keys = [self.cache_key(s) for s in seqs]
+        missing = [k for k in set(keys) if k not in self.results]
+        if missing:
+            self.results.update(cache.get_many(missing))
+        missing = [i for i, k in enumerate(keys) if k not in self.results]
+
+        # search each uncached sequence once
+        searched = OrderedDict()
+        for i in missing:
+            if keys[i] not in searched:
+                searched[keys[i]] = seqs[i]
+        searched_keys = list(searched)
+        new_results = {}
+        for start in range(0, len(searched_keys), self.batch_size):
+            batch = searched_keys[start:start + self.batch_size]
+            for key, hits in zip(batch, self.run_blast([searched[k] for k in batch])):
+                new_results[key] = hits[:self.top_results]
+        if new_results:
+            self.results.update(new_results)
+            cache.set_many(new_results, BLAST_CACHE_TIMEOUT)
+
+        return [[(hit.hit_id, hit) for hit in self.results[k]] for k in keys]
+
+    def cache_key(self, seq):
+        # the database files change when the database is rebuilt
+        try:
+            version = os.path.getmtime(self.blastdb + '.pin')
+        except OSError:
+            version = ''
+        key = '|'.join([self.blastdb, str(version), str(self.top_results), seq])
+        return 'blast_' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def run_blast(self, seqs):
+        """Run one blastp process for a list of sequences, returns a list of hits per sequence"""
+        output = [OrderedDict() for s in seqs]
+        query_ids = dict([('q{}'.format(i), i) for i, s in enumerate(seqs)])
+        # empty sequences have no hits
+        queries = ''.join(['>q{}\n{}\n'.format(i, s) for i, s in enumerate(seqs) if s])
+        if not queries:
+            return [[] for s in seqs]
+
+        command = '%s -db %s -outfmt "6 %s"' % (self.blast_path, self.blastdb, ' '.join(BLAST_FIELDS))
+        logger.debug("Running Blast with {} sequences".format(len(seqs)))
+        with self.workers:
+            #Windows has problems with Popen and PIPE
+            if sys.platform == 'win32':
+                tmp = tempfile.NamedTemporaryFile()
+                tmp.write(bytes(queries, 'latin1'))
+                tmp.seek(0)
+                blast = Popen(command, universal_newlines=True, stdin=tmp, stdout=PIPE, stderr=PIPE)
+                (blast_out, blast_err) = blast.communicate()
+            else:
+            #Rest of the world:
+                blast = Popen(command, universal_newlines=True, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                (blast_out, blast_err) = blast.communicate(input=queries)
 
         if len(blast_err) != 0:
             logger.debug(blast_err)
-        if blast_out!='\n':
-            result = NCBIXML.read(StringIO(blast_out))
-            for aln in result.alignments[:self.top_results]:
-                logger.debug("Looping over alignments, current hit: {}".format(aln.hit_id))
-                output.append((aln.hit_id, aln))
-        return output
+        for line in blast_out.splitlines():
+            values = line.split('\t')
+            if len(values) != len(BLAST_FIELDS):
+                continue
+            row = dict(zip(BLAST_FIELDS, values))
+            if row['qseqid'] not in query_ids:
+                logger.debug('Unexpected BLAST query id {}'.format(row['qseqid']))
+                continue
+            hits = output[query_ids[row['qseqid']]]
+            if row['sseqid'] not in hits:
+                # the title starts with the id when the database has no separate description
+                hit_def = row['stitle']
+                if hit_def.startswith(row['sseqid'] + ' '):
+                    hit_def = hit_def[len(row['sseqid']) + 1:]
+                hits[row['sseqid']] = BlastHit(row['sseqid'], hit_def)
+                logger.debug("Looping over alignments, current hit: {}".format(row['sseqid']))
+            hits[row['sseqid']].hsps.append(BlastHsp(row))
+        return [list(hits.values()) for hits in output]
 #==============================================================================
 
 class BlastSearchOnline(object):
@@ -15,7 +15,6 @@ import structure.structural_superposition as sp
 import structure.assign_generic_numbers_gpcr as as_gn
 import structure.homology_models_tests as tests
 
-import Bio.PDB as PDB
 from modeller import *
 from modeller.automodel import *
 from collections import OrderedDict
@@ -24,7 +23,6 @@ import subprocess
 import shlex
 import logging
 import pprint
-from io import StringIO
 import sys
 import re
 import zipfile
@@ -70,8 +68,7 @@ class StructureAnomalyRecognition(object):
 			except:
 				self.structure = Structure.objects.get(pdb_code__index=xtal.upper())
 			self.parent_prot_conf = ProteinConformation.objects.get(protein=self.structure.protein_conformation.protein.parent)
-			io = StringIO(self.structure.pdb_data.pdb)
-			self.pdb_struct = PDB.PDBParser(QUIET=True).get_structure(self.structure.pdb_code.index, io)[0]
+			self.pdb_struct = self.structure.get_pdb_structure()[0]
 			self.range = []
 			if num_range:
 				self.range = [[int(i) for i in num_range.split('-')]]
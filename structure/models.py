@@ -1,6 +1,8 @@
 from django.db import models
 from django.core.cache import cache
 
+from structure import coordinates as parsed_coordinates
+
 from io import StringIO
 from Bio.PDB import PDBIO
 
@@ -27,45 +29,34 @@ class Structure(models.Model):
     def __str__(self):
         return self.pdb_code.index
 
+    def get_coordinates(self):
+        """Parsed PDB data, see structure.coordinates"""
+        return parsed_coordinates.StructureCoordinates.for_structure(self)
+
     def get_cleaned_pdb(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, remove_aux=False, aux_range=5.0):
+        lines = self.get_coordinates().cleaned_lines(self.preferred_chain[0], 'refined' in self.pdb_code.index,
+            pref_chain, remove_waters, ligands_to_keep)
+        return self.get_coordinates().pdb_text(lines)
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            save_line = False
-            if pref_chain:
-                if (line.startswith('ATOM') or line.startswith('HET')) and (line[21] == self.preferred_chain[0] or 'refined' in self.pdb_code.index):
-                    save_line = True
-            else:
-                save_line = True
-            if remove_waters and line.startswith('HET') and line[17:20] == 'HOH':
-                save_line = False
-            if ligands_to_keep and line.startswith('HET'):
-                if line[17:20] != 'HOH' and line[17:20] in ligands_to_keep:
-                    save_line = True
-                elif line[17:20] != 'HOH':
-                    save_line=False
-            if save_line:
-                tmp.append(line)
-
-        return '\n'.join(tmp)
-    
-    def get_ligand_pdb(self, ligand):
+    def get_cleaned_structure(self, pref_chain=True, remove_waters=True, ligands_to_keep=None, structure_id=None):
+        """Biopython structure of the atoms in get_cleaned_pdb, without parsing the PDB text"""
+        coordinates = self.get_coordinates()
+        lines = coordinates.cleaned_lines(self.preferred_chain[0], 'refined' in self.pdb_code.index, pref_chain,
+            remove_waters, ligands_to_keep)
+        return coordinates.get_structure(structure_id or self.pdb_code.index, coordinates.select_atoms(lines=lines))
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            if line.startswith('HET') and line[21] == self.preferred_chain[0]:
-                if line[17:20] != 'HOH' and line[17:20] == ligand:
-                    tmp.append(line)
-        return '\n'.join(tmp)
+    def get_pdb_structure(self, structure_id=None):
+        """Biopython structure of the full PDB data, without parsing the PDB text"""
+        return self.get_coordinates().get_structure(structure_id or self.pdb_code.index)
 
-    def get_preferred_chain_pdb(self):
+    def get_ligand_pdb(self, ligand):
+        coordinates = self.get_coordinates()
+        return coordinates.pdb_text(coordinates.ligand_lines(self.preferred_chain[0], ligand))
 
-        tmp = []
-        for line in self.pdb_data.pdb.split('\n'):
-            # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
-            if (line.startswith('ATOM') or line.startswith('HET')) and line[21] == self.preferred_chain[0]:
-                tmp.append(line)
-        return '\n'.join(tmp)
+    def get_preferred_chain_pdb(self):
+        # http://www.wwpdb.org/documentation/file-format-content/format33/sect9.html#ATOM
+        coordinates = self.get_coordinates()
+        return coordinates.pdb_text(coordinates.chain_lines(self.preferred_chain[0]))
 
     @property
     def is_refined(self):
@@ -239,7 +239,13 @@ class SequenceParser(object):
                 if res.resname.replace('HID', 'HIS') not in self.residue_list:
                     continue
                 self.residues[chain.id].append(res)
-            poly = self.get_chain_peptides(chain.id)
+
+        # search the peptides of all chains with one blast run, map_to_wt_blast then uses the stored results
+        peptides = OrderedDict([(chain.id, self.get_chain_peptides(chain.id)) for chain in pdb_struct])
+        self.blast.run_many([self.get_peptide_sequence(peptide) for poly in peptides.values() for peptide in poly])
+
+        for chain in pdb_struct:
+            poly = peptides[chain.id]
             for peptide in poly:
                 #print("Start: {} Stop: {} Len: {}".format(peptide[0].id[1], peptide[-1].id[1], len(peptide)))
                 self.map_to_wt_blast(chain.id, peptide, None, int(peptide[0].id[1]))
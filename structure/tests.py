@@ -1,3 +1,133 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from common.models import WebLink
+from protein.models import Protein, ProteinFamily, ProteinState
+from structure import downloads
+from structure.functions import BlastSearch, query_sequence
+from structure.models import PdbData, Structure, StructureModel
+
+from datetime import date
+from unittest import mock
+import os
+import tempfile
+import zipfile
+
+
+PDB = '\n'.join([
+    'HEADER    MEMBRANE PROTEIN                        01-JAN-00   1ABC',
+    'ATOM      1  N   ALA A   1      11.104   6.134  -6.504  1.00  0.00           N',
+    'ATOM      2  CA  ALA A   1      11.639   6.071  -5.147  1.00  0.00           C',
+    'ATOM      3  N   GLY B   1      12.104   7.134  -7.504  1.00  0.00           N',
+    'HETATM    4  C1  RET A 401      10.000   5.000  -4.000  1.00  0.00           C',
+    'HETATM    5  O   HOH A 501       9.000   4.000  -3.000  1.00  0.00           O',
+    'END',
+])
+
+
+class StructurePdbTestCase(SimpleTestCase):
+
+    def setUp(self):
+        # unsaved instances, the parsed coordinates are built from the PDB text
+        self.structure = Structure(pk=-1, pdb_code=WebLink(index='1ABC'), preferred_chain='A',
+            pdb_data=PdbData(pdb=PDB))
+
+    def test_cleaned_pdb(self):
+        pdb = self.structure.get_cleaned_pdb().split('\n')
+        self.assertEqual([l[17:22] for l in pdb], ['ALA A', 'ALA A', 'RET A'])
+
+    def test_cleaned_pdb_keeps_waters_and_chains(self):
+        pdb = self.structure.get_cleaned_pdb(pref_chain=False, remove_waters=False)
+        self.assertIn('GLY B', pdb)
+        self.assertIn('HOH A', pdb)
+
+    def test_ligand_pdb(self):
+        self.assertEqual(self.structure.get_ligand_pdb('RET').split('\n'), [PDB.split('\n')[4]])
+
+    def test_preferred_chain_pdb(self):
+        self.assertNotIn('GLY B', self.structure.get_preferred_chain_pdb())
+
+
+def blast_row(qseqid, sseqid):
+    return '\t'.join([qseqid, sseqid, sseqid + ' Receptor', '100', '50.0', '1e-10', '10', '12', '0', '12', '1', '12',
+        '1', '12', 'MNGTEGPNFYVP', 'MNGTEGPNFYVP'])
+
+
+class BlastSearchTestCase(SimpleTestCase):
+
+    def test_query_sequence(self):
+        self.assertEqual(query_sequence(' MNGTEG\n'), 'MNGTEG')
+        self.assertEqual(query_sequence('>sp|P02699|OPSD_BOVIN Rhodopsin\nMNGTEG\nPNFYVP\n'), 'MNGTEGPNFYVP')
+        self.assertEqual(query_sequence('>first\nMNGTEG\n>second\nPNFYVP'), 'MNGTEG')
+
+    def run_blast(self, seqs, rows):
+        process = mock.Mock()
+        process.communicate.return_value = ('\n'.join(rows), '')
+        with mock.patch('structure.functions.Popen', return_value=process) as popen:
+            hits = BlastSearch(blastdb='test_blastdb').run_blast(seqs)
+        return hits, popen, process
+
+    def test_batch(self):
+        hits, popen, process = self.run_blast(['MNGTEG', '', 'PNFYVP'], [blast_row('q0', '12'), blast_row('q2', '34'),
+            blast_row('q2', '56'), blast_row('q2', '34')])
+        self.assertEqual(popen.call_count, 1)
+        self.assertEqual(process.communicate.call_args[1]['input'], '>q0\nMNGTEG\n>q2\nPNFYVP\n')
+        self.assertEqual([[h.hit_id for h in seq_hits] for seq_hits in hits], [['12'], [], ['34', '56']])
+        self.assertEqual(len(hits[2][0].hsps), 2)
+        self.assertEqual(hits[0][0].hit_def, 'Receptor')
+
+    def test_unknown_query_id(self):
+        hits, popen, process = self.run_blast(['MNGTEG'], [blast_row('sp|P02699|OPSD_BOVIN', '12'),
+            blast_row('q0', '34')])
+        self.assertEqual([[h.hit_id for h in seq_hits] for seq_hits in hits], [['34']])
+
+
+class ModelArchiveTestCase(SimpleTestCase):
+
+    def setUp(self):
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        patches = [
+            mock.patch.object(downloads, 'STORE_DIR', store_dir.name),
+            mock.patch.object(downloads, 'template_rows',
+                return_value=iter([(1, [('TM1', 35, '1x50', '4LDE', None)])])),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # the version of an uploaded model is the date string of its file name
+        self.hommod = StructureModel(pk=1, protein=Protein(entry_name='adrb2_human',
+            family=ProteinFamily(slug='001_001_001_003')), state=ProteinState(name='Inactive'),
+            main_template=Structure(pdb_code=WebLink(index='4LDE')), pdb=PDB, version='2020-03-06')
+
+    def test_archive_string_version(self):
+        downloads.save_model_archive(self.hommod)
+        path = downloads.archive_path(self.hommod)
+        with zipfile.ZipFile(path) as zipf:
+            self.assertEqual(zipf.namelist(), ['ClassA_adrb2_human_Inactive_4LDE_2020-03-06_GPCRDB.pdb',
+                'ClassA_adrb2_human_Inactive_4LDE_2020-03-06_GPCRDB.templates.csv'])
+            self.assertEqual(zipf.infolist()[0].date_time, (2020, 3, 6, 0, 0, 0))
+            self.assertEqual(zipf.read(zipf.namelist()[0]).decode(), PDB)
+            self.assertEqual(zipf.read(zipf.namelist()[1]).decode(), downloads.TEMPLATES_HEADER + 'TM1,35,1x50,4LDE,-\n')
+        self.assertEqual(len(downloads.read_model_archive(self.hommod, path)), 2)
+
+    def test_version_date(self):
+        self.assertEqual(downloads.version_date('2020-03-06'), date(2020, 3, 6))
+        self.assertEqual(downloads.version_date(date(2020, 3, 6)), date(2020, 3, 6))
+
+    def test_other_version(self):
+        # an archive written for an earlier upload of the model is not used
+        downloads.save_model_archive(self.hommod)
+        self.hommod.version = date(2020, 4, 1)
+        self.assertIsNone(downloads.read_model_archive(self.hommod, downloads.archive_path(self.hommod)))
+
+    def test_remove(self):
+        downloads.save_model_archive(self.hommod)
+        downloads.remove_model_archive(self.hommod)
+        self.assertFalse(os.path.exists(downloads.archive_path(self.hommod)))
+        # models without an archive are read from the database
+        with mock.patch.object(StructureModel, 'objects') as objects:
+            objects.filter.return_value.values_list.return_value = [PDB]
+            entries = list(downloads.stream_models([self.hommod]))
+        self.assertEqual([e.name for e in entries], ['ClassA_adrb2_human_Inactive_4LDE_2020-03-06_GPCRDB.pdb',
+            'ClassA_adrb2_human_Inactive_4LDE_2020-03-06_GPCRDB.templates.csv'])
+        downloads.remove_model_archive(self.hommod)
@@ -1,10 +1,9 @@
 from django.shortcuts import render
 from django.conf import settings
 from django.views.generic import TemplateView, View
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.db.models import Count, Q, Prefetch
 from django import forms
-from django.core.cache import cache
 from django.views.decorators.cache import cache_page
 
 from common.phylogenetic_tree import PhylogeneticTreeGenerator
@@ -14,6 +13,7 @@ from structure.models import (Structure, StructureModel, StructureComplexModel,
 from structure.functions import CASelector, SelectionParser, GenericNumbersSelector, SubstructureSelector, check_gn, PdbStateIdentifier
 from structure.assign_generic_numbers_gpcr import GenericNumbering
 from structure.structural_superposition import ProteinSuperpose,FragmentSuperpose
+from structure.downloads import compress_entry, stream_zip, stream_models
 from structure.forms import *
 from signprot.models import SignprotComplex
 from interaction.models import ResidueFragmentInteraction,StructureLigandInteraction
@@ -1304,9 +1304,6 @@ class SuperpositionWorkflowDownload(View):
         if self.kwargs['substructure'] == 'select':
             return HttpResponseRedirect('/structure/superposition_workflow_selection')
 
-        io = PDBIO()
-        out_stream = BytesIO()
-        zipf = zipfile.ZipFile(out_stream, 'w')
         simple_selection = self.request.session.get('selection', False)
         selection = Selection()
         if simple_selection:
@@ -1340,49 +1337,20 @@ class SuperpositionWorkflowDownload(View):
             self.alt_substructure_mapping[alt_id] = gn_assigner.get_substructure_mapping_dict()
 
         if self.kwargs['substructure'] == 'full':
-
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp)
-            zipf.writestr(ref_name, tmp.getvalue())
-
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp)
-                zipf.writestr(alt_name, tmp.getvalue())
-
+            ref_selector = None
+            alt_selectors = dict([(alt_name, None) for alt_name in self.request.session['alt_structs']])
         elif self.kwargs['substructure'] == 'substr':
-
             consensus_gn_set = CASelector(SelectionParser(selection), ref_struct, alt_structs.values()).get_consensus_gn_set()
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp, GenericNumbersSelector(consensus_gn_set))
-            zipf.writestr(ref_name, tmp.getvalue())
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp, GenericNumbersSelector(consensus_gn_set))
-                zipf.writestr(alt_name, tmp.getvalue())
-
+            ref_selector = GenericNumbersSelector(consensus_gn_set)
+            alt_selectors = dict([(alt_name, GenericNumbersSelector(consensus_gn_set)) for alt_name in self.request.session['alt_structs']])
         elif self.kwargs['substructure'] == 'custom':
+            ref_selector = SubstructureSelector(self.ref_substructure_mapping, parsed_selection=SelectionParser(selection))
+            alt_selectors = dict([(alt_name, SubstructureSelector(self.alt_substructure_mapping[alt_name], parsed_selection=SelectionParser(selection))) for alt_name in self.request.session['alt_structs']])
 
-            io.set_structure(ref_struct)
-            tmp = StringIO()
-            io.save(tmp, SubstructureSelector(self.ref_substructure_mapping, parsed_selection=SelectionParser(selection)))
-            
-            zipf.writestr(ref_name, tmp.getvalue())
-            for alt_name in self.request.session['alt_structs']:
-                tmp = StringIO()
-                io.set_structure(alt_structs[alt_name])
-                io.save(tmp, SubstructureSelector(self.alt_substructure_mapping[alt_name], parsed_selection=SelectionParser(selection)))
-                zipf.writestr(alt_name, tmp.getvalue())
-
-        zipf.close()
-        if len(out_stream.getvalue()) > 0:
-            response = HttpResponse(content_type="application/zip")
-            response['Content-Disposition'] = 'attachment; filename="Superposed_structures.zip"'
-            response.write(out_stream.getvalue())
+        # the structures are written and compressed one at a time while the response is sent
+        structures = [(ref_name, ref_struct, ref_selector)] + [(alt_name, alt_structs[alt_name], alt_selectors[alt_name]) for alt_name in self.request.session['alt_structs']]
+        response = StreamingHttpResponse(stream_zip(self.write_structures(structures)), content_type="application/zip")
+        response['Content-Disposition'] = 'attachment; filename="Superposed_structures.zip"'
 
         if 'ref_file' in request.FILES:
             request.session['ref_file'] = request.FILES['ref_file']
@@ -1391,6 +1359,17 @@ class SuperpositionWorkflowDownload(View):
 
         return response
 
+    def write_structures(self, structures):
+        io = PDBIO()
+        for name, struct, selector in structures:
+            tmp = StringIO()
+            io.set_structure(struct)
+            if selector:
+                io.save(tmp, selector)
+            else:
+                io.save(tmp)
+            yield compress_entry(name, tmp.getvalue())
+
 
 class FragmentSuperpositionIndex(TemplateView):
 
@@ -1689,7 +1668,7 @@ class PDBClean(TemplateView):
                         lig_names = [x.pdb_reference for x in StructureLigandInteraction.objects.filter(structure=selected_struct.item, annotated=True)]
                     else:
                         lig_names = None
-                    gn_assigner = GenericNumbering(structure=PDBParser(QUIET=True).get_structure(struct_name, StringIO(selected_struct.item.get_cleaned_pdb(pref, water, lig_names)))[0])
+                    gn_assigner = GenericNumbering(structure=selected_struct.item.get_cleaned_structure(pref, water, lig_names, struct_name)[0])
                     tmp = StringIO()
                     io.set_structure(gn_assigner.assign_generic_numbers())
                     request.session['substructure_mapping'] = gn_assigner.get_substructure_mapping_dict()
@@ -1949,100 +1928,19 @@ def ConvertStructureComplexSignprotToProteins(request):
 def HommodDownload(request):
     "Download selected homology models in zip file"
 
-    out_stream = BytesIO()
-    io = PDBIO()
-    zipf = zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_DEFLATED)
     pks = request.GET['ids'].split(',')
-    class_dict = {'001':'A','002':'B1','003':'B2','004':'C','005':'F','006':'T','007':'O'}
-    hommodels = StructureModel.objects.filter(pk__in=pks).prefetch_related('protein__family','state','main_template__pdb_code').all()
-    print(hommodels)
-    for hommod in hommodels:
-        mod_name = 'Class{}_{}_{}_{}_{}_GPCRDB.pdb'.format(class_dict[hommod.protein.family.slug[:3]], hommod.protein.entry_name, 
-                                                                      hommod.state.name, hommod.main_template.pdb_code.index, hommod.version)
-
-        tmp = StringIO(hommod.pdb)
-        zipf.writestr(mod_name, tmp.getvalue())
-        del tmp
-
-        stats_name = mod_name[:-3]+'templates.csv'
-        # Use cache to prevent this being performed too often
-        stats_data = cache.get(stats_name)
-        if stats_data is None:
-            rotamers = StructureModelStatsRotamer.objects.filter(homology_model=hommod).prefetch_related('homology_model','residue__generic_number','residue__protein_segment','backbone_template__pdb_code','rotamer_template__pdb_code').all().order_by('residue__sequence_number')
-            stats_data = 'Segment,Sequence_number,Generic_number,Backbone_template,Rotamer_template\n'
-            for r in rotamers:
-                h = r.homology_model.pk
-                try:
-                    gn = r.residue.generic_number.label
-                except:
-                    gn = '-'
-                if r.backbone_template:
-                    bt = r.backbone_template.pdb_code.index
-                else:
-                    bt = '-'
-                if r.rotamer_template:
-                    rt = r.rotamer_template.pdb_code.index
-                else:
-                    rt = '-'
-                stats_data+='{},{},{},{},{}\n'.format(r.residue.protein_segment.slug, r.residue.sequence_number, gn, bt, rt)
-
-            cache.set(stats_name,stats_data,3600*24*7) # cache a week
-
-        zipf.writestr(stats_name, stats_data)
-        del stats_data
-    zipf.close()
-    response = HttpResponse(content_type="application/zip")
+    hommodels = StructureModel.objects.filter(pk__in=pks).select_related('protein__family','state','main_template__pdb_code').defer('pdb')
+    response = StreamingHttpResponse(stream_zip(stream_models(hommodels)), content_type="application/zip")
     response['Content-Disposition'] = 'attachment; filename="GPCRDB_homology_models.zip"'
-    response.write(out_stream.getvalue())
     return response
 
 def ComplexmodDownload(request):
     "Download selected complex homology models in zip file"
 
-    out_stream = BytesIO()
-    io = PDBIO()
-    zipf = zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_DEFLATED)
     pks = request.GET['ids'].split(',')
-    class_dict = {'001':'A','002':'B1','003':'B2','004':'C','005':'F','006':'T','007':'O'}
-    hommodels = StructureComplexModel.objects.filter(pk__in=pks).prefetch_related('receptor_protein__family','main_template__pdb_code').all()
-    print(hommodels)
-    for hommod in hommodels:
-        mod_name = 'Class{}_{}-{}_{}_{}_GPCRDB_complex.pdb'.format(class_dict[hommod.receptor_protein.family.slug[:3]], hommod.receptor_protein.entry_name, 
-                                                                   hommod.sign_protein.entry_name, hommod.main_template.pdb_code.index, hommod.version)
-        tmp = StringIO(hommod.pdb)
-        zipf.writestr(mod_name, tmp.getvalue())
-        del tmp
-
-        stats_name = mod_name[:-3]+'templates.csv'
-        # Use cache to prevent this being performed too often
-        stats_data = cache.get(stats_name)
-        if stats_data is None:
-            rotamers = StructureComplexModelStatsRotamer.objects.filter(homology_model=hommod).prefetch_related('homology_model','residue__generic_number','residue__protein_segment','backbone_template__pdb_code','rotamer_template__pdb_code').all().order_by('protein','residue__sequence_number')
-            stats_data = 'Segment,Sequence_number,Generic_number,Backbone_template,Rotamer_template\n'
-            for r in rotamers:
-                h = r.homology_model.pk
-                try:
-                    gn = r.residue.generic_number.label
-                except:
-                    gn = '-'
-                if r.backbone_template:
-                    bt = r.backbone_template.pdb_code.index
-                else:
-                    bt = '-'
-                if r.rotamer_template:
-                    rt = r.rotamer_template.pdb_code.index
-                else:
-                    rt = '-'
-                stats_data+='{},{},{},{},{}\n'.format(r.residue.protein_segment.slug, r.residue.sequence_number, gn, bt, rt)
-
-            cache.set(stats_name,stats_data,3600*24*7) # cache a week
-
-        zipf.writestr(stats_name, stats_data)
-        del stats_data
-    zipf.close()
-    response = HttpResponse(content_type="application/zip")
+    hommodels = StructureComplexModel.objects.filter(pk__in=pks).select_related('receptor_protein__family','sign_protein','main_template__pdb_code').defer('pdb')
+    response = StreamingHttpResponse(stream_zip(stream_models(hommodels)), content_type="application/zip")
     response['Content-Disposition'] = 'attachment; filename="GPCRDB_complex_homology_models.zip"'
-    response.write(out_stream.getvalue())
     return response
 
 def SingleModelDownload(request, modelname, state, csv=False):
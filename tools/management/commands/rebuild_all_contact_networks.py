@@ -8,6 +8,7 @@ from django.db import IntegrityError
 from contactnetwork.cube import compute_interactions
 from contactnetwork.models import *
 import contactnetwork.interaction as ci
+from contactnetwork import frequencies
 
 from residue.models import ResidueGenericNumber, ResidueNumberingScheme, Residue, ResidueGenericNumberEquivalent
 
@@ -64,10 +65,12 @@ class Command(BaseCommand):
 
         for i in ii:
             i.delete()
+        InteractionFact.objects.filter(structure=s).delete()
 
     def build_contact_network(self,s,pdb_code):
         interacting_pairs = compute_interactions(pdb_code)
 
+        facts = []
         for p in interacting_pairs:
             # Create the pair
             res1_seq_num = p.get_residue_1().id[1]
@@ -76,8 +79,10 @@ class Command(BaseCommand):
 
             # Get the residues
             try:
-                res1 = Residue.objects.get(sequence_number=res1_seq_num, protein_conformation=conformation)
-                res2 = Residue.objects.get(sequence_number=res2_seq_num, protein_conformation=conformation)
+                res1 = Residue.objects.select_related('generic_number', 'protein_segment').get(
+                    sequence_number=res1_seq_num, protein_conformation=conformation)
+                res2 = Residue.objects.select_related('generic_number', 'protein_segment').get(
+                    sequence_number=res2_seq_num, protein_conformation=conformation)
             except:
                 # print('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
                 # print('Error with pair between %s and %s (%s)' % (res1_seq_num,res2_seq_num,conformation))
@@ -92,6 +97,7 @@ class Command(BaseCommand):
 
             # Add the interactions to the pair
             for i in p.get_interactions():
+                ni = None
                 if type(i) is ci.VanDerWaalsInteraction:
                     ni = VanDerWaalsInteraction()
                     ni.interacting_pair = pair
@@ -144,12 +150,18 @@ class Command(BaseCommand):
                     ni.interacting_pair = pair
                     ni.res1_has_pi = False
                     ni.save()
+                if ni is not None:
+                    facts.append(frequencies.interaction_fact(s, pair, ni))
+
+        # Denormalised copy of the interactions for the contact browser
+        InteractionFact.objects.bulk_create(facts)
 
     def handle(self, *args, **options):
 
         self.ss = Structure.objects.filter(refined=False).all()
         self.structure_data_dir = os.sep.join([settings.DATA_DIR, 'structure_data', 'structures'])
         self.prepare_input(16, self.ss)
+        frequencies.invalidate()
 
         # for s in Structure.objects.filter(refined=False).all():
         #     print(s,s.pdb_code.index)
@@ -190,5 +202,5 @@ class Command(BaseCommand):
             self.purge_contact_network(s)
             self.build_contact_network(s,s.pdb_code.index)
             print(s,"Ligand Interactions")
-            runcalculation(s.pdb_code.index,peptide_chain)
-            parsecalculation(s.pdb_code.index,False)
\ No newline at end of file
+            results = runcalculation(s.pdb_code.index,peptide_chain)
+            parsecalculation(s.pdb_code.index,False,results=results)
\ No newline at end of file